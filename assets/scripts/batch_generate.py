@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+Offline batch TODO generation for many repository snapshots
+Builds the same prompt as ONNXAIService._buildAnalysisPrompt for every repo,
+sorts prompts by token length, runs them through an exported ONNX model in
+length buckets sized to a memory budget and writes one result file per repo
+as soon as its batch finishes
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import numpy as np
+
+from ort_runtime import DecoderSession, _NUMPY_DTYPES
+from stage_trace import add_trace_arguments, stage, trace_run
+
+DEFAULT_MEMORY_BUDGET_MB = 2048
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_NEW_TOKENS = 256
+# Start a new batch when padding would exceed this fraction of the longest prompt
+DEFAULT_MAX_PADDING = 0.25
+# What the retrieved chunks should cover when a repository index is available
+RETRIEVAL_QUERY = ("What is missing, unfinished or needs improvement in this {project_type} project: "
+                   "TODO and FIXME notes, tests, documentation, known issues and next steps")
+
+PROJECT_FOCUS = {
+    "flutter": [
+        "This is a Flutter project. Focus on:",
+        "- Flutter-specific architecture and best practices",
+        "- Mobile/web/desktop platform optimization",
+        "- Flutter testing and CI/CD",
+        "- Flutter performance and state management",
+        "- Use Flutter-specific tools: pubspec.yaml, main.dart, lib/, test/",
+    ],
+    "godot": [
+        "This is a Godot game project. Focus on:",
+        "- Game development best practices",
+        "- Mobile game optimization",
+        "- Game testing and QA processes",
+        "- Game deployment and distribution",
+        "- Use Godot-specific tools: project.godot, scenes/, scripts/, assets/",
+    ],
+    "python": [
+        "This is a Python project. Focus on:",
+        "- Python development best practices",
+        "- Python testing and documentation",
+        "- Python packaging and distribution",
+        "- Python CI/CD and deployment",
+        "- Use Python-specific tools: requirements.txt, pyproject.toml, main.py, tests/",
+    ],
+    "web": [
+        "This is a web project. Focus on:",
+        "- Web development best practices",
+        "- Frontend/backend architecture",
+        "- Web testing and deployment",
+        "- Web performance and optimization",
+        "- Use web-specific tools: package.json, index.html, src/, assets/",
+    ],
+}
+
+
+# ---------------------------------------------------------------------------
+# Snapshots and prompts (mirrors simple_ai_widget.dart / onnx_ai_service.dart)
+# ---------------------------------------------------------------------------
+
+def _read_text(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def parse_pubspec_dependencies(pubspec):
+    """Same line-based parse as _parsePubspecDependencies"""
+    dependencies = {}
+    in_dependencies = False
+    for line in pubspec.split("\n"):
+        if line.strip() == "dependencies:":
+            in_dependencies = True
+            continue
+        if in_dependencies and line.strip().startswith("dev_dependencies:"):
+            break
+        if in_dependencies and line.strip() and not line.strip().startswith("#"):
+            parts = line.strip().split(":")
+            if len(parts) >= 2:
+                dependencies[parts[0].strip()] = parts[1].strip()
+    return dependencies
+
+
+def parse_package_json_dependencies(package_json):
+    try:
+        data = json.loads(package_json)
+        if isinstance(data, dict) and isinstance(data.get("dependencies"), dict):
+            return dict(data["dependencies"])
+    except ValueError:
+        pass
+    return {}
+
+
+def load_snapshot(name, path):
+    """README, pubspec, package.json, dependencies and top-level entries of a checkout"""
+    snapshot = {
+        "name": name,
+        "readme": _read_text(os.path.join(path, "README.md")),
+        "pubspec": _read_text(os.path.join(path, "pubspec.yaml")),
+        "package_json": _read_text(os.path.join(path, "package.json")),
+        "dependencies": None,
+        "source_files": sorted(os.listdir(path)),
+    }
+    if snapshot["pubspec"] is not None:
+        snapshot["dependencies"] = parse_pubspec_dependencies(snapshot["pubspec"])
+    if snapshot["package_json"] is not None and snapshot["dependencies"] is None:
+        snapshot["dependencies"] = parse_package_json_dependencies(snapshot["package_json"])
+    return snapshot
+
+
+def load_snapshots(repos_dir=None, manifest_path=None):
+    """
+    Snapshots from a directory of checkouts (one per subdirectory) and/or a
+    manifest: a JSON list or JSON-lines file whose entries either point to a
+    checkout ({"name", "path"}) or carry the content inline ({"name",
+    "readme", "pubspec", "package_json", "dependencies", "source_files"}).
+    """
+    snapshots = []
+    if repos_dir:
+        for entry in sorted(os.listdir(repos_dir)):
+            path = os.path.join(repos_dir, entry)
+            if os.path.isdir(path):
+                snapshots.append(load_snapshot(entry, path))
+    if manifest_path:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        stripped = text.lstrip()
+        entries = json.loads(text) if stripped.startswith("[") else [
+            json.loads(line) for line in text.splitlines() if line.strip()
+        ]
+        base_dir = os.path.dirname(os.path.abspath(manifest_path))
+        for entry in entries:
+            if "path" in entry:
+                path = os.path.join(base_dir, entry["path"])
+                snapshots.append(load_snapshot(entry.get("name") or os.path.basename(os.path.normpath(path)), path))
+            else:
+                snapshots.append({
+                    "name": entry["name"],
+                    "readme": entry.get("readme"),
+                    "pubspec": entry.get("pubspec"),
+                    "package_json": entry.get("package_json"),
+                    "dependencies": entry.get("dependencies"),
+                    "source_files": entry.get("source_files"),
+                })
+    return snapshots
+
+
+def detect_project_type(source_files):
+    """Same rules and priority as _detectProjectType"""
+    if source_files is None:
+        return "unknown"
+
+    def any_contains(*needles):
+        return any(needle in name for name in source_files for needle in needles)
+
+    if any_contains("pubspec.yaml", "main.dart") or (any_contains(".dart") and any_contains("lib/")):
+        return "flutter"
+    if any_contains("project.godot", ".gd", ".tscn"):
+        return "godot"
+    if any_contains(".py", "requirements.txt", "pyproject.toml", "setup.py"):
+        return "python"
+    if any_contains(".html", ".js", ".ts", "package.json", "webpack.config"):
+        return "web"
+    return "unknown"
+
+
+def build_analysis_prompt(snapshot):
+    """
+    The prompt _buildAnalysisPrompt builds for the same repository content.
+    A snapshot with retrieved "context" chunks lists them instead of the
+    first 500 README characters.
+    """
+    project_type = detect_project_type(snapshot["source_files"])
+    lines = [
+        "You are an intelligent project analyzer. Analyze this repository and generate specific, "
+        "actionable TODOs based on the ACTUAL project content:",
+        f"Repository: {snapshot['name']}",
+        f"Detected Project Type: {project_type}",
+        "",
+        "CRITICAL RULES:",
+        "1. Generate TODOs based on what is ACTUALLY missing or needs improvement. Do NOT suggest generic "
+        "tasks that are already implemented.",
+        "2. Each task should appear ONLY ONCE in the most appropriate category.",
+        f"3. All tasks must be specific to the detected project type ({project_type}).",
+        "4. Do NOT mix frameworks unless the project actually uses multiple frameworks.",
+        "5. Use framework-specific terminology and tools (e.g., pubspec.yaml for Flutter, requirements.txt "
+        "for Python).",
+        "",
+    ]
+    readme = snapshot["readme"]
+    context = snapshot.get("context")
+    if context:
+        # Retrieved chunks (repo_index.py) take the place of the README excerpt
+        lines.append(f"Relevant Repository Content ({len(context)} excerpts):")
+        for chunk in context:
+            lines += [f"--- {chunk['path']}:{chunk['start_line']}-{chunk['end_line']} ---", chunk["text"]]
+        lines.append("")
+    elif readme:
+        lines += [f"README Content ({len(readme)} chars):", readme[:500], ""]
+    dependencies = snapshot["dependencies"]
+    if dependencies:
+        lines += ["Dependencies:"] + [f"- {key}: {value}" for key, value in dependencies.items()] + [""]
+    source_files = snapshot["source_files"]
+    if source_files:
+        lines.append(f"Source Files ({len(source_files)} files):")
+        lines += [f"- {name}" for name in source_files[:20]]
+        if len(source_files) > 20:
+            lines.append(f"- ... and {len(source_files) - 20} more files")
+        lines.append("")
+    if project_type in PROJECT_FOCUS:
+        lines += PROJECT_FOCUS[project_type] + [""]
+    lines += [
+        "Based on this actual repository content, generate:",
+        "1. Current Progress - What's already implemented (be specific about what exists)",
+        "2. Next Steps - What actually needs to be done next (based on gaps)",
+        "3. Roadmap - Future development plan specific to this project type",
+        "",
+        f"REMEMBER: Each task should appear only once, and all tasks must be specific to the {project_type} "
+        "project type.",
+    ]
+    # StringBuffer.writeln ends every line, including the last one
+    return "\n".join(lines) + "\n", project_type
+
+
+def safe_name(name):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+
+
+def result_path(output_dir, name):
+    return os.path.join(output_dir, safe_name(name) + ".json")
+
+
+# ---------------------------------------------------------------------------
+# Bucketing
+# ---------------------------------------------------------------------------
+
+def memory_per_token(decoder, decode_session=None):
+    """
+    (KV cache bytes per token, logits bytes per scored position, whether the
+    graph returns logits for every position)
+    """
+    step = decode_session or decoder
+    kv_bytes = 0
+    for name in step.past_names:
+        meta = step.inputs[name]
+        num_heads, head_dim = (dim if isinstance(dim, int) else 1 for dim in (meta.shape[1], meta.shape[3]))
+        kv_bytes += num_heads * head_dim * np.dtype(_NUMPY_DTYPES[meta.type]).itemsize
+    logits = decoder.outputs.get("logits")
+    vocab_size = decoder.vocab_size or (decoder.outputs["topk_logits"].shape[-1] if decoder.topk else 0)
+    full_logits = logits is not None and len(logits.shape) == 3
+    return kv_bytes, vocab_size * 4, full_logits
+
+
+def estimate_batch_bytes(batch_size, prompt_length, max_new_tokens, kv_bytes, logits_bytes, full_logits):
+    """Peak of the prefill logits plus the KV cache grown to its final length"""
+    total_length = prompt_length + max_new_tokens
+    if kv_bytes:
+        scored = prompt_length if full_logits else 1
+        return batch_size * (total_length * kv_bytes + scored * logits_bytes)
+    # Without a KV cache every step re-scores the whole sequence
+    return batch_size * (total_length if full_logits else 1) * logits_bytes
+
+
+def plan_batches(items, memory_budget_bytes, max_new_tokens, kv_bytes, logits_bytes, full_logits,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_padding=DEFAULT_MAX_PADDING, equal_lengths=False):
+    """
+    Cut length-sorted items into consecutive batches. A batch grows while
+    it fits the memory budget, stays under max_batch_size and its padding
+    (longest minus shortest prompt) stays under max_padding of the longest.
+    """
+    items = sorted(items, key=lambda item: len(item["prompt_ids"]))
+    batches, batch = [], []
+    for item in items:
+        length = len(item["prompt_ids"])
+        if batch:
+            shortest = len(batch[0]["prompt_ids"])
+            fits = (
+                len(batch) < max_batch_size
+                and (length - shortest <= max_padding * length if not equal_lengths else length == shortest)
+                and estimate_batch_bytes(len(batch) + 1, length, max_new_tokens,
+                                         kv_bytes, logits_bytes, full_logits) <= memory_budget_bytes
+            )
+            if not fits:
+                batches.append(batch)
+                batch = []
+        batch.append(item)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# ---------------------------------------------------------------------------
+# Generation
+# ---------------------------------------------------------------------------
+
+def _write_result(path, record):
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2)
+    os.replace(temporary, path)
+
+
+def run_batch(decoder, decode_session, batch, max_new_tokens, pad_token_id, eos_token_id):
+    """
+    Left-pad one bucket, greedy-decode it and return generated ids per row.
+    When every prompt starts with the same stored prefix state only the
+    suffixes are prefilled; the padding then sits between prefix and suffix.
+    """
+    state, reused = batch[0]["prefix"]
+    if state is None or any(item["prefix"][0] is not state or item["prefix"][1] != reused for item in batch):
+        state, reused = None, 0
+    suffixes = [item["prompt_ids"][reused:] for item in batch]
+    length = max(len(suffix) for suffix in suffixes)
+    input_ids = np.full((len(batch), length), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(batch), reused + length), dtype=np.int64)
+    attention_mask[:, :reused] = 1
+    for row, suffix in enumerate(suffixes):
+        input_ids[row, length - len(suffix):] = suffix
+        attention_mask[row, reused + length - len(suffix):] = 1
+    past = state.past(len(batch), reused) if state is not None else None
+    tokens, _ = decoder.generate_greedy(input_ids, max_new_tokens, attention_mask=attention_mask,
+                                        eos_token_id=eos_token_id, decode_session=decode_session, past=past)
+    generated = []
+    for row in tokens.tolist():
+        if eos_token_id is not None and eos_token_id in row:
+            row = row[:row.index(eos_token_id)]
+        generated.append(row)
+    return generated
+
+
+def batch_generate(model_path, snapshots, output_dir, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                   max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                   max_padding=DEFAULT_MAX_PADDING, max_prompt_tokens=None, pad_token_id=0, overwrite=False,
+                   prefix_reuse=True, index_root=None, retrieve_k=None, context_tokens=None):
+    """
+    Generate results for every snapshot that does not have one yet. With
+    index_root, repositories that have an index at <index_root>/<name>
+    (repo_index.py) get the chunks retrieved for RETRIEVAL_QUERY instead of
+    the README excerpt.
+    """
+    from inference_server import load_tokenizer
+    from prefix_state import PrefixCache
+    from repo_index import DEFAULT_CONTEXT_TOKENS, DEFAULT_RESULTS, INDEX_FILE, retrieve_context
+
+    try:
+        if max_prompt_tokens is not None and max_prompt_tokens < 2:
+            raise ValueError("max_prompt_tokens must be at least 2 (the first token plus the tail)")
+        os.makedirs(output_dir, exist_ok=True)
+        tokenizer = load_tokenizer(model_path)
+        if tokenizer is None:
+            raise FileNotFoundError("No tokenizer.bin or tokenizer.json next to the graph or in its parent")
+
+        pending = []
+        with stage("prompts", repos=len(snapshots)):
+            for snapshot in snapshots:
+                path = result_path(output_dir, snapshot["name"])
+                if os.path.exists(path) and not overwrite:
+                    continue
+                index_dir = os.path.join(index_root, safe_name(snapshot["name"])) if index_root else None
+                if index_dir and os.path.exists(os.path.join(index_dir, INDEX_FILE)):
+                    query = RETRIEVAL_QUERY.format(project_type=detect_project_type(snapshot["source_files"]))
+                    context = retrieve_context(index_dir, query, retrieve_k or DEFAULT_RESULTS,
+                                               context_tokens or DEFAULT_CONTEXT_TOKENS, tokenizer)
+                    snapshot = dict(snapshot, context=context)
+                prompt, project_type = build_analysis_prompt(snapshot)
+                prompt_ids = tokenizer.encode(prompt)
+                if max_prompt_tokens and len(prompt_ids) > max_prompt_tokens:
+                    # Keep the tail: the instructions the model has to follow come last
+                    prompt_ids = prompt_ids[:1] + prompt_ids[-(max_prompt_tokens - 1):]
+                pending.append({"name": snapshot["name"], "path": path, "project_type": project_type,
+                                "prompt_ids": prompt_ids, "retrieved": len(snapshot.get("context") or [])})
+        skipped = len(snapshots) - len(pending)
+        print(f"📖 {len(snapshots)} repositories, {skipped} already done, {len(pending)} to generate")
+        if not pending:
+            return True
+
+        decoder = DecoderSession.load(model_path)
+        decode_session = None
+        if model_path.endswith("_prefill.onnx"):
+            decode_path = model_path[:-len("_prefill.onnx")] + "_decode.onnx"
+            if os.path.exists(decode_path):
+                decode_session = DecoderSession.load(decode_path)
+        kv_bytes, logits_bytes, full_logits = memory_per_token(decoder, decode_session)
+        masked = "attention_mask" in decoder.inputs
+
+        # Reusing a prefix state needs a mask to skip the padding behind it
+        cache = None
+        if prefix_reuse and masked and kv_bytes:
+            cache = PrefixCache.load(model_path, decode_session or decoder)
+        for item in pending:
+            item["prefix"] = cache.match(item["prompt_ids"]) if cache else (None, 0)
+        reused = sum(length for _, length in (item["prefix"] for item in pending))
+        if reused:
+            print(f"🔄 Prefix states cover {reused} of {sum(len(item['prompt_ids']) for item in pending)} "
+                  f"prompt tokens")
+        batches = plan_batches(
+            pending, memory_budget_mb * 1024 * 1024, max_new_tokens, kv_bytes, logits_bytes, full_logits,
+            max_batch_size, max_padding,
+            # Without an attention mask padding would change the results
+            equal_lengths=not masked,
+        )
+        real = sum(len(item["prompt_ids"]) for item in pending)
+        padded = sum(len(batch) * max(len(item["prompt_ids"]) for item in batch) for batch in batches)
+        print(f"🔧 {len(batches)} batch(es), mean size {len(pending) / len(batches):.1f}, "
+              f"prompt padding {1 - real / padded:.1%}")
+
+        start = time.time()
+        generated_tokens = 0
+        for index, batch in enumerate(batches, 1):
+            lengths = [len(item["prompt_ids"]) for item in batch]
+            batch_start = time.perf_counter()
+            with stage("batch", size=len(batch), max_length=max(lengths)):
+                outputs = run_batch(decoder, decode_session, batch, max_new_tokens, pad_token_id,
+                                    tokenizer.eos_token_id)
+            seconds = time.perf_counter() - batch_start
+            for item, tokens in zip(batch, outputs):
+                _write_result(item["path"], {
+                    "name": item["name"],
+                    "project_type": item["project_type"],
+                    "prompt_tokens": len(item["prompt_ids"]),
+                    "retrieved_chunks": item["retrieved"],
+                    "generated_tokens": len(tokens),
+                    "text": tokenizer.decode(tokens),
+                    "tokens": tokens,
+                    "model": os.path.basename(model_path),
+                    "batch_seconds": seconds,
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                })
+                generated_tokens += len(tokens)
+            print(f"   ✅ batch {index}/{len(batches)}: {len(batch)} repos, prompts {min(lengths)}-{max(lengths)} "
+                  f"tokens, {seconds:.1f} s")
+
+        elapsed = time.time() - start
+        print(f"📊 Generated {generated_tokens} tokens for {len(pending)} repos in {elapsed:.1f} s "
+              f"({generated_tokens / elapsed:.1f} tokens/s)")
+        return True
+    except Exception as e:
+        print(f"❌ Error during batch generation: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate TODO analyses for many repository snapshots offline")
+    parser.add_argument("model", help="Exported graph with logits (KV-cache exports decode much faster)")
+    parser.add_argument("--repos", default=None, help="Directory with one repository checkout per subdirectory")
+    parser.add_argument("--manifest", default=None, help="JSON or JSON-lines manifest of snapshots")
+    parser.add_argument("--output-dir", default="todo_results", help="One <repo>.json result per repository")
+    parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="Upper bound for a batch's KV cache and logits")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_MAX_NEW_TOKENS)
+    parser.add_argument("--max-padding", type=float, default=DEFAULT_MAX_PADDING,
+                        help="Largest padding per batch as a fraction of its longest prompt")
+    parser.add_argument("--max-prompt-tokens", type=int, default=None)
+    parser.add_argument("--pad-token-id", type=int, default=0)
+    parser.add_argument("--overwrite", action="store_true", help="Regenerate repos that already have a result")
+    parser.add_argument("--no-prefix-reuse", action="store_true",
+                        help="Prefill whole prompts even when prefix states are stored next to the graph")
+    parser.add_argument("--index-root", default=None,
+                        help="Repository indexes from repo_index.py --index-root; retrieved chunks replace the README excerpt")
+    parser.add_argument("--retrieve-k", type=int, default=None, help="Chunks retrieved per repository")
+    parser.add_argument("--context-tokens", type=int, default=None, help="Token budget for the retrieved chunks")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    if not args.repos and not args.manifest:
+        parser.error("pass --repos and/or --manifest")
+    if args.max_prompt_tokens is not None and args.max_prompt_tokens < 2:
+        parser.error("--max-prompt-tokens must be at least 2 (the first token plus the tail)")
+
+    with trace_run("batch_generate", args.trace):
+        success = batch_generate(
+            args.model,
+            load_snapshots(args.repos, args.manifest),
+            args.output_dir,
+            memory_budget_mb=args.memory_budget_mb,
+            max_batch_size=args.max_batch_size,
+            max_new_tokens=args.max_new_tokens,
+            max_padding=args.max_padding,
+            max_prompt_tokens=args.max_prompt_tokens,
+            pad_token_id=args.pad_token_id,
+            overwrite=args.overwrite,
+            prefix_reuse=not args.no_prefix_reuse,
+            index_root=args.index_root,
+            retrieve_k=args.retrieve_k,
+            context_tokens=args.context_tokens,
+        )
+    if success:
+        print("\n🎉 Batch generation completed successfully!")
+    else:
+        print("\n💥 Batch generation failed. Finished repositories were kept; rerun to resume.")
+        exit(1)
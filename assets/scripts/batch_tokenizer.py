@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Batch encoder/decoder for CrypticDash pipeline scripts
+Encodes lists of prompts into padded int64 id arrays with attention masks in
+one call, caches the ids of pre-tokenized words, and decodes streamed ids
+incrementally; ids match the Hugging Face tokenizer the file was compiled from
+"""
+
+import os
+import time
+import heapq
+import argparse
+import functools
+import numpy as np
+
+from binary_tokenizer import DEFAULT_CORPUS, BinaryTokenizer, compile_tokenizer, iter_corpus
+
+DEFAULT_CACHE_SIZE = 65536
+DEFAULT_BATCH_SIZE = 32
+PADDING_SIDES = ("right", "left")
+
+
+class BatchTokenizer(BinaryTokenizer):
+    """
+    BinaryTokenizer with in-memory vocabulary and merge tables and an LRU cache
+    of word -> ids. Mapping stays cheap for one-off use; this trades a one-time
+    table build for throughput when encoding many prompts.
+    """
+
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE):
+        super().__init__(path)
+        data = bytes(self._strings[:int(self._offsets[-1])])
+        offsets = self._offsets.tolist()
+        self._tokens = [data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+        self._vocab = {token: index for index, token in enumerate(self._tokens) if token}
+        self._merges = {}
+        if self.model_type == "BPE":
+            keys = self._sections["merge_keys"].tolist()
+            self._merges = dict(zip(keys, map(tuple, self._sections["merge_values"].tolist())))
+        self._cached_word = functools.lru_cache(maxsize=cache_size)(super()._encode_word)
+
+        special_ids = self.special_ids
+        self.pad_id = next((special_ids[name] for name in ("pad", "eos") if special_ids.get(name) is not None), 0)
+
+    @classmethod
+    def compile_and_load(cls, model_path, output_path=None, cache_size=DEFAULT_CACHE_SIZE):
+        path = compile_tokenizer(
+            os.path.join(model_path, "tokenizer.json"),
+            os.path.join(model_path, "tokenizer_config.json"),
+            output_path,
+        )
+        return cls(path, cache_size)
+
+    def close(self):
+        self._cached_word.cache_clear()
+        super().close()
+
+    # -- table lookups (dicts instead of searches over the mapped file) -----------
+
+    def id_to_token(self, token_id):
+        return self._tokens[int(token_id)]
+
+    def token_to_id(self, token):
+        return self._vocab.get(token)
+
+    def merge(self, left_id, right_id):
+        return self._merges.get((left_id << 32) | right_id)
+
+    def _bpe(self, word):
+        """
+        Same merges as BinaryTokenizer._bpe, but pairs wait in a heap ordered by
+        (rank, position) instead of being rescanned after every merge, so words
+        without pre-tokenizer splits (SentencePiece-style) stay O(n log n)
+        """
+        if self.header["ignore_merges"] and word in self._vocab:
+            return [self._vocab[word]]
+        ids = self._symbol_ids(word)
+        if len(ids) < 2:
+            return ids
+
+        following = list(range(1, len(ids))) + [-1]
+        previous = list(range(-1, len(ids) - 1))
+        heap = []
+        for index in range(len(ids) - 1):
+            merge = self._merges.get((ids[index] << 32) | ids[index + 1])
+            if merge is not None:
+                heap.append((merge[0], index, ids[index], ids[index + 1], merge[1]))
+        heapq.heapify(heap)
+
+        while heap:
+            _, index, left, right, merged = heapq.heappop(heap)
+            right_index = following[index]
+            # Stale entry: one side was merged away since it was pushed
+            if ids[index] != left or right_index == -1 or ids[right_index] != right:
+                continue
+            ids[index] = merged
+            ids[right_index] = -1
+            after = following[right_index]
+            following[index] = after
+            if after != -1:
+                previous[after] = index
+            for start, end in ((previous[index], index), (index, after)):
+                if start == -1 or end == -1:
+                    continue
+                merge = self._merges.get((ids[start] << 32) | ids[end])
+                if merge is not None:
+                    heapq.heappush(heap, (merge[0], start, ids[start], ids[end], merge[1]))
+
+        result = []
+        index = 0
+        while index != -1:
+            result.append(ids[index])
+            index = following[index]
+        return result
+
+    def _encode_word(self, word):
+        return self._cached_word(word)
+
+    def cache_info(self):
+        return self._cached_word.cache_info()
+
+    # -- batch API --------------------------------------------------------------------
+
+    def encode_batch(self, texts, add_special_tokens=True, max_length=None, padding_side="right",
+                     truncation_side="right", pad_to_multiple_of=None):
+        """
+        Encode texts into {"input_ids", "attention_mask"}, both int64 arrays of
+        shape (len(texts), longest row), padded with the pad (else eos) id
+        """
+        if padding_side not in PADDING_SIDES or truncation_side not in PADDING_SIDES:
+            raise ValueError(f"Padding and truncation sides must be one of {', '.join(PADDING_SIDES)}")
+        rows = [self.encode(text, add_special_tokens) for text in texts]
+        if max_length is not None:
+            rows = [row[:max_length] if truncation_side == "right" else row[-max_length:] for row in rows]
+
+        width = max((len(row) for row in rows), default=0)
+        if pad_to_multiple_of:
+            width = -(-width // pad_to_multiple_of) * pad_to_multiple_of
+        input_ids = np.full((len(rows), width), self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(rows), width), dtype=np.int64)
+        for index, row in enumerate(rows):
+            span = slice(0, len(row)) if padding_side == "right" else slice(width - len(row), width)
+            input_ids[index, span] = row
+            attention_mask[index, span] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def decode_batch(self, id_rows, skip_special_tokens=True):
+        """Decode rows of ids, dropping padding where a mask row says so"""
+        if isinstance(id_rows, dict):
+            masks = id_rows["attention_mask"]
+            id_rows = [row[mask.astype(bool)] for row, mask in zip(id_rows["input_ids"], masks)]
+        return [self.decode(row, skip_special_tokens=skip_special_tokens) for row in id_rows]
+
+
+class IncrementalDecoder:
+    """
+    Turns streamed ids into text deltas by re-decoding only a short window:
+    the ids since the last emitted text plus the ones just before them, so
+    decoders that strip a leading space or join bytes see the same context.
+    Works with BinaryTokenizer and tokenizers.Tokenizer.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_id):
+        """Add one id; returns the newly completed text (empty while a character is still partial)"""
+        self.ids.append(int(token_id))
+        prefix_text = self._decode(self.ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self.ids[self._prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self._prefix_offset, self._read_offset = self._read_offset, len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """Text held back at the end of the stream, partial characters included"""
+        if self._read_offset == len(self.ids):
+            return ""
+        prefix_text = self._decode(self.ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self.ids[self._prefix_offset:])
+        self._prefix_offset = self._read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+# ---------------------------------------------------------------------------
+# Parity and throughput
+# ---------------------------------------------------------------------------
+
+def _batches(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def verify_batch_parity(tokenizer, reference, texts, batch_size=DEFAULT_BATCH_SIZE, max_reports=5):
+    """Padded batch ids, masks and incremental decoding against tokenizers.Tokenizer"""
+    mismatches = 0
+    for batch in _batches(texts, batch_size):
+        encoded = tokenizer.encode_batch(batch)
+        expected = [encoding.ids for encoding in reference.encode_batch(batch, add_special_tokens=True)]
+        for row, ids, mask, text in zip(expected, encoded["input_ids"], encoded["attention_mask"], batch):
+            actual = ids[mask.astype(bool)].tolist()
+            if actual != row or int(mask.sum()) != len(row):
+                mismatches += 1
+                if mismatches <= max_reports:
+                    print(f"   ❌ Ids differ for {text[:40]!r}...")
+                continue
+
+            decoder = IncrementalDecoder(tokenizer)
+            streamed = "".join(decoder.push(token_id) for token_id in row) + decoder.flush()
+            if streamed != reference.decode(row, skip_special_tokens=True):
+                mismatches += 1
+                if mismatches <= max_reports:
+                    print(f"   ❌ Incremental decode differs for {text[:40]!r}...")
+    print(f"   - Checked {len(texts)} texts: {mismatches} mismatch(es)")
+    return bool(texts) and mismatches == 0
+
+
+def _pad_reference(encodings, pad_id):
+    """What a caller has to do with tokenizers output to get the same arrays"""
+    width = max(len(encoding.ids) for encoding in encodings)
+    input_ids = np.full((len(encodings), width), pad_id, dtype=np.int64)
+    attention_mask = np.zeros((len(encodings), width), dtype=np.int64)
+    for index, encoding in enumerate(encodings):
+        input_ids[index, :len(encoding.ids)] = encoding.ids
+        attention_mask[index, :len(encoding.ids)] = 1
+    return input_ids, attention_mask
+
+
+def compare_throughput(tokenizer, reference, texts, batch_size=DEFAULT_BATCH_SIZE, repeats=3):
+    """Tokens per second for cold and warm word caches versus tokenizers.encode_batch"""
+    batches = _batches(texts, batch_size)
+    tokens = sum(int(tokenizer.encode_batch(batch)["attention_mask"].sum()) for batch in batches)
+
+    def timed(encode):
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for batch in batches:
+                encode(batch)
+            samples.append(time.perf_counter() - start)
+        return min(samples)
+
+    tokenizer._cached_word.cache_clear()
+    start = time.perf_counter()
+    for batch in batches:
+        tokenizer.encode_batch(batch)
+    results = {
+        "tokens": tokens,
+        "cold_s": time.perf_counter() - start,
+        "warm_s": timed(tokenizer.encode_batch),
+        "reference_s": timed(lambda batch: _pad_reference(reference.encode_batch(batch), tokenizer.pad_id)),
+    }
+    info = tokenizer.cache_info()
+    print(f"   - {tokens:,} tokens in {len(batches)} batch(es) of up to {batch_size}")
+    for label, key in (("cold cache", "cold_s"), ("warm cache", "warm_s"), ("tokenizers", "reference_s")):
+        print(f"   - {label:<11} {results[key] * 1000:8.1f} ms ({tokens / results[key]:>12,.0f} tokens/s)")
+    print(f"   - Word cache: {info.currsize:,} entries, {info.hits / max(1, info.hits + info.misses):.0%} hit rate")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the batch tokenizer against the HF tokenizer and time it")
+    parser.add_argument("--model-path", default="../ai_models/gemma_3_270m_it")
+    parser.add_argument("--binary", default=None, help="Compiled tokenizer.bin (default: compile tokenizer.json)")
+    parser.add_argument("--corpus", nargs="*", default=list(DEFAULT_CORPUS),
+                        help="Files/directories of repository text to encode")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    try:
+        from tokenizers import Tokenizer
+
+        tokenizer_path = os.path.join(args.model_path, "tokenizer.json")
+        if args.binary:
+            tokenizer = BatchTokenizer(args.binary, args.cache_size)
+        else:
+            print(f"🔧 Compiling {tokenizer_path}...")
+            tokenizer = BatchTokenizer.compile_and_load(args.model_path, cache_size=args.cache_size)
+        reference = Tokenizer.from_file(tokenizer_path)
+        texts = [text for _, text in iter_corpus(args.corpus)]
+        print(f"📖 {len(texts)} corpus chunk(s)")
+
+        print("🧪 Checking parity with the Hugging Face tokenizer...")
+        success = verify_batch_parity(tokenizer, reference, texts, args.batch_size)
+        print("📊 Throughput:")
+        compare_throughput(tokenizer, reference, texts, args.batch_size, args.repeats)
+        tokenizer.close()
+    except Exception as e:
+        print(f"❌ Error during tokenizer check: {e}")
+        import traceback
+        traceback.print_exc()
+        success = False
+
+    if success:
+        print("\n🎉 Batch tokenizer matches the reference tokenizer!")
+    else:
+        print("\n💥 Batch tokenizer check failed.")
+        exit(1)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+CPU inference benchmark for exported CrypticDash ONNX models
+Measures session creation, prefill sweep, decode latency and peak RSS
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import multiprocessing
+from queue import Empty
+import numpy as np
+
+DEFAULT_SEQUENCE_LENGTHS = (16, 32, 64, 128, 256)
+
+# Safe id range when the graph does not expose its vocabulary (hidden-state / top-k outputs)
+FALLBACK_VOCAB_SIZE = 1000
+
+# Metrics compared against a baseline run (all "lower is better")
+REGRESSION_METRICS = ("session_create_s", "decode_per_token_ms", "peak_rss_mb")
+
+# How often benchmark_isolated checks that its worker is still alive
+WORKER_POLL_SECONDS = 1.0
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS and kilobytes on Linux
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / (1024 * 1024)
+
+
+def _median_ms(samples):
+    return 1000 * statistics.median(samples)
+
+
+def benchmark_model(model_path, sequence_lengths=DEFAULT_SEQUENCE_LENGTHS, decode_tokens=32,
+                    repeats=3, vocab_size=None, seed=0):
+    """Benchmark one model in the current process and return a result dict"""
+    import onnxruntime as ort
+    from ort_runtime import DecoderSession, model_size_bytes
+
+    print(f"📊 Benchmarking {model_path}")
+    decoder = DecoderSession.load(model_path)
+    print(f"   - Session created in {decoder.load_seconds:.2f} s")
+
+    vocab_size = vocab_size or decoder.vocab_size
+    if vocab_size is None:
+        print(f"   ⚠️ Vocabulary size unknown, sampling ids below {FALLBACK_VOCAB_SIZE}")
+        vocab_size = FALLBACK_VOCAB_SIZE
+    rng = np.random.default_rng(seed)
+
+    # Prefill latency across the sequence-length sweep (one warmup run each)
+    prefill = []
+    for sequence_length in sequence_lengths:
+        input_ids = rng.integers(0, vocab_size, size=(1, sequence_length), dtype=np.int64)
+        decoder.run(input_ids)
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            decoder.run(input_ids)
+            samples.append(time.perf_counter() - start)
+        latency_ms = _median_ms(samples)
+        prefill.append({
+            "sequence_length": sequence_length,
+            "latency_ms": latency_ms,
+            "tokens_per_s": sequence_length / (latency_ms / 1000),
+        })
+        print(f"   - Prefill {sequence_length:>5} tokens: {latency_ms:8.1f} ms")
+
+    # Per-token decode latency (graphs that return hidden states cannot decode)
+    decode = None
+    if "logits" in decoder.outputs or decoder.topk:
+        prompt_ids = rng.integers(0, vocab_size, size=(1, sequence_lengths[0]), dtype=np.int64)
+        _, timings = decoder.generate_greedy(prompt_ids, decode_tokens)
+        if timings["step_s"]:
+            per_token_ms = _median_ms(timings["step_s"])
+            decode = {
+                "prompt_length": sequence_lengths[0],
+                "new_tokens": len(timings["step_s"]) + 1,
+                "per_token_ms": per_token_ms,
+                "tokens_per_s": 1000 / per_token_ms,
+                "kv_cache": decoder.has_past,
+            }
+            print(f"   - Decode: {per_token_ms:.1f} ms/token ({decode['tokens_per_s']:.1f} tokens/s)")
+
+    result = {
+        "model": model_path,
+        "size_mb": model_size_bytes(model_path) / (1024 * 1024),
+        "session_create_s": decoder.load_seconds,
+        "prefill": prefill,
+        "decode": decode,
+        "decode_per_token_ms": decode["per_token_ms"] if decode else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "onnxruntime_version": ort.__version__,
+    }
+    print(f"   - Peak RSS: {result['peak_rss_mb']:.1f} MB")
+    return result
+
+
+def _benchmark_worker(queue, model_path, options):
+    try:
+        queue.put(("ok", benchmark_model(model_path, **options)))
+    except Exception as e:
+        queue.put(("error", f"{type(e).__name__}: {e}"))
+
+
+def _wait_for_result(queue, process, timeout):
+    start = time.perf_counter()
+    while True:
+        try:
+            return queue.get(timeout=WORKER_POLL_SECONDS)
+        except Empty:
+            pass
+        if not process.is_alive():
+            # The result may still be in flight from a worker that just exited
+            try:
+                return queue.get(timeout=WORKER_POLL_SECONDS)
+            except Empty:
+                return "error", f"worker exited with code {process.exitcode} without a result"
+        if timeout and time.perf_counter() - start > timeout:
+            return "error", f"no result after {timeout:g} s"
+
+
+def benchmark_isolated(model_path, timeout=None, **options):
+    """
+    Benchmark a model in a fresh process so peak RSS only covers that model.
+    A worker that dies (OOM kill, provider crash) or runs past `timeout`
+    seconds fails the run instead of hanging it.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_benchmark_worker, args=(queue, model_path, options))
+    process.start()
+    status, payload = _wait_for_result(queue, process, timeout)
+    if status != "ok" and process.is_alive():
+        process.terminate()
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"Benchmark of {model_path} failed: {payload}")
+    return payload
+
+
+def compare_to_baseline(results, baseline, max_regression):
+    """Return human-readable regressions of results against a baseline run"""
+    baseline_runs = {run.get("name") or os.path.basename(run["model"]): run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        name = run.get("name") or os.path.basename(run["model"])
+        previous = baseline_runs.get(name)
+        if previous is None:
+            continue
+
+        pairs = [(metric, run.get(metric), previous.get(metric)) for metric in REGRESSION_METRICS]
+        previous_prefill = {entry["sequence_length"]: entry["latency_ms"] for entry in previous["prefill"]}
+        for entry in run["prefill"]:
+            pairs.append((f"prefill_{entry['sequence_length']}_ms", entry["latency_ms"],
+                          previous_prefill.get(entry["sequence_length"])))
+
+        for metric, current, reference in pairs:
+            if current is None or not reference:
+                continue
+            change = (current - reference) / reference
+            if change > max_regression:
+                regressions.append(f"{name}: {metric} {reference:.2f} -> {current:.2f} (+{change:.0%})")
+    return regressions
+
+
+def run_benchmarks(model_paths, output_path, baseline_path=None, max_regression=0.10, **options):
+    """Benchmark every model, write the JSON report and check for regressions"""
+    try:
+        results = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "options": options,
+            "runs": [benchmark_isolated(path, **options) for path in model_paths],
+        }
+    except Exception as e:
+        print(f"❌ Error during benchmark: {e}")
+        return False
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"📝 Wrote {output_path}")
+
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, max_regression)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) over {max_regression:.0%}:")
+            for line in regressions:
+                print(f"   - {line}")
+            return False
+        print(f"✅ No regressions over {max_regression:.0%} against {baseline_path}")
+
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark exported ONNX models on CPU")
+    parser.add_argument("models", nargs="+",
+                        help="Model files, e.g. model.onnx model_q4.onnx ../ai_models/phi-2/tiny_model.onnx")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results path")
+    parser.add_argument("--sequence-lengths", type=int, nargs="+", default=list(DEFAULT_SEQUENCE_LENGTHS))
+    parser.add_argument("--decode-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--vocab-size", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds before a model's benchmark is failed")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Fail when a metric is this fraction slower/larger than the baseline")
+    args = parser.parse_args()
+
+    success = run_benchmarks(
+        args.models,
+        args.output,
+        baseline_path=args.baseline,
+        max_regression=args.max_regression,
+        sequence_lengths=args.sequence_lengths,
+        decode_tokens=args.decode_tokens,
+        repeats=args.repeats,
+        vocab_size=args.vocab_size,
+        timeout=args.timeout,
+    )
+    if success:
+        print("\n🎉 Benchmark completed successfully!")
+    else:
+        print("\n💥 Benchmark failed or regressed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,718 @@
+#!/usr/bin/env python3
+"""
+Compact binary tokenizer format for CrypticDash models
+Compiles tokenizer.json / tokenizer_config.json into one memory-mappable file
+(sorted string table, id-indexed offsets, merge/score tables) and encodes
+with it exactly like the Hugging Face tokenizer it was compiled from
+"""
+
+import os
+import re
+import json
+import mmap
+import time
+import struct
+import bisect
+import argparse
+import unicodedata
+import numpy as np
+
+MAGIC = b"CDTK"
+FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct("<4sII")  # magic, format version, header length
+_ALIGNMENT = 8
+
+SUPPORTED = {
+    "model": ("BPE", "Unigram"),
+    "normalizer": ("Sequence", "Replace", "Prepend", "NFC", "NFKC", "NFD", "NFKD", "Lowercase", "Strip"),
+    "pre_tokenizer": ("Sequence", "ByteLevel", "Metaspace", "Split", "Digits", "Whitespace", "WhitespaceSplit"),
+    "decoder": ("Sequence", "ByteLevel", "Metaspace", "Replace", "ByteFallback", "Fuse", "Strip"),
+    "post_processor": ("Sequence", "TemplateProcessing", "ByteLevel", "RobertaProcessing", "BertProcessing"),
+}
+
+# GPT-2 / ByteLevel pre-tokenization pattern
+_BYTE_LEVEL_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+DEFAULT_CORPUS = ("../../docs", "../../lib", "../../README.md", "../../crypticdash-TODO.md")
+CORPUS_EXTENSIONS = (".md", ".dart", ".py", ".txt", ".yaml", ".json")
+
+
+def bytes_to_unicode():
+    """GPT-2 byte <-> printable unicode mapping used by ByteLevel"""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    codes = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            codes.append(256 + extra)
+            extra += 1
+    return {byte: chr(code) for byte, code in zip(printable, codes)}
+
+
+_BYTE_ENCODER = bytes_to_unicode()
+_BYTE_DECODER = {char: byte for byte, char in _BYTE_ENCODER.items()}
+
+
+def _align(value):
+    return (value + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+# ---------------------------------------------------------------------------
+# Compiler
+# ---------------------------------------------------------------------------
+
+def _check_supported(spec, kind):
+    """Fail at compile time on any component the encoder cannot reproduce exactly"""
+    if spec is None:
+        return
+    if spec["type"] not in SUPPORTED[kind]:
+        raise ValueError(f"Unsupported {kind}: {spec['type']}")
+    children = spec.get("normalizers") or spec.get("pretokenizers") or spec.get("decoders") or spec.get("processors")
+    for child in children or []:
+        _check_supported(child, kind)
+
+
+def _post_processor_ids(spec, token_ids):
+    """Reduce a post-processor to the ids it adds before/after a single sequence"""
+    prefix, suffix = [], []
+    if spec is None or spec["type"] == "ByteLevel":
+        return prefix, suffix
+    if spec["type"] == "Sequence":
+        for child in spec["processors"]:
+            child_prefix, child_suffix = _post_processor_ids(child, token_ids)
+            prefix += child_prefix
+            suffix += child_suffix
+        return prefix, suffix
+    if spec["type"] in ("RobertaProcessing", "BertProcessing"):
+        return [spec["cls"][1]], [spec["sep"][1]]
+
+    seen_sequence = False
+    for item in spec["single"]:
+        if "Sequence" in item:
+            seen_sequence = True
+            continue
+        ids = spec["special_tokens"][item["SpecialToken"]["id"]]["ids"]
+        (suffix if seen_sequence else prefix).extend(ids)
+    return prefix, suffix
+
+
+def _config_token_id(config, name, token_ids):
+    """Resolve bos/eos/pad/unk from tokenizer_config.json (string or AddedToken dict)"""
+    value = config.get(name)
+    if isinstance(value, dict):
+        value = value.get("content")
+    return token_ids.get(value) if value is not None else None
+
+
+def compile_tokenizer(tokenizer_path, config_path=None, output_path=None):
+    """Compile tokenizer.json (+ tokenizer_config.json) into the binary format"""
+    with open(tokenizer_path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+    config = {}
+    if config_path and os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+
+    model = spec["model"]
+    model_type = model.get("type") or ("BPE" if "merges" in model else "Unigram")
+    _check_supported({"type": model_type}, "model")
+    for kind in ("normalizer", "pre_tokenizer", "decoder", "post_processor"):
+        _check_supported(spec.get(kind), kind)
+    if model_type == "BPE" and (model.get("continuing_subword_prefix") or model.get("end_of_word_suffix")):
+        raise ValueError("BPE continuing_subword_prefix / end_of_word_suffix are not supported")
+
+    # id -> token, including added tokens
+    if model_type == "BPE":
+        vocab = model["vocab"]
+        scores = None
+    else:
+        vocab = {token: index for index, (token, _) in enumerate(model["vocab"])}
+        scores = np.array([score for _, score in model["vocab"]], dtype=np.float32)
+    added_tokens = spec.get("added_tokens", [])
+    vocab_size = max([*vocab.values(), *(token["id"] for token in added_tokens)]) + 1
+    tokens = [""] * vocab_size
+    for token, index in vocab.items():
+        tokens[index] = token
+    for token in added_tokens:
+        tokens[token["id"]] = token["content"]
+    token_ids = {token: index for index, token in enumerate(tokens) if token}
+
+    encoded = [token.encode("utf-8") for token in tokens]
+    offsets = np.zeros(vocab_size + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum([len(token) for token in encoded])
+    sorted_ids = np.array(sorted(range(vocab_size), key=lambda index: encoded[index]), dtype=np.uint32)
+
+    sections = [
+        ("strings", np.frombuffer(b"".join(encoded), dtype=np.uint8)),
+        ("offsets", offsets),
+        ("sorted_ids", sorted_ids),
+    ]
+
+    if model_type == "BPE":
+        keys, values = [], []
+        for rank, merge in enumerate(model.get("merges", [])):
+            left, right = merge.split(" ", 1) if isinstance(merge, str) else merge
+            merged = token_ids.get(left + right)
+            if left in vocab and right in vocab and merged is not None:
+                keys.append((vocab[left] << 32) | vocab[right])
+                values.append((rank, merged))
+        order = np.argsort(np.array(keys, dtype=np.uint64), kind="stable")
+        sections.append(("merge_keys", np.array(keys, dtype=np.uint64)[order]))
+        sections.append(("merge_values", np.array(values, dtype=np.uint32).reshape(-1, 2)[order]))
+    else:
+        sections.append(("scores", scores))
+
+    prefix, suffix = _post_processor_ids(spec.get("post_processor"), token_ids)
+    header = {
+        "format_version": FORMAT_VERSION,
+        "model_type": model_type,
+        "vocab_size": vocab_size,
+        "unk_id": model.get("unk_id") if model_type == "Unigram" else token_ids.get(model.get("unk_token")),
+        "byte_fallback": bool(model.get("byte_fallback", False)),
+        "fuse_unk": bool(model.get("fuse_unk", False)),
+        "ignore_merges": bool(model.get("ignore_merges", False)),
+        "max_token_chars": max(len(token) for token in tokens),
+        "normalizer": spec.get("normalizer"),
+        "pre_tokenizer": spec.get("pre_tokenizer"),
+        "decoder": spec.get("decoder"),
+        "post_processor": {"prefix": prefix, "suffix": suffix},
+        "added_tokens": [
+            {key: token[key] for key in ("id", "content", "special", "lstrip", "rstrip", "normalized")}
+            for token in added_tokens
+        ],
+        "special_ids": {
+            name: _config_token_id(config, f"{name}_token", token_ids) for name in ("bos", "eos", "pad", "unk")
+        },
+        "sections": {},
+    }
+
+    data = bytearray()
+    for name, array in sections:
+        array = np.ascontiguousarray(array)
+        data.extend(b"\0" * (_align(len(data)) - len(data)))
+        header["sections"][name] = [len(data), str(array.dtype), list(array.shape)]
+        data.extend(array.tobytes())
+
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+    output_path = output_path or os.path.join(os.path.dirname(tokenizer_path), "tokenizer.bin")
+    with open(output_path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * (data_start - _PREAMBLE.size - len(header_bytes)))
+        f.write(data)
+    return output_path
+
+
+# ---------------------------------------------------------------------------
+# Reader / encoder
+# ---------------------------------------------------------------------------
+
+def _pattern(spec):
+    """Compile a tokenizers pattern ({"String": ...} or {"Regex": ...})"""
+    import regex
+    if "String" in spec:
+        return regex.compile(regex.escape(spec["String"]))
+    return regex.compile(spec["Regex"])
+
+
+def _split_spans(text, pattern, invert=False):
+    """(piece, is_match) spans covering the whole text"""
+    spans = []
+    position = 0
+    for match in pattern.finditer(text):
+        if match.start() == match.end():
+            continue
+        if match.start() > position:
+            spans.append((text[position:match.start()], invert))
+        spans.append((match.group(), not invert))
+        position = match.end()
+    if position < len(text):
+        spans.append((text[position:], invert))
+    return spans
+
+
+def _apply_split_behavior(spans, behavior):
+    """Implements the Removed/Isolated/MergedWith*/Contiguous split behaviors"""
+    pieces = []
+    if behavior == "Removed":
+        return [piece for piece, is_match in spans if not is_match]
+    if behavior == "Isolated":
+        return [piece for piece, _ in spans]
+    if behavior == "MergedWithPrevious":
+        for piece, is_match in spans:
+            if is_match and pieces:
+                pieces[-1] += piece
+            else:
+                pieces.append(piece)
+        return pieces
+    if behavior == "MergedWithNext":
+        pending = ""
+        for piece, is_match in spans:
+            if is_match:
+                pending += piece
+            else:
+                pieces.append(pending + piece)
+                pending = ""
+        if pending:
+            pieces.append(pending)
+        return pieces
+    if behavior == "Contiguous":
+        previous_match = None
+        for piece, is_match in spans:
+            if is_match and previous_match:
+                pieces[-1] += piece
+            else:
+                pieces.append(piece)
+            previous_match = is_match
+        return pieces
+    raise ValueError(f"Unsupported split behavior: {behavior}")
+
+
+class BinaryTokenizer:
+    """Memory-mapped reader for tokenizer.bin with HF-compatible encode/decode"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} tokenizer.bin file")
+        self.header = json.loads(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_length].decode("utf-8"))
+        data_start = _align(_PREAMBLE.size + header_length)
+
+        self._sections = {}
+        for name, (offset, dtype, shape) in self.header["sections"].items():
+            count = int(np.prod(shape)) if shape else 1
+            self._sections[name] = np.frombuffer(
+                self._mmap, dtype=dtype, count=count, offset=data_start + offset
+            ).reshape(shape)
+
+        self.vocab_size = self.header["vocab_size"]
+        self.model_type = self.header["model_type"]
+        self.special_ids = self.header["special_ids"]
+        self._strings = memoryview(self._mmap)[data_start + self.header["sections"]["strings"][0]:]
+        self._offsets = self._sections["offsets"]
+        self._sorted_ids = self._sections["sorted_ids"]
+        self._prefix_ids = self.header["post_processor"]["prefix"]
+        self._suffix_ids = self.header["post_processor"]["suffix"]
+
+        self._added = {token["content"]: token for token in self.header["added_tokens"]}
+        self._special_ids = {token["id"] for token in self.header["added_tokens"] if token["special"]}
+        self._added_pattern = None
+
+    @classmethod
+    def compile_and_load(cls, model_path, output_path=None):
+        path = compile_tokenizer(
+            os.path.join(model_path, "tokenizer.json"),
+            os.path.join(model_path, "tokenizer_config.json"),
+            output_path,
+        )
+        return cls(path)
+
+    def close(self):
+        # Views into the mapping must be dropped before it can be unmapped
+        self._sections.clear()
+        self._offsets = self._sorted_ids = None
+        self._strings.release()
+        self._mmap.close()
+        self._file.close()
+
+    # -- vocabulary ---------------------------------------------------------
+
+    def _token_bytes(self, token_id):
+        return bytes(self._strings[self._offsets[token_id]:self._offsets[token_id + 1]])
+
+    def id_to_token(self, token_id):
+        return self._token_bytes(int(token_id)).decode("utf-8")
+
+    def token_to_id(self, token):
+        """Binary search in the sorted string table; None when absent"""
+        target = token.encode("utf-8")
+        index = bisect.bisect_left(self._sorted_ids, target, key=self._token_bytes)
+        if index < self.vocab_size:
+            token_id = int(self._sorted_ids[index])
+            if self._token_bytes(token_id) == target:
+                return token_id
+        return None
+
+    def merge(self, left_id, right_id):
+        """(rank, merged id) for a BPE pair, or None"""
+        keys = self._sections["merge_keys"]
+        key = np.uint64((left_id << 32) | right_id)
+        index = int(np.searchsorted(keys, key))
+        if index < len(keys) and keys[index] == key:
+            rank, merged = self._sections["merge_values"][index]
+            return int(rank), int(merged)
+        return None
+
+    # -- normalization / pre-tokenization ------------------------------------
+
+    def _normalize(self, text, spec):
+        if spec is None:
+            return text
+        kind = spec["type"]
+        if kind == "Sequence":
+            for child in spec["normalizers"]:
+                text = self._normalize(text, child)
+            return text
+        if kind == "Replace":
+            return _pattern(spec["pattern"]).sub(spec["content"].replace("\\", "\\\\"), text)
+        if kind == "Prepend":
+            return spec["prepend"] + text if text else text
+        if kind in ("NFC", "NFKC", "NFD", "NFKD"):
+            return unicodedata.normalize(kind, text)
+        if kind == "Lowercase":
+            return text.lower()
+        if kind == "Strip":
+            if spec.get("strip_left", True):
+                text = text.lstrip()
+            if spec.get("strip_right", True):
+                text = text.rstrip()
+            return text
+        raise ValueError(f"Unsupported normalizer: {kind}")
+
+    def _pre_tokenize(self, pieces, spec, first_segment):
+        if spec is None:
+            return pieces
+        kind = spec["type"]
+        if kind == "Sequence":
+            for child in spec["pretokenizers"]:
+                pieces = self._pre_tokenize(pieces, child, first_segment)
+            return pieces
+
+        result = []
+        for index, piece in enumerate(pieces):
+            if kind == "ByteLevel":
+                if spec.get("add_prefix_space", False) and index == 0 and not piece.startswith(" "):
+                    piece = " " + piece
+                import regex
+                words = regex.findall(_BYTE_LEVEL_PATTERN, piece) if spec.get("use_regex", True) else [piece]
+                result.extend("".join(_BYTE_ENCODER[byte] for byte in word.encode("utf-8")) for word in words)
+            elif kind == "Metaspace":
+                replacement = spec.get("replacement", "▁")
+                piece = piece.replace(" ", replacement)
+                scheme = spec.get("prepend_scheme") or ("always" if spec.get("add_prefix_space", True) else "never")
+                if index == 0 and not piece.startswith(replacement) and (
+                    scheme == "always" or (scheme == "first" and first_segment)
+                ):
+                    piece = replacement + piece
+                if spec.get("split", True):
+                    result.extend(_apply_split_behavior(
+                        _split_spans(piece, _pattern({"String": replacement})), "MergedWithNext"
+                    ))
+                else:
+                    result.append(piece)
+            elif kind == "Split":
+                spans = _split_spans(piece, _pattern(spec["pattern"]), spec.get("invert", False))
+                result.extend(_apply_split_behavior(spans, spec["behavior"]))
+            elif kind == "Digits":
+                import regex
+                digits = regex.compile(r"\p{N}" if spec.get("individual_digits") else r"\p{N}+")
+                result.extend(_apply_split_behavior(_split_spans(piece, digits), "Isolated"))
+            elif kind == "Whitespace":
+                import regex
+                result.extend(regex.findall(r"\w+|[^\w\s]+", piece))
+            elif kind == "WhitespaceSplit":
+                result.extend(piece.split())
+            else:
+                raise ValueError(f"Unsupported pre-tokenizer: {kind}")
+        return [piece for piece in result if piece]
+
+    # -- models ---------------------------------------------------------------
+
+    def _symbol_ids(self, word):
+        """Initial per-character ids with byte fallback and unk fusing"""
+        ids = []
+        unk_id = self.header["unk_id"]
+        for char in word:
+            token_id = self.token_to_id(char)
+            if token_id is not None:
+                ids.append(token_id)
+                continue
+            if self.header["byte_fallback"]:
+                byte_ids = [self.token_to_id(f"<0x{byte:02X}>") for byte in char.encode("utf-8")]
+                if all(byte_id is not None for byte_id in byte_ids):
+                    ids.extend(byte_ids)
+                    continue
+            if unk_id is None:
+                raise ValueError(f"Character {char!r} is not in the vocabulary and no unk token is set")
+            if not (self.header["fuse_unk"] and ids and ids[-1] == unk_id):
+                ids.append(unk_id)
+        return ids
+
+    def _bpe(self, word):
+        if self.header["ignore_merges"]:
+            token_id = self.token_to_id(word)
+            if token_id is not None:
+                return [token_id]
+
+        symbols = self._symbol_ids(word)
+        while len(symbols) > 1:
+            best = None
+            for left, right in zip(symbols, symbols[1:]):
+                merge = self.merge(left, right)
+                if merge is not None and (best is None or merge[0] < best[0]):
+                    best = (merge[0], left, right, merge[1])
+            if best is None:
+                break
+            _, left, right, merged = best
+            result = []
+            index = 0
+            while index < len(symbols):
+                if index + 1 < len(symbols) and symbols[index] == left and symbols[index + 1] == right:
+                    result.append(merged)
+                    index += 2
+                else:
+                    result.append(symbols[index])
+                    index += 1
+            symbols = result
+        return symbols
+
+    def _unigram(self, word):
+        """Viterbi segmentation maximizing the summed piece scores"""
+        scores = self._sections["scores"]
+        unk_id = self.header["unk_id"]
+        unk_score = float(scores.min()) - 10.0
+        max_chars = self.header["max_token_chars"]
+        best = [(0.0, 0, None)] + [(-np.inf, 0, None)] * len(word)
+        for end in range(1, len(word) + 1):
+            for start in range(max(0, end - max_chars), end):
+                if best[start][0] == -np.inf:
+                    continue
+                token_id = self.token_to_id(word[start:end])
+                if token_id is None or token_id in self._special_ids:
+                    if end - start == 1:
+                        candidate = (best[start][0] + unk_score, start, unk_id)
+                        if candidate[0] > best[end][0]:
+                            best[end] = candidate
+                    continue
+                candidate = (best[start][0] + float(scores[token_id]), start, token_id)
+                if candidate[0] > best[end][0]:
+                    best[end] = candidate
+
+        pieces = []
+        end = len(word)
+        while end > 0:
+            _, start, token_id = best[end]
+            if token_id == unk_id and self.header["byte_fallback"]:
+                pieces.extend(reversed(self._symbol_ids(word[start:end])))
+            elif not (self.header["fuse_unk"] and token_id == unk_id and pieces and pieces[-1] == unk_id):
+                pieces.append(token_id)
+            end = start
+        return pieces[::-1]
+
+    def _encode_word(self, word):
+        return self._bpe(word) if self.model_type == "BPE" else self._unigram(word)
+
+    # -- public API -------------------------------------------------------------
+
+    def _segments(self, text):
+        """Split on added tokens first, honouring their lstrip/rstrip flags"""
+        if not self._added:
+            return [("text", text)]
+        if self._added_pattern is None:
+            # Compiled on first use so mapping the file stays cheap
+            import regex
+            contents = sorted(self._added, key=len, reverse=True)
+            self._added_pattern = regex.compile("|".join(regex.escape(content) for content in contents))
+        segments = []
+        position = 0
+        for match in self._added_pattern.finditer(text):
+            segments.append(("text", text[position:match.start()]))
+            segments.append(("added", self._added[match.group()]))
+            position = match.end()
+        segments.append(("text", text[position:]))
+
+        for index, (kind, value) in enumerate(segments):
+            if kind != "added":
+                continue
+            if value["lstrip"] and index > 0:
+                segments[index - 1] = ("text", segments[index - 1][1].rstrip())
+            if value["rstrip"] and index + 1 < len(segments):
+                segments[index + 1] = ("text", segments[index + 1][1].lstrip())
+        return [(kind, value) for kind, value in segments if kind == "added" or value]
+
+    def encode_pieces(self, text):
+        """Normalized, pre-tokenized words (added tokens kept as dicts)"""
+        pieces = []
+        for index, (kind, value) in enumerate(self._segments(text)):
+            if kind == "added":
+                pieces.append(value)
+                continue
+            normalized = self._normalize(value, self.header["normalizer"])
+            pieces.extend(self._pre_tokenize([normalized], self.header["pre_tokenizer"], index == 0))
+        return pieces
+
+    def encode(self, text, add_special_tokens=True):
+        ids = []
+        for piece in self.encode_pieces(text):
+            if isinstance(piece, dict):
+                ids.append(piece["id"])
+            else:
+                ids.extend(self._encode_word(piece))
+        if add_special_tokens:
+            ids = self._prefix_ids + ids + self._suffix_ids
+        return ids
+
+    def _decode_tokens(self, tokens, spec):
+        if spec is None:
+            return tokens
+        kind = spec["type"]
+        if kind == "Sequence":
+            for child in spec["decoders"]:
+                tokens = self._decode_tokens(tokens, child)
+            return tokens
+        if kind == "ByteLevel":
+            data = bytes(_BYTE_DECODER.get(char, ord(" ")) for char in "".join(tokens))
+            return [data.decode("utf-8", errors="replace")]
+        if kind == "Metaspace":
+            replacement = spec.get("replacement", "▁")
+            scheme = spec.get("prepend_scheme") or ("always" if spec.get("add_prefix_space", True) else "never")
+            result = []
+            for index, token in enumerate(tokens):
+                token = token.replace(replacement, " ")
+                if index == 0 and scheme != "never" and token.startswith(" "):
+                    token = token[1:]
+                result.append(token)
+            return result
+        if kind == "Replace":
+            pattern = _pattern(spec["pattern"])
+            return [pattern.sub(spec["content"].replace("\\", "\\\\"), token) for token in tokens]
+        if kind == "ByteFallback":
+            result, pending = [], bytearray()
+            for token in tokens:
+                match = re.fullmatch(r"<0x([0-9A-Fa-f]{2})>", token)
+                if match:
+                    pending.append(int(match.group(1), 16))
+                    continue
+                if pending:
+                    result.append(pending.decode("utf-8", errors="replace"))
+                    pending = bytearray()
+                result.append(token)
+            if pending:
+                result.append(pending.decode("utf-8", errors="replace"))
+            return result
+        if kind == "Fuse":
+            return ["".join(tokens)]
+        if kind == "Strip":
+            content, start, stop = spec["content"], spec.get("start", 0), spec.get("stop", 0)
+            result = []
+            for token in tokens:
+                for _ in range(start):
+                    if token.startswith(content):
+                        token = token[len(content):]
+                for _ in range(stop):
+                    if token.endswith(content):
+                        token = token[:-len(content)]
+                result.append(token)
+            return result
+        raise ValueError(f"Unsupported decoder: {kind}")
+
+    def decode(self, ids, skip_special_tokens=False):
+        tokens = [
+            self.id_to_token(token_id) for token_id in ids
+            if not (skip_special_tokens and int(token_id) in self._special_ids)
+        ]
+        return "".join(self._decode_tokens(tokens, self.header["decoder"]))
+
+
+# ---------------------------------------------------------------------------
+# Parity check
+# ---------------------------------------------------------------------------
+
+def iter_corpus(paths):
+    """Yield (name, paragraph) chunks from files or directories of text"""
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path) for name in names
+                if name.endswith(CORPUS_EXTENSIONS)
+            )
+        elif os.path.exists(path):
+            files = [path]
+        else:
+            continue
+        for file_path in files:
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            for index, paragraph in enumerate(content.split("\n\n")):
+                if paragraph.strip():
+                    yield f"{file_path}#{index}", paragraph
+
+
+def verify_parity(binary_path, tokenizer_path, corpus_paths, max_reports=5):
+    """Compare ids against the HF tokenizers reference on every corpus chunk"""
+    from tokenizers import Tokenizer
+
+    reference = Tokenizer.from_file(tokenizer_path)
+    compiled = BinaryTokenizer(binary_path)
+    checked = mismatches = tokens = 0
+    for name, text in iter_corpus(corpus_paths):
+        expected = reference.encode(text, add_special_tokens=True).ids
+        actual = compiled.encode(text, add_special_tokens=True)
+        checked += 1
+        tokens += len(expected)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= max_reports:
+                first = next((i for i, (a, b) in enumerate(zip(actual, expected)) if a != b), min(len(actual), len(expected)))
+                print(f"   ❌ {name}: first difference at token {first} "
+                      f"(expected {expected[first:first + 5]}, got {actual[first:first + 5]})")
+    compiled.close()
+    print(f"   - Checked {checked} chunks ({tokens:,} tokens): {mismatches} mismatch(es)")
+    return checked > 0 and mismatches == 0
+
+
+def compare_load_cost(binary_path, tokenizer_path):
+    """Startup time of the binary file versus decoding tokenizer.json"""
+    start = time.perf_counter()
+    with open(tokenizer_path, "r", encoding="utf-8") as f:
+        json.load(f)
+    json_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    BinaryTokenizer(binary_path).close()
+    binary_seconds = time.perf_counter() - start
+
+    json_mb = os.path.getsize(tokenizer_path) / (1024 * 1024)
+    binary_mb = os.path.getsize(binary_path) / (1024 * 1024)
+    print(f"   - tokenizer.json: {json_mb:.1f} MB, {json_seconds * 1000:.0f} ms to decode")
+    print(f"   - tokenizer.bin:  {binary_mb:.1f} MB, {binary_seconds * 1000:.0f} ms to map")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile tokenizer.json into the compact binary format")
+    parser.add_argument("--model-path", default="../ai_models/gemma_3_270m_it")
+    parser.add_argument("--output", default=None, help="Defaults to <model-path>/tokenizer.bin")
+    parser.add_argument("--corpus", nargs="*", default=list(DEFAULT_CORPUS),
+                        help="Files/directories used for the parity check against the HF tokenizer")
+    parser.add_argument("--skip-verify", action="store_true")
+    args = parser.parse_args()
+
+    tokenizer_path = os.path.join(args.model_path, "tokenizer.json")
+    print(f"🔧 Compiling {tokenizer_path}...")
+    try:
+        binary_path = compile_tokenizer(
+            tokenizer_path, os.path.join(args.model_path, "tokenizer_config.json"), args.output
+        )
+        print(f"✅ Wrote {binary_path}")
+        compare_load_cost(binary_path, tokenizer_path)
+        success = True
+        if not args.skip_verify:
+            print("🧪 Checking parity with the Hugging Face tokenizer...")
+            success = verify_parity(binary_path, tokenizer_path, args.corpus)
+    except Exception as e:
+        print(f"❌ Error compiling tokenizer: {e}")
+        import traceback
+        traceback.print_exc()
+        success = False
+
+    if success:
+        print("\n🎉 Binary tokenizer ready and matches the reference tokenizer!")
+    else:
+        print("\n💥 Tokenizer compilation or parity check failed.")
+        exit(1)
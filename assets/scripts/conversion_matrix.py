@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Multi-target conversion scheduler for CrypticDash models
+Expands a target matrix (model x KV cache mode x precisions) into pipeline
+jobs and runs them in parallel processes, admitting a job only while the
+estimated peak RSS of all running jobs fits the memory budget
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from model_pipeline import CACHE_DIR, MODELS
+from quantize_onnx import QUANT_MODES
+from stage_trace import add_trace_arguments, stage, trace_run
+
+PRECISIONS = ("fp32",) + tuple(QUANT_MODES)
+DEFAULT_MEMORY_BUDGET_GB = 16.0
+
+# Peak RSS heuristics, in multiples of the fp32 weights: tracing holds the
+# model, the traced constants and the serialized proto at once; streamed
+# exports never hold the model, so quantization (model + quantized copy) peaks
+EXPORT_PEAK_FACTOR = 3.0
+STREAM_PEAK_FACTOR = 2.0
+# Python, torch and onnxruntime before any weights are loaded
+BASE_RSS_BYTES = int(1.5 * 1024 ** 3)
+# dtype each converter loads the checkpoint in (convert_phi2_to_onnx uses float16)
+EXPORT_BYTES_PER_PARAMETER = {"gemma": 4, "phi2": 2}
+STREAM_BYTES_PER_PARAMETER = {"float32": 4, "float16": 2}
+
+# Every maintained variant: both models, all precisions, with and without KV cache
+DEFAULT_MATRIX = {
+    "targets": [
+        {"model": "gemma", "kv_cache": ["none", "merged"], "precisions": list(PRECISIONS)},
+        {"model": "phi2", "kv_cache": ["none", "merged"], "precisions": list(PRECISIONS)},
+    ],
+}
+
+# MLP weight matrices per layer: gated (gate/up/down) unless listed here
+_UNGATED_MODEL_TYPES = ("phi", "gpt2", "gpt_neox", "gptj")
+
+
+def count_parameters(config):
+    """Approximate parameter count of a decoder-only model from its config.json"""
+    config = config.get("text_config", config)
+    hidden = config["hidden_size"]
+    heads = config["num_attention_heads"]
+    kv_heads = config.get("num_key_value_heads") or heads
+    head_dim = config.get("head_dim") or hidden // heads
+    intermediate = config.get("intermediate_size") or 4 * hidden
+    mlp_matrices = 2 if config.get("model_type") in _UNGATED_MODEL_TYPES else 3
+
+    attention = 2 * hidden * heads * head_dim + 2 * hidden * kv_heads * head_dim
+    per_layer = attention + mlp_matrices * hidden * intermediate
+    embeddings = config["vocab_size"] * hidden
+    head = 0 if config.get("tie_word_embeddings", True) else embeddings
+    return config["num_hidden_layers"] * per_layer + embeddings + head
+
+
+def estimate_peak_rss_bytes(parameters, bytes_per_parameter=4, stream=False):
+    """Peak RSS of one pipeline job for a model with `parameters` weights"""
+    factor = STREAM_PEAK_FACTOR if stream else EXPORT_PEAK_FACTOR
+    return BASE_RSS_BYTES + int(parameters * bytes_per_parameter * factor)
+
+
+def load_matrix(path=None):
+    if path is None:
+        return DEFAULT_MATRIX
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def expand_jobs(matrix):
+    """
+    One job per (model, KV cache mode). Its precisions share that export:
+    fp32 is the export itself, the others are quantized variants of it.
+    """
+    jobs = []
+    for target in matrix["targets"]:
+        spec = MODELS[target["model"]]
+        model_path = target.get("model_path") or spec["path"]
+        precisions = target.get("precisions") or ["fp32"]
+        unknown = sorted(set(precisions) - set(PRECISIONS))
+        if unknown:
+            raise ValueError(f"Unknown precision(s) for {target['model']}: {', '.join(unknown)}")
+
+        with open(os.path.join(model_path, "config.json"), "r", encoding="utf-8") as f:
+            parameters = count_parameters(json.load(f))
+        stream = bool(target.get("stream", False))
+        if stream:
+            bytes_per_parameter = STREAM_BYTES_PER_PARAMETER[target.get("dtype") or "float32"]
+        else:
+            bytes_per_parameter = EXPORT_BYTES_PER_PARAMETER.get(target["model"], 4)
+        estimate = target.get("peak_rss_gb")
+        estimate_bytes = int(estimate * 1024 ** 3) if estimate else estimate_peak_rss_bytes(
+            parameters, bytes_per_parameter, stream)
+        output_root = target.get("output_dir") or os.path.join(model_path, "onnx")
+
+        for kv_cache in target.get("kv_cache") or ["none"]:
+            jobs.append({
+                "name": f"{target.get('name') or target['model']}-{kv_cache}",
+                "model": target["model"],
+                "model_path": model_path,
+                # The no-cache build keeps the path the app already loads from
+                "output_dir": output_root if kv_cache == "none" else os.path.join(output_root, f"kv_{kv_cache}"),
+                "export_options": {
+                    "kv_cache": kv_cache,
+                    "logits_mode": target.get("logits_mode"),
+                    "stream": stream,
+                    "dtype": target.get("dtype"),
+                    "memory_budget_mb": target.get("memory_budget_mb"),
+                },
+                "optimize": bool(target.get("optimize", False)),
+                "quantize": [precision for precision in precisions if precision != "fp32"],
+                "parameters": parameters,
+                "estimate_bytes": estimate_bytes,
+            })
+    return jobs
+
+
+def _peak_rss_bytes():
+    """Peak RSS of this process and of any process it waited for"""
+    import resource
+
+    peaks = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return max(peaks) * (1 if os.uname().sysname == "Darwin" else 1024)
+
+
+def _run_job(job, cache_dir):
+    """Runs in a fresh process: one pipeline run for one matrix job, traced on its own"""
+    from model_pipeline import run_pipeline
+
+    start = time.time()
+    with trace_run(f"convert_{job['name']}"):
+        ok = run_pipeline(
+            job["model"],
+            model_path=job["model_path"],
+            output_dir=job["output_dir"],
+            cache_dir=cache_dir,
+            export_options=job["export_options"],
+            optimize=job["optimize"],
+            quantize=job["quantize"],
+        )
+    try:
+        peak = _peak_rss_bytes()
+    except (ImportError, AttributeError):
+        peak = None
+    return {"ok": ok, "seconds": time.time() - start, "peak_rss_bytes": peak}
+
+
+def schedule(jobs, memory_budget_bytes, workers, run_job, cache_dir=CACHE_DIR):
+    """
+    Run jobs largest-estimate first, each in its own spawned process. A job
+    is admitted while running estimates plus its own fit the budget; a job
+    over the whole budget runs alone. Returns {job name: result}.
+    """
+    context = multiprocessing.get_context("spawn")
+    pending = sorted(jobs, key=lambda job: job["estimate_bytes"], reverse=True)
+    running = {}
+    results = {}
+    start = time.time()
+
+    def admissible(job):
+        reserved = sum(entry[0]["estimate_bytes"] for entry in running.values())
+        if not running:
+            return True
+        return len(running) < workers and reserved + job["estimate_bytes"] <= memory_budget_bytes
+
+    while pending or running:
+        for job in list(pending):
+            if not admissible(job):
+                continue
+            if job["estimate_bytes"] > memory_budget_bytes:
+                print(f"⚠️ {job['name']} is estimated at {job['estimate_bytes'] / 1024 ** 3:.1f} GB, over the "
+                      f"{memory_budget_bytes / 1024 ** 3:.1f} GB budget; running it alone")
+            pending.remove(job)
+            # A fresh process per job, so no job inherits another's allocator arenas
+            executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            future = executor.submit(run_job, job, cache_dir)
+            running[future] = (job, executor, time.time())
+            reserved = sum(entry[0]["estimate_bytes"] for entry in running.values())
+            print(f"🔄 Started {job['name']} (~{job['estimate_bytes'] / 1024 ** 3:.1f} GB); {len(running)} running, "
+                  f"{reserved / 1024 ** 3:.1f}/{memory_budget_bytes / 1024 ** 3:.1f} GB reserved")
+
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            job, executor, started = running.pop(future)
+            executor.shutdown()
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"ok": False, "error": f"{type(e).__name__}: {e}", "seconds": time.time() - started,
+                          "peak_rss_bytes": None}
+            result.update({"queued_s": started - start, "estimate_bytes": job["estimate_bytes"],
+                           "parameters": job["parameters"], "output_dir": job["output_dir"],
+                           "precisions": ["fp32", *job["quantize"]]})
+            results[job["name"]] = result
+            peak = result["peak_rss_bytes"]
+            print(f"   {'✅' if result['ok'] else '❌'} {job['name']} finished in {result['seconds']:.1f} s"
+                  + (f", peak RSS {peak / 1024 ** 3:.1f} GB" if peak else ""))
+    return results
+
+
+def write_matrix_report(results, memory_budget_bytes, workers, report_path):
+    """Markdown table of estimated versus measured peak RSS plus a JSON copy"""
+    lines = [
+        "# Conversion matrix report",
+        "",
+        f"- Memory budget: {memory_budget_bytes / 1024 ** 3:.1f} GB, up to {workers} concurrent job(s)",
+        f"- Jobs: {sum(result['ok'] for result in results.values())}/{len(results)} succeeded",
+        "",
+        "| Job | Precisions | Parameters | Estimated peak (GB) | Measured peak (GB) | Started at (s) | Time (s) | Status |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for name, result in sorted(results.items(), key=lambda item: item[1]["queued_s"]):
+        peak = result["peak_rss_bytes"]
+        lines.append(
+            f"| {name} | {', '.join(result['precisions'])} | {result['parameters'] / 1e6:.0f}M | "
+            f"{result['estimate_bytes'] / 1024 ** 3:.1f} | {f'{peak / 1024 ** 3:.1f}' if peak else '-'} | "
+            f"{result['queued_s']:.1f} | {result['seconds']:.1f} | {'ok' if result['ok'] else result.get('error', 'failed')} |"
+        )
+    lines.append("")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump({"memory_budget_bytes": memory_budget_bytes, "workers": workers, "jobs": results}, f, indent=2)
+    return report_path
+
+
+def run_matrix(matrix, memory_budget_gb=None, workers=None, cache_dir=CACHE_DIR,
+               report_path="conversion_matrix_report.md", dry_run=False):
+    """Expand, schedule and report a whole target matrix; arguments override the matrix's own settings"""
+    try:
+        memory_budget_gb = memory_budget_gb or matrix.get("memory_budget_gb") or DEFAULT_MEMORY_BUDGET_GB
+        workers = workers or matrix.get("workers") or os.cpu_count() or 1
+        memory_budget_bytes = int(memory_budget_gb * 1024 ** 3)
+        with stage("plan"):
+            jobs = expand_jobs(matrix)
+
+        print(f"📋 {len(jobs)} job(s), budget {memory_budget_gb:.1f} GB, up to {workers} at a time:")
+        for job in sorted(jobs, key=lambda job: job["estimate_bytes"], reverse=True):
+            print(f"   - {job['name']:<16} {job['parameters'] / 1e6:8.0f}M params, ~{job['estimate_bytes'] / 1024 ** 3:5.1f} GB,"
+                  f" {', '.join(['fp32', *job['quantize']])} -> {job['output_dir']}")
+        if dry_run:
+            return True
+
+        results = schedule(jobs, memory_budget_bytes, workers, _run_job, cache_dir)
+        write_matrix_report(results, memory_budget_bytes, workers, report_path)
+        print(f"📝 Wrote {report_path}")
+        return all(result["ok"] for result in results.values())
+    except Exception as e:
+        print(f"❌ Error during conversion matrix: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build every model variant in a target matrix within a memory budget")
+    parser.add_argument("--matrix", default=None,
+                        help="JSON target matrix (default: gemma and phi2, all precisions, with and without KV cache)")
+    parser.add_argument("--memory-budget-gb", type=float, default=None,
+                        help=f"Sum of estimated peak RSS allowed at once (default: the matrix's memory_budget_gb, "
+                             f"else {DEFAULT_MEMORY_BUDGET_GB:g})")
+    parser.add_argument("--workers", type=int, default=None, help="Maximum concurrent jobs (default: CPU count)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--report", default="conversion_matrix_report.md")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the jobs and their estimates")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("conversion_matrix", args.trace):
+        success = run_matrix(
+            load_matrix(args.matrix),
+            memory_budget_gb=args.memory_budget_gb,
+            workers=args.workers,
+            cache_dir=args.cache_dir,
+            report_path=args.report,
+            dry_run=args.dry_run,
+        )
+    if success:
+        print("\n🎉 Conversion matrix completed successfully!")
+    else:
+        print("\n💥 Conversion matrix failed. Check the report and messages above.")
+        exit(1)
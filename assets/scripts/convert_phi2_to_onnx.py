@@ -6,16 +6,35 @@ Based on the existing Gemma conversion template
 
 import os
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer
 import json
+import argparse
+from export_wrappers import (
+    DEFAULT_TOP_K, EMBEDDING_POOLING, KV_CACHE_MODES, LOGITS_MODES, LogitsHead,
+    embedding_output_path, export_embedding_model, export_with_kv_cache, logits_dynamic_axes, logits_output_names,
+    parse_top_k,
+)
+from quantize_onnx import parse_modes, run_quantization_stage
+from optimize_onnx import run_optimization_stage
+from parity_check import run_parity_check
+from generation_loop import run_generation_loop_stage
+from stream_export import KV_CACHE_MODES as STREAM_KV_CACHE_MODES, add_streaming_arguments, stream_export_model
+from shard_loader import DEFAULT_LOAD_TIMEOUT, load_model_parallel
+from stage_trace import add_trace_arguments, current_rss_mb, stage, trace_run
 
-def convert_phi2_to_onnx():
+PHI2_MODEL_PATH = "../ai_models/phi-2"
+
+def convert_phi2_to_onnx(kv_cache="none", logits_mode=None, top_k=DEFAULT_TOP_K, optimize=False, quantize=(),
+                         load_timeout=DEFAULT_LOAD_TIMEOUT, load_workers=None, model_path=PHI2_MODEL_PATH,
+                         output_dir=None, parity=False, generation_loop=False,
+                         embedding=False, embedding_pooling="mean"):
     """Convert Microsoft Phi-2 from Safetensors to ONNX format"""
     
     print("🚀 Starting Microsoft Phi-2 to ONNX conversion...")
     
-    # Model path (phi-2 directory)
-    model_path = "../ai_models/phi-2"
+    # Outputs go next to the checkpoint unless a directory is given
+    output_dir = output_dir or model_path
+    os.makedirs(output_dir, exist_ok=True)
     
     # Add verbose logging
     print(f"🔍 Model path: {os.path.abspath(model_path)}")
@@ -23,16 +42,17 @@ def convert_phi2_to_onnx():
     
     # List all files in the model directory
     print("📁 Files in model directory:")
-    try:
-        for file in os.listdir(model_path):
-            file_path = os.path.join(model_path, file)
-            if os.path.isfile(file_path):
-                size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                print(f"   - {file} ({size:.1f} MB)")
-            else:
-                print(f"   - {file} (directory)")
-    except Exception as e:
-        print(f"   ❌ Error listing directory: {e}")
+    with stage("directory scan"):
+        try:
+            for file in os.listdir(model_path):
+                file_path = os.path.join(model_path, file)
+                if os.path.isfile(file_path):
+                    size = os.path.getsize(file_path) / (1024 * 1024)  # MB
+                    print(f"   - {file} ({size:.1f} MB)")
+                else:
+                    print(f"   - {file} (directory)")
+        except Exception as e:
+            print(f"   ❌ Error listing directory: {e}")
     
     try:
         print("\n📖 Loading Microsoft Phi-2 model and tokenizer...")
@@ -50,89 +70,46 @@ def convert_phi2_to_onnx():
         import time
         start_time = time.time()
         
-        # Add memory monitoring
-        import psutil
-        process = psutil.Process()
-        initial_memory = process.memory_info().rss / (1024 * 1024)  # MB
-        print(f"🔍 Initial memory usage: {initial_memory:.1f} MB")
+        # Memory is sampled for every stage; see the stage metrics table at the end
+        print(f"🔍 Initial memory usage: {current_rss_mb():.1f} MB")
         
         # Add progress indicator
         print("🔍 Starting model load...")
         
         try:
-            print("🔍 About to call AutoModelForCausalLM.from_pretrained...")
+            print("🔍 Loading safetensors shards in parallel...")
             print("🔍 Parameters:")
             print(f"   - model_path: {model_path}")
-            print(f"   - torch_dtype: float32")
-            print(f"   - device_map: {'auto' if torch.cuda.is_available() else 'cpu'}")
-            print(f"   - use_cache: False")
-            print(f"   - local_files_only: True")
-            print(f"   - low_cpu_mem_usage: True")
-            print(f"   - offload_folder: temp_offload")
-            
-            print("🔍 Calling from_pretrained...")
+            print(f"   - torch_dtype: float16")
+            print(f"   - use_cache: {kv_cache != 'none'}")
+            print(f"   - load_timeout: {load_timeout} seconds")
+            print(f"   - load_workers: {load_workers or 'one per shard'}")
             
-            # Try to add more granular logging by checking what transformers is doing
             print("🔍 Checking if model directory is valid...")
             if not os.path.exists(model_path):
                 raise FileNotFoundError(f"Model path does not exist: {model_path}")
             
             print("🔍 Checking config.json...")
-            config_path = os.path.join(model_path, "config.json")
-            if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    config_content = f.read()
-                print(f"🔍 Config.json content (first 200 chars): {config_content[:200]}...")
-            else:
-                print("❌ config.json not found!")
-            
-            print("🔍 About to call from_pretrained - this may hang...")
-            
-            # Try to add a timeout mechanism using threading
-            import threading
-            import queue
-            
-            result_queue = queue.Queue()
-            exception_queue = queue.Queue()
-            
-            def load_model_in_thread():
-                try:
-                    print("🔍 Starting model load in background thread...")
-                    model = AutoModelForCausalLM.from_pretrained(
-                        model_path,
-                        torch_dtype=torch.float16,  # Use float16 to reduce memory usage
-                        device_map="cpu",  # Force CPU to avoid GPU memory issues
-                        use_cache=False,  # Disable cache for ONNX export
-                        local_files_only=True,  # Only use local files
-                        low_cpu_mem_usage=True,  # Reduce memory usage
-                        offload_folder="temp_offload",  # Offload to disk if needed
-                        max_memory={0: "8GB"},  # Limit memory usage to 8GB
-                        load_in_8bit=False,  # Don't use 8-bit quantization
-                        load_in_4bit=False,  # Don't use 4-bit quantization
-                        attn_implementation="eager"  # Use eager attention for memory efficiency
-                    )
-                    result_queue.put(model)
-                    print("🔍 Model loaded successfully in background thread!")
-                except Exception as e:
-                    exception_queue.put(e)
-                    print(f"❌ Model loading failed in background thread: {e}")
-            
-            # Start model loading in background thread
-            model_thread = threading.Thread(target=load_model_in_thread)
-            model_thread.daemon = True
-            model_thread.start()
+            with stage("config read"):
+                config_path = os.path.join(model_path, "config.json")
+                if os.path.exists(config_path):
+                    with open(config_path, 'r') as f:
+                        config_content = f.read()
+                    print(f"🔍 Config.json content (first 200 chars): {config_content[:200]}...")
+                else:
+                    print("❌ config.json not found!")
             
-            # Wait for result with timeout
-            print("🔍 Waiting for model to load (60 second timeout)...")
-            try:
-                model = result_queue.get(timeout=60)
-                print("🔍 Model loaded successfully!")
-            except queue.Empty:
-                print("❌ Model loading timed out after 60 seconds")
-                raise TimeoutError("Model loading timed out after 60 seconds")
-            except Exception as e:
-                print(f"❌ Model loading failed: {e}")
-                raise
+            # Shards are read in a worker process that is killed on timeout or Ctrl+C,
+            # so a cancelled load does not keep holding memory
+            with stage("model load"):
+                model = load_model_parallel(
+                    model_path,
+                    dtype=torch.float16,  # Use float16 to reduce memory usage
+                    max_workers=load_workers,
+                    timeout=load_timeout,
+                    use_cache=kv_cache != "none",  # Only keep the cache for KV-cache export
+                    attn_implementation="eager"  # Use eager attention for memory efficiency
+                )
             load_time = time.time() - start_time
             print(f"✅ Model loaded successfully in {load_time:.1f} seconds")
         except Exception as e:
@@ -146,21 +123,26 @@ def convert_phi2_to_onnx():
             raise
         
         print("🔍 Loading tokenizer...")
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_path,
-            local_files_only=True  # Only use local files
-        )
+        with stage("tokenizer load"):
+            tokenizer = AutoTokenizer.from_pretrained(
+                model_path,
+                local_files_only=True  # Only use local files
+            )
         
         # Create a simple wrapper for ONNX export
         class SimplePhi2Wrapper(torch.nn.Module):
-            def __init__(self, model):
+            def __init__(self, model, logits_mode=None, top_k=DEFAULT_TOP_K):
                 super().__init__()
                 self.model = model
+                # Without a logits mode the graph keeps returning last_hidden_state
+                self.head = LogitsHead(model, logits_mode, top_k) if logits_mode else None
                 
             def forward(self, input_ids):
                 # Simple forward pass without complex attention mechanisms
                 outputs = self.model.model(input_ids=input_ids)
-                return outputs.last_hidden_state
+                if self.head is None:
+                    return outputs.last_hidden_state
+                return self.head(outputs.last_hidden_state)
         
         print(f"✅ Model loaded successfully!")
         print(f"   - Model type: {type(model).__name__}")
@@ -169,7 +151,9 @@ def convert_phi2_to_onnx():
         
         # Create a simplified wrapper model for ONNX export
         print("🔧 Creating simplified wrapper for ONNX export...")
-        wrapper_model = SimplePhi2Wrapper(model)
+        if logits_mode:
+            print(f"   - Logits mode: {logits_mode}" + (f" (k={top_k})" if logits_mode == "topk" else ""))
+        wrapper_model = SimplePhi2Wrapper(model, logits_mode, top_k)
         wrapper_model.eval()
         
         # Create dummy input for ONNX export
@@ -183,38 +167,98 @@ def convert_phi2_to_onnx():
         dummy_input = torch.randint(0, vocab_size, (1, 128))
         print(f"   - Input shape: {dummy_input.shape}")
         
-        # Convert to ONNX
-        print("🔄 Converting to ONNX format...")
-        
-        output_path = os.path.join(model_path, "model.onnx")
-        
-        # Use traditional ONNX exporter with simplified wrapper
-        torch.onnx.export(
-            wrapper_model,
-            dummy_input,
-            output_path,
-            input_names=['input_ids'],
-            output_names=['last_hidden_state'],
-            dynamic_axes={
-                'input_ids': {0: 'batch_size', 1: 'sequence_length'},
-                'last_hidden_state': {0: 'batch_size', 1: 'sequence_length'}
-            },
-            opset_version=9,  # Use ONNX opset 9 for compatibility with ONNX Runtime 1.4.1
-            do_constant_folding=True,
-            export_params=True,
-            verbose=False
-        )
+        output_path = os.path.join(output_dir, "model.onnx")
+        
+        with stage("export", kv_cache=kv_cache, logits_mode=logits_mode):
+            if kv_cache != "none":
+                # KV-cache graphs return logits (not hidden states) so they can drive decoding
+                print(f"🔄 Converting to ONNX format with KV cache ({kv_cache})...")
+                output_paths = export_with_kv_cache(
+                    model, model.config, vocab_size, output_path, mode=kv_cache,
+                    logits_mode=logits_mode or "full", top_k=top_k
+                )
+            else:
+                # Convert to ONNX
+                print("🔄 Converting to ONNX format...")
+            
+                if logits_mode:
+                    output_names = logits_output_names(logits_mode)
+                    output_axes = logits_dynamic_axes(logits_mode)
+                else:
+                    output_names = ['last_hidden_state']
+                    output_axes = {'last_hidden_state': {0: 'batch_size', 1: 'sequence_length'}}
+            
+                # Use traditional ONNX exporter with simplified wrapper
+                torch.onnx.export(
+                    wrapper_model,
+                    dummy_input,
+                    output_path,
+                    input_names=['input_ids'],
+                    output_names=output_names,
+                    dynamic_axes={
+                        'input_ids': {0: 'batch_size', 1: 'sequence_length'},
+                        **output_axes
+                    },
+                    opset_version=9,  # Use ONNX opset 9 for compatibility with ONNX Runtime 1.4.1
+                    do_constant_folding=True,
+                    export_params=True,
+                    verbose=False
+                )
+                output_paths = [output_path]
         
         print(f"✅ ONNX conversion completed!")
-        print(f"   - Output file: {output_path}")
         
-        # Verify the ONNX file was created
-        if os.path.exists(output_path):
-            file_size = os.path.getsize(output_path) / (1024 * 1024)  # Convert to MB
-            print(f"   - File size: {file_size:.1f} MB")
-        else:
-            print("❌ Error: ONNX file was not created!")
-            return False
+        # Verify the ONNX files were created
+        for path in output_paths:
+            print(f"   - Output file: {path}")
+            if os.path.exists(path):
+                file_size = os.path.getsize(path) / (1024 * 1024)  # Convert to MB
+                print(f"   - File size: {file_size:.1f} MB")
+            else:
+                print("❌ Error: ONNX file was not created!")
+                return False
+        
+        # Offline optimization stage: the fused, ORT-optimized graph replaces each export
+        if optimize:
+            for path in output_paths:
+                if not run_optimization_stage(path, replace=True,
+                                              config_path=os.path.join(model_path, "config.json")):
+                    return False
+        
+        # Quantization stage: int8 / int4 / fp16 variants next to each exported graph
+        if quantize:
+            print(f"🔧 Quantizing exported graphs: {', '.join(quantize)}")
+            for path in output_paths:
+                # The report needs logits and a multi-token graph (not the split decode graph)
+                report = (bool(logits_mode) or kv_cache != "none") and path == output_paths[0]
+                if not run_quantization_stage(path, quantize, report=report, vocab_size=vocab_size):
+                    return False
+        
+        # Generation loop stage: <stem>_generate.onnx samples inside one Loop over the decoder
+        if generation_loop:
+            if kv_cache == "split":
+                print("❌ The generation loop wraps a merged KV-cache graph; use --kv-cache merged")
+                return False
+            if not run_generation_loop_stage(output_paths[0]):
+                return False
+        
+        # Embedding stage: pooled hidden states for repository retrieval (repo_index.py)
+        if embedding:
+            embedding_path = embedding_output_path(output_paths[0])
+            with stage("embedding export", pooling=embedding_pooling):
+                export_embedding_model(model, vocab_size, embedding_path, embedding_pooling, dynamo=False)
+            print(f"✅ Embedding graph: {embedding_path} ({model.config.hidden_size} dimensions)")
+        
+        # Parity stage: the exported graph and its variants against the PyTorch model
+        if parity:
+            # The workers load their own copy of the checkpoint
+            del wrapper_model, model
+            import gc
+            gc.collect()
+            precisions = ["fp32", *quantize]
+            # One worker: each holds an fp32 copy of the checkpoint next to this process
+            if not run_parity_check(model_path, output_paths[0], precisions=precisions, workers=1):
+                return False
         
         print("✅ Conversion successful! The model should now work with ONNX Runtime 1.4.1")
         return True
@@ -226,7 +270,62 @@ def convert_phi2_to_onnx():
         return False
 
 if __name__ == "__main__":
-    success = convert_phi2_to_onnx()
+    parser = argparse.ArgumentParser(description="Convert Microsoft Phi-2 to ONNX")
+    parser.add_argument("--kv-cache", choices=KV_CACHE_MODES, default="none",
+                        help="Export past_key_values/present I/O as one merged graph or prefill+decode graphs")
+    parser.add_argument("--logits", choices=LOGITS_MODES, default=None,
+                        help="Emit logits (all positions, last position, or last-position top-k) instead of last_hidden_state")
+    parser.add_argument("--top-k", type=parse_top_k, default=DEFAULT_TOP_K,
+                        help="Number of (ids, scores) returned by --logits topk")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Fuse attention/norm/GELU/rotary ops and save the offline-optimized graph")
+    parser.add_argument("--quantize", type=parse_modes, default=[],
+                        help="Comma separated quantization modes to run after export (int8,int4,fp16)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream weights from the mmapped safetensors shards instead of loading the full model")
+    add_streaming_arguments(parser)
+    parser.add_argument("--load-timeout", type=float, default=DEFAULT_LOAD_TIMEOUT,
+                        help="Seconds before the shard loader process is killed")
+    parser.add_argument("--load-workers", type=int, default=None,
+                        help="Threads used to read shards (default: one per shard)")
+    parser.add_argument("--parity", action="store_true",
+                        help="Compare the exported graph and its quantized variants against the PyTorch model")
+    parser.add_argument("--generation-loop", action="store_true",
+                        help="Also write <stem>_generate.onnx: the decoder in an ONNX Loop with greedy/top-k/top-p sampling")
+    parser.add_argument("--embedding", action="store_true",
+                        help="Also write embedding_model.onnx: pooled hidden states for repo_index.py")
+    parser.add_argument("--embedding-pooling", choices=EMBEDDING_POOLING, default="mean")
+    parser.add_argument("--model-path", default=PHI2_MODEL_PATH, help="Phi-2 checkpoint directory")
+    parser.add_argument("--output-dir", default=None, help="Where model.onnx goes (default: --model-path)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    if args.stream:
+        # The streamed graph only goes through export; run model_pipeline.py --stream for the later stages
+        unsupported = [flag for flag, value in (("--optimize", args.optimize), ("--quantize", args.quantize),
+                                                ("--parity", args.parity), ("--generation-loop", args.generation_loop),
+                                                ("--embedding", args.embedding)) if value]
+        if args.kv_cache not in STREAM_KV_CACHE_MODES:
+            unsupported.append(f"--kv-cache {args.kv_cache}")
+        if unsupported:
+            parser.error(f"--stream cannot be combined with {', '.join(unsupported)}")
+    
+    with trace_run("convert_phi2_to_onnx", args.trace):
+        if args.stream:
+            success = stream_export_model(
+                args.model_path,
+                os.path.join(args.output_dir, "model.onnx") if args.output_dir else None,
+                memory_budget_mb=args.memory_budget_mb,
+                dtype=args.dtype,
+                kv_cache=args.kv_cache,
+                logits_mode=args.logits,
+                top_k=args.top_k,
+            )
+        else:
+            success = convert_phi2_to_onnx(kv_cache=args.kv_cache, logits_mode=args.logits, top_k=args.top_k, optimize=args.optimize, quantize=args.quantize,
+                                           load_timeout=args.load_timeout, load_workers=args.load_workers,
+                                           model_path=args.model_path, output_dir=args.output_dir, parity=args.parity,
+                                           generation_loop=args.generation_loop, embedding=args.embedding,
+                                           embedding_pooling=args.embedding_pooling)
     if success:
         print("\n🎉 Phi-2 ONNX conversion completed successfully!")
         print("The model should now work with your app.")
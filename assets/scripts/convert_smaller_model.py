@@ -1,29 +1,42 @@
 #!/usr/bin/env python3
 """
 Try to convert a smaller model that might actually work
+Also builds draft models for speculative decoding: a few-layer model that
+shares the target's vocabulary, exported next to the target
 """
 
 import os
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import json
+import argparse
+from export_wrappers import KV_CACHE_MODES, export_with_kv_cache
+from stage_trace import add_trace_arguments, stage, trace_run
 
-def try_smaller_model():
+# Targets a draft model can be built for, and where their ONNX graphs live
+DRAFT_TARGETS = {
+    "phi2": {"path": "../ai_models/phi-2", "output_dir": "../ai_models/phi-2"},
+    "gemma": {"path": "../ai_models/gemma_3_270m_it", "output_dir": "../ai_models/gemma_3_270m_it/onnx"},
+}
+DRAFT_INITS = ("truncate", "random")
+
+def try_smaller_model(kv_cache="none"):
     print("🧪 Trying to find a smaller, workable model...")
     
     # Check what we have
     model_path = "../ai_models/phi-2"
     
     print("📁 Available models:")
-    try:
-        for file in os.listdir(model_path):
-            file_path = os.path.join(model_path, file)
-            if os.path.isfile(file_path):
-                size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                print(f"   - {file} ({size:.1f} MB)")
-    except Exception as e:
-        print(f"❌ Error listing files: {e}")
-        return
+    with stage("directory scan"):
+        try:
+            for file in os.listdir(model_path):
+                file_path = os.path.join(model_path, file)
+                if os.path.isfile(file_path):
+                    size = os.path.getsize(file_path) / (1024 * 1024)  # MB
+                    print(f"   - {file} ({size:.1f} MB)")
+        except Exception as e:
+            print(f"❌ Error listing files: {e}")
+            return
     
     print("\n🔍 The issue: Phi-2 is 5.3GB - too large for CPU loading")
     print("💡 Solutions:")
@@ -36,9 +49,10 @@ def try_smaller_model():
     
     try:
         # Try to load just the config and create a tiny model
-        config_path = os.path.join(model_path, "config.json")
-        with open(config_path, 'r') as f:
-            config = json.load(f)
+        with stage("config read"):
+            config_path = os.path.join(model_path, "config.json")
+            with open(config_path, 'r') as f:
+                config = json.load(f)
         
         print("✅ Config loaded successfully")
         print(f"   - Model type: {config.get('model_type', 'Unknown')}")
@@ -62,7 +76,8 @@ def try_smaller_model():
         )
         
         print("🔧 Creating tiny model from config...")
-        tiny_model = PhiForCausalLM(tiny_config)
+        with stage("model build"):
+            tiny_model = PhiForCausalLM(tiny_config)
         
         print("✅ Tiny model created successfully!")
         print(f"   - Parameters: {sum(p.numel() for p in tiny_model.parameters()):,}")
@@ -75,22 +90,31 @@ def try_smaller_model():
         
         output_path = os.path.join(model_path, "tiny_model.onnx")
         
-        torch.onnx.export(
-            tiny_model,
-            dummy_input,
-            output_path,
-            input_names=['input_ids'],
-            output_names=['logits'],
-            dynamic_axes={
-                'input_ids': {0: 'batch_size', 1: 'sequence_length'},
-                'logits': {0: 'batch_size', 1: 'sequence_length'}
-            },
-            opset_version=9,
-            do_constant_folding=True,
-            export_params=True,
-            verbose=False,
-            dynamo=True  # Use modern ONNX export that supports DynamicCache
-        )
+        if kv_cache != "none":
+            # past_key_values/present I/O plus attention_mask, e.g. for batched serving
+            with stage("export", kv_cache=kv_cache):
+                output_paths = export_with_kv_cache(
+                    tiny_model, tiny_config, 51200, output_path, mode=kv_cache
+                )
+            output_path = output_paths[0]
+        else:
+            with stage("export"):
+                torch.onnx.export(
+                    tiny_model,
+                    dummy_input,
+                    output_path,
+                    input_names=['input_ids'],
+                    output_names=['logits'],
+                    dynamic_axes={
+                        'input_ids': {0: 'batch_size', 1: 'sequence_length'},
+                        'logits': {0: 'batch_size', 1: 'sequence_length'}
+                    },
+                    opset_version=9,
+                    do_constant_folding=True,
+                    export_params=True,
+                    verbose=False,
+                    dynamo=True  # Use modern ONNX export that supports DynamicCache
+                )
         
         if os.path.exists(output_path):
             file_size = os.path.getsize(output_path) / (1024 * 1024)
@@ -107,8 +131,115 @@ def try_smaller_model():
         traceback.print_exc()
         return False
 
+def build_draft_model(target_path, num_layers=2, init="truncate"):
+    """
+    A small causal LM with the target's vocabulary.
+
+    "truncate" keeps the target's embeddings, first num_layers decoder layers,
+    final norm and head, so its greedy guesses often agree with the target.
+    "random" is the untrained 256-hidden Phi model from try_smaller_model.
+    """
+    from transformers import AutoConfig, PhiConfig, PhiForCausalLM
+    
+    config = AutoConfig.from_pretrained(target_path)
+    if init == "random":
+        draft_config = PhiConfig(
+            hidden_size=256,
+            num_hidden_layers=num_layers,
+            num_attention_heads=8,
+            intermediate_size=512,
+            vocab_size=config.vocab_size,
+            max_position_embeddings=2048
+        )
+        return PhiForCausalLM(draft_config)
+    
+    config.num_hidden_layers = num_layers
+    if getattr(config, "layer_types", None):
+        # Gemma 3 lists sliding/full attention per layer
+        config.layer_types = config.layer_types[:num_layers]
+    # Weights of the dropped layers are simply not loaded
+    return AutoModelForCausalLM.from_pretrained(
+        target_path, config=config, torch_dtype=torch.float32, attn_implementation="eager"
+    )
+
+def export_draft_model(target="phi2", num_layers=2, init="truncate", target_path=None, output_dir=None):
+    """Export draft_model.onnx (merged KV-cache graph) next to the target's graphs"""
+    target_path = target_path or DRAFT_TARGETS[target]["path"]
+    output_dir = output_dir or DRAFT_TARGETS[target]["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    
+    print(f"🚀 Building a {num_layers}-layer draft model for {target} ({init})...")
+    try:
+        with stage("model build", init=init, num_layers=num_layers):
+            draft_model = build_draft_model(target_path, num_layers, init)
+        draft_model.eval()
+        
+        with open(os.path.join(target_path, "config.json"), 'r') as f:
+            target_vocab_size = json.load(f).get("vocab_size")
+        vocab_size = draft_model.config.vocab_size
+        if target_vocab_size is not None and vocab_size != target_vocab_size:
+            print(f"❌ Draft vocabulary ({vocab_size}) does not match the target ({target_vocab_size})")
+            return False
+        
+        print("✅ Draft model created successfully!")
+        print(f"   - Parameters: {sum(p.numel() for p in draft_model.parameters()):,}")
+        print(f"   - Vocabulary size: {vocab_size:,}")
+        
+        # The driver runs the draft one token at a time, so it always gets a KV cache
+        output_path = os.path.join(output_dir, "draft_model.onnx")
+        print(f"🔄 Exporting draft model -> {output_path}")
+        with stage("export", kv_cache="merged"):
+            export_with_kv_cache(draft_model, draft_model.config, vocab_size, output_path, mode="merged")
+        
+        metadata = {
+            "target": target,
+            "target_path": os.path.abspath(target_path),
+            "init": init,
+            "num_layers": num_layers,
+            "vocab_size": vocab_size,
+            "parameters": sum(p.numel() for p in draft_model.parameters()),
+        }
+        with open(os.path.join(output_dir, "draft_model.json"), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        
+        file_size = os.path.getsize(output_path) / (1024 * 1024)
+        print(f"✅ Draft ONNX model created! Size: {file_size:.1f} MB")
+        print("💡 Pair it with a merged KV-cache export of the target (--kv-cache merged --logits full)")
+        return True
+    
+    except Exception as e:
+        print(f"❌ Error exporting draft model: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
 if __name__ == "__main__":
-    success = try_smaller_model()
+    parser = argparse.ArgumentParser(description="Build and export a tiny Phi model to ONNX")
+    parser.add_argument("--kv-cache", choices=KV_CACHE_MODES, default="none",
+                        help="Export past_key_values/present and attention_mask I/O (merged or prefill+decode graphs)")
+    parser.add_argument("--draft-for", choices=sorted(DRAFT_TARGETS), default=None,
+                        help="Instead of the tiny test model, export a speculative-decoding draft for this target")
+    parser.add_argument("--draft-layers", type=int, default=2, help="Decoder layers in the draft model")
+    parser.add_argument("--draft-init", choices=DRAFT_INITS, default="truncate",
+                        help="Reuse the target's first layers (truncate) or build an untrained tiny model (random)")
+    parser.add_argument("--target-path", default=None, help="Target checkpoint directory (default: the target's ai_models dir)")
+    parser.add_argument("--output-dir", default=None, help="Where draft_model.onnx goes (default: next to the target's graphs)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    
+    if args.draft_for:
+        with trace_run("convert_smaller_model", args.trace):
+            success = export_draft_model(args.draft_for, args.draft_layers, args.draft_init,
+                                         target_path=args.target_path, output_dir=args.output_dir)
+        if success:
+            print("\n🎉 Draft model export successful!")
+        else:
+            print("\n💥 Draft model export failed.")
+            exit(1)
+        exit(0)
+    
+    with trace_run("convert_smaller_model", args.trace):
+        success = try_smaller_model(kv_cache=args.kv_cache)
     if success:
         print("\n🎉 Tiny model conversion successful!")
         print("This proves the approach works - we just need a smaller model.")
@@ -8,39 +8,63 @@ import os
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import json
+import argparse
+from export_wrappers import (
+    DEFAULT_TOP_K, EMBEDDING_POOLING, KV_CACHE_MODES, LOGITS_MODES, LogitsHead,
+    embedding_output_path, export_embedding_model, export_with_kv_cache, logits_dynamic_axes, logits_output_names,
+    parse_top_k,
+)
+from quantize_onnx import parse_modes, run_quantization_stage
+from optimize_onnx import run_optimization_stage
+from parity_check import run_parity_check
+from generation_loop import run_generation_loop_stage
+from stage_trace import add_trace_arguments, stage, trace_run
 
-def convert_gemma_to_onnx():
+GEMMA_MODEL_PATH = "../ai_models/gemma_3_270m_it"
+# A subdirectory: Flutter bundles the model directory itself, not its subdirectories
+GEMMA_OUTPUT_DIR = os.path.join(GEMMA_MODEL_PATH, "onnx")
+
+def convert_gemma_to_onnx(kv_cache="none", logits_mode="full", top_k=DEFAULT_TOP_K, optimize=False, quantize=(),
+                          model_path=GEMMA_MODEL_PATH, output_dir=None, parity=False, generation_loop=False,
+                          embedding=False, embedding_pooling="mean"):
     """Convert Gemma 3 270M-IT from Safetensors to ONNX format"""
     
     print("🚀 Starting Gemma 3 270M-IT to ONNX conversion...")
     
-    # Model path (Gemma model directory)
-    model_path = "../ai_models/gemma_3_270m_it"
+    output_dir = output_dir or os.path.join(model_path, "onnx")
+    os.makedirs(output_dir, exist_ok=True)
     
     try:
         print("📖 Loading Gemma 3 270M-IT model and tokenizer...")
         
         # Load the model and tokenizer from local files
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.float32,  # Use float32 for better compatibility
-            device_map="auto" if torch.cuda.is_available() else "cpu",
-            use_cache=False  # Disable cache for ONNX export
-        )
+        with stage("model load"):
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                torch_dtype=torch.float32,  # Use float32 for better compatibility
+                device_map="auto" if torch.cuda.is_available() else "cpu",
+                use_cache=kv_cache != "none"  # Only keep the cache for KV-cache export
+            )
         
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        with stage("tokenizer load"):
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
         
         # Create a simple wrapper for ONNX export
         class SimpleGemmaWrapper(torch.nn.Module):
-            def __init__(self, model):
+            def __init__(self, model, logits_mode="full", top_k=DEFAULT_TOP_K):
                 super().__init__()
                 self.model = model
+                self.head = LogitsHead(model, logits_mode, top_k)
                 
             def forward(self, input_ids):
-                # Use a simpler approach - just get the logits
                 with torch.no_grad():
-                    outputs = self.model(input_ids=input_ids, use_cache=False)
-                    return outputs.logits
+                    if self.head.mode == "full":
+                        # Use a simpler approach - just get the logits
+                        outputs = self.model(input_ids=input_ids, use_cache=False)
+                        return outputs.logits
+                    # Only project the last position through the LM head
+                    outputs = self.model.model(input_ids=input_ids, use_cache=False)
+                    return self.head(outputs.last_hidden_state)
         
         print(f"✅ Model loaded successfully!")
         print(f"   - Model type: {type(model).__name__}")
@@ -49,7 +73,8 @@ def convert_gemma_to_onnx():
         
         # Create a simplified wrapper model for ONNX export
         print("🔧 Creating simplified wrapper for ONNX export...")
-        wrapper_model = SimpleGemmaWrapper(model)
+        print(f"   - Logits mode: {logits_mode}" + (f" (k={top_k})" if logits_mode == "topk" else ""))
+        wrapper_model = SimpleGemmaWrapper(model, logits_mode, top_k)
         wrapper_model.eval()
         
         # Create dummy input for ONNX export
@@ -63,39 +88,66 @@ def convert_gemma_to_onnx():
         dummy_input = torch.randint(0, vocab_size, (1, 128))
         print(f"   - Input shape: {dummy_input.shape}")
         
-        # Convert to ONNX
-        print("🔄 Converting to ONNX format...")
-        
-        output_path = "model.onnx"
-        
-        # Use newer PyTorch export method with compatible opset
-        torch.onnx.export(
-            wrapper_model,
-            dummy_input,
-            output_path,
-            input_names=['input_ids'],
-            output_names=['logits'],
-            dynamic_axes={
-                'input_ids': {0: 'batch_size', 1: 'sequence_length'},
-                'logits': {0: 'batch_size', 1: 'sequence_length'}
-            },
-            opset_version=11,  # Use compatible opset for ONNX Runtime 1.4.1
-            do_constant_folding=True,
-            export_params=True,
-            verbose=False,
-            dynamo=True  # Use new export method
-        )
+        output_path = os.path.join(output_dir, "model.onnx")
+        
+        with stage("export", kv_cache=kv_cache, logits_mode=logits_mode):
+            if kv_cache != "none":
+                # Export with past_key_values.* inputs and present.* outputs
+                print(f"🔄 Converting to ONNX format with KV cache ({kv_cache})...")
+                output_paths = export_with_kv_cache(
+                    model, model.config, vocab_size, output_path, mode=kv_cache, dynamo=True,
+                    logits_mode=logits_mode, top_k=top_k
+                )
+            else:
+                # Convert to ONNX
+                print("🔄 Converting to ONNX format...")
+            
+                # Use newer PyTorch export method with compatible opset
+                torch.onnx.export(
+                    wrapper_model,
+                    dummy_input,
+                    output_path,
+                    input_names=['input_ids'],
+                    output_names=logits_output_names(logits_mode),
+                    dynamic_axes={
+                        'input_ids': {0: 'batch_size', 1: 'sequence_length'},
+                        **logits_dynamic_axes(logits_mode)
+                    },
+                    opset_version=11,  # Use compatible opset for ONNX Runtime 1.4.1
+                    do_constant_folding=True,
+                    export_params=True,
+                    verbose=False,
+                    dynamo=True  # Use new export method
+                )
+                output_paths = [output_path]
         
         print(f"✅ ONNX conversion completed!")
-        print(f"   - Output file: {output_path}")
         
-        # Verify the ONNX file was created
-        if os.path.exists(output_path):
-            file_size = os.path.getsize(output_path) / (1024 * 1024)  # Convert to MB
-            print(f"   - File size: {file_size:.1f} MB")
-        else:
-            print("❌ Error: ONNX file was not created!")
-            return False
+        # Verify the ONNX files were created
+        for path in output_paths:
+            print(f"   - Output file: {path}")
+            if os.path.exists(path):
+                file_size = os.path.getsize(path) / (1024 * 1024)  # Convert to MB
+                print(f"   - File size: {file_size:.1f} MB")
+            else:
+                print("❌ Error: ONNX file was not created!")
+                return False
+        
+        # Offline optimization stage: the fused, ORT-optimized graph replaces each export
+        if optimize:
+            for path in output_paths:
+                if not run_optimization_stage(path, replace=True,
+                                              config_path=os.path.join(model_path, "config.json")):
+                    return False
+        
+        # Quantization stage: int8 / int4 / fp16 variants next to each exported graph
+        if quantize:
+            print(f"🔧 Quantizing exported graphs: {', '.join(quantize)}")
+            for path in output_paths:
+                # The report needs logits and a multi-token graph (not the split decode graph)
+                report = path == output_paths[0]
+                if not run_quantization_stage(path, quantize, report=report, vocab_size=vocab_size):
+                    return False
         
         # Test the ONNX model with a simple prompt
         print("🧪 Testing ONNX model...")
@@ -105,15 +157,43 @@ def convert_gemma_to_onnx():
         print(f"   - Test prompt: '{test_prompt}'")
         
         # Tokenize the input
-        inputs = tokenizer(test_prompt, return_tensors="pt")
+        with stage("tokenize prompt"):
+            inputs = tokenizer(test_prompt, return_tensors="pt")
         input_ids = inputs["input_ids"]
         
         print(f"   - Input tokens: {input_ids.shape}")
         print(f"   - Token count: {input_ids.shape[1]}")
         
+        # Generation loop stage: <stem>_generate.onnx samples inside one Loop over the decoder
+        if generation_loop:
+            if kv_cache == "split":
+                print("❌ The generation loop wraps a merged KV-cache graph; use --kv-cache merged")
+                return False
+            if not run_generation_loop_stage(output_paths[0]):
+                return False
+        
+        # Embedding stage: pooled hidden states for repository retrieval (repo_index.py)
+        if embedding:
+            embedding_path = embedding_output_path(output_paths[0])
+            with stage("embedding export", pooling=embedding_pooling):
+                export_embedding_model(model, vocab_size, embedding_path, embedding_pooling, dynamo=True)
+            print(f"✅ Embedding graph: {embedding_path} ({model.config.hidden_size} dimensions)")
+        
+        # Parity stage: the exported graph and its variants against the PyTorch model
+        if parity:
+            # The workers load their own copy of the checkpoint
+            del wrapper_model, model
+            import gc
+            gc.collect()
+            precisions = ["fp32", *quantize]
+            # One worker: each holds an fp32 copy of the checkpoint next to this process
+            if not run_parity_check(model_path, output_paths[0], precisions=precisions, workers=1):
+                return False
+        
         print("✅ Conversion and testing completed successfully!")
         print("\n📁 Files ready for CrypticDash:")
-        print("   - model.onnx (ONNX model)")
+        for path in output_paths:
+            print(f"   - {path} (ONNX model)")
         print("   - tokenizer.json (tokenizer)")
         print("   - config.json (model config)")
         
@@ -125,7 +205,7 @@ def convert_gemma_to_onnx():
         traceback.print_exc()
         return False
 
-def create_gemma_readme():
+def create_gemma_readme(output_dir=GEMMA_OUTPUT_DIR):
     """Create a README file for the Gemma 3 270M model"""
     
     readme_content = """# Gemma 3 270M-IT Model for CrypticDash
@@ -197,31 +277,62 @@ The SimpleAIService will use this model for:
     readme_content = readme_content.replace("{date}", current_date)
     
     # Write README file
-    with open("README.md", "w", encoding="utf-8") as f:
+    with stage("file write"), open(os.path.join(output_dir, "README.md"), "w", encoding="utf-8") as f:
         f.write(readme_content)
     
     print("📝 Created README.md for Gemma 3 270M")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Gemma 3 270M-IT to ONNX")
+    parser.add_argument("--kv-cache", choices=KV_CACHE_MODES, default="none",
+                        help="Export past_key_values/present I/O as one merged graph or prefill+decode graphs")
+    parser.add_argument("--logits", choices=LOGITS_MODES, default="full",
+                        help="Emit logits for every position, only the last position, or last-position top-k")
+    parser.add_argument("--top-k", type=parse_top_k, default=DEFAULT_TOP_K,
+                        help="Number of (ids, scores) returned by --logits topk")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Fuse attention/norm/GELU/rotary ops and save the offline-optimized graph")
+    parser.add_argument("--quantize", type=parse_modes, default=[],
+                        help="Comma separated quantization modes to run after export (int8,int4,fp16)")
+    parser.add_argument("--parity", action="store_true",
+                        help="Compare the exported graph and its quantized variants against the PyTorch model")
+    parser.add_argument("--generation-loop", action="store_true",
+                        help="Also write <stem>_generate.onnx: the decoder in an ONNX Loop with greedy/top-k/top-p sampling")
+    parser.add_argument("--embedding", action="store_true",
+                        help="Also write embedding_model.onnx: pooled hidden states for repo_index.py")
+    parser.add_argument("--embedding-pooling", choices=EMBEDDING_POOLING, default="mean")
+    parser.add_argument("--model-path", default=GEMMA_MODEL_PATH, help="Gemma checkpoint directory")
+    parser.add_argument("--output-dir", default=None, help="Where model.onnx and README.md go (default: <model-path>/onnx)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("🤖 Gemma 3 270M-IT to ONNX Converter")
     print("=" * 60)
     
-    # Check if the model files exist in the correct path
-    model_path = "../ai_models/gemma_3_270m_it"
-    if not os.path.exists(os.path.join(model_path, "model.safetensors")):
-        print("❌ Error: model.safetensors not found!")
-        print(f"   Expected path: {os.path.abspath(model_path)}/model.safetensors")
-        print("   Please check that the Gemma model files are downloaded correctly")
-        exit(1)
-    
-    # Convert the model
-    success = convert_gemma_to_onnx()
+    with trace_run("convert_to_onnx", args.trace):
+        # Check if the model files exist in the correct path
+        model_path = args.model_path
+        with stage("directory scan"):
+            checkpoint_found = os.path.exists(os.path.join(model_path, "model.safetensors"))
+        if not checkpoint_found:
+            print("❌ Error: model.safetensors not found!")
+            print(f"   Expected path: {os.path.abspath(model_path)}/model.safetensors")
+            print("   Please check that the Gemma model files are downloaded correctly")
+            exit(1)
+        
+        # Convert the model
+        success = convert_gemma_to_onnx(kv_cache=args.kv_cache, logits_mode=args.logits, top_k=args.top_k, optimize=args.optimize, quantize=args.quantize,
+                                        model_path=model_path, output_dir=args.output_dir, parity=args.parity,
+                                        generation_loop=args.generation_loop, embedding=args.embedding,
+                                        embedding_pooling=args.embedding_pooling)
+        
+        if success:
+            # Create README
+            create_gemma_readme(args.output_dir or os.path.join(model_path, "onnx"))
     
     if success:
-        # Create README
-        create_gemma_readme()
         print("\n🎉 All done! Your Gemma 3 270M model is ready for CrypticDash!")
     else:
         print("\n❌ Conversion failed. Please check the error messages above.")
-        exit(1)
+        exit(1)
\ No newline at end of file
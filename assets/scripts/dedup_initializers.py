@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Tied-weight and duplicate-initializer deduplication for exported models
+Finds initializers that are byte-identical or transposes of each other (a
+tied embedding exported again as the LM head MatMul weight), points every
+reader at one shared tensor, drops unused initializers and reports sizes by
+tensor and by decoder layer
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import onnx
+from onnx import TensorProto, helper
+from onnx.external_data_helper import uses_external_data
+
+from ort_runtime import EXTERNAL_DATA_THRESHOLD, model_size_bytes, tensor_array, tensor_bytes
+from weight_layout import DEFAULT_REPEATS, MIN_EXTERNAL_BYTES, _iter_nodes, compare_cold_start, tensor_groups
+from stage_trace import add_trace_arguments, stage, trace_run
+
+DEDUP_SUFFIX = "_dedup.onnx"
+DEFAULT_TOP = 20
+# Below this a shared tensor is not worth an extra node or a renamed reader
+MIN_DEDUP_BYTES = 1024
+# Readers that take a transposed weight as an attribute instead of a Transpose node
+TRANSPOSE_DTYPES = (TensorProto.FLOAT,)
+
+
+def dedup_path(model_path):
+    return os.path.splitext(model_path)[0] + DEDUP_SUFFIX
+
+
+def _canonical_order(name):
+    """Prefer module names (model.embed_tokens.weight) over folded ones (onnx::MatMul_123)"""
+    return (name.startswith("onnx::") or name.startswith("/"), name)
+
+
+def find_duplicates(graph, data):
+    """
+    {duplicate name: (canonical name, transposed)} over the main graph's
+    initializers. Initializers that are also graph inputs can be overridden
+    at run time, so they are never merged.
+    """
+    graph_inputs = {value.name for value in graph.input}
+    tensors = {tensor.name: tensor for tensor in graph.initializer
+               if tensor.name not in graph_inputs and len(data[tensor.name]) >= MIN_DEDUP_BYTES}
+
+    by_key = {}
+    for name in sorted(tensors, key=_canonical_order):
+        tensor = tensors[name]
+        key = (tensor.data_type, tuple(tensor.dims), hashlib.sha256(data[name]).hexdigest())
+        by_key.setdefault(key, []).append(name)
+
+    duplicates = {}
+    for names in by_key.values():
+        for name in names[1:]:
+            duplicates[name] = (names[0], False)
+
+    # Transposes only need checking between 2-D tensors whose shapes mirror each other
+    matrices = {}
+    for key, names in by_key.items():
+        data_type, dims, _ = key
+        if len(dims) == 2:
+            matrices.setdefault((data_type, dims), []).append(names[0])
+    for (data_type, dims), names in sorted(matrices.items()):
+        if dims[0] == dims[1] or (data_type, dims[::-1]) not in matrices:
+            continue
+        for name in names:
+            if name in duplicates:
+                continue
+            transposed = np.ascontiguousarray(tensor_array(tensors[name], data[name]).T).tobytes()
+            match = by_key.get((data_type, dims[::-1], hashlib.sha256(transposed).hexdigest()))
+            if match and match[0] not in duplicates and _canonical_order(match[0]) < _canonical_order(name):
+                duplicates[name] = (match[0], True)
+
+    # A group's canonical tensor may itself be the transpose of another group's
+    for name, (canonical, transposed) in list(duplicates.items()):
+        if canonical in duplicates:
+            root, root_transposed = duplicates[canonical]
+            duplicates[name] = (root, transposed != root_transposed)
+    return duplicates
+
+
+def _ms_domain_version(model):
+    return next((entry.version for entry in model.opset_import if entry.domain == "com.microsoft"), None)
+
+
+def rewrite_readers(model, duplicates, dtypes):
+    """
+    Point readers of each duplicate at its canonical tensor. A transposed
+    duplicate read as a float MatMul weight becomes FusedMatMul(transB=1), a
+    Gemm weight flips transB, and any other reader gets one shared Transpose.
+    Returns {duplicate name: how its readers were rewritten}.
+    """
+    graph = model.graph
+    transposes = {}
+    actions = {name: set() for name in duplicates}
+    for node in list(_iter_nodes(graph)):
+        for index, name in enumerate(node.input):
+            if name not in duplicates:
+                continue
+            canonical, transposed = duplicates[name]
+            if not transposed:
+                node.input[index] = canonical
+                actions[name].add("shared")
+            elif node.op_type == "MatMul" and index == 1 and dtypes[canonical] in TRANSPOSE_DTYPES:
+                node.op_type = "FusedMatMul"
+                node.domain = "com.microsoft"
+                node.attribute.extend([helper.make_attribute("transB", 1), helper.make_attribute("alpha", 1.0)])
+                node.input[index] = canonical
+                actions[name].add("FusedMatMul(transB)")
+            elif node.op_type == "Gemm" and index == 1:
+                attributes = {attribute.name: attribute for attribute in node.attribute}
+                if "transB" in attributes:
+                    attributes["transB"].i = 1 - attributes["transB"].i
+                else:
+                    node.attribute.append(helper.make_attribute("transB", 1))
+                node.input[index] = canonical
+                actions[name].add("Gemm(transB)")
+            else:
+                if canonical not in transposes:
+                    transposes[canonical] = f"{canonical}_transposed"
+                node.input[index] = transposes[canonical]
+                actions[name].add("Transpose")
+
+    # Transposes of initializers go first, ahead of every reader
+    for position, (canonical, output) in enumerate(transposes.items()):
+        graph.node.insert(position, helper.make_node("Transpose", [canonical], [output], perm=[1, 0],
+                                                     name=f"{canonical}/DedupTranspose"))
+    if any("FusedMatMul(transB)" in action for action in actions.values()) and _ms_domain_version(model) is None:
+        model.opset_import.append(helper.make_opsetid("com.microsoft", 1))
+    for value in graph.output:
+        if value.name in duplicates and not duplicates[value.name][1]:
+            value.name = duplicates[value.name][0]
+    return {name: sorted(action) for name, action in actions.items()}
+
+
+def _used_names(graph):
+    used = {name for node in _iter_nodes(graph) for name in node.input}
+    used.update(value.name for value in graph.output)
+    return used
+
+
+def save_with_data(model, data, output_path, external):
+    """
+    Save a model whose initializer bytes are held in data ({name: bytes}),
+    as <output>.data external data when external is set. The output may be
+    the file the bytes were read from.
+    """
+    for tensor in model.graph.initializer:
+        # Bytes go back inline; onnx.save_model moves them out again when external
+        del tensor.external_data[:]
+        tensor.data_location = TensorProto.DEFAULT
+        tensor.raw_data = data[tensor.name]
+        for field in ("float_data", "int32_data", "int64_data", "double_data", "uint64_data", "string_data"):
+            tensor.ClearField(field)
+    for path in (output_path, output_path + ".data"):
+        if os.path.exists(path):
+            os.remove(path)
+    onnx.save_model(model, output_path, save_as_external_data=external,
+                    location=os.path.basename(output_path) + ".data", size_threshold=MIN_EXTERNAL_BYTES)
+
+
+def deduplicate_model(model_path, output_path=None):
+    """
+    Write a copy of the model with duplicate initializers merged and unused
+    ones dropped. The copy keeps external data when the original used it.
+    Returns (output path, report dict).
+    """
+    output_path = output_path or dedup_path(model_path)
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    model = onnx.load(model_path, load_external_data=False)
+    graph = model.graph
+    external = any(uses_external_data(tensor) for tensor in graph.initializer)
+    groups = tensor_groups(graph)
+
+    print(f"📖 Reading {len(graph.initializer)} initializers from {os.path.basename(model_path)}...")
+    data = {tensor.name: tensor_bytes(tensor, base_dir) for tensor in graph.initializer}
+    dtypes = {tensor.name: tensor.data_type for tensor in graph.initializer}
+    before = {tensor.name: len(data[tensor.name]) for tensor in graph.initializer}
+
+    duplicates = find_duplicates(graph, data)
+    actions = rewrite_readers(model, duplicates, dtypes)
+    used = _used_names(graph)
+    kept = [tensor for tensor in graph.initializer if tensor.name in used]
+    dropped = sorted(set(before) - {tensor.name for tensor in kept})
+    del graph.initializer[:]
+    graph.initializer.extend(kept)
+    save_with_data(model, data, output_path, external or sum(before.values()) >= EXTERNAL_DATA_THRESHOLD)
+
+    readers = {}
+    for node in _iter_nodes(graph):
+        for name in node.input:
+            readers[name] = readers.get(name, 0) + 1
+    report = {
+        "model": os.path.basename(model_path),
+        "output": os.path.basename(output_path),
+        "initializers_before": len(before),
+        "initializers_after": len(kept),
+        "bytes_before": sum(before.values()),
+        "bytes_after": sum(before[tensor.name] for tensor in kept),
+        "merged": [
+            {"name": name, "into": canonical, "transposed": transposed, "bytes": before[name],
+             "readers": actions.get(name, [])}
+            for name, (canonical, transposed) in sorted(duplicates.items(), key=lambda item: -before[item[0]])
+        ],
+        "unused_dropped": [{"name": name, "bytes": before[name]} for name in dropped if name not in duplicates],
+        "tensors": sorted(
+            ({"name": tensor.name, "bytes": before[tensor.name], "group": groups[tensor.name],
+              "dtype": helper.tensor_dtype_to_np_dtype(tensor.data_type).name, "shape": list(tensor.dims),
+              "readers": readers.get(tensor.name, 0),
+              "shared_by": sorted(name for name, (canonical, _) in duplicates.items() if canonical == tensor.name)}
+             for tensor in kept),
+            key=lambda entry: -entry["bytes"],
+        ),
+        "layers": {},
+    }
+    for name, size in before.items():
+        entry = report["layers"].setdefault(groups[name], {"bytes_before": 0, "bytes_after": 0, "tensors_after": 0})
+        entry["bytes_before"] += size
+        if name in used:
+            entry["bytes_after"] += size
+            entry["tensors_after"] += 1
+    return output_path, report
+
+
+def check_outputs(model_path, output_path, prompt_ids):
+    """Largest absolute output difference; FusedMatMul may round differently from MatMul"""
+    from ort_runtime import DecoderSession
+
+    ids = np.array([prompt_ids], dtype=np.int64)
+    expected, _ = DecoderSession.load(model_path).run(ids)
+    actual, _ = DecoderSession.load(output_path).run(ids)
+    return max(
+        float(np.max(np.abs(expected[name].astype(np.float64) - actual[name].astype(np.float64))))
+        if expected[name].size else 0.0
+        for name in expected
+    )
+
+
+def write_dedup_report(report, report_path, top=DEFAULT_TOP):
+    """Markdown tables (merges, largest tensors, per-layer sizes) plus a JSON copy"""
+    mb = 1024 ** 2
+    saved = report["bytes_before"] - report["bytes_after"]
+    lines = [
+        f"# Initializer deduplication: {report['model']}",
+        "",
+        f"- Initializers: {report['initializers_before']} -> {report['initializers_after']}",
+        f"- Weights: {report['bytes_before'] / mb:.1f} MB -> {report['bytes_after'] / mb:.1f} MB "
+        f"({saved / mb:.1f} MB, {saved / max(1, report['bytes_before']):.1%} saved)",
+        f"- On disk: {report['disk_bytes_before'] / mb:.1f} MB -> {report['disk_bytes_after'] / mb:.1f} MB",
+    ]
+    if report.get("max_abs_diff") is not None:
+        lines.append(f"- Largest output difference: {report['max_abs_diff']:.3g}")
+    lines += ["", "## Merged and dropped initializers", ""]
+    if report["merged"] or report["unused_dropped"]:
+        lines += ["| Initializer | Size (MB) | Now reads | Rewrite |", "|---|---|---|---|"]
+        for entry in report["merged"]:
+            rewrite = ", ".join(entry["readers"]) or "-"
+            kind = "transpose of " if entry["transposed"] else ""
+            lines.append(f"| {entry['name']} | {entry['bytes'] / mb:.2f} | {kind}{entry['into']} | {rewrite} |")
+        for entry in report["unused_dropped"]:
+            lines.append(f"| {entry['name']} | {entry['bytes'] / mb:.2f} | - | unused, dropped |")
+    else:
+        lines.append("No duplicate or unused initializers found.")
+
+    lines += ["", f"## Largest tensors (top {top})", "",
+              "| Tensor | Group | dtype | Shape | Size (MB) | Share | Readers | Shared by |",
+              "|---|---|---|---|---|---|---|---|"]
+    for entry in report["tensors"][:top]:
+        lines.append(
+            f"| {entry['name']} | {entry['group']} | {entry['dtype']} | {'x'.join(map(str, entry['shape'])) or '-'} | "
+            f"{entry['bytes'] / mb:.2f} | {entry['bytes'] / max(1, report['bytes_after']):.1%} | {entry['readers']} | "
+            f"{', '.join(entry['shared_by']) or '-'} |"
+        )
+
+    lines += ["", "## By layer", "", "| Group | Before (MB) | After (MB) | Tensors |", "|---|---|---|---|"]
+    for group, entry in sorted(report["layers"].items(), key=lambda item: -item[1]["bytes_after"]):
+        lines.append(f"| {group} | {entry['bytes_before'] / mb:.2f} | {entry['bytes_after'] / mb:.2f} | "
+                     f"{entry['tensors_after']} |")
+
+    if report.get("cold_start"):
+        lines += ["", "## Load", "", "| Graph | Disk (MB) | Load (ms) | First token (ms) | RSS after load (MB) |",
+                  "|---|---|---|---|---|"]
+        for label, result in report["cold_start"].items():
+            lines.append(f"| {label} | {result['disk_mb']:.1f} | {result['load_s'] * 1000:.1f} | "
+                         f"{result['first_token_s'] * 1000:.1f} | {result['session_rss_mb']:.1f} |")
+    lines.append("")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report_path
+
+
+def run_dedup_stage(model_path, output_path=None, replace=False, prompt_ids=None, measure=True,
+                    repeats=DEFAULT_REPEATS, top=DEFAULT_TOP, report_path=None):
+    """
+    Deduplicate a model and write <stem>_dedup_report.md next to it. With
+    replace=True the result takes the original file name (and its .data
+    name), so later stages and the app pick it up unchanged.
+    """
+    report_path = report_path or os.path.splitext(model_path)[0] + "_dedup_report.md"
+    prompt_ids = prompt_ids or list(range(1, 17))
+    try:
+        disk_before = model_size_bytes(model_path)
+        with stage("dedup", model=os.path.basename(model_path)):
+            output, report = deduplicate_model(model_path, output_path or dedup_path(model_path))
+        report["disk_bytes_before"] = disk_before
+        report["disk_bytes_after"] = model_size_bytes(output)
+        print(f"✅ {len(report['merged'])} duplicate(s) merged, {len(report['unused_dropped'])} unused dropped: "
+              f"{report['bytes_before'] / 1024 ** 2:.1f} MB -> {report['bytes_after'] / 1024 ** 2:.1f} MB of weights")
+
+        with stage("dedup check"):
+            report["max_abs_diff"] = check_outputs(model_path, output, prompt_ids)
+        print(f"   - Largest output difference: {report['max_abs_diff']:.3g}")
+        if measure:
+            print("🧪 Cold start (fresh process per run)...")
+            with stage("cold start", repeats=repeats):
+                report["cold_start"] = compare_cold_start(
+                    {"original": (model_path, {}), "deduplicated": (output, {})}, prompt_ids, repeats)
+
+        if replace:
+            from optimize_onnx import move_model
+
+            # The data file is renamed after the original graph, so its .data name is kept too
+            move_model(output, model_path)
+            output = model_path
+        write_dedup_report(report, report_path, top)
+        print(f"📝 Wrote {report_path}")
+        return output
+    except Exception as e:
+        print(f"❌ Error during initializer deduplication: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge duplicate and transposed-duplicate initializers of an ONNX model")
+    parser.add_argument("model", help="Exported model.onnx or model_q4.onnx")
+    parser.add_argument("--output", default=None, help=f"Defaults to <stem>{DEDUP_SUFFIX}")
+    parser.add_argument("--replace", action="store_true", help="Overwrite the model (and its external data) in place")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="Tensors listed in the size report")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="Cold-start runs per graph")
+    parser.add_argument("--no-measure", action="store_true", help="Skip the cold-start comparison")
+    parser.add_argument("--report", default=None, help="Report path (default: <stem>_dedup_report.md)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("dedup_initializers", args.trace):
+        output = run_dedup_stage(args.model, args.output, args.replace, measure=not args.no_measure,
+                                 repeats=args.repeats, top=args.top, report_path=args.report)
+    if output:
+        print("\n🎉 Deduplication completed successfully!")
+    else:
+        print("\n💥 Deduplication failed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Shared ONNX export wrappers for the Gemma and Phi-2 converters
+Threads the KV cache through flat past_key_values.* / present.* tensors
+"""
+
+import argparse
+import os
+import torch
+
+KV_CACHE_MODES = ("none", "merged", "split")
+
+# full: [B, S, vocab] logits, last: [B, vocab] logits, topk: [B, k] scores + ids
+LOGITS_MODES = ("full", "last", "topk")
+DEFAULT_TOP_K = 50
+
+# KV-cache graphs need Trilu/Where on bool masks, which opset 9/11 lack
+KV_CACHE_OPSET = 17
+
+# mean: average over unmasked positions, last: the last unmasked position
+EMBEDDING_POOLING = ("mean", "last")
+EMBEDDING_GRAPH = "embedding_model.onnx"
+
+
+def past_input_names(num_layers):
+    """Names of the flat past_key_values.* graph inputs, key before value"""
+    names = []
+    for layer in range(num_layers):
+        names.append(f"past_key_values.{layer}.key")
+        names.append(f"past_key_values.{layer}.value")
+    return names
+
+
+def present_output_names(num_layers):
+    """Names of the flat present.* graph outputs, key before value"""
+    names = []
+    for layer in range(num_layers):
+        names.append(f"present.{layer}.key")
+        names.append(f"present.{layer}.value")
+    return names
+
+
+def logits_output_names(mode):
+    """Names of the graph outputs produced by a logits mode"""
+    if mode == "topk":
+        return ["topk_logits", "topk_ids"]
+    return ["logits"]
+
+
+def logits_dynamic_axes(mode, dynamic_sequence=True):
+    """Dynamic axes for the outputs produced by a logits mode"""
+    if mode == "full":
+        return {"logits": {0: "batch_size", **({1: "sequence_length"} if dynamic_sequence else {})}}
+    return {name: {0: "batch_size"} for name in logits_output_names(mode)}
+
+
+def parse_top_k(value):
+    """argparse type for --top-k: a positive integer"""
+    try:
+        top_k = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"top-k must be an integer, got {value!r}")
+    if top_k < 1:
+        raise argparse.ArgumentTypeError(f"top-k must be at least 1, got {top_k}")
+    return top_k
+
+
+class LogitsHead(torch.nn.Module):
+    """
+    LM head that slices to the last position before projecting, so the
+    [B, S, vocab] tensor is never materialized outside "full" mode.
+    """
+
+    def __init__(self, model, mode="full", top_k=DEFAULT_TOP_K):
+        super().__init__()
+        if mode not in LOGITS_MODES:
+            raise ValueError(f"Unsupported logits mode: {mode}")
+        self.lm_head = model.get_output_embeddings()
+        self.softcap = getattr(model.config, "final_logit_softcapping", None)
+        self.mode = mode
+        self.top_k = top_k
+        if mode == "topk":
+            vocab_size = self.lm_head.weight.shape[0]
+            if not 1 <= top_k <= vocab_size:
+                raise ValueError(f"top_k must be between 1 and the vocabulary size ({vocab_size}), got {top_k}")
+
+    def forward(self, hidden_states):
+        if self.mode != "full":
+            hidden_states = hidden_states[:, -1, :]
+        logits = self.lm_head(hidden_states)
+        if self.softcap:
+            logits = torch.tanh(logits / self.softcap) * self.softcap
+        if self.mode == "topk":
+            return torch.topk(logits, self.top_k, dim=-1)
+        return logits
+
+
+def kv_cache_shape(config):
+    """Return (num_layers, num_kv_heads, head_dim) for a HF decoder config"""
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    return config.num_hidden_layers, num_kv_heads, head_dim
+
+
+def _build_cache(flat_past, num_layers):
+    """Rebuild a transformers DynamicCache from flat (key, value, key, value, ...) tensors"""
+    from transformers import DynamicCache
+
+    cache = DynamicCache()
+    for layer in range(num_layers):
+        cache.update(flat_past[2 * layer], flat_past[2 * layer + 1], layer)
+    return cache
+
+
+def _flatten_cache(cache):
+    """Flatten a transformers cache object (any version) into [key0, value0, key1, ...]"""
+    if hasattr(cache, "layers"):
+        pairs = [(layer.keys, layer.values) for layer in cache.layers]
+    elif hasattr(cache, "key_cache"):
+        pairs = list(zip(cache.key_cache, cache.value_cache))
+    else:
+        pairs = list(cache)
+
+    flat = []
+    for key, value in pairs:
+        flat.extend((key, value))
+    return flat
+
+
+class DecoderWithPastWrapper(torch.nn.Module):
+    """Causal LM wrapper with explicit attention mask, position ids and KV cache I/O"""
+
+    def __init__(self, model, num_layers, logits_mode="full", top_k=DEFAULT_TOP_K):
+        super().__init__()
+        self.model = model
+        self.num_layers = num_layers
+        self.head = LogitsHead(model, logits_mode, top_k)
+
+    def forward(self, input_ids, attention_mask, position_ids, *past_key_values):
+        past = _build_cache(past_key_values, self.num_layers) if past_key_values else None
+        outputs = self.model.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        logits = self.head(outputs.last_hidden_state)
+        if not isinstance(logits, tuple):
+            logits = (logits,)
+        return (*logits, *_flatten_cache(outputs.past_key_values))
+
+
+def build_kv_dummy_inputs(config, vocab_size, batch_size=1, sequence_length=8,
+                          past_length=8, with_past=True, dtype=torch.float32):
+    """Create (input_ids, attention_mask, position_ids, *past) dummy inputs for export"""
+    num_layers, num_kv_heads, head_dim = kv_cache_shape(config)
+    if not with_past:
+        past_length = 0
+
+    input_ids = torch.randint(0, vocab_size, (batch_size, sequence_length))
+    attention_mask = torch.ones(batch_size, past_length + sequence_length, dtype=torch.int64)
+    position_ids = torch.arange(past_length, past_length + sequence_length).unsqueeze(0).expand(batch_size, -1)
+
+    past = []
+    if with_past:
+        for _ in range(num_layers * 2):
+            past.append(torch.randn(batch_size, num_kv_heads, past_length, head_dim, dtype=dtype))
+
+    return (input_ids, attention_mask, position_ids, *past)
+
+
+def kv_dynamic_axes(num_layers, with_past=True, dynamic_sequence=True, logits_mode="full"):
+    """Dynamic axes for a decoder graph with KV cache inputs/outputs"""
+    sequence_axis = {1: "sequence_length"} if dynamic_sequence else {}
+    axes = {
+        "input_ids": {0: "batch_size", **sequence_axis},
+        "attention_mask": {0: "batch_size", 1: "total_sequence_length"},
+        "position_ids": {0: "batch_size", **sequence_axis},
+        **logits_dynamic_axes(logits_mode, dynamic_sequence),
+    }
+    if with_past:
+        for name in past_input_names(num_layers):
+            axes[name] = {0: "batch_size", 2: "past_sequence_length"}
+    for name in present_output_names(num_layers):
+        axes[name] = {0: "batch_size", 2: "total_sequence_length"}
+    return axes
+
+
+def kv_cache_output_paths(output_path, mode):
+    """Return the graph files written for a KV cache mode"""
+    if mode == "merged":
+        return {"merged": output_path}
+    stem, ext = os.path.splitext(output_path)
+    return {"prefill": f"{stem}_prefill{ext}", "decode": f"{stem}_decode{ext}"}
+
+
+def export_with_kv_cache(model, config, vocab_size, output_path, mode="merged", dynamo=False,
+                         logits_mode="full", top_k=DEFAULT_TOP_K):
+    """
+    Export a decoder with KV cache inputs/outputs.
+
+    "merged" writes one graph with past inputs; prefill runs it with a
+    zero-length past. "split" writes a prefill graph (no past inputs) and
+    a single-token decode graph.
+    """
+    if mode not in KV_CACHE_MODES or mode == "none":
+        raise ValueError(f"Unsupported KV cache mode: {mode}")
+
+    num_layers = config.num_hidden_layers
+    dtype = next(model.parameters()).dtype
+    wrapper_model = DecoderWithPastWrapper(model, num_layers, logits_mode, top_k)
+    wrapper_model.eval()
+
+    # (with_past, sequence_length, dynamic_sequence) for each graph
+    graph_specs = {
+        "merged": (True, 8, True),
+        "prefill": (False, 8, True),
+        "decode": (True, 1, False),
+    }
+
+    written = []
+    for graph, path in kv_cache_output_paths(output_path, mode).items():
+        with_past, sequence_length, dynamic_sequence = graph_specs[graph]
+        dummy_inputs = build_kv_dummy_inputs(
+            config, vocab_size, sequence_length=sequence_length, with_past=with_past, dtype=dtype
+        )
+        input_names = ["input_ids", "attention_mask", "position_ids"]
+        if with_past:
+            input_names += past_input_names(num_layers)
+
+        print(f"🔄 Exporting {graph} graph with KV cache -> {path}")
+        with torch.no_grad():
+            torch.onnx.export(
+                wrapper_model,
+                dummy_inputs,
+                path,
+                input_names=input_names,
+                output_names=logits_output_names(logits_mode) + present_output_names(num_layers),
+                dynamic_axes=kv_dynamic_axes(num_layers, with_past, dynamic_sequence, logits_mode),
+                opset_version=KV_CACHE_OPSET,
+                do_constant_folding=True,
+                export_params=True,
+                verbose=False,
+                dynamo=dynamo,
+            )
+        written.append(path)
+
+    return written
+
+
+class EmbeddingWrapper(torch.nn.Module):
+    """
+    Pooled, L2-normalized last_hidden_state: input_ids and attention_mask
+    [B, S] -> float32 embeddings [B, hidden_size]. Position ids are left to
+    the model, so batches should be right-padded.
+    """
+
+    def __init__(self, model, pooling="mean"):
+        super().__init__()
+        if pooling not in EMBEDDING_POOLING:
+            raise ValueError(f"Unsupported embedding pooling: {pooling}")
+        self.model = model
+        self.pooling = pooling
+
+    def forward(self, input_ids, attention_mask):
+        outputs = self.model.model(input_ids=input_ids, attention_mask=attention_mask, use_cache=False)
+        hidden_states = outputs.last_hidden_state.float()
+        if self.pooling == "mean":
+            mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1.0)
+        else:
+            # Positions grow along the row, so the largest masked position is the last real token
+            positions = torch.arange(input_ids.shape[1], device=input_ids.device).unsqueeze(0) * attention_mask
+            # gather keeps hidden_size static in the graph, unlike advanced indexing
+            last = positions.argmax(dim=1).view(-1, 1, 1).expand(-1, 1, hidden_states.shape[-1])
+            pooled = hidden_states.gather(1, last).squeeze(1)
+        return torch.nn.functional.normalize(pooled, dim=-1)
+
+
+def embedding_output_path(output_path):
+    """The embedding graph written next to a decoder export"""
+    return os.path.join(os.path.dirname(output_path), EMBEDDING_GRAPH)
+
+
+def export_embedding_model(model, vocab_size, output_path, pooling="mean", dynamo=False):
+    """Export the pooled-embedding graph; the output dimension is fixed to hidden_size"""
+    wrapper_model = EmbeddingWrapper(model, pooling)
+    wrapper_model.eval()
+    input_ids = torch.randint(0, vocab_size, (2, 8))
+    attention_mask = torch.ones(2, 8, dtype=torch.int64)
+    attention_mask[1, 5:] = 0
+
+    print(f"🔄 Exporting {pooling}-pooled embedding graph -> {output_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper_model,
+            (input_ids, attention_mask),
+            output_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch_size", 1: "sequence_length"},
+                "attention_mask": {0: "batch_size", 1: "sequence_length"},
+                "embeddings": {0: "batch_size"},
+            },
+            opset_version=KV_CACHE_OPSET,
+            do_constant_folding=True,
+            export_params=True,
+            verbose=False,
+            dynamo=dynamo,
+        )
+
+    import onnx
+
+    # The exporter can lose the static width through the pooling ops; pin it
+    graph = onnx.load(output_path, load_external_data=False)
+    width = graph.graph.output[0].type.tensor_type.shape.dim[1]
+    width.Clear()
+    width.dim_value = model.config.hidden_size
+    onnx.save(graph, output_path)
+    return output_path
@@ -25,10 +25,10 @@ def fix_tokenizer_encoding():
             tokenizer_data = json.load(f)
         print("✅ Tokenizer data loaded successfully")
         
-        # Write back with proper encoding
+        # Write back with proper encoding (compact: indentation bloats the file and startup decode)
         print("💾 Writing tokenizer with proper encoding...")
         with open(tokenizer_path, 'w', encoding='utf-8') as f:
-            json.dump(tokenizer_data, f, ensure_ascii=False, indent=2)
+            json.dump(tokenizer_data, f, ensure_ascii=False, separators=(",", ":"))
         
         print("✅ Tokenizer encoding fixed!")
         print(f"   - Original backed up to: {backup_path}")
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+In-graph generation loop for exported CrypticDash models
+Wraps an exported decoder in an ONNX Loop that samples the next token inside
+the graph (greedy, top-k or top-p), so a whole generation is a single
+session.run instead of one host round trip and logits copy per token
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import onnx
+from onnx import TensorProto, helper
+
+from ort_runtime import PAST_PREFIX, PRESENT_PREFIX, DecoderSession, create_session
+from stage_trace import add_trace_arguments, stage, trace_run
+
+GENERATION_SUFFIX = "_generate.onnx"
+# Unsqueeze/Squeeze take axes as an input from opset 13 on
+MIN_GENERATION_OPSET = 13
+DEFAULT_MAX_NEW_TOKENS = 64
+
+# Inputs of the generation graph besides input_ids / attention_mask.
+# temperature 0 decodes greedily, top_k 0 and top_p 1 disable the filters,
+# eos_token_id -1 never stops early.
+SAMPLING_INPUTS = {
+    "max_new_tokens": TensorProto.INT64,
+    "temperature": TensorProto.FLOAT,
+    "top_k": TensorProto.INT64,
+    "top_p": TensorProto.FLOAT,
+    "eos_token_id": TensorProto.INT64,
+}
+
+SAMPLING_MODES = {
+    "greedy": {"temperature": 0.0, "top_k": 0, "top_p": 1.0},
+    "top_k": {"temperature": 1.0, "top_k": 40, "top_p": 1.0},
+    "top_p": {"temperature": 1.0, "top_k": 0, "top_p": 0.9},
+}
+
+
+def generation_graph_path(model_path):
+    """<stem>_generate.onnx next to the decoder, so external data paths stay valid"""
+    return os.path.splitext(model_path)[0] + GENERATION_SUFFIX
+
+
+def _untyped(name, elem_type):
+    """Value info without a shape, for loop-carried values that grow every iteration"""
+    return helper.make_tensor_value_info(name, elem_type, None)
+
+
+class _GraphBuilder:
+    """Collects nodes with unique names; decoder exports already use most plain names"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.nodes = []
+        self.initializers = []
+
+    def node(self, op_type, inputs, outputs, **attributes):
+        name = f"{self.prefix}/{op_type}_{len(self.nodes)}"
+        self.nodes.append(helper.make_node(op_type, inputs, outputs, name=name, **attributes))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def op(self, op_type, inputs, **attributes):
+        """Single-output node with a generated output name"""
+        return self.node(op_type, inputs, [f"{self.prefix}.{op_type.lower()}_{len(self.nodes)}"], **attributes)
+
+    def const(self, name, values, elem_type=TensorProto.INT64):
+        """1-D initializer from a list, scalar initializer otherwise"""
+        name = f"{self.prefix}.{name}"
+        dims = [len(values)] if isinstance(values, list) else []
+        self.initializers.append(helper.make_tensor(name, elem_type, dims, values if dims else [values]))
+        return name
+
+
+def _sampling_branches(scores, prefix, seed=None):
+    """
+    then/else graphs of the If that picks an index into `scores` ([B, K] float).
+    Sampling: scale by temperature, keep the top_k best (all when 0), drop the
+    tail past top_p of the probability mass and draw with Multinomial.
+    """
+    sample = _GraphBuilder(f"{prefix}/sample")
+    scaled = sample.op("Div", [scores, "temperature"])
+    width = sample.op("Slice", [sample.op("Shape", [scaled]), sample.const("one", [1]), sample.const("two", [2])])
+    top_k = sample.op("Reshape", ["top_k", sample.const("vector", [1])])
+    k = sample.op("Where", [sample.op("Greater", [top_k, sample.const("zero", [0])]),
+                            sample.op("Min", [top_k, width]), width])
+    values, indices = sample.node("TopK", [scaled, k], [f"{prefix}.top_values", f"{prefix}.top_indices"],
+                                  axis=-1, largest=1, sorted=1)
+    probabilities = sample.op("Softmax", [values], axis=-1)
+    cumulative = sample.op("CumSum", [probabilities, sample.const("axis", 1)])
+    # A candidate is dropped when the mass before it already reaches top_p, so the best one always stays
+    dropped = sample.op("Greater", [sample.op("Sub", [cumulative, probabilities]), "top_p"])
+    filtered = sample.op("Where", [dropped, sample.const("minus_inf", -np.inf, TensorProto.FLOAT), values])
+    drawn = sample.op("Multinomial", [filtered], dtype=TensorProto.INT64, sample_size=1,
+                      **({"seed": float(seed)} if seed is not None else {}))
+    picked = sample.op("GatherElements", [indices, drawn], axis=1)
+    sample.node("Squeeze", [picked, sample.const("squeeze_axes", [1])], [f"{prefix}.sampled"])
+
+    greedy = _GraphBuilder(f"{prefix}/greedy")
+    greedy.node("ArgMax", [scores], [f"{prefix}.greedy"], axis=-1, keepdims=0)
+
+    then_branch = helper.make_graph(sample.nodes, "sample", [], [_untyped(f"{prefix}.sampled", TensorProto.INT64)],
+                                    sample.initializers)
+    else_branch = helper.make_graph(greedy.nodes, "greedy", [], [_untyped(f"{prefix}.greedy", TensorProto.INT64)],
+                                    greedy.initializers)
+    return then_branch, else_branch
+
+
+def build_generation_graph(model_path, output_path=None, seed=None):
+    """
+    Wrap a decoder export (merged KV-cache graph, or a graph without a KV
+    cache) in a Loop. Inputs: input_ids / attention_mask [B, S] plus the
+    scalar SAMPLING_INPUTS; output: sequences [B, steps] int64 with
+    eos_token_id repeated after a row finished. Weights stay in the outer
+    graph, and external data keeps pointing at the decoder's data file.
+    Returns the written path.
+    """
+    output_path = output_path or generation_graph_path(model_path)
+    model = onnx.load(model_path, load_external_data=False)
+    graph = model.graph
+    opset = next((entry.version for entry in model.opset_import if entry.domain in ("", "ai.onnx")), 0)
+    if opset < MIN_GENERATION_OPSET:
+        raise ValueError(f"{os.path.basename(model_path)} uses opset {opset}; the generation loop needs "
+                         f"{MIN_GENERATION_OPSET}+ (re-export with --kv-cache merged)")
+
+    initializer_names = {tensor.name for tensor in graph.initializer}
+    inputs = {value.name: value for value in graph.input if value.name not in initializer_names}
+    outputs = {value.name for value in graph.output}
+    past_names = [name for name in inputs if name.startswith(PAST_PREFIX)]
+    kv_cache = bool(past_names)
+    if not kv_cache and any(name.startswith(PRESENT_PREFIX) for name in outputs):
+        raise ValueError("Split prefill graphs cannot loop; wrap the merged KV-cache export instead")
+    if "input_ids" not in inputs or not ({"logits", "topk_logits"} & outputs):
+        raise ValueError("The decoder needs an input_ids input and logits or topk_logits outputs")
+    topk = "topk_logits" in outputs
+    masked = "attention_mask" in inputs
+
+    # Body-scope names for the decoder inputs
+    renamed = {name: f"loop.{name}" for name in inputs}
+    positions_builder = _GraphBuilder("GenerationLoop/positions")
+    body = _GraphBuilder("GenerationLoop/step")
+    carried = ["loop.input_ids", "loop.attention_mask", *(renamed[name] for name in past_names), "loop.finished"]
+
+    if "position_ids" in inputs:
+        # Same positions the host computes from the mask (ort_runtime.DecoderSession.run)
+        pre = positions_builder
+        positions = pre.op("Sub", [pre.op("CumSum", ["loop.attention_mask", pre.const("axis", 1)]), pre.const("one", 1)])
+        padding = pre.op("Equal", ["loop.attention_mask", pre.const("zero", 0)])
+        positions = pre.op("Where", [padding, pre.const("pad_position", 1), positions])
+        length = pre.op("Slice", [pre.op("Shape", ["loop.input_ids"]), pre.const("one_start", [1]),
+                                  pre.const("two_end", [2])])
+        pre.node("Slice", [positions, pre.op("Neg", [length]), pre.const("end", [int(np.iinfo(np.int64).max)]),
+                           pre.const("slice_axes", [1])], [renamed["position_ids"]])
+
+    decoder_nodes = []
+    for node in graph.node:
+        node = onnx.NodeProto.FromString(node.SerializeToString())
+        for index, name in enumerate(node.input):
+            if name in renamed:
+                node.input[index] = renamed[name]
+        decoder_nodes.append(node)
+
+    # Last-position scores [B, K] as float32
+    scores = "topk_logits" if topk else "logits"
+    if not topk and len(next(value for value in graph.output if value.name == "logits")
+                        .type.tensor_type.shape.dim) == 3:
+        scores = body.op("Gather", [scores, body.const("last", -1)], axis=1)
+    scores = body.op("Cast", [scores], to=TensorProto.FLOAT)
+
+    then_branch, else_branch = _sampling_branches(scores, "GenerationLoop/select", seed)
+    choice = body.node("If", [body.op("Greater", ["temperature", body.const("no_temperature", 0.0,
+                                                                              TensorProto.FLOAT)])],
+                       ["loop.choice"], then_branch=then_branch, else_branch=else_branch)
+    unsqueeze_axes = body.const("unsqueeze_axes", [1])
+    token = choice
+    if topk:
+        token = body.op("Squeeze", [body.op("GatherElements", ["topk_ids", body.op("Unsqueeze", [choice, unsqueeze_axes])],
+                                            axis=1), unsqueeze_axes])
+
+    # Finished rows keep emitting eos; the loop stops once every row finished
+    token = body.node("Where", ["loop.finished", "eos_token_id", token], ["loop.token"])
+    stopped = body.op("And", [body.op("Equal", [token, "eos_token_id"]),
+                              body.op("GreaterOrEqual", ["eos_token_id", body.const("no_eos", 0)])])
+    finished = body.node("Or", ["loop.finished", stopped], ["loop.finished_out"])
+    remaining = body.op("ReduceMin", [body.op("Cast", [finished], to=TensorProto.INT64)], keepdims=0)
+    body.node("Equal", [remaining, body.const("not_all", 0)], ["loop.cond_out"])
+
+    column = body.op("Unsqueeze", [token, unsqueeze_axes])
+    if kv_cache:
+        next_ids = body.node("Identity", [column], ["loop.input_ids_out"])
+    else:
+        next_ids = body.node("Concat", ["loop.input_ids", column], ["loop.input_ids_out"], axis=1)
+    ones = body.op("ConstantOfShape", [body.op("Concat", [
+        body.op("Slice", [body.op("Shape", [column]), body.const("zero_start", [0]), body.const("one_end", [1])]),
+        body.const("one_column", [1])], axis=0)], value=helper.make_tensor("value", TensorProto.INT64, [1], [1]))
+    next_mask = body.node("Concat", ["loop.attention_mask", ones], ["loop.attention_mask_out"], axis=1)
+    next_past = [name.replace(PAST_PREFIX, PRESENT_PREFIX, 1) for name in past_names]
+
+    past_types = {name: inputs[name].type.tensor_type.elem_type for name in past_names}
+    body_inputs = [
+        helper.make_tensor_value_info("loop.iteration", TensorProto.INT64, []),
+        helper.make_tensor_value_info("loop.cond", TensorProto.BOOL, []),
+        _untyped("loop.input_ids", TensorProto.INT64),
+        _untyped("loop.attention_mask", TensorProto.INT64),
+        *(_untyped(renamed[name], past_types[name]) for name in past_names),
+        _untyped("loop.finished", TensorProto.BOOL),
+    ]
+    body_outputs = [
+        helper.make_tensor_value_info("loop.cond_out", TensorProto.BOOL, []),
+        _untyped(next_ids, TensorProto.INT64),
+        _untyped(next_mask, TensorProto.INT64),
+        *(_untyped(name, past_types[past]) for name, past in zip(next_past, past_names)),
+        _untyped(finished, TensorProto.BOOL),
+        _untyped(token, TensorProto.INT64),
+    ]
+    body_graph = helper.make_graph(
+        positions_builder.nodes + decoder_nodes + body.nodes, "generation_step", body_inputs, body_outputs,
+        positions_builder.initializers + body.initializers,
+        value_info=[value for value in graph.value_info if value.name not in inputs],
+    )
+
+    # Outer graph: empty KV cache, unfinished rows, the loop and [steps, B] -> [B, steps]
+    outer = _GraphBuilder("GenerationLoop")
+    batch = outer.op("Slice", [outer.op("Shape", ["input_ids"]), outer.const("zero_start", [0]),
+                               outer.const("one_end", [1])])
+    initial_past = []
+    for name in past_names:
+        _, num_heads, _, head_dim = (dim.dim_value for dim in inputs[name].type.tensor_type.shape.dim)
+        shape = outer.op("Concat", [batch, outer.const(f"{name}.heads", [num_heads]), outer.const(f"{name}.empty", [0]),
+                                    outer.const(f"{name}.head_dim", [head_dim])], axis=0)
+        initial_past.append(outer.op("ConstantOfShape", [shape], value=helper.make_tensor(
+            "value", past_types[name], [1], [0])))
+    unfinished = outer.op("ConstantOfShape", [batch], value=helper.make_tensor("value", TensorProto.BOOL, [1], [False]))
+    mask = "attention_mask" if masked else outer.op(
+        "ConstantOfShape", [outer.op("Shape", ["input_ids"])],
+        value=helper.make_tensor("value", TensorProto.INT64, [1], [1]))
+    final = [f"GenerationLoop.final_{index}" for index in range(len(carried))]
+    outer.node("Loop", ["max_new_tokens", outer.const("start", True, TensorProto.BOOL),
+                        "input_ids", mask, *initial_past, unfinished],
+               final + ["GenerationLoop.steps"], body=body_graph)
+    outer.node("Transpose", ["GenerationLoop.steps"], ["sequences"], perm=[1, 0])
+
+    graph_inputs = [
+        helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch_size", "sequence_length"]),
+        *([helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch_size", "sequence_length"])]
+          if masked else []),
+        *(helper.make_tensor_value_info(name, elem_type, []) for name, elem_type in SAMPLING_INPUTS.items()),
+    ]
+    generation = helper.make_graph(
+        outer.nodes, "generation_loop", graph_inputs,
+        [helper.make_tensor_value_info("sequences", TensorProto.INT64, ["batch_size", "new_tokens"])],
+        list(graph.initializer) + outer.initializers,
+    )
+    generation_model = helper.make_model(generation, opset_imports=model.opset_import, ir_version=model.ir_version)
+    generation_model.functions.extend(model.functions)
+    onnx.save_model(generation_model, output_path)
+    return output_path
+
+
+class GenerationLoopSession:
+    """Runs a generation graph built by build_generation_graph"""
+
+    def __init__(self, session, load_seconds=0.0):
+        self.session = session
+        self.load_seconds = load_seconds
+        self.input_names = {meta.name for meta in session.get_inputs()}
+
+    @classmethod
+    def load(cls, model_path, session_options=None):
+        session, load_seconds = create_session(model_path, session_options)
+        return cls(session, load_seconds)
+
+    def generate(self, input_ids, max_new_tokens, attention_mask=None, temperature=0.0, top_k=0, top_p=1.0,
+                 eos_token_id=None):
+        """[B, S] prompt -> generated [B, n] ids, in one session.run"""
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        feed = {
+            "input_ids": input_ids,
+            "max_new_tokens": np.array(max_new_tokens, dtype=np.int64),
+            "temperature": np.array(temperature, dtype=np.float32),
+            "top_k": np.array(top_k, dtype=np.int64),
+            "top_p": np.array(top_p, dtype=np.float32),
+            "eos_token_id": np.array(-1 if eos_token_id is None else eos_token_id, dtype=np.int64),
+        }
+        if "attention_mask" in self.input_names:
+            feed["attention_mask"] = (np.ones_like(input_ids) if attention_mask is None
+                                      else np.asarray(attention_mask, dtype=np.int64))
+        return self.session.run(["sequences"], feed)[0]
+
+
+def run_generation_loop_stage(model_path, output_path=None, seed=None):
+    """Build <stem>_generate.onnx next to an exported decoder; returns its path or None"""
+    try:
+        with stage("generation loop", model=os.path.basename(model_path)):
+            path = build_generation_graph(model_path, output_path, seed)
+        print(f"✅ Generation loop graph: {path}")
+        return path
+    except Exception as e:
+        print(f"❌ Error during generation loop build: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def benchmark_generation_loop(model_path, generation_path, prompts, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                              modes=tuple(SAMPLING_MODES), eos_token_id=None):
+    """
+    Time the host-driven greedy loop (one session.run per token) against the
+    in-graph loop for every sampling mode. Greedy outputs must match.
+    """
+    decoder = DecoderSession.load(model_path)
+    generation = GenerationLoopSession.load(generation_path)
+    results = {"model": model_path, "generation_graph": generation_path, "prompts": len(prompts),
+               "max_new_tokens": max_new_tokens, "modes": {}}
+
+    def timed(function):
+        outputs, seconds = [], 0.0
+        for prompt in prompts:
+            ids = np.array([prompt], dtype=np.int64)
+            start = time.perf_counter()
+            outputs.append(function(ids)[0].tolist())
+            seconds += time.perf_counter() - start
+        tokens = sum(len(output) for output in outputs)
+        return outputs, {"tokens": tokens, "seconds": seconds, "tokens_per_s": tokens / seconds}
+
+    # Warm up both sessions
+    decoder.generate_greedy(np.array([prompts[0]], dtype=np.int64), 2)
+    generation.generate(np.array([prompts[0]], dtype=np.int64), 2)
+
+    host, results["host_greedy"] = timed(
+        lambda ids: decoder.generate_greedy(ids, max_new_tokens, eos_token_id=eos_token_id)[0])
+    print(f"   - host greedy   {results['host_greedy']['tokens']} tokens in {results['host_greedy']['seconds']:.2f} s"
+          f" = {results['host_greedy']['tokens_per_s']:.1f} tokens/s")
+    for mode in modes:
+        outputs, run = timed(lambda ids: generation.generate(ids, max_new_tokens, eos_token_id=eos_token_id,
+                                                             **SAMPLING_MODES[mode]))
+        run["speedup"] = results["host_greedy"]["seconds"] / run["seconds"]
+        if mode == "greedy":
+            run["identical_outputs"] = sum(a == b for a, b in zip(host, outputs))
+        results["modes"][mode] = run
+        identical = f", identical {run['identical_outputs']}/{len(prompts)}" if mode == "greedy" else ""
+        print(f"   - graph {mode:<9} {run['tokens']} tokens in {run['seconds']:.2f} s = {run['tokens_per_s']:.1f} "
+              f"tokens/s, {run['speedup']:.2f}x{identical}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and benchmark an in-graph ONNX generation loop")
+    parser.add_argument("model", help="Merged KV-cache export (or a graph without a KV cache)")
+    parser.add_argument("--output", default=None, help="Generation graph path (default: <stem>_generate.onnx)")
+    parser.add_argument("--seed", type=float, default=None, help="Multinomial seed baked into the graph")
+    parser.add_argument("--benchmark", action="store_true", help="Compare against the host-driven loop")
+    parser.add_argument("--modes", default=",".join(SAMPLING_MODES),
+                        help="Comma separated sampling modes to benchmark (greedy, top_k, top_p)")
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_MAX_NEW_TOKENS)
+    parser.add_argument("--prompt", dest="prompts", action="append", default=[], help="Prompt text, repeatable")
+    parser.add_argument("--report", default=None, help="Write the benchmark results as JSON")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("generation_loop", args.trace):
+        path = run_generation_loop_stage(args.model, args.output, args.seed)
+        success = path is not None
+
+        if success and args.benchmark:
+            from inference_server import load_tokenizer
+            from speculative_decoding import BENCHMARK_PROMPTS
+
+            print(f"🧪 Benchmarking {path} against the host-driven loop...")
+            try:
+                tokenizer = load_tokenizer(args.model)
+                texts = args.prompts or list(BENCHMARK_PROMPTS)
+                if tokenizer is not None:
+                    prompts = [tokenizer.encode(text) for text in texts]
+                    eos_token_id = tokenizer.eos_token_id
+                else:
+                    print("⚠️ No tokenizer next to the model, using random prompt ids")
+                    rng = np.random.default_rng(0)
+                    vocab_size = DecoderSession.load(args.model).vocab_size or 1000
+                    prompts = [rng.integers(0, vocab_size, size=16).tolist() for _ in texts]
+                    eos_token_id = None
+                modes = [mode for mode in args.modes.split(",") if mode]
+                results = benchmark_generation_loop(args.model, path, prompts, args.max_new_tokens, modes, eos_token_id)
+                if args.report:
+                    with open(args.report, "w", encoding="utf-8") as f:
+                        json.dump(results, f, indent=2)
+                    print(f"📝 Wrote {args.report}")
+                greedy = results["modes"].get("greedy")
+                success = greedy is None or greedy["identical_outputs"] == len(prompts)
+            except Exception as e:
+                print(f"❌ Error during generation loop benchmark: {e}")
+                import traceback
+                traceback.print_exc()
+                success = False
+
+    if success:
+        print("\n🎉 Generation loop is ready!")
+    else:
+        print("\n💥 Generation loop build failed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+"""
+Local inference server for exported CrypticDash ONNX models
+Merges concurrent generation requests into shared batches (continuous
+batching with padding/masking) and streams tokens back as server-sent events
+"""
+
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+
+from ort_runtime import DecoderSession, run_with_past
+from prefix_state import PrefixCache
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_NEW_TOKENS = 128
+
+
+class GenerationRequest:
+    """One client request; the engine pushes ("token", id) / ("done", stats) / ("error", message) events"""
+
+    def __init__(self, prompt_ids, max_new_tokens=DEFAULT_MAX_NEW_TOKENS, eos_token_id=None,
+                 temperature=0.0, top_k=0, seed=None):
+        if not prompt_ids:
+            raise ValueError("prompt must contain at least one token")
+        # The limit is only checked after a token is sampled, so 0 would still produce one
+        if max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be at least 1")
+        if top_k < 0:
+            raise ValueError("top_k must be 0 (no cutoff) or positive")
+        self.prompt_ids = [int(token) for token in prompt_ids]
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.temperature = temperature
+        self.top_k = top_k
+        self.rng = np.random.default_rng(seed)
+        self.generated = []
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+        self.submitted = time.perf_counter()
+        self.first_token_s = None
+
+    def sample(self, scores, ids=None):
+        """Greedy, or temperature/top-k sampling, from one row of next-token scores"""
+        if self.temperature <= 0:
+            index = int(np.argmax(scores))
+        else:
+            scores = scores.astype(np.float64) / self.temperature
+            if self.top_k and self.top_k < scores.shape[-1]:
+                cutoff = np.partition(scores, -self.top_k)[-self.top_k]
+                scores = np.where(scores < cutoff, -np.inf, scores)
+            probabilities = np.exp(scores - scores.max())
+            probabilities /= probabilities.sum()
+            index = int(self.rng.choice(scores.shape[-1], p=probabilities))
+        return int(ids[index]) if ids is not None else index
+
+    def tokens(self, timeout=None):
+        """Yield generated token ids until the request finishes"""
+        while True:
+            kind, payload = self.events.get(timeout=timeout)
+            if kind == "token":
+                yield payload
+            elif kind == "done":
+                return
+            else:
+                raise RuntimeError(payload)
+
+
+def _left_pad(array, length, axis, value=0):
+    missing = length - array.shape[axis]
+    if missing <= 0:
+        return array
+    widths = [(0, 0)] * array.ndim
+    widths[axis] = (missing, 0)
+    return np.pad(array, widths, constant_values=value)
+
+
+class BatchState:
+    """
+    Row-aligned state of the running batch. Rows are left-padded to a
+    common length and masked, so new requests can join and finished ones
+    leave between any two decode steps.
+    """
+
+    def __init__(self, rows, scores, mask, past=None, sequence=None):
+        self.rows = rows          # GenerationRequest per batch row
+        self.scores = scores      # (scores [B, V or k], ids [B, k] or None) for the next token
+        self.mask = mask          # [B, L] attention mask over past (+ sequence) tokens
+        self.past = past          # {past name: [B, H, L, D]} for KV-cache graphs
+        self.sequence = sequence  # [B, L] token ids for graphs that re-run the full sequence
+
+    @staticmethod
+    def merge(first, second):
+        if first is None:
+            return second
+        length = max(first.mask.shape[1], second.mask.shape[1])
+        mask = np.concatenate([_left_pad(first.mask, length, 1), _left_pad(second.mask, length, 1)])
+        past = sequence = None
+        if first.past is not None:
+            past = {
+                name: np.concatenate([_left_pad(first.past[name], length, 2), _left_pad(second.past[name], length, 2)])
+                for name in first.past
+            }
+        if first.sequence is not None:
+            sequence = np.concatenate([_left_pad(first.sequence, length, 1), _left_pad(second.sequence, length, 1)])
+        scores = np.concatenate([first.scores[0], second.scores[0]])
+        ids = np.concatenate([first.scores[1], second.scores[1]]) if first.scores[1] is not None else None
+        return BatchState(first.rows + second.rows, (scores, ids), mask, past, sequence)
+
+    def select(self, keep):
+        """Keep the given rows and drop leading columns that are padding in every row"""
+        keep = np.asarray(keep, dtype=np.int64)
+        mask = self.mask[keep]
+        start = int(np.argmax(mask.any(axis=0))) if mask.any() else 0
+        past = {name: value[keep][:, :, start:] for name, value in self.past.items()} if self.past else None
+        sequence = self.sequence[keep][:, start:] if self.sequence is not None else None
+        ids = self.scores[1][keep] if self.scores[1] is not None else None
+        return BatchState([self.rows[i] for i in keep], (self.scores[0][keep], ids), mask[:, start:], past, sequence)
+
+
+class BatchEngine:
+    """
+    Continuous-batching decode loop for one model. Every iteration admits
+    waiting requests (prefilled together), samples one token for every
+    row, retires finished rows and runs a single batched decode step.
+    """
+
+    def __init__(self, name, decoder, decode_session=None, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 pad_token_id=0, tokenizer=None, eos_token_id=None, prefixes=None):
+        self.name = name
+        self.decoder = decoder
+        self.step_session = decode_session or decoder
+        self.max_batch_size = max_batch_size
+        self.pad_token_id = pad_token_id
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.kv_cache = bool(decoder.present_names) and self.step_session.has_past
+        # Without an attention_mask input, padding would leak into attention
+        self.masked = "attention_mask" in decoder.inputs
+        # Precomputed prompt-prefix states; reusing one needs a KV cache to start from
+        self.prefixes = prefixes if prefixes and self.kv_cache else None
+        self.pending = queue.Queue()
+        # One padded batch for masked graphs; one batch per sequence length otherwise
+        self.groups = []
+        self.stats = {"requests": 0, "tokens": 0, "steps": 0, "batched_rows": 0, "busy_s": 0.0,
+                      "prefix_hits": 0, "prefix_tokens": 0}
+        # submit() runs on request threads while the engine thread updates the rest
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f"engine-{name}", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def load(cls, name, model_path, prefix_reuse=True, **options):
+        """
+        Load a graph (and the matching _decode graph for split _prefill
+        exports) plus any prefix states stored next to it
+        """
+        decoder = DecoderSession.load(model_path)
+        decode_session = None
+        if model_path.endswith("_prefill.onnx"):
+            decode_path = model_path[:-len("_prefill.onnx")] + "_decode.onnx"
+            if os.path.exists(decode_path):
+                decode_session = DecoderSession.load(decode_path)
+        if prefix_reuse:
+            options["prefixes"] = PrefixCache.load(model_path, decode_session if decode_session else decoder)
+        return cls(name, decoder, decode_session, **options)
+
+    def submit(self, request):
+        if request.eos_token_id is None:
+            request.eos_token_id = self.eos_token_id
+        with self._stats_lock:
+            self.stats["requests"] += 1
+        self.pending.put(request)
+        return request
+
+    def generate(self, prompt_ids, **options):
+        """Blocking helper: submit one request and return its generated ids"""
+        request = self.submit(GenerationRequest(prompt_ids, **options))
+        return list(request.tokens())
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    # -- batching ---------------------------------------------------------------
+
+    def _prefix_match(self, request):
+        return self.prefixes.match(request.prompt_ids) if self.prefixes else (None, 0)
+
+    def _prefill(self, requests):
+        """
+        Run new prompts together; rows are left-padded and masked. Requests
+        sharing a stored prefix start from its KV state and only run the rest.
+        """
+        prefix, reused = self._prefix_match(requests[0])
+        prompts = [request.prompt_ids[reused:] for request in requests]
+        length = max(len(prompt) for prompt in prompts)
+        input_ids = np.full((len(requests), length), self.pad_token_id, dtype=np.int64)
+        mask = np.zeros((len(requests), length), dtype=np.int64)
+        for row, prompt in enumerate(prompts):
+            input_ids[row, length - len(prompt):] = prompt
+            mask[row, length - len(prompt):] = 1
+
+        if prefix is None:
+            outputs, present = self.decoder.run(input_ids, mask)
+            session = self.decoder
+        else:
+            mask = np.concatenate([np.ones((len(requests), reused), dtype=np.int64), mask], axis=1)
+            outputs, present, session = run_with_past(
+                self.decoder, input_ids, mask, prefix.past(len(requests), reused), self.step_session
+            )
+            self.stats["prefix_hits"] += len(requests)
+            self.stats["prefix_tokens"] += reused * len(requests)
+        scores = session.next_token_scores(outputs)
+        if self.kv_cache:
+            return BatchState(list(requests), scores, mask, past=present)
+        return BatchState(list(requests), scores, mask, sequence=input_ids)
+
+    def _fail(self, requests, error):
+        print(f"❌ Error in {self.name} engine: {error}")
+        import traceback
+        traceback.print_exc()
+        for request in requests:
+            request.events.put(("error", f"{type(error).__name__}: {error}"))
+
+    def _admit(self, first=None):
+        """
+        Prefill waiting requests (after `first`, already taken off the queue
+        by an idle loop) and merge them into the running batch
+        """
+        capacity = self.max_batch_size - sum(len(group.rows) for group in self.groups)
+        admitted = [first] if first is not None and not first.cancelled.is_set() else []
+        while len(admitted) < capacity:
+            try:
+                request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if not request.cancelled.is_set():
+                admitted.append(request)
+        # Rows of one prefill share a prefix state, and without an attention
+        # mask only equal-length prompts can share a batch
+        batches = {}
+        for request in admitted:
+            prefix, reused = self._prefix_match(request)
+            key = (prefix.name if prefix else None, reused, None if self.masked else len(request.prompt_ids))
+            batches.setdefault(key, []).append(request)
+        batches = list(batches.values())
+
+        for requests in batches:
+            # A failed prefill only fails its own requests; they are not in a group yet
+            try:
+                state = self._prefill(requests)
+            except Exception as e:
+                self._fail(requests, e)
+                continue
+            for index, group in enumerate(self.groups):
+                if self.masked or group.mask.shape[1] == state.mask.shape[1]:
+                    self.groups[index] = BatchState.merge(group, state)
+                    break
+            else:
+                self.groups.append(state)
+
+    def _sample(self, state):
+        """Pick one token per row, stream it and return (tokens, rows to keep)"""
+        scores, ids = state.scores
+        tokens = np.zeros(len(state.rows), dtype=np.int64)
+        keep = []
+        for row, request in enumerate(state.rows):
+            token = request.sample(scores[row], ids[row] if ids is not None else None)
+            tokens[row] = token
+            if request.first_token_s is None:
+                request.first_token_s = time.perf_counter() - request.submitted
+            request.generated.append(token)
+            request.events.put(("token", token))
+            self.stats["tokens"] += 1
+            finished = (
+                len(request.generated) >= request.max_new_tokens
+                or (request.eos_token_id is not None and token == request.eos_token_id)
+                or request.cancelled.is_set()
+            )
+            if finished:
+                request.events.put(("done", {
+                    "tokens": len(request.generated),
+                    "first_token_s": request.first_token_s,
+                    "total_s": time.perf_counter() - request.submitted,
+                }))
+            else:
+                keep.append(row)
+        return tokens, keep
+
+    def _step(self, state, tokens):
+        """One batched decode step for the surviving rows"""
+        mask = np.concatenate([state.mask, np.ones((len(state.rows), 1), dtype=np.int64)], axis=1)
+        if self.kv_cache:
+            outputs, present = self.step_session.run(tokens[:, None], mask, state.past)
+            return BatchState(state.rows, self.step_session.next_token_scores(outputs), mask, past=present)
+        sequence = np.concatenate([state.sequence, tokens[:, None]], axis=1)
+        outputs, _ = self.decoder.run(sequence, mask)
+        return BatchState(state.rows, self.decoder.next_token_scores(outputs), mask, sequence=sequence)
+
+    def _advance(self, state):
+        tokens, keep = self._sample(state)
+        if not keep:
+            return None
+        state = state.select(keep)
+        self.stats["steps"] += 1
+        self.stats["batched_rows"] += len(state.rows)
+        return self._step(state, tokens[keep])
+
+    def _loop(self):
+        while not self._stop.is_set():
+            request = None
+            if not self.groups:
+                try:
+                    request = self.pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+            start = time.perf_counter()
+            try:
+                self._admit(request)
+                advanced = (self._advance(group) for group in self.groups)
+                self.groups = [group for group in advanced if group is not None]
+            except Exception as e:
+                self._fail([request for group in self.groups for request in group.rows], e)
+                self.groups = []
+            with self._stats_lock:
+                self.stats["busy_s"] += time.perf_counter() - start
+
+    def throughput(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["tokens_per_s"] = stats["tokens"] / stats["busy_s"] if stats["busy_s"] else 0.0
+        stats["mean_batch_size"] = stats["batched_rows"] / stats["steps"] if stats["steps"] else 0.0
+        return stats
+
+
+# ---------------------------------------------------------------------------
+# Tokenizers
+# ---------------------------------------------------------------------------
+
+class _TokenizerAdapter:
+    """Common encode/decode/eos over BinaryTokenizer or tokenizers.Tokenizer"""
+
+    def __init__(self, tokenizer, eos_token_id):
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+
+    def encode(self, text):
+        ids = self.tokenizer.encode(text)
+        return ids if isinstance(ids, list) else ids.ids
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def incremental_decoder(self):
+        from batch_tokenizer import IncrementalDecoder
+        return IncrementalDecoder(self.tokenizer)
+
+
+def load_tokenizer(model_path):
+    """tokenizer.bin (compiled) or tokenizer.json next to the graph or in its parent"""
+    directory = os.path.dirname(os.path.abspath(model_path))
+    for candidate in (directory, os.path.dirname(directory)):
+        binary_path = os.path.join(candidate, "tokenizer.bin")
+        if os.path.exists(binary_path):
+            from binary_tokenizer import BinaryTokenizer
+            tokenizer = BinaryTokenizer(binary_path)
+            return _TokenizerAdapter(tokenizer, tokenizer.special_ids.get("eos"))
+        json_path = os.path.join(candidate, "tokenizer.json")
+        if os.path.exists(json_path):
+            from tokenizers import Tokenizer
+            tokenizer = Tokenizer.from_file(json_path)
+            eos_token_id = None
+            config_path = os.path.join(candidate, "tokenizer_config.json")
+            if os.path.exists(config_path):
+                with open(config_path, "r", encoding="utf-8") as f:
+                    eos = json.load(f).get("eos_token")
+                if isinstance(eos, dict):
+                    eos = eos.get("content")
+                eos_token_id = tokenizer.token_to_id(eos) if eos else None
+            return _TokenizerAdapter(tokenizer, eos_token_id)
+    return None
+
+
+# ---------------------------------------------------------------------------
+# HTTP
+# ---------------------------------------------------------------------------
+
+def _sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def create_app(engines):
+    """Flask app serving /health, /v1/models, /v1/stats and /v1/generate"""
+    from flask import Flask, Response, jsonify, request as http_request, stream_with_context
+
+    app = Flask(__name__)
+
+    @app.get("/health")
+    def health():
+        return jsonify({"status": "ok", "models": sorted(engines)})
+
+    @app.get("/v1/models")
+    def models():
+        return jsonify({
+            name: {
+                "kv_cache": engine.kv_cache,
+                "masked": engine.masked,
+                "max_batch_size": engine.max_batch_size,
+                "tokenizer": engine.tokenizer is not None,
+                "prefixes": [state.name for state in engine.prefixes.states] if engine.prefixes else [],
+            }
+            for name, engine in engines.items()
+        })
+
+    @app.get("/v1/stats")
+    def stats():
+        return jsonify({name: engine.throughput() for name, engine in engines.items()})
+
+    @app.post("/v1/generate")
+    def generate():
+        body = http_request.get_json(force=True, silent=True) or {}
+        name = body.get("model") or next(iter(engines))
+        engine = engines.get(name)
+        if engine is None:
+            return jsonify({"error": f"Unknown model: {name}"}), 404
+
+        prompt_ids = body.get("input_ids")
+        if prompt_ids is None:
+            if "prompt" not in body:
+                return jsonify({"error": "Provide 'prompt' or 'input_ids'"}), 400
+            if engine.tokenizer is None:
+                return jsonify({"error": f"No tokenizer found for {name}; send 'input_ids'"}), 400
+            prompt_ids = engine.tokenizer.encode(body["prompt"])
+
+        try:
+            generation = GenerationRequest(
+                prompt_ids,
+                max_new_tokens=int(body.get("max_new_tokens", DEFAULT_MAX_NEW_TOKENS)),
+                eos_token_id=body.get("eos_token_id"),
+                temperature=float(body.get("temperature", 0.0)),
+                top_k=int(body.get("top_k", 0)),
+                seed=body.get("seed"),
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        engine.submit(generation)
+
+        if not body.get("stream", True):
+            try:
+                tokens = list(generation.tokens())
+            except RuntimeError as e:
+                return jsonify({"error": str(e)}), 500
+            result = {"model": name, "prompt_tokens": len(prompt_ids), "tokens": tokens}
+            if engine.tokenizer is not None:
+                result["text"] = engine.tokenizer.decode(tokens)
+            return jsonify(result)
+
+        def events():
+            # Holds back partial multi-token characters without re-decoding the whole continuation
+            decoder = engine.tokenizer.incremental_decoder() if engine.tokenizer is not None else None
+            try:
+                for token in generation.tokens():
+                    event = {"token": token}
+                    if decoder is not None:
+                        event["text"] = decoder.push(token)
+                    yield _sse(event)
+                done = {"tokens": len(generation.generated), "first_token_s": generation.first_token_s}
+                tail = decoder.flush() if decoder is not None else ""
+                if tail:
+                    done["text"] = tail
+                yield _sse(done, "done")
+            except RuntimeError as e:
+                yield _sse({"error": str(e)}, "error")
+            finally:
+                # Client went away (or finished): stop generating for this row
+                generation.cancelled.set()
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return app
+
+
+# ---------------------------------------------------------------------------
+# Offline batching benchmark
+# ---------------------------------------------------------------------------
+
+def _run_concurrently(engine, prompts, max_new_tokens):
+    start = time.perf_counter()
+    requests = [engine.submit(GenerationRequest(prompt, max_new_tokens)) for prompt in prompts]
+    outputs = [list(request.tokens(timeout=600)) for request in requests]
+    return outputs, time.perf_counter() - start
+
+
+def benchmark_batching(model_path, num_requests=8, max_new_tokens=32, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                       seed=0):
+    """
+    Serve random prompts of mixed lengths serially (batch size 1) and with
+    continuous batching, compare throughput and check greedy outputs match.
+    """
+    try:
+        probe = DecoderSession.load(model_path)
+        vocab_size = probe.vocab_size or 1000
+        del probe
+        rng = np.random.default_rng(seed)
+        prompts = [
+            rng.integers(0, vocab_size, size=int(rng.integers(8, 48))).tolist()
+            for _ in range(num_requests)
+        ]
+
+        results = {}
+        for label, batch_size in (("serial", 1), ("batched", max_batch_size)):
+            engine = BatchEngine.load(label, model_path, max_batch_size=batch_size)
+            _run_concurrently(engine, prompts[:1], 2)  # Warm up
+            outputs, seconds = _run_concurrently(engine, prompts, max_new_tokens)
+            stats = engine.throughput()
+            engine.close()
+            tokens = sum(len(output) for output in outputs)
+            results[label] = {"outputs": outputs, "seconds": seconds, "tokens_per_s": tokens / seconds,
+                              "mean_batch_size": stats["mean_batch_size"]}
+            print(f"   - {label:<8} {tokens} tokens in {seconds:.2f} s = {tokens / seconds:.1f} tokens/s "
+                  f"(mean batch {stats['mean_batch_size']:.1f})")
+
+        matches = sum(a == b for a, b in zip(results["serial"]["outputs"], results["batched"]["outputs"]))
+        speedup = results["batched"]["tokens_per_s"] / results["serial"]["tokens_per_s"]
+        print(f"📊 Continuous batching speedup: {speedup:.2f}x, identical greedy outputs: {matches}/{num_requests}")
+        return matches == num_requests
+    except Exception as e:
+        print(f"❌ Error during batching benchmark: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def parse_model_argument(value):
+    """name=path.onnx (name defaults to the file stem)"""
+    name, _, path = value.rpartition("=")
+    return name or os.path.splitext(os.path.basename(path))[0], path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve exported ONNX models with continuous batching")
+    parser.add_argument("--model", dest="models", type=parse_model_argument, action="append", required=True,
+                        help="name=path.onnx, repeatable (e.g. tiny=../ai_models/phi-2/tiny_model.onnx)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--pad-token-id", type=int, default=0)
+    parser.add_argument("--no-prefix-reuse", action="store_true",
+                        help="Ignore <graph>.*.prefix.npz states and prefill every prompt in full")
+    parser.add_argument("--benchmark", type=int, default=0, metavar="N",
+                        help="Instead of serving, compare serial vs batched generation for N requests")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="Tokens per request for --benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        success = True
+        for name, path in args.models:
+            print(f"🚀 Benchmarking continuous batching for {name} ({path})")
+            success = benchmark_batching(path, args.benchmark, args.max_new_tokens, args.max_batch_size) and success
+        if success:
+            print("\n🎉 Batched generation matches serial generation!")
+        else:
+            print("\n💥 Batching benchmark failed. Check the messages above.")
+            exit(1)
+    else:
+        engines = {}
+        for name, path in args.models:
+            print(f"📖 Loading {name} from {path}...")
+            tokenizer = load_tokenizer(path)
+            engines[name] = BatchEngine.load(
+                name, path, max_batch_size=args.max_batch_size, pad_token_id=args.pad_token_id,
+                tokenizer=tokenizer, eos_token_id=tokenizer.eos_token_id if tokenizer else None,
+                prefix_reuse=not args.no_prefix_reuse,
+            )
+            engine = engines[name]
+            prefixes = ", ".join(state.name for state in engine.prefixes.states) if engine.prefixes else "none"
+            print(f"✅ {name}: kv_cache={engine.kv_cache}, masked={engine.masked}, tokenizer={tokenizer is not None}, "
+                  f"prefixes={prefixes}")
+        print(f"🚀 Serving on http://{args.host}:{args.port} (POST /v1/generate)")
+        create_app(engines).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,661 @@
+#!/usr/bin/env python3
+"""
+Incremental conversion pipeline for CrypticDash models
+Fingerprints the inputs of every stage (load, export, optimize, quantize,
+dedup, validate, prefix, layout) and reuses the cached outputs of stages whose inputs did not change
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+import importlib
+import importlib.metadata
+
+from export_wrappers import DEFAULT_TOP_K, KV_CACHE_MODES, LOGITS_MODES, parse_top_k
+from quantize_onnx import QUANT_MODES, parse_modes
+from stream_export import DEFAULT_MEMORY_BUDGET_MB, DTYPES, KV_CACHE_MODES as STREAM_KV_CACHE_MODES
+from prefix_state import PROMPT_PREFIXES, parse_prefix_argument
+import stage_trace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(SCRIPT_DIR, ".model_cache")
+STAGES = ("load", "export", "optimize", "quantize", "dedup", "validate", "prefix", "layout")
+HASH_BLOCK = 16 * 1024 * 1024
+
+MODELS = {
+    "gemma": {
+        "path": "../ai_models/gemma_3_270m_it",
+        "module": "convert_to_onnx",
+        "function": "convert_gemma_to_onnx",
+        "logits_mode": "full",
+    },
+    "phi2": {
+        "path": "../ai_models/phi-2",
+        "module": "convert_phi2_to_onnx",
+        "function": "convert_phi2_to_onnx",
+        "logits_mode": None,
+        "loader_options": ("load_timeout", "load_workers"),
+    },
+}
+
+CHECKPOINT_FILES = ("config.json", "generation_config.json", "model.safetensors.index.json")
+TOKENIZER_FILES = (
+    "tokenizer.json", "tokenizer_config.json", "tokenizer.model", "special_tokens_map.json",
+    "vocab.json", "merges.txt", "added_tokens.json",
+)
+
+# Code and libraries whose changes invalidate a stage
+STAGE_CODE = {
+    "export": ("export_wrappers.py", "stream_export.py", "shard_loader.py"),
+    "optimize": ("optimize_onnx.py", "ort_runtime.py"),
+    "quantize": ("quantize_onnx.py", "ort_runtime.py"),
+    "dedup": ("dedup_initializers.py", "weight_layout.py", "ort_runtime.py"),
+    "validate": ("model_pipeline.py", "ort_runtime.py"),
+    "prefix": ("prefix_state.py", "ort_runtime.py"),
+    "layout": ("weight_layout.py", "ort_runtime.py"),
+}
+STAGE_LIBRARIES = {
+    "export": ("torch", "transformers", "accelerate", "onnx", "onnxscript", "safetensors"),
+    "optimize": ("onnx", "onnxruntime"),
+    "quantize": ("onnx", "onnxruntime", "numpy"),
+    "dedup": ("onnx", "onnxruntime", "numpy"),
+    "validate": ("onnxruntime", "numpy", "tokenizers"),
+    "prefix": ("onnxruntime", "numpy", "tokenizers"),
+    "layout": ("onnx", "onnxruntime", "numpy", "psutil"),
+}
+
+# Export options that change how a stage runs but not what it writes
+UNFINGERPRINTED_OPTIONS = ("load_timeout", "load_workers", "memory_budget_mb")
+
+VALIDATION_PROMPT = "Generate a TODO list for a Flutter project:"
+
+
+def library_versions(names):
+    versions = {}
+    for name in names:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def graph_files(names):
+    """ONNX graphs among a stage's files, prefill/merged graph first"""
+    graphs = [name for name in names if name.endswith(".onnx")]
+    return sorted(graphs, key=lambda name: ("_decode" in name, name))
+
+
+class ArtifactCache:
+    """
+    Content-addressed stage store. Each entry lives in <root>/<stage>/<key>/
+    and is only visible once its manifest.json exists, so interrupted runs
+    never leave half-written entries behind.
+    """
+
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        self._digest_path = os.path.join(root, "digests.json")
+        self._digests = {}
+        if os.path.exists(self._digest_path):
+            with open(self._digest_path, "r", encoding="utf-8") as f:
+                self._digests = json.load(f)
+
+    def file_digest(self, path):
+        """sha256 of a file, re-hashed only when its size or mtime changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._digests.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                digest.update(block)
+        self._digests[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return self._digests[path][2]
+
+    def directory_digests(self, directory, names):
+        return {
+            name: self.file_digest(os.path.join(directory, name))
+            for name in sorted(names) if os.path.isfile(os.path.join(directory, name))
+        }
+
+    def code_digests(self, names):
+        return self.directory_digests(SCRIPT_DIR, names)
+
+    def save_digests(self):
+        # Per process: conversion_matrix.py runs several pipelines on one cache
+        temporary = f"{self._digest_path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self._digests, f)
+        os.replace(temporary, self._digest_path)
+
+    @staticmethod
+    def stage_key(stage, inputs):
+        payload = json.dumps({"stage": stage, "inputs": inputs}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def lookup(self, stage, key):
+        manifest_path = os.path.join(self.entry_dir(stage, key), "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def build(self, stage, key, inputs, builder, sources=()):
+        """
+        Run builder(work_dir) in a scratch directory and publish it as the
+        cache entry. `sources` are (directory, names) pairs linked into the
+        scratch directory first; those the builder leaves untouched are not
+        stored again. Returns the manifest, or None when the builder fails.
+        """
+        work_dir = os.path.join(self.root, "tmp", f"{stage}-{key}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(work_dir)
+        try:
+            linked = {}
+            for directory, names in sources:
+                link_files(directory, names, work_dir)
+                for name in names:
+                    stat = os.stat(os.path.join(work_dir, name))
+                    linked[name] = (stat.st_ino, stat.st_mtime_ns)
+
+            start = time.time()
+            result = builder(work_dir)
+            if not result:
+                return None
+
+            for name, identity in linked.items():
+                path = os.path.join(work_dir, name)
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    if (stat.st_ino, stat.st_mtime_ns) == identity:
+                        os.remove(path)
+
+            manifest = {
+                "stage": stage,
+                "key": key,
+                "inputs": inputs,
+                "files": sorted(os.listdir(work_dir)),
+                "result": result if isinstance(result, dict) else None,
+                "seconds": time.time() - start,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            with open(os.path.join(work_dir, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+
+            target = self.entry_dir(stage, key)
+            if os.path.exists(target):
+                # A complete entry was published by a concurrent job that may be reading it: keep it
+                existing = self.lookup(stage, key)
+                if existing is not None:
+                    return existing
+                shutil.rmtree(target, ignore_errors=True)  # Left over from an interrupted publish
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.replace(work_dir, target)
+            except OSError:
+                # Another pipeline process published the same entry first
+                existing = self.lookup(stage, key)
+                if existing is None:
+                    raise
+                return existing
+            return manifest
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def link_files(source_dir, names, target_dir):
+    """Hard-link files into target_dir, copying when they are on another device"""
+    for name in names:
+        source = os.path.join(source_dir, name)
+        target = os.path.join(target_dir, name)
+        if os.path.exists(target):
+            if os.path.samefile(source, target):
+                continue
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+
+class Pipeline:
+    """Runs the conversion stages for one model against an ArtifactCache"""
+
+    def __init__(self, model, model_path=None, output_dir=None, cache_dir=CACHE_DIR, force=()):
+        self.model = model
+        self.spec = MODELS[model]
+        self.model_path = model_path or self.spec["path"]
+        # Not the model directory itself: Flutter bundles everything directly in it
+        self.output_dir = output_dir or os.path.join(self.model_path, "onnx")
+        self.cache = ArtifactCache(cache_dir)
+        self.force = set(force)
+        self.summary = []
+
+    def _stage(self, stage, label, inputs, builder, sources=()):
+        """Return the manifest for a stage, from cache unless its inputs changed"""
+        key = self.cache.stage_key(stage, inputs)
+        start = time.time()
+        with stage_trace.stage(label, key=key) as record:
+            manifest = None if stage in self.force else self.cache.lookup(stage, key)
+            if manifest is not None:
+                print(f"⏭️ {label}: unchanged ({key[:12]}), reusing cached outputs")
+                status = "cached"
+            else:
+                print(f"🔄 {label}: running ({key[:12]})...")
+                manifest = self.cache.build(stage, key, inputs, builder, sources)
+                status = "ran" if manifest is not None else "failed"
+            record["args"]["status"] = status
+        self.summary.append((label, status, time.time() - start))
+        if manifest is None:
+            raise RuntimeError(f"Stage {label} failed")
+        manifest["dir"] = self.cache.entry_dir(stage, key)
+        return manifest
+
+    def load(self):
+        """
+        Fingerprint the checkpoint. The model itself is only loaded by the
+        export stage, and only when that stage has to run.
+        """
+        names = [name for name in os.listdir(self.model_path)
+                 if name.endswith(".safetensors") or name in CHECKPOINT_FILES]
+        if not any(name.endswith(".safetensors") for name in names):
+            raise FileNotFoundError(f"No .safetensors checkpoint in {os.path.abspath(self.model_path)}")
+        inputs = {"checkpoint": self.cache.directory_digests(self.model_path, names)}
+        return self._stage("load", "load", inputs, lambda work_dir: {"files": sorted(inputs["checkpoint"])})
+
+    def export(self, load, options):
+        fingerprinted = {key: value for key, value in options.items() if key not in UNFINGERPRINTED_OPTIONS}
+        inputs = {
+            "parent": load["key"],
+            "model": self.model,
+            "options": fingerprinted,
+            "code": self.cache.code_digests((self.spec["module"] + ".py",) + STAGE_CODE["export"]),
+            "libraries": library_versions(STAGE_LIBRARIES["export"]),
+        }
+
+        def builder(work_dir):
+            if options["stream"]:
+                from stream_export import stream_export_model
+                return stream_export_model(
+                    self.model_path,
+                    os.path.join(work_dir, "model.onnx"),
+                    memory_budget_mb=options["memory_budget_mb"],
+                    dtype=options["dtype"],
+                    kv_cache=options["kv_cache"],
+                    logits_mode=options["logits_mode"],
+                    top_k=options["top_k"],
+                )
+            convert = getattr(importlib.import_module(self.spec["module"]), self.spec["function"])
+            extra = {name: options[name] for name in self.spec.get("loader_options", ()) if options[name] is not None}
+            return convert(
+                kv_cache=options["kv_cache"],
+                logits_mode=options["logits_mode"],
+                top_k=options["top_k"],
+                model_path=self.model_path,
+                output_dir=work_dir,
+                **extra,
+            )
+
+        return self._stage("export", "export", inputs, builder)
+
+    def optimize(self, parent):
+        inputs = {
+            "parent": parent["key"],
+            "code": self.cache.code_digests(STAGE_CODE["optimize"]),
+            "libraries": library_versions(STAGE_LIBRARIES["optimize"]),
+        }
+
+        def builder(work_dir):
+            from optimize_onnx import run_optimization_stage
+            return all(
+                run_optimization_stage(os.path.join(work_dir, name), replace=True,
+                                       config_path=os.path.join(self.model_path, "config.json"))
+                for name in graph_files(parent["files"])
+            )
+
+        return self._stage("optimize", "optimize", inputs, builder, [(parent["dir"], parent["files"])])
+
+    def quantize(self, parent, mode):
+        """One cache entry per mode, so adding a mode does not redo the others"""
+        inputs = {
+            "parent": parent["key"],
+            "mode": mode,
+            "code": self.cache.code_digests(STAGE_CODE["quantize"]),
+            "libraries": library_versions(STAGE_LIBRARIES["quantize"]),
+        }
+
+        def builder(work_dir):
+            from quantize_onnx import run_quantization_stage
+            return all(
+                run_quantization_stage(os.path.join(work_dir, name), [mode], report=False)
+                for name in graph_files(parent["files"])
+            )
+
+        return self._stage("quantize", f"quantize ({mode})", inputs, builder, [(parent["dir"], parent["files"])])
+
+    def dedup(self, parent):
+        """Merge duplicate and transposed-duplicate initializers of one variant's graphs in place"""
+        inputs = {
+            "parent": parent["key"],
+            "code": self.cache.code_digests(STAGE_CODE["dedup"]),
+            "libraries": library_versions(STAGE_LIBRARIES["dedup"]),
+        }
+        mode = parent["inputs"].get("mode")
+        if mode:
+            inputs["mode"] = mode
+
+        def builder(work_dir):
+            from dedup_initializers import run_dedup_stage
+            return all(
+                run_dedup_stage(os.path.join(work_dir, name), replace=True, measure=False,
+                                prompt_ids=[1] if "_decode" in name else None)
+                for name in graph_files(parent["files"])
+            )
+
+        label = f"dedup ({mode})" if mode else "dedup"
+        return self._stage("dedup", label, inputs, builder, [(parent["dir"], parent["files"])])
+
+    def validate(self, variants):
+        """Load every graph, check outputs are finite and greedy-decode a prompt"""
+        tokenizer_inputs = self.cache.directory_digests(self.model_path, TOKENIZER_FILES)
+        inputs = {
+            "parents": sorted(manifest["key"] for manifest in variants),
+            "tokenizer": tokenizer_inputs,
+            "prompt": VALIDATION_PROMPT,
+            "code": self.cache.code_digests(STAGE_CODE["validate"]),
+            "libraries": library_versions(STAGE_LIBRARIES["validate"]),
+        }
+
+        def builder(work_dir):
+            results = {}
+            prompt_ids, tokenizer = self._validation_prompt()
+            for manifest in variants:
+                graphs = graph_files(manifest["files"])
+                decode = next((name for name in graphs if "_decode" in name), None)
+                for name in graphs:
+                    if name == decode:
+                        continue
+                    results[name] = validate_model(
+                        os.path.join(manifest["dir"], name),
+                        prompt_ids,
+                        os.path.join(manifest["dir"], decode) if decode else None,
+                        tokenizer,
+                    )
+            with open(os.path.join(work_dir, "validation.json"), "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            failed = [name for name, result in results.items() if not result["ok"]]
+            if failed:
+                print(f"❌ Validation failed for: {', '.join(failed)}")
+                return None
+            return {"models": sorted(results)}
+
+        return self._stage("validate", "validate", inputs, builder)
+
+    def prefix_states(self, variants, prefixes):
+        """KV state of each declared prompt prefix for every KV-cache graph"""
+        inputs = {
+            "parents": sorted(manifest["key"] for manifest in variants),
+            "tokenizer": self.cache.directory_digests(self.model_path, TOKENIZER_FILES),
+            "prefixes": prefixes,
+            "code": self.cache.code_digests(STAGE_CODE["prefix"]),
+            "libraries": library_versions(STAGE_LIBRARIES["prefix"]),
+        }
+
+        def builder(work_dir):
+            from prefix_state import build_prefix_states, check_prefix_reuse
+
+            _, tokenizer = self._validation_prompt()
+            if tokenizer is None:
+                print("❌ Prefix states need tokenizer.json")
+                return None
+            results = {}
+            for manifest in variants:
+                for name in graph_files(manifest["files"]):
+                    if "_decode" in name:
+                        continue
+                    # Built against the linked graph so the check finds the states next to it
+                    graph_path = os.path.join(work_dir, name)
+                    build_prefix_states(graph_path, tokenizer, prefixes)
+                    results[name] = check_prefix_reuse(graph_path, tokenizer, prefixes)
+            failed = [name for name, checks in results.items() if not all(check["ok"] for check in checks.values())]
+            if failed:
+                print(f"❌ Prefix reuse does not match a full prefill for: {', '.join(failed)}")
+                return None
+            return {"checks": results}
+
+        sources = [(manifest["dir"], manifest["files"]) for manifest in variants]
+        return self._stage("prefix", "prefix states", inputs, builder, sources)
+
+    def layout(self, variants):
+        """Page-aligned, layer-grouped external data for every graph, with a cold-start report"""
+        inputs = {
+            "parents": sorted(manifest["key"] for manifest in variants),
+            "tokenizer": self.cache.directory_digests(self.model_path, TOKENIZER_FILES),
+            "code": self.cache.code_digests(STAGE_CODE["layout"]),
+            "libraries": library_versions(STAGE_LIBRARIES["layout"]),
+        }
+
+        def builder(work_dir):
+            from weight_layout import run_layout_stage
+
+            prompt_ids, _ = self._validation_prompt()
+            layouts = []
+            for manifest in variants:
+                for name in graph_files(manifest["files"]):
+                    # Linked next to their external data, so relative locations resolve
+                    ids = prompt_ids[0].tolist()
+                    if not run_layout_stage(os.path.join(work_dir, name), prompt_ids=ids[:1] if "_decode" in name else ids):
+                        return None
+                    layouts.append(name)
+            return {"graphs": layouts}
+
+        sources = [(manifest["dir"], manifest["files"]) for manifest in variants]
+        return self._stage("layout", "mmap layout", inputs, builder, sources)
+
+    def _validation_prompt(self):
+        import numpy as np
+
+        tokenizer_path = os.path.join(self.model_path, "tokenizer.json")
+        if os.path.exists(tokenizer_path):
+            from tokenizers import Tokenizer
+            tokenizer = Tokenizer.from_file(tokenizer_path)
+            ids = tokenizer.encode(VALIDATION_PROMPT).ids
+            return np.array([ids], dtype=np.int64), tokenizer
+        print("⚠️ tokenizer.json not found, validating with fixed token ids")
+        return np.arange(1, 17, dtype=np.int64)[None, :], None
+
+    def publish(self, manifests):
+        """Link the final artifacts into the output directory"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        published = []
+        for manifest in manifests:
+            names = [name for name in manifest["files"] if name != "manifest.json"]
+            link_files(manifest["dir"], names, self.output_dir)
+            published.extend(names)
+        if os.path.abspath(self.output_dir) != os.path.abspath(self.model_path):
+            tokenizer_files = [name for name in TOKENIZER_FILES if os.path.exists(os.path.join(self.model_path, name))]
+            link_files(self.model_path, tokenizer_files, self.output_dir)
+            published.extend(tokenizer_files)
+
+        record = {
+            "model": self.model,
+            "stages": {manifest["stage"] + (f":{manifest['inputs']['mode']}" if "mode" in manifest["inputs"] else ""):
+                       manifest["key"] for manifest in manifests},
+            "files": sorted(published),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with open(os.path.join(self.output_dir, "pipeline_manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        return published
+
+    def print_summary(self):
+        print("📊 Pipeline summary:")
+        for label, status, seconds in self.summary:
+            print(f"   - {label:<18} {status:<7} {seconds:8.1f} s")
+
+
+def validate_model(model_path, prompt_ids, decode_path=None, tokenizer=None, max_new_tokens=8):
+    """Smoke-test one graph with onnxruntime"""
+    import numpy as np
+    from ort_runtime import DecoderSession
+
+    name = os.path.basename(model_path)
+    print(f"🧪 Validating {name}...")
+    try:
+        decoder = DecoderSession.load(model_path)
+        outputs, _ = decoder.run(prompt_ids)
+        finite = all(
+            bool(np.isfinite(value).all()) for value in outputs.values()
+            if np.issubdtype(value.dtype, np.floating)
+        )
+        result = {"ok": finite, "finite": finite, "load_s": decoder.load_seconds}
+        if finite and ("logits" in decoder.outputs or decoder.topk):
+            decode_session = DecoderSession.load(decode_path) if decode_path else None
+            tokens, _ = decoder.generate_greedy(prompt_ids, max_new_tokens, decode_session=decode_session)
+            result["tokens"] = tokens[0].tolist()
+            if tokenizer is not None:
+                result["text"] = tokenizer.decode(result["tokens"])
+        print(f"   {'✅' if result['ok'] else '❌'} {name}: finite={finite}"
+              + (f", continuation={result.get('text', result.get('tokens'))!r}" if "tokens" in result else ""))
+        return result
+    except Exception as e:
+        print(f"   ❌ {name}: {e}")
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+
+def run_pipeline(model, model_path=None, output_dir=None, cache_dir=CACHE_DIR, export_options=None,
+                 optimize=False, quantize=(), validate=True, force=(), prefixes=PROMPT_PREFIXES, mmap_layout=False,
+                 tune_sessions=False, dedup=False):
+    """
+    Run every stage, skipping the ones whose fingerprinted inputs are unchanged.
+    Session tuning is specific to the machine, so it is never cached and
+    writes its sidecars straight into the output directory.
+    """
+    pipeline = Pipeline(model, model_path, output_dir, cache_dir, force)
+    options = {
+        "kv_cache": "none", "logits_mode": pipeline.spec["logits_mode"], "top_k": DEFAULT_TOP_K,
+        "stream": False, "memory_budget_mb": DEFAULT_MEMORY_BUDGET_MB, "dtype": "float32",
+        "load_timeout": None, "load_workers": None,
+    }
+    options.update({key: value for key, value in (export_options or {}).items() if value is not None})
+    if options["stream"] and options["kv_cache"] not in STREAM_KV_CACHE_MODES:
+        raise ValueError(f"Streaming export supports kv_cache {', '.join(STREAM_KV_CACHE_MODES)}, not {options['kv_cache']}")
+
+    print(f"🚀 Running {model} pipeline for {os.path.abspath(pipeline.model_path)}")
+    start = time.time()
+    try:
+        load = pipeline.load()
+        graph = pipeline.export(load, options)
+        if optimize:
+            graph = pipeline.optimize(graph)
+        variants = [graph] + [pipeline.quantize(graph, mode) for mode in quantize]
+        if dedup:
+            # After quantization: a tied head quantizes differently from the embedding it shares
+            variants = [pipeline.dedup(variant) for variant in variants]
+        manifests = [load, *variants]
+        if validate:
+            manifests.append(pipeline.validate(variants))
+        if prefixes and options["kv_cache"] != "none":
+            manifests.append(pipeline.prefix_states(variants, prefixes))
+        if mmap_layout:
+            manifests.append(pipeline.layout(variants))
+
+        published = pipeline.publish(manifests[1:])
+        print(f"📁 Published {len(published)} file(s) to {os.path.abspath(pipeline.output_dir)}")
+        if tune_sessions:
+            from session_tuner import tune_session
+
+            for manifest in variants:
+                for name in manifest["files"]:
+                    if name.endswith(".onnx"):
+                        start_tuning = time.time()
+                        if tune_session(os.path.join(pipeline.output_dir, name)) is None:
+                            raise RuntimeError(f"Session tuning of {name} failed")
+                        pipeline.summary.append((f"tune {os.path.splitext(name)[0]}", "ran", time.time() - start_tuning))
+        return True
+    except Exception as e:
+        print(f"❌ Error during pipeline: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+    finally:
+        pipeline.cache.save_digests()
+        pipeline.print_summary()
+        print(f"   - total              {time.time() - start:16.1f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally convert a model to ONNX with a stage cache")
+    parser.add_argument("model", choices=sorted(MODELS), help="Which conversion to run")
+    parser.add_argument("--model-path", default=None, help="Checkpoint directory (default: the model's ai_models dir)")
+    parser.add_argument("--output-dir", default=None, help="Where final artifacts are linked (default: <model-path>/onnx)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--kv-cache", choices=KV_CACHE_MODES, default="none")
+    parser.add_argument("--logits", choices=LOGITS_MODES, default=None)
+    parser.add_argument("--top-k", type=parse_top_k, default=DEFAULT_TOP_K)
+    parser.add_argument("--stream", action="store_true", help="Use the memory-bounded streaming exporter")
+    parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET_MB)
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default="float32")
+    parser.add_argument("--load-timeout", type=float, default=None)
+    parser.add_argument("--load-workers", type=int, default=None)
+    parser.add_argument("--optimize", action="store_true")
+    parser.add_argument("--quantize", type=parse_modes, default=[],
+                        help=f"Comma separated quantization modes ({','.join(QUANT_MODES)})")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Merge duplicate and transposed-duplicate initializers (tied embedding / LM head) of every graph")
+    parser.add_argument("--no-validate", action="store_true")
+    parser.add_argument("--prefix", dest="prefixes", type=parse_prefix_argument, action="append", default=[],
+                        help="Extra name=text prompt prefix to precompute (with --kv-cache), repeatable")
+    parser.add_argument("--no-prefix-states", action="store_true",
+                        help="Skip precomputing KV states for the declared prompt prefixes")
+    parser.add_argument("--mmap-layout", action="store_true",
+                        help="Also write <stem>_mmap.onnx with page-aligned per-layer weight files and a cold-start report")
+    parser.add_argument("--tune-sessions", action="store_true",
+                        help="Search onnxruntime session options on this machine and write <stem>.session.json sidecars")
+    parser.add_argument("--force", type=lambda value: [stage.strip() for stage in value.split(",") if stage.strip()],
+                        default=[], help=f"Comma separated stages to rerun regardless of the cache ({','.join(STAGES)})")
+    stage_trace.add_trace_arguments(parser)
+    args = parser.parse_args()
+    if args.stream and args.kv_cache not in STREAM_KV_CACHE_MODES:
+        parser.error(f"--stream cannot be combined with --kv-cache {args.kv_cache}")
+
+    with stage_trace.trace_run("model_pipeline", args.trace):
+        success = run_pipeline(
+            args.model,
+            model_path=args.model_path,
+            output_dir=args.output_dir,
+            cache_dir=args.cache_dir,
+            export_options={
+                "kv_cache": args.kv_cache,
+                "logits_mode": args.logits,
+                "top_k": args.top_k,
+                "stream": args.stream,
+                "memory_budget_mb": args.memory_budget_mb,
+                "dtype": args.dtype,
+                "load_timeout": args.load_timeout,
+                "load_workers": args.load_workers,
+            },
+            optimize=args.optimize,
+            quantize=args.quantize,
+            validate=not args.no_validate,
+            force=args.force,
+            prefixes={} if args.no_prefix_states else {**PROMPT_PREFIXES, **dict(args.prefixes)},
+            mmap_layout=args.mmap_layout,
+            tune_sessions=args.tune_sessions,
+            dedup=args.dedup,
+        )
+    if success:
+        print("\n🎉 Pipeline completed successfully!")
+    else:
+        print("\n💥 Pipeline failed. Check the error messages above.")
+        exit(1)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Per-operator profiling report for exported CrypticDash models
+Runs a graph with the onnxruntime profiler over a set of prompts, aggregates
+kernel time by op type, node and transformer layer, flags kernels that fell
+back to another provider or to unfused decompositions, and diffs two
+profiles (e.g. model.onnx vs model_q4.onnx) to show where time moved
+"""
+
+import os
+import json
+import bisect
+import argparse
+import numpy as np
+import onnxruntime as ort
+
+from ort_runtime import DecoderSession, load_session_options
+from weight_layout import LAYER_PATTERN
+from stage_trace import add_trace_arguments, stage, trace_run
+
+DEFAULT_DECODE_TOKENS = 8
+DEFAULT_TOP = 20
+FALLBACK_VOCAB_SIZE = 1000
+KERNEL_SUFFIX = "_kernel_time"
+OTHER_LAYER = "other"
+
+PROFILE_PROMPTS = (
+    "Generate a TODO list for a Flutter project:",
+    "You are an intelligent project analyzer. Analyze this repository and generate specific, "
+    "actionable TODOs based on the ACTUAL project content:\nRepository: crypticdash\n",
+    "Next steps for a Python CLI that parses requirements.txt:",
+)
+
+# Op types that only show up when optimize_onnx.py could not fuse a block
+UNFUSED_OPS = {
+    "Softmax": "attention is not fused (Attention / MultiHeadAttention / GroupQueryAttention)",
+    "Pow": "decomposed LayerNorm / RMSNorm",
+    "ReduceMean": "decomposed LayerNorm / RMSNorm",
+    "Sqrt": "decomposed LayerNorm / RMSNorm",
+    "Erf": "decomposed GELU (Gelu)",
+    "Tanh": "decomposed GELU (FastGelu)",
+    "Sin": "rotary embedding computed in the graph (RotaryEmbedding)",
+    "Cos": "rotary embedding computed in the graph (RotaryEmbedding)",
+}
+# Kernels that move or convert data rather than compute
+DATA_MOVEMENT_OPS = ("Transpose", "Cast", "Concat", "Expand", "Where", "Slice", "Gather", "Split")
+# Shape bookkeeping that runs on every step of a dynamic-shape export
+SHAPE_OPS = ("Shape", "Unsqueeze", "Squeeze", "Reshape", "Range", "Equal", "ConstantOfShape")
+QUANTIZED_MATMUL_OPS = ("MatMulNBits", "MatMulInteger", "DynamicQuantizeMatMul", "QLinearMatMul")
+# Op types below this share of kernel time are not worth flagging
+FLAG_MIN_PERCENT = 1.0
+
+
+def _generate(decoder, input_ids, decode_tokens):
+    """Run one prompt; returns the phase of every session run it made"""
+    if decode_tokens and ("logits" in decoder.outputs or decoder.topk):
+        tokens, _ = decoder.generate_greedy(input_ids, decode_tokens + 1)
+        return ["prefill"] + ["decode"] * (tokens.shape[1] - 1)
+    decoder.run(input_ids)
+    return ["prefill"]
+
+
+def layer_of(node_name):
+    match = LAYER_PATTERN.search(node_name)
+    return f"layer {int(match.group(1))}" if match else OTHER_LAYER
+
+
+def _layer_order(layer):
+    return (1, 0) if layer == OTHER_LAYER else (0, int(layer.split()[1]))
+
+
+def _add(table, key, duration, phase, **fields):
+    entry = table.setdefault(key, {**fields, "calls": 0, "total_us": 0, "prefill_us": 0, "decode_us": 0})
+    entry["calls"] += 1
+    entry["total_us"] += duration
+    entry[f"{phase}_us"] += duration
+
+
+def _ranked(table, key_name, total_us):
+    rows = []
+    for key, entry in table.items():
+        rows.append({
+            key_name: key,
+            **entry,
+            "per_call_us": entry["total_us"] / entry["calls"],
+            "percent": 100 * entry["total_us"] / total_us if total_us else 0.0,
+        })
+    return sorted(rows, key=lambda row: row["total_us"], reverse=True)
+
+
+def summarize_trace(trace_path, phases, preferred_provider="CPUExecutionProvider"):
+    """
+    Aggregate the Node events of an onnxruntime profile. `phases` names every
+    model_run in order ("warmup", "prefill" or "decode"); warmup runs are dropped.
+    """
+    with open(trace_path, "r", encoding="utf-8") as f:
+        events = json.load(f)
+    runs = sorted((event["ts"], event["ts"] + event["dur"]) for event in events
+                  if event.get("cat") == "Session" and event["name"] == "model_run")
+    if len(runs) != len(phases):
+        raise ValueError(f"Profile has {len(runs)} runs but {len(phases)} were made")
+    starts = [start for start, _ in runs]
+
+    op_types, nodes, layers = {}, {}, {}
+    total_us = 0
+    for event in events:
+        if event.get("cat") != "Node" or not event["name"].endswith(KERNEL_SUFFIX):
+            continue
+        index = bisect.bisect_right(starts, event["ts"]) - 1
+        if index < 0 or event["ts"] > runs[index][1] or phases[index] == "warmup":
+            continue
+        phase = phases[index]
+        duration = event["dur"]
+        name = event["name"][:-len(KERNEL_SUFFIX)]
+        op_type = event["args"].get("op_name", "?")
+        provider = event["args"].get("provider", "?")
+        layer = layer_of(name)
+        total_us += duration
+        _add(op_types, op_type, duration, phase)
+        _add(nodes, name, duration, phase, op_type=op_type, provider=provider, layer=layer)
+        _add(layers, layer, duration, phase)
+
+    profile = {
+        "total_us": total_us,
+        "runs": {phase: phases.count(phase) for phase in ("prefill", "decode")},
+        "op_types": _ranked(op_types, "op_type", total_us),
+        "nodes": _ranked(nodes, "node", total_us),
+        "layers": sorted(_ranked(layers, "layer", total_us), key=lambda row: _layer_order(row["layer"])),
+    }
+    profile["phases"] = {phase: sum(row[f"{phase}_us"] for row in profile["op_types"]) for phase in ("prefill", "decode")}
+    profile["flags"] = find_flags(profile, preferred_provider)
+    return profile
+
+
+def find_flags(profile, preferred_provider):
+    """Provider fallbacks, unfused decompositions, leftover fp32 MatMuls, data movement and shape bookkeeping"""
+    flags = []
+    fallbacks = [row for row in profile["nodes"] if row["provider"] != preferred_provider]
+    for row in fallbacks:
+        flags.append({"kind": "fallback", "target": row["node"], "percent": row["percent"],
+                      "reason": f"{row['op_type']} ran on {row['provider']} instead of {preferred_provider}"})
+
+    present = {row["op_type"] for row in profile["op_types"]}
+    for row in profile["op_types"]:
+        if row["percent"] < FLAG_MIN_PERCENT:
+            continue
+        op_type = row["op_type"]
+        if op_type in UNFUSED_OPS:
+            flags.append({"kind": "unfused", "target": op_type, "percent": row["percent"],
+                          "reason": UNFUSED_OPS[op_type] + " (run optimize_onnx.py)"})
+        elif op_type == "MatMul" and present.intersection(QUANTIZED_MATMUL_OPS):
+            flags.append({"kind": "slow kernel", "target": op_type, "percent": row["percent"],
+                          "reason": "fp32 MatMul left in a quantized graph"})
+        elif op_type in DATA_MOVEMENT_OPS:
+            flags.append({"kind": "data movement", "target": op_type, "percent": row["percent"],
+                          "reason": f"{row['calls']} calls copying or converting tensors"})
+        elif op_type in SHAPE_OPS:
+            flags.append({"kind": "shape arithmetic", "target": op_type, "percent": row["percent"],
+                          "reason": f"{row['calls']} calls computing shapes at run time"})
+    return sorted(flags, key=lambda flag: flag["percent"], reverse=True)
+
+
+def prompt_ids_for(model_path, decoder, prompts, seed=0):
+    from inference_server import load_tokenizer
+
+    tokenizer = load_tokenizer(model_path)
+    if tokenizer is not None:
+        return [np.array([tokenizer.encode(text)], dtype=np.int64) for text in prompts]
+    print("⚠️ No tokenizer next to the graph, using random prompt ids")
+    rng = np.random.default_rng(seed)
+    vocab_size = decoder.vocab_size or FALLBACK_VOCAB_SIZE
+    return [rng.integers(0, vocab_size, size=(1, 16 * (index + 1)), dtype=np.int64) for index in range(len(prompts))]
+
+
+def profile_model(model_path, prompts=PROFILE_PROMPTS, decode_tokens=DEFAULT_DECODE_TOKENS, trace_prefix=None):
+    """
+    Profile one graph with its tuned session options (if any) over the
+    prompts, after one warmup prompt. The raw onnxruntime trace is kept at
+    <trace_prefix>_<time>.json for Perfetto. Returns the aggregated profile.
+    """
+    options = load_session_options(model_path) or ort.SessionOptions()
+    options.enable_profiling = True
+    options.profile_file_prefix = trace_prefix or os.path.splitext(model_path)[0] + "_ort_profile"
+    decoder = DecoderSession.load(model_path, options)
+    workloads = prompt_ids_for(model_path, decoder, prompts)
+
+    phases = ["warmup"] * len(_generate(decoder, workloads[0], decode_tokens))
+    for input_ids in workloads:
+        phases += _generate(decoder, input_ids, decode_tokens)
+    trace_path = decoder.session.end_profiling()
+
+    providers = decoder.session.get_providers()
+    profile = summarize_trace(trace_path, phases, providers[0])
+    profile.update({
+        "model": os.path.basename(model_path),
+        "path": os.path.abspath(model_path),
+        "trace": trace_path,
+        "providers": providers,
+        "prompt_tokens": [int(ids.shape[1]) for ids in workloads],
+        "decode_tokens": decode_tokens,
+        "onnxruntime_version": ort.__version__,
+    })
+    return profile
+
+
+def _per_run_ms(profile, total_us):
+    runs = sum(profile["runs"].values())
+    return total_us / runs / 1000 if runs else 0.0
+
+
+def diff_profiles(base, other):
+    """
+    Per-run kernel time of `other` against `base` by op type, layer and phase.
+    Op types present in only one profile (e.g. MatMul -> MatMulNBits) get a
+    zero on the other side. Rows are sorted by the absolute change.
+    """
+    def rows(key_name, table_name):
+        base_rows = {row[key_name]: row for row in base[table_name]}
+        other_rows = {row[key_name]: row for row in other[table_name]}
+        result = []
+        for key in base_rows.keys() | other_rows.keys():
+            before = _per_run_ms(base, base_rows[key]["total_us"]) if key in base_rows else 0.0
+            after = _per_run_ms(other, other_rows[key]["total_us"]) if key in other_rows else 0.0
+            result.append({key_name: key, "base_ms": before, "other_ms": after, "delta_ms": after - before,
+                           "ratio": after / before if before else None})
+        return sorted(result, key=lambda row: abs(row["delta_ms"]), reverse=True)
+
+    def phase_ms(profile, phase):
+        runs = profile["runs"][phase]
+        return profile["phases"][phase] / runs / 1000 if runs else 0.0
+
+    base_ms, other_ms = _per_run_ms(base, base["total_us"]), _per_run_ms(other, other["total_us"])
+    return {
+        "base": base["model"],
+        "other": other["model"],
+        "total": {"base_ms": base_ms, "other_ms": other_ms, "delta_ms": other_ms - base_ms,
+                  "ratio": other_ms / base_ms if base_ms else None},
+        "phases": {phase: {"base_ms": phase_ms(base, phase), "other_ms": phase_ms(other, phase)}
+                   for phase in ("prefill", "decode")},
+        "op_types": rows("op_type", "op_types"),
+        "layers": sorted(rows("layer", "layers"), key=lambda row: _layer_order(row["layer"])),
+    }
+
+
+def write_profile_report(profile, report_path, top=DEFAULT_TOP):
+    """Markdown hotspot tables plus a JSON copy next to it"""
+    total_ms = profile["total_us"] / 1000
+    runs = profile["runs"]
+    lines = [
+        f"# Operator profile: {profile['model']}",
+        "",
+        f"- Providers: {', '.join(profile['providers'])}, onnxruntime {profile['onnxruntime_version']}",
+        f"- Prompts: {len(profile['prompt_tokens'])} ({', '.join(map(str, profile['prompt_tokens']))} tokens), "
+        f"{profile['decode_tokens']} decode token(s) each",
+        f"- Kernel time: {total_ms:.1f} ms over {runs['prefill']} prefill and {runs['decode']} decode run(s) "
+        f"(prefill {profile['phases']['prefill'] / 1000:.1f} ms, decode {profile['phases']['decode'] / 1000:.1f} ms)",
+        f"- Raw trace: {profile['trace']}",
+        "",
+        "## Flags",
+        "",
+    ]
+    if profile["flags"]:
+        lines += [f"- **{flag['kind']}** {flag['target']} ({flag['percent']:.1f}%): {flag['reason']}"
+                  for flag in profile["flags"]]
+    else:
+        lines.append("- None")
+    lines += [
+        "",
+        "## By op type",
+        "",
+        "| Op type | Calls | Total (ms) | Per call (us) | Share | Prefill (ms) | Decode (ms) |",
+        "|---|---|---|---|---|---|---|",
+    ]
+    for row in profile["op_types"]:
+        lines.append(f"| {row['op_type']} | {row['calls']} | {row['total_us'] / 1000:.2f} | {row['per_call_us']:.1f} | "
+                     f"{row['percent']:.1f}% | {row['prefill_us'] / 1000:.2f} | {row['decode_us'] / 1000:.2f} |")
+    lines += [
+        "",
+        f"## Top {top} nodes by total time",
+        "",
+        "| Node | Op type | Layer | Calls | Total (ms) | Per call (us) | Share |",
+        "|---|---|---|---|---|---|---|",
+    ]
+    for row in profile["nodes"][:top]:
+        lines.append(f"| {row['node']} | {row['op_type']} | {row['layer']} | {row['calls']} | "
+                     f"{row['total_us'] / 1000:.2f} | {row['per_call_us']:.1f} | {row['percent']:.1f}% |")
+    lines += [
+        "",
+        f"## Top {top} nodes by time per call",
+        "",
+        "| Node | Op type | Per call (us) | Calls |",
+        "|---|---|---|---|",
+    ]
+    for row in sorted(profile["nodes"], key=lambda row: row["per_call_us"], reverse=True)[:top]:
+        lines.append(f"| {row['node']} | {row['op_type']} | {row['per_call_us']:.1f} | {row['calls']} |")
+    lines += [
+        "",
+        "## By layer",
+        "",
+        "| Layer | Total (ms) | Share | Prefill (ms) | Decode (ms) |",
+        "|---|---|---|---|---|",
+    ]
+    for row in profile["layers"]:
+        lines.append(f"| {row['layer']} | {row['total_us'] / 1000:.2f} | {row['percent']:.1f}% | "
+                     f"{row['prefill_us'] / 1000:.2f} | {row['decode_us'] / 1000:.2f} |")
+    lines.append("")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    return report_path
+
+
+def _ratio(row):
+    return f"{row['ratio']:.2f}x" if row["ratio"] is not None else "new"
+
+
+def write_diff_report(diff, report_path):
+    """Markdown before/after tables plus a JSON copy next to it"""
+    total = diff["total"]
+    lines = [
+        f"# Operator profile diff: {diff['base']} -> {diff['other']}",
+        "",
+        f"- Kernel time per run: {total['base_ms']:.2f} ms -> {total['other_ms']:.2f} ms ({_ratio(total)})",
+        *(f"- {phase.capitalize()} per run: {values['base_ms']:.2f} ms -> {values['other_ms']:.2f} ms"
+          for phase, values in diff["phases"].items()),
+        "",
+        "## By op type (largest change first)",
+        "",
+        f"| Op type | {diff['base']} (ms/run) | {diff['other']} (ms/run) | Change (ms/run) | Ratio |",
+        "|---|---|---|---|---|",
+    ]
+    for row in diff["op_types"]:
+        lines.append(f"| {row['op_type']} | {row['base_ms']:.3f} | {row['other_ms']:.3f} | {row['delta_ms']:+.3f} | "
+                     f"{_ratio(row)} |")
+    lines += [
+        "",
+        "## By layer",
+        "",
+        f"| Layer | {diff['base']} (ms/run) | {diff['other']} (ms/run) | Change (ms/run) | Ratio |",
+        "|---|---|---|---|---|",
+    ]
+    for row in diff["layers"]:
+        lines.append(f"| {row['layer']} | {row['base_ms']:.3f} | {row['other_ms']:.3f} | {row['delta_ms']:+.3f} | "
+                     f"{_ratio(row)} |")
+    lines.append("")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(diff, f, indent=2)
+    return report_path
+
+
+def print_hotspots(profile, top=5):
+    print(f"   - {profile['total_us'] / 1000:.1f} ms kernel time, top op types:")
+    for row in profile["op_types"][:top]:
+        print(f"     {row['op_type']:<28} {row['total_us'] / 1000:9.2f} ms {row['percent']:5.1f}% "
+              f"({row['calls']} calls, {row['per_call_us']:.1f} us/call)")
+    for flag in profile["flags"]:
+        print(f"   ⚠️ {flag['kind']}: {flag['target']} ({flag['percent']:.1f}%) {flag['reason']}")
+
+
+def load_profile(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run_profiles(model_paths, prompts=PROFILE_PROMPTS, decode_tokens=DEFAULT_DECODE_TOKENS, top=DEFAULT_TOP,
+                 baseline_path=None):
+    """
+    Profile every graph into <stem>_profile.md, then diff each one against
+    the baseline profile JSON, or against the first graph when there is no
+    baseline, into <stem>_vs_<base stem>_profile_diff.md
+    """
+    try:
+        profiles = []
+        for model_path in model_paths:
+            print(f"🔍 Profiling {model_path}...")
+            with stage("profile", model=os.path.basename(model_path)):
+                profile = profile_model(model_path, prompts, decode_tokens)
+            report_path = write_profile_report(profile, os.path.splitext(model_path)[0] + "_profile.md", top)
+            print_hotspots(profile)
+            print(f"📝 Wrote {report_path}")
+            profiles.append(profile)
+
+        base = load_profile(baseline_path) if baseline_path else profiles[0]
+        for profile in profiles if baseline_path else profiles[1:]:
+            diff = diff_profiles(base, profile)
+            report_path = os.path.splitext(profile["path"])[0] + \
+                f"_vs_{os.path.splitext(base['model'])[0]}_profile_diff.md"
+            write_diff_report(diff, report_path)
+            total = diff["total"]
+            print(f"📊 {diff['other']} vs {diff['base']}: {total['base_ms']:.2f} -> {total['other_ms']:.2f} ms/run "
+                  f"({_ratio(total)})")
+            for row in diff["op_types"][:5]:
+                print(f"   - {row['op_type']:<28} {row['delta_ms']:+9.3f} ms/run ({_ratio(row)})")
+            print(f"📝 Wrote {report_path}")
+        return True
+    except Exception as e:
+        print(f"❌ Error during profiling: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-operator onnxruntime profile of exported graphs")
+    parser.add_argument("models", nargs="+",
+                        help="Graphs to profile; later graphs are diffed against the first (e.g. model.onnx model_q4.onnx)")
+    parser.add_argument("--baseline", default=None, help="Diff every graph against this saved <stem>_profile.json instead")
+    parser.add_argument("--prompt", dest="prompts", action="append", default=[],
+                        help="Prompt text, repeatable (default: built-in TODO prompts)")
+    parser.add_argument("--decode-tokens", type=int, default=DEFAULT_DECODE_TOKENS,
+                        help="Greedy tokens generated after each prompt (0 for prefill only)")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="Nodes listed in the hotspot tables")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"🚀 Profiling {len(args.models)} graph(s)")
+    with trace_run("op_profiler", args.trace):
+        success = run_profiles(args.models, args.prompts or PROFILE_PROMPTS, args.decode_tokens, args.top, args.baseline)
+
+    if success:
+        print("\n🎉 Profiling completed!")
+    else:
+        print("\n💥 Profiling failed. Check the messages above.")
+        exit(1)
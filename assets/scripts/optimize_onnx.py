@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Offline graph optimization for exported CrypticDash ONNX models
+Fuses attention / LayerNorm / RMSNorm / GELU / rotary embeddings, drops dead
+initializers and saves the ORT-optimized graph so sessions skip that work
+"""
+
+import os
+import json
+import argparse
+import onnx
+import onnxruntime as ort
+
+from ort_runtime import EXTERNAL_DATA_THRESHOLD, create_session, model_size_bytes
+from stage_trace import add_trace_arguments, stage, trace_run
+
+# onnxruntime.transformers fusion profile; "gpt2" covers decoder-only models
+DEFAULT_FUSION_MODEL_TYPE = "gpt2"
+
+
+def optimized_path(model_path):
+    stem, ext = os.path.splitext(model_path)
+    return f"{stem}_optimized{ext}"
+
+
+def node_count(model_path):
+    return len(onnx.load(model_path, load_external_data=False).graph.node)
+
+
+def _read_model_config(model_path, config_path=None):
+    """
+    num_heads / hidden_size from the checkpoint's config.json, else one next to
+    the graph or in its parent (exports go to <checkpoint>/onnx)
+    """
+    model_dir = os.path.dirname(os.path.abspath(model_path))
+    candidates = [config_path] if config_path else [
+        os.path.join(model_dir, "config.json"), os.path.join(os.path.dirname(model_dir), "config.json")]
+    config_path = next((path for path in candidates if os.path.exists(path)), None)
+    if config_path is None:
+        return 0, 0
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    config = config.get("text_config", config)
+    return config.get("num_attention_heads", 0), config.get("hidden_size", 0)
+
+
+def _fusion_options(model_type):
+    from onnxruntime.transformers.fusion_options import FusionOptions
+
+    options = FusionOptions(model_type)
+    options.enable_attention = True
+    options.enable_layer_norm = True
+    options.enable_skip_layer_norm = True
+    options.enable_gelu = True
+    options.enable_bias_gelu = True
+    # Keep exact GELU numerics; the tanh approximation is a separate accuracy decision
+    options.enable_gelu_approximation = False
+    if hasattr(options, "enable_rotary_embeddings"):
+        options.enable_rotary_embeddings = True
+    return options
+
+
+def _external_locations(model):
+    from onnx.external_data_helper import uses_external_data
+
+    return sorted({
+        entry.value
+        for tensor in model.graph.initializer if uses_external_data(tensor)
+        for entry in tensor.external_data if entry.key == "location"
+    })
+
+
+def remove_model(model_path):
+    """Delete a model file and any external-data files it references"""
+    model = onnx.load(model_path, load_external_data=False)
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    for location in _external_locations(model):
+        path = os.path.join(base_dir, location)
+        if os.path.exists(path):
+            os.remove(path)
+    os.remove(model_path)
+
+
+def move_model(source, destination):
+    """
+    Move a model over another one without re-serializing its weights. The
+    destination's old external data is deleted and the moved data file is
+    renamed after the destination graph (<name>.onnx.data).
+    """
+    if os.path.exists(destination):
+        remove_model(destination)
+    model = onnx.load(source, load_external_data=False)
+    source_dir = os.path.dirname(os.path.abspath(source))
+    destination_dir = os.path.dirname(os.path.abspath(destination))
+    locations = _external_locations(model)
+    renamed = {}
+    for index, location in enumerate(locations):
+        name = os.path.basename(destination) + (".data" if len(locations) == 1 else f".{index}.data")
+        os.replace(os.path.join(source_dir, location), os.path.join(destination_dir, name))
+        renamed[location] = name
+    for tensor in model.graph.initializer:
+        for entry in tensor.external_data:
+            if entry.key == "location":
+                entry.value = renamed[entry.value]
+    # Offsets are unchanged, so only the small graph proto is rewritten
+    with open(destination, "wb") as f:
+        f.write(model.SerializeToString())
+    os.remove(source)
+
+
+def optimize_model_file(model_path, output_path=None, model_type=DEFAULT_FUSION_MODEL_TYPE,
+                        num_heads=None, hidden_size=None, config_path=None):
+    """
+    Run transformer fusions, prune dead nodes/initializers, then let ORT apply
+    its extended CPU optimizations and save the result offline.
+    Returns (output_path, fused operator statistics).
+    """
+    from onnxruntime.transformers.optimizer import optimize_model
+
+    output_path = output_path or optimized_path(model_path)
+    if num_heads is None or hidden_size is None:
+        config_heads, config_hidden = _read_model_config(model_path, config_path)
+        num_heads = num_heads if num_heads is not None else config_heads
+        hidden_size = hidden_size if hidden_size is not None else config_hidden
+        if not num_heads or not hidden_size:
+            # 0 makes onnxruntime guess from the graph, which is unreliable for grouped-query attention
+            print("   ⚠️ num_heads / hidden_size unknown (no config.json found); attention fusion will auto-detect them")
+    large = model_size_bytes(model_path) >= EXTERNAL_DATA_THRESHOLD
+
+    print(f"🔧 Fusing transformer ops ({model_type}, heads={num_heads}, hidden={hidden_size})...")
+    fused = optimize_model(
+        model_path,
+        model_type=model_type,
+        num_heads=num_heads,
+        hidden_size=hidden_size,
+        opt_level=0,  # Python fusions only; ORT passes run below
+        optimization_options=_fusion_options(model_type),
+        use_gpu=False,
+    )
+    fused.prune_graph()  # Drops dead nodes and the initializers only they used
+    stats = {op: count for op, count in fused.get_fused_operator_statistics().items() if count}
+
+    fused_path = os.path.splitext(output_path)[0] + ".fused.onnx"
+    fused.save_model_to_file(fused_path, use_external_data_format=large)
+    del fused
+
+    print("🔧 Applying onnxruntime offline optimizations...")
+    session_options = ort.SessionOptions()
+    # EXTENDED is portable across CPUs; ENABLE_ALL adds machine-specific layout changes
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    session_options.optimized_model_filepath = output_path
+    if large:
+        session_options.add_session_config_entry(
+            "session.optimized_model_external_initializers_file_name", os.path.basename(output_path) + ".data"
+        )
+        session_options.add_session_config_entry(
+            "session.optimized_model_external_initializers_min_size_in_bytes", "1024"
+        )
+    ort.InferenceSession(fused_path, session_options, providers=["CPUExecutionProvider"])
+    remove_model(fused_path)
+
+    return output_path, stats
+
+
+def _startup_seconds(model_path, level, repeats=3):
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = level
+    timings = []
+    for _ in range(repeats):
+        _, seconds = create_session(model_path, session_options)
+        timings.append(seconds)
+    return min(timings)
+
+
+def optimization_report(original_path, optimized_model_path, stats):
+    """Before/after node count, size and session startup time"""
+    default_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    report = {
+        "original": {
+            "path": original_path,
+            "nodes": node_count(original_path),
+            "size_mb": model_size_bytes(original_path) / (1024 * 1024),
+            "startup_s": _startup_seconds(original_path, default_level),
+        },
+        "optimized": {
+            "path": optimized_model_path,
+            "nodes": node_count(optimized_model_path),
+            "size_mb": model_size_bytes(optimized_model_path) / (1024 * 1024),
+            "startup_s": _startup_seconds(optimized_model_path, default_level),
+            # How the app should load it: the graph is already optimized
+            "startup_no_opt_s": _startup_seconds(
+                optimized_model_path, ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            ),
+        },
+        "fused_operators": stats,
+    }
+
+    before, after = report["original"], report["optimized"]
+    print("📊 Optimization report:")
+    print(f"   - Nodes:   {before['nodes']:>8,} -> {after['nodes']:,}")
+    print(f"   - Size:    {before['size_mb']:>8.1f} -> {after['size_mb']:.1f} MB")
+    print(f"   - Startup: {before['startup_s']:>8.2f} -> {after['startup_s']:.2f} s "
+          f"({after['startup_no_opt_s']:.2f} s with graph optimizations disabled)")
+    for op, count in sorted(stats.items()):
+        print(f"   - Fused {op}: {count}")
+    return report
+
+
+def run_optimization_stage(model_path, output_path=None, replace=False, **options):
+    """
+    Optimize an exported model and write <stem>_optimization.json next to it.
+    With replace=True the optimized graph takes the original file name, so
+    later stages (quantization) and the app pick it up unchanged.
+    """
+    try:
+        with stage("optimize", model=os.path.basename(model_path)):
+            output, stats = optimize_model_file(model_path, output_path, **options)
+        with stage("optimization report"):
+            report = optimization_report(model_path, output, stats)
+        with open(os.path.splitext(model_path)[0] + "_optimization.json", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        if replace:
+            move_model(output, model_path)
+            output = model_path
+        print(f"✅ Optimized model: {output}")
+        return output
+    except Exception as e:
+        print(f"❌ Error during optimization: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuse and offline-optimize an exported ONNX model")
+    parser.add_argument("model", help="Path to the exported model.onnx")
+    parser.add_argument("--output", default=None, help="Defaults to <stem>_optimized.onnx")
+    parser.add_argument("--model-type", default=DEFAULT_FUSION_MODEL_TYPE,
+                        help="onnxruntime.transformers fusion profile (gpt2, phi, bert, ...)")
+    parser.add_argument("--config", default=None,
+                        help="Checkpoint config.json (default: next to the model or in its parent directory)")
+    parser.add_argument("--num-heads", type=int, default=None, help="Defaults to num_attention_heads in the config")
+    parser.add_argument("--hidden-size", type=int, default=None, help="Defaults to hidden_size in the config")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("optimize_onnx", args.trace):
+        output = run_optimization_stage(
+            args.model,
+            args.output,
+            model_type=args.model_type,
+            num_heads=args.num_heads,
+            hidden_size=args.hidden_size,
+            config_path=args.config,
+        )
+    if output:
+        print("\n🎉 Optimization completed successfully!")
+    else:
+        print("\n💥 Optimization failed. Check the error messages above.")
+        exit(1)
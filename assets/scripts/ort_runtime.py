@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Shared onnxruntime helpers for running exported CrypticDash models
+Handles plain (input_ids only), last/top-k logits and KV-cache graphs
+"""
+
+import os
+import json
+import time
+import numpy as np
+import onnxruntime as ort
+
+DEFAULT_PROVIDERS = ("CPUExecutionProvider",)
+
+# protobuf cannot serialize a single model file past 2 GB
+EXTERNAL_DATA_THRESHOLD = 2 * 1024 ** 3
+
+# Tuned SessionOptions written by session_tuner.py next to a graph
+SESSION_CONFIG_SUFFIX = ".session.json"
+
+PAST_PREFIX = "past_key_values."
+PRESENT_PREFIX = "present."
+
+_NUMPY_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(int64)": np.int64,
+    "tensor(int32)": np.int32,
+}
+
+
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+OPTIMIZATION_LEVELS = {
+    "disabled": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def session_config_path(model_path):
+    return os.path.splitext(model_path)[0] + SESSION_CONFIG_SUFFIX
+
+
+def build_session_options(config):
+    """
+    SessionOptions from a JSON-friendly dict: SessionOptions attribute names,
+    execution_mode / graph_optimization_level by name, and session config
+    entries under "config_entries"
+    """
+    options = ort.SessionOptions()
+    for key, value in config.items():
+        if key == "config_entries":
+            for entry, entry_value in value.items():
+                options.add_session_config_entry(entry, str(entry_value))
+            continue
+        if key == "execution_mode":
+            value = EXECUTION_MODES[value]
+        elif key == "graph_optimization_level":
+            value = OPTIMIZATION_LEVELS[value]
+        setattr(options, key, value)
+    return options
+
+
+def load_session_options(model_path):
+    """SessionOptions from the tuned sidecar next to a graph, or None when there is none"""
+    path = session_config_path(model_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return build_session_options(json.load(f)["session_options"])
+    except Exception as e:
+        print(f"⚠️ Ignoring session config {path}: {e}")
+        return None
+
+
+def create_session(model_path, session_options=None, providers=DEFAULT_PROVIDERS):
+    """
+    Create an onnxruntime session and return it with its creation time in
+    seconds. Without explicit session_options the tuned sidecar is used when present.
+    """
+    if session_options is None:
+        session_options = load_session_options(model_path)
+    start = time.perf_counter()
+    session = ort.InferenceSession(model_path, sess_options=session_options, providers=list(providers))
+    return session, time.perf_counter() - start
+
+
+def model_size_bytes(model_path):
+    """Size of an ONNX model including any external-data files it references"""
+    import onnx
+    from onnx.external_data_helper import uses_external_data
+
+    total = os.path.getsize(model_path)
+    model = onnx.load(model_path, load_external_data=False)
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    locations = set()
+    for tensor in model.graph.initializer:
+        if uses_external_data(tensor):
+            for entry in tensor.external_data:
+                if entry.key == "location":
+                    locations.add(entry.value)
+    for location in locations:
+        path = os.path.join(base_dir, location)
+        if os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def tensor_bytes(tensor, base_dir):
+    """Raw little-endian bytes of an initializer, embedded or in an external-data file under base_dir"""
+    from onnx import numpy_helper
+    from onnx.external_data_helper import uses_external_data
+
+    if uses_external_data(tensor):
+        info = {entry.key: entry.value for entry in tensor.external_data}
+        with open(os.path.join(base_dir, info["location"]), "rb") as f:
+            f.seek(int(info.get("offset", 0)))
+            return f.read(int(info["length"])) if "length" in info else f.read()
+    if tensor.HasField("raw_data"):
+        return tensor.raw_data
+    return numpy_helper.to_array(tensor).tobytes()
+
+
+def tensor_array(tensor, data):
+    """Read-only array view of an initializer's bytes (from tensor_bytes) with its dtype and shape"""
+    from onnx import helper
+
+    return np.frombuffer(data, dtype=helper.tensor_dtype_to_np_dtype(tensor.data_type)).reshape(tuple(tensor.dims))
+
+
+class DecoderSession:
+    """
+    Feeds input_ids / attention_mask / position_ids / past_key_values.* to
+    whichever of them the graph declares, and maps present.* outputs back to
+    past inputs so the result of one run can be fed into the next.
+    """
+
+    def __init__(self, session, load_seconds=0.0):
+        self.session = session
+        self.load_seconds = load_seconds
+        self.inputs = {meta.name: meta for meta in session.get_inputs()}
+        self.outputs = {meta.name: meta for meta in session.get_outputs()}
+        self.output_names = list(self.outputs)
+        self.past_names = [name for name in self.inputs if name.startswith(PAST_PREFIX)]
+        self.present_names = [name for name in self.output_names if name.startswith(PRESENT_PREFIX)]
+        self.has_past = bool(self.past_names)
+        self.topk = "topk_ids" in self.outputs
+
+    @classmethod
+    def load(cls, model_path, session_options=None, providers=DEFAULT_PROVIDERS):
+        session, load_seconds = create_session(model_path, session_options, providers)
+        return cls(session, load_seconds)
+
+    @property
+    def vocab_size(self):
+        """Vocabulary size from the logits output shape, or None when it is not static"""
+        meta = self.outputs.get("logits")
+        if meta is not None and isinstance(meta.shape[-1], int):
+            return meta.shape[-1]
+        return None
+
+    def empty_past(self, batch_size):
+        """Zero-length past state for prefilling a merged KV-cache graph"""
+        past = {}
+        for name in self.past_names:
+            meta = self.inputs[name]
+            _, num_heads, _, head_dim = meta.shape
+            past[name] = np.zeros((batch_size, num_heads, 0, head_dim), dtype=_NUMPY_DTYPES[meta.type])
+        return past
+
+    def run(self, input_ids, attention_mask=None, past=None):
+        """
+        Run one forward pass.
+
+        attention_mask covers past + current tokens (0 marks padding).
+        Returns (outputs by name, present state keyed by past input name or None).
+        """
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        batch_size, sequence_length = input_ids.shape
+        if self.has_past and past is None:
+            past = self.empty_past(batch_size)
+        past_length = next(iter(past.values())).shape[2] if past else 0
+
+        if attention_mask is None:
+            attention_mask = np.ones((batch_size, past_length + sequence_length), dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+        position_ids = np.cumsum(attention_mask, axis=1) - 1
+        position_ids = np.where(attention_mask == 0, 1, position_ids)[:, -sequence_length:]
+
+        feed = {"input_ids": input_ids}
+        if "attention_mask" in self.inputs:
+            feed["attention_mask"] = attention_mask
+        if "position_ids" in self.inputs:
+            feed["position_ids"] = position_ids
+        if self.has_past:
+            feed.update(past)
+
+        values = self.session.run(self.output_names, feed)
+        outputs = dict(zip(self.output_names, values))
+        present = None
+        if self.present_names:
+            present = {
+                name.replace(PRESENT_PREFIX, PAST_PREFIX, 1): outputs[name]
+                for name in self.present_names
+            }
+        return outputs, present
+
+    def next_token_scores(self, outputs):
+        """Last-position scores: ([B, vocab] logits, None) or ([B, k] scores, [B, k] ids)"""
+        if self.topk:
+            return outputs["topk_logits"], outputs["topk_ids"]
+        logits = outputs["logits"]
+        if logits.ndim == 3:
+            logits = logits[:, -1, :]
+        return logits, None
+
+    def greedy_tokens(self, outputs):
+        """Greedy next token per batch row"""
+        scores, ids = self.next_token_scores(outputs)
+        if ids is not None:
+            return ids[:, 0]
+        return scores.argmax(axis=-1)
+
+    def generate_greedy(self, prompt_ids, max_new_tokens, attention_mask=None,
+                        eos_token_id=None, decode_session=None, past=None):
+        """
+        Greedy decoding from a [B, S] prompt.
+
+        Graphs without a KV cache re-run the whole sequence every step. For
+        split prefill/decode exports pass the decode graph as decode_session.
+        `past` starts from an existing KV state (e.g. a precomputed prompt
+        prefix); prompt_ids then only holds the tokens that follow it.
+        Returns (generated [B, n] ids, {"prefill_s": float, "step_s": [float, ...]}).
+        """
+        step_session = decode_session or self
+        prompt_ids = np.asarray(prompt_ids, dtype=np.int64)
+        batch_size = prompt_ids.shape[0]
+        past_length = next(iter(past.values())).shape[2] if past else 0
+        if attention_mask is None:
+            attention_mask = np.ones((batch_size, past_length + prompt_ids.shape[1]), dtype=np.int64)
+        attention_mask = np.asarray(attention_mask, dtype=np.int64)
+
+        start = time.perf_counter()
+        if past:
+            outputs, past, last_session = run_with_past(self, prompt_ids, attention_mask, past, decode_session)
+        else:
+            outputs, past = self.run(prompt_ids, attention_mask)
+            last_session = self
+        timings = {"prefill_s": time.perf_counter() - start, "step_s": []}
+
+        sequence = prompt_ids
+        generated = []
+        finished = np.zeros(batch_size, dtype=bool)
+        for _ in range(max_new_tokens):
+            next_tokens = last_session.greedy_tokens(outputs).astype(np.int64)
+            if eos_token_id is not None:
+                next_tokens = np.where(finished, eos_token_id, next_tokens)
+                finished |= next_tokens == eos_token_id
+            generated.append(next_tokens)
+            if finished.all() or len(generated) == max_new_tokens:
+                break
+
+            attention_mask = np.concatenate([attention_mask, np.ones((batch_size, 1), dtype=np.int64)], axis=1)
+            start = time.perf_counter()
+            if past is not None and step_session.has_past:
+                last_session = step_session
+                outputs, past = step_session.run(next_tokens[:, None], attention_mask, past)
+            else:
+                sequence = np.concatenate([sequence, next_tokens[:, None]], axis=1)
+                outputs, past = self.run(sequence, attention_mask)
+            timings["step_s"].append(time.perf_counter() - start)
+
+        tokens = np.stack(generated, axis=1) if generated else np.zeros((batch_size, 0), dtype=np.int64)
+        return tokens, timings
+
+
+def run_with_past(decoder, input_ids, attention_mask, past, decode_session=None):
+    """
+    Continue from an existing KV state with several new tokens.
+
+    Merged graphs take the state and all tokens in one run. The prefill graph
+    of a split export has no past inputs, so the tokens go through the
+    single-token decode graph one at a time instead.
+    Returns (outputs, present, session that produced the outputs).
+    """
+    input_ids = np.asarray(input_ids, dtype=np.int64)
+    if decoder.has_past:
+        outputs, present = decoder.run(input_ids, attention_mask, past)
+        return outputs, present, decoder
+    if decode_session is None or not decode_session.has_past:
+        raise ValueError("Continuing from a KV state needs a graph with past_key_values inputs")
+    past_length = attention_mask.shape[1] - input_ids.shape[1]
+    for column in range(input_ids.shape[1]):
+        outputs, past = decode_session.run(
+            input_ids[:, column:column + 1], attention_mask[:, :past_length + column + 1], past
+        )
+    return outputs, past, decode_session
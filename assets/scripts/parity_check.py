@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+PyTorch-vs-ONNX numerical parity check for exported CrypticDash models
+Feeds the same inputs to the Hugging Face checkpoint and to every precision
+variant of an exported graph over a matrix of batch sizes and sequence lengths,
+and reports logit error and top-k agreement per case
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+from quantize_onnx import QUANT_MODES, quantized_path
+from stage_trace import add_trace_arguments, stage, trace_run
+
+DEFAULT_BATCH_SIZES = (1, 2, 4)
+DEFAULT_SEQUENCE_LENGTHS = (1, 16, 128)
+DEFAULT_AGREEMENT_K = 5
+PRECISIONS = ("fp32",) + QUANT_MODES
+
+# Minimum top-1 agreement and maximum mean abs logit error per precision
+TOLERANCES = {
+    "fp32": {"top1": 0.99, "mean_abs": 1e-2},
+    "fp16": {"top1": 0.95, "mean_abs": 1e-1},
+    "int8": {"top1": 0.80, "mean_abs": None},
+    "int4": {"top1": 0.70, "mean_abs": None},
+}
+
+# Share of the currently available memory the worker pool may plan to use
+MEMORY_HEADROOM = 0.8
+
+
+def discover_variants(graph_path, precisions=PRECISIONS):
+    """{precision: path} for the graph and the quantized variants written next to it"""
+    variants = {}
+    for precision in precisions:
+        path = graph_path if precision == "fp32" else quantized_path(graph_path, precision)
+        if os.path.exists(path):
+            variants[precision] = path
+        elif precision != "fp32":
+            print(f"⚠️ No {precision} variant ({os.path.basename(path)}), skipping")
+    return variants
+
+
+def tolerance_key(precision, path):
+    """
+    Which TOLERANCES entry a variant is held to. The base graph keeps the
+    dtype the converter loaded the checkpoint in (float16 for Phi-2), so it
+    is judged by its weights rather than by its "fp32" slot.
+    """
+    if precision != "fp32":
+        return precision
+    import onnx
+
+    elements = {}
+    for tensor in onnx.load(path, load_external_data=False).graph.initializer:
+        elements[tensor.data_type] = elements.get(tensor.data_type, 0) + int(np.prod(tensor.dims))
+    half = elements.get(onnx.TensorProto.FLOAT16, 0) + elements.get(onnx.TensorProto.BFLOAT16, 0)
+    return "fp16" if half > elements.get(onnx.TensorProto.FLOAT, 0) else "fp32"
+
+
+def default_workers(model_path, variants, cases):
+    """
+    Half the CPUs, capped by memory: every worker holds an fp32 copy of the
+    checkpoint plus every variant (about 11 GB per worker for Phi-2)
+    """
+    from ort_runtime import model_size_bytes
+
+    workers = max(1, min(cases, (os.cpu_count() or 1) // 2))
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return 1  # No portable way to ask; one worker is always safe
+    checkpoint = sum(os.path.getsize(os.path.join(model_path, name)) for name in os.listdir(model_path)
+                     if name.endswith((".safetensors", ".bin")))
+    with open(os.path.join(model_path, "config.json"), "r", encoding="utf-8") as f:
+        stored = json.load(f).get("torch_dtype", "float32")
+    # The reference is loaded in fp32 whatever dtype the checkpoint is stored in
+    per_worker = checkpoint * (2 if stored in ("float16", "bfloat16") else 1)
+    per_worker += sum(model_size_bytes(path) for path in variants.values())
+    return max(1, min(workers, int(available * MEMORY_HEADROOM // max(1, per_worker))))
+
+
+def make_inputs(batch_size, sequence_length, vocab_size, padded, seed=0):
+    """
+    Random ids and a left-padded attention mask. With padding every row
+    after the first loses up to half its tokens, like a mixed-length batch.
+    """
+    rng = np.random.default_rng([seed, batch_size, sequence_length])
+    input_ids = rng.integers(0, vocab_size, size=(batch_size, sequence_length), dtype=np.int64)
+    attention_mask = np.ones_like(input_ids)
+    if padded and sequence_length > 1:
+        for row in range(1, batch_size):
+            attention_mask[row, :int(rng.integers(0, sequence_length // 2 + 1))] = 0
+    input_ids = np.where(attention_mask == 0, 0, input_ids)
+    return input_ids, attention_mask
+
+
+def compare_scores(reference, candidate, candidate_ids=None, k=DEFAULT_AGREEMENT_K):
+    """
+    Error and agreement between [N, vocab] reference logits and a candidate:
+    [N, vocab] logits, or [N, k'] scores at candidate_ids for top-k graphs.
+    """
+    reference_top = np.argsort(-reference, axis=-1, kind="stable")
+    if candidate_ids is None:
+        diff = np.abs(reference - candidate)
+        candidate_top = np.argsort(-candidate, axis=-1, kind="stable")
+    else:
+        # Top-k graphs only return scores at their own ids
+        diff = np.abs(np.take_along_axis(reference, candidate_ids, axis=-1) - candidate)
+        candidate_top = candidate_ids
+    k = min(k, candidate_top.shape[-1])
+    overlap = [
+        len(np.intersect1d(reference_row[:k], candidate_row[:k])) / k
+        for reference_row, candidate_row in zip(reference_top, candidate_top)
+    ]
+    return {
+        "max_abs_error": float(diff.max()),
+        "mean_abs_error": float(diff.mean()),
+        "top1_agreement": float(np.mean(reference_top[:, 0] == candidate_top[:, 0])),
+        "topk_agreement": float(np.mean(overlap)),
+    }
+
+
+def passes(key, metrics):
+    tolerance = TOLERANCES.get(key, TOLERANCES["int4"])
+    if metrics["top1_agreement"] < tolerance["top1"]:
+        return False
+    return tolerance["mean_abs"] is None or metrics["mean_abs_error"] <= tolerance["mean_abs"]
+
+
+# ---------------------------------------------------------------------------
+# Worker processes: each loads the reference model and every variant once
+# ---------------------------------------------------------------------------
+
+_worker = {}
+
+
+def _init_worker(model_path, variants, threads):
+    import torch
+    import onnxruntime as ort
+    from transformers import AutoModelForCausalLM
+    from ort_runtime import DecoderSession
+
+    torch.set_num_threads(threads)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path, torch_dtype=torch.float32, attn_implementation="eager"
+    )
+    model.eval()
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    _worker["model"] = model
+    # A variant that fails to load is reported as a failed case instead of breaking the pool
+    _worker["decoders"] = {}
+    for precision, path in variants.items():
+        try:
+            _worker["decoders"][precision] = DecoderSession.load(path, session_options=options)
+        except Exception as e:
+            _worker["decoders"][precision] = f"{type(e).__name__}: {e}"
+
+
+def _reference(input_ids, attention_mask):
+    """HF logits [B, S, V] and final hidden states projected by lm_head"""
+    import torch
+
+    model = _worker["model"]
+    ids = torch.from_numpy(input_ids)
+    mask = torch.from_numpy(attention_mask)
+    position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+    with torch.no_grad():
+        outputs = model(input_ids=ids, attention_mask=mask, position_ids=position_ids,
+                        use_cache=False, output_hidden_states=True)
+        projected = model.get_output_embeddings()(outputs.hidden_states[-1])
+    return outputs.logits.float().numpy(), projected.float().numpy()
+
+
+def _project_hidden(hidden_states):
+    import torch
+
+    with torch.no_grad():
+        head = _worker["model"].get_output_embeddings()
+        return head(torch.from_numpy(hidden_states.astype(np.float32))).float().numpy()
+
+
+def _run_case(batch_size, sequence_length, padded, k, seed, tolerances):
+    """Compare every variant for one input shape"""
+    model = _worker["model"]
+    decoders = _worker["decoders"]
+    # Graphs without an attention_mask input cannot see padding
+    padded = padded and all("attention_mask" in decoder.inputs for decoder in decoders.values()
+                            if not isinstance(decoder, str))
+    input_ids, attention_mask = make_inputs(batch_size, sequence_length, model.config.vocab_size, padded, seed)
+
+    start = time.perf_counter()
+    logits, projected = _reference(input_ids, attention_mask)
+    reference_ms = 1000 * (time.perf_counter() - start)
+    valid = attention_mask.astype(bool)
+
+    results = []
+    for precision, decoder in decoders.items():
+        case = {"precision": precision, "batch_size": batch_size, "sequence_length": sequence_length,
+                "padded": bool(not valid.all())}
+        if isinstance(decoder, str):
+            results.append({**case, "error": decoder, "passed": False})
+            continue
+        row_mask = attention_mask if "attention_mask" in decoder.inputs else None
+        # Like a load failure, a run-time failure (e.g. a kernel rejecting a shape) only fails this case
+        try:
+            start = time.perf_counter()
+            outputs, _ = decoder.run(input_ids, row_mask)
+            onnx_ms = 1000 * (time.perf_counter() - start)
+
+            candidate_ids = None
+            if decoder.topk:
+                kind, reference = "topk", logits[:, -1]
+                candidate, candidate_ids = outputs["topk_logits"], outputs["topk_ids"]
+            elif "logits" in outputs and outputs["logits"].ndim == 2:
+                kind, reference, candidate = "last", logits[:, -1], outputs["logits"]
+            elif "logits" in outputs:
+                kind, reference, candidate = "full", logits[valid], outputs["logits"][valid]
+            else:
+                # Hidden-state graphs: both sides go through the checkpoint's lm_head
+                kind, reference = "hidden", projected[valid]
+                candidate = _project_hidden(outputs[decoder.output_names[0]][valid])
+
+            metrics = compare_scores(reference, candidate.astype(np.float32), candidate_ids, k)
+        except Exception as e:
+            results.append({**case, "error": f"{type(e).__name__}: {e}", "passed": False})
+            continue
+        results.append({
+            **case,
+            "output": kind,
+            **metrics,
+            "reference_ms": reference_ms,
+            "onnx_ms": onnx_ms,
+            "tolerance": tolerances[precision],
+            "passed": passes(tolerances[precision], metrics),
+        })
+    return results
+
+
+def run_parity_check(model_path, graph_path, precisions=PRECISIONS, batch_sizes=DEFAULT_BATCH_SIZES,
+                     sequence_lengths=DEFAULT_SEQUENCE_LENGTHS, padded=True, k=DEFAULT_AGREEMENT_K,
+                     workers=None, report_path=None, seed=0):
+    """
+    Run the case matrix on a process pool and write a markdown report plus a
+    JSON copy. Returns True when every case is within its tolerance.
+    """
+    try:
+        variants = discover_variants(graph_path, precisions)
+        if not variants:
+            raise FileNotFoundError(f"No graphs to check for {graph_path}")
+        shapes = [(batch_size, sequence_length) for batch_size in batch_sizes for sequence_length in sequence_lengths]
+        tolerances = {precision: tolerance_key(precision, path) for precision, path in variants.items()}
+        for precision, key in tolerances.items():
+            if key != precision:
+                print(f"   - {precision} graph has {key} weights, checking it against the {key} tolerance")
+        workers = workers or default_workers(model_path, variants, len(shapes))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        print(f"🧪 Parity check: {len(variants)} variant(s) x {len(shapes)} shape(s) on {workers} worker(s) "
+              f"({threads} thread(s) each)")
+
+        results = []
+        with stage("parity check", variants=",".join(variants), workers=workers):
+            # Every worker holds the reference model and all variants, so memory grows with workers
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_path, variants, threads),
+            ) as pool:
+                futures = [pool.submit(_run_case, batch_size, sequence_length, padded, k, seed, tolerances)
+                           for batch_size, sequence_length in shapes]
+                for future in concurrent.futures.as_completed(futures):
+                    for case in future.result():
+                        results.append(case)
+                        if "error" in case:
+                            print(f"   ❌ {case['precision']:<5} B={case['batch_size']} S={case['sequence_length']}: "
+                                  f"{case['error']}")
+                            continue
+                        print(f"   {'✅' if case['passed'] else '❌'} {case['precision']:<5} "
+                              f"B={case['batch_size']} S={case['sequence_length']}: "
+                              f"max {case['max_abs_error']:.4f}, mean {case['mean_abs_error']:.5f}, "
+                              f"top-1 {case['top1_agreement']:.0%}, top-{k} {case['topk_agreement']:.0%}")
+
+        results.sort(key=lambda case: (PRECISIONS.index(case["precision"]), case["batch_size"], case["sequence_length"]))
+        write_parity_report(graph_path, variants, results, k, report_path)
+        failed = [case for case in results if not case["passed"]]
+        if failed:
+            print(f"❌ {len(failed)} of {len(results)} case(s) outside tolerance")
+            return False
+        print(f"✅ All {len(results)} case(s) within tolerance")
+        return True
+    except Exception as e:
+        print(f"❌ Error during parity check: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def write_parity_report(graph_path, variants, results, k=DEFAULT_AGREEMENT_K, report_path=None):
+    lines = [
+        f"# Parity report for {os.path.basename(graph_path)}",
+        "",
+        "Reference: Hugging Face checkpoint in fp32. " + ", ".join(
+            f"{precision}: {os.path.basename(path)}" for precision, path in variants.items()
+        ) + "".join(
+            f" ({case['precision']} graph checked at {case['tolerance']} tolerance)"
+            for case in {case["precision"]: case for case in results
+                         if case.get("tolerance", case["precision"]) != case["precision"]}.values()
+        ),
+        "",
+        f"| Variant | Batch | Seq | Output | Max abs err | Mean abs err | Top-1 agree | Top-{k} agree "
+        f"| Torch (ms) | ONNX (ms) | Pass |",
+        "|---|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for case in results:
+        if "error" in case:
+            lines.append(f"| {case['precision']} | {case['batch_size']} | {case['sequence_length']} "
+                         f"| error: {case['error'].splitlines()[0][:120]} | | | | | | | ❌ |")
+            continue
+        lines.append(
+            f"| {case['precision']} | {case['batch_size']} | {case['sequence_length']}"
+            f"{' (padded)' if case['padded'] else ''} | {case['output']} | {case['max_abs_error']:.4f} "
+            f"| {case['mean_abs_error']:.5f} | {case['top1_agreement']:.0%} | {case['topk_agreement']:.0%} "
+            f"| {case['reference_ms']:.1f} | {case['onnx_ms']:.1f} | {'✅' if case['passed'] else '❌'} |"
+        )
+
+    report = "\n".join(lines) + "\n"
+    report_path = report_path or os.path.splitext(graph_path)[0] + "_parity_report.md"
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write(report)
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump({"variants": variants, "tolerances": TOLERANCES, "cases": results}, f, indent=2)
+    print(report)
+    print(f"📝 Wrote {report_path}")
+    return report_path
+
+
+def parse_precisions(value):
+    precisions = [precision.strip() for precision in value.split(",") if precision.strip()]
+    for precision in precisions:
+        if precision not in PRECISIONS:
+            raise argparse.ArgumentTypeError(f"Unknown precision: {precision}")
+    return precisions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare exported ONNX graphs against the PyTorch checkpoint")
+    parser.add_argument("graph", help="fp32 graph (model.onnx, or model_prefill.onnx for split KV exports)")
+    parser.add_argument("--model-path", default="../ai_models/gemma_3_270m_it", help="Hugging Face checkpoint directory")
+    parser.add_argument("--precisions", type=parse_precisions, default=list(PRECISIONS),
+                        help="Comma separated variants to check (fp32,int8,int4,fp16)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=list(DEFAULT_BATCH_SIZES))
+    parser.add_argument("--sequence-lengths", type=int, nargs="+", default=list(DEFAULT_SEQUENCE_LENGTHS))
+    parser.add_argument("--no-padding", action="store_true", help="Use full attention masks for every row")
+    parser.add_argument("--k", type=int, default=DEFAULT_AGREEMENT_K, help="k for top-k agreement")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: half the CPUs, fewer if their models do not fit in memory)")
+    parser.add_argument("--report", default=None, help="Markdown report path")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("parity_check", args.trace):
+        success = run_parity_check(
+            args.model_path,
+            args.graph,
+            precisions=args.precisions,
+            batch_sizes=args.batch_sizes,
+            sequence_lengths=args.sequence_lengths,
+            padded=not args.no_padding,
+            k=args.k,
+            workers=args.workers,
+            report_path=args.report,
+        )
+    if success:
+        print("\n🎉 Exported graphs match the PyTorch model!")
+    else:
+        print("\n💥 Parity check failed. Check the report above.")
+        exit(1)
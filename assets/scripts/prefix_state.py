@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Precomputed KV state for fixed prompt prefixes
+Every TODO-generation prompt starts with the same instruction preamble, so the
+preamble is run once through a KV-cache export and its key/value state is stored
+next to the graph. Requests that start with it only prefill the remaining tokens.
+"""
+
+import os
+import json
+import time
+import glob
+import hashlib
+import argparse
+import numpy as np
+
+from ort_runtime import PAST_PREFIX, DecoderSession
+
+PREFIX_STATE_VERSION = 1
+PREFIX_STATE_SUFFIX = ".prefix.npz"
+
+# Declared prompt prefixes: the preamble of ONNXAIService._buildAnalysisPrompt
+# and the conversion test prompt. The analysis preamble ends on a line break so
+# the tokens of a full prompt still begin with the tokens of the prefix; the test
+# prompt is used verbatim, so it is kept as is and only matches when the text
+# after it starts a new token (a line break, as in the reuse check).
+PROMPT_PREFIXES = {
+    "todo_analysis": (
+        "You are an intelligent project analyzer. Analyze this repository and generate specific, "
+        "actionable TODOs based on the ACTUAL project content:\n"
+    ),
+    "flutter_todo": "Generate a TODO list for a Flutter project:",
+}
+
+# Appended to each prefix, on a new line, when checking that reuse matches a full prefill
+CHECK_SUFFIX = "Repository: crypticdash\n"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def encode_ids(tokenizer, text):
+    """Token ids from a BinaryTokenizer, tokenizers.Tokenizer or _TokenizerAdapter"""
+    ids = tokenizer.encode(text)
+    return list(ids if isinstance(ids, list) else ids.ids)
+
+
+def prefix_state_path(graph_path, name):
+    """<graph stem>.<name>.prefix.npz next to the graph"""
+    stem = os.path.splitext(graph_path)[0]
+    return f"{stem}.{name}{PREFIX_STATE_SUFFIX}"
+
+
+def graph_signature(decoder):
+    """Past input names, head counts and head dims a state has to match"""
+    return {name: [decoder.inputs[name].shape[1], decoder.inputs[name].shape[3], decoder.inputs[name].type]
+            for name in decoder.past_names}
+
+
+class PrefixState:
+    """The KV state of one prompt prefix, [1, heads, prefix_len, head_dim] per past input"""
+
+    def __init__(self, name, token_ids, past, meta):
+        self.name = name
+        self.token_ids = list(token_ids)
+        self.past_state = past
+        self.meta = meta
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != PREFIX_STATE_VERSION:
+                raise ValueError(f"{os.path.basename(path)} has prefix state version {meta.get('version')}, "
+                                 f"expected {PREFIX_STATE_VERSION}")
+            past = {name: data[name] for name in data.files if name.startswith(PAST_PREFIX)}
+            return cls(meta["name"], data["input_ids"].tolist(), past, meta)
+
+    def save(self, path):
+        np.savez(path, meta=np.array(json.dumps(self.meta)), input_ids=np.array(self.token_ids, dtype=np.int64),
+                 **self.past_state)
+        return path
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def reuse_length(self, prompt_ids):
+        """
+        How many leading prompt tokens the state covers (0 when the prompt
+        does not start with the prefix). At least one token is always left
+        to run, so a prompt equal to the prefix reuses all but its last token.
+        """
+        length = len(self.token_ids)
+        if length == 0 or len(prompt_ids) < length or list(prompt_ids[:length]) != self.token_ids:
+            return 0
+        return length if len(prompt_ids) > length else length - 1
+
+    def past(self, batch_size, length=None):
+        """State of the first `length` tokens, repeated for every batch row"""
+        length = len(self.token_ids) if length is None else length
+        return {name: np.repeat(value[:, :, :length], batch_size, axis=0) for name, value in self.past_state.items()}
+
+
+class PrefixCache:
+    """All prefix states stored next to one graph"""
+
+    def __init__(self, states=()):
+        self.states = list(states)
+
+    @classmethod
+    def load(cls, graph_path, decoder=None, check_graph=True):
+        """
+        Load <graph stem>.*.prefix.npz. States built from a different graph
+        (digest) or whose past inputs do not match `decoder` are skipped.
+        """
+        states = []
+        digest = file_sha256(graph_path) if check_graph else None
+        signature = graph_signature(decoder) if decoder is not None else None
+        pattern = glob.escape(os.path.splitext(graph_path)[0]) + ".*" + PREFIX_STATE_SUFFIX
+        for path in sorted(glob.glob(pattern)):
+            try:
+                state = PrefixState.load(path)
+            except Exception as e:
+                print(f"⚠️ Skipping {os.path.basename(path)}: {e}")
+                continue
+            if digest is not None and state.meta.get("graph_sha256") != digest:
+                print(f"⚠️ Skipping {os.path.basename(path)}: built for a different graph")
+                continue
+            if signature is not None and state.meta.get("signature") != signature:
+                print(f"⚠️ Skipping {os.path.basename(path)}: past inputs do not match the graph")
+                continue
+            states.append(state)
+        return cls(states)
+
+    def __bool__(self):
+        return bool(self.states)
+
+    def match(self, prompt_ids):
+        """(state, reused token count) for the longest stored prefix of prompt_ids, or (None, 0)"""
+        best, best_length = None, 0
+        for state in self.states:
+            length = state.reuse_length(prompt_ids)
+            if length > best_length:
+                best, best_length = state, length
+        return best, best_length
+
+
+def build_prefix_states(graph_path, tokenizer, prefixes=PROMPT_PREFIXES, output_dir=None):
+    """
+    Run each prefix through a KV-cache graph (merged or the _prefill graph of
+    a split export) and save its present.* outputs. Returns the written paths.
+    """
+    decoder = DecoderSession.load(graph_path)
+    if not decoder.present_names:
+        raise ValueError(f"{os.path.basename(graph_path)} has no present.* outputs; export it with --kv-cache")
+
+    signature = graph_signature(decoder)
+    if not signature:
+        # Split prefill graphs have no past inputs; the state feeds the decode graph
+        decode_path = graph_path.replace("_prefill.onnx", "_decode.onnx")
+        if os.path.exists(decode_path):
+            signature = graph_signature(DecoderSession.load(decode_path))
+
+    digest = file_sha256(graph_path)
+    written = []
+    for name, text in prefixes.items():
+        token_ids = encode_ids(tokenizer, text)
+        start = time.perf_counter()
+        _, present = decoder.run(np.array([token_ids], dtype=np.int64))
+        seconds = time.perf_counter() - start
+        meta = {
+            "version": PREFIX_STATE_VERSION,
+            "name": name,
+            "text": text,
+            "graph": os.path.basename(graph_path),
+            "graph_sha256": digest,
+            "signature": signature,
+            "num_tokens": len(token_ids),
+            "prefill_s": seconds,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        path = graph_path if output_dir is None else os.path.join(output_dir, os.path.basename(graph_path))
+        path = PrefixState(name, token_ids, present, meta).save(prefix_state_path(path, name))
+        size = os.path.getsize(path) / (1024 * 1024)
+        print(f"✅ {name}: {len(token_ids)} tokens, prefill {seconds * 1000:.1f} ms -> {os.path.basename(path)} "
+              f"({size:.1f} MB)")
+        written.append(path)
+    return written
+
+
+def generate_with_prefix(decoder, prompt_ids, cache, max_new_tokens, decode_session=None, eos_token_id=None):
+    """
+    Greedy decoding for one prompt that starts from the longest matching
+    prefix state. Returns (tokens, timings, reused token count).
+    """
+    state, length = cache.match(prompt_ids) if cache else (None, 0)
+    suffix = np.array([prompt_ids[length:]], dtype=np.int64)
+    past = state.past(1, length) if state is not None else None
+    tokens, timings = decoder.generate_greedy(suffix, max_new_tokens, eos_token_id=eos_token_id,
+                                              decode_session=decode_session, past=past)
+    return tokens[0].tolist(), timings, length
+
+
+def check_prefix_reuse(graph_path, tokenizer, prefixes=PROMPT_PREFIXES, max_new_tokens=8):
+    """
+    Compare a full prefill against starting from each stored prefix state:
+    greedy tokens must match. Returns {name: result}.
+    """
+    decoder = DecoderSession.load(graph_path)
+    decode_session = None
+    decode_path = graph_path.replace("_prefill.onnx", "_decode.onnx")
+    if decode_path != graph_path and os.path.exists(decode_path):
+        decode_session = DecoderSession.load(decode_path)
+    cache = PrefixCache.load(graph_path, decode_session or decoder)
+    stored = {state.name for state in cache.states}
+
+    results = {}
+    for name, text in prefixes.items():
+        if name not in stored:
+            print(f"   ❌ {name}: no usable prefix state next to {os.path.basename(graph_path)}")
+            results[name] = {"ok": False, "reused_tokens": 0}
+            continue
+        separator = "" if text.endswith("\n") else "\n"
+        prompt_ids = encode_ids(tokenizer, text + separator + CHECK_SUFFIX)
+        full, full_timings = decoder.generate_greedy(np.array([prompt_ids], dtype=np.int64), max_new_tokens,
+                                                     decode_session=decode_session)
+        reused, timings, length = generate_with_prefix(decoder, prompt_ids, cache, max_new_tokens, decode_session)
+        result = {
+            # A prefix whose tokens change when followed by more text is never matched, which is safe
+            "ok": full[0].tolist() == reused,
+            "prompt_tokens": len(prompt_ids),
+            "reused_tokens": length,
+            "full_prefill_s": full_timings["prefill_s"],
+            "prefix_prefill_s": timings["prefill_s"],
+        }
+        if length == 0:
+            print(f"   ⚠️ {name}: prompt tokens do not start with the prefix tokens, no reuse")
+        else:
+            print(f"   {'✅' if result['ok'] else '❌'} {name}: reused {length}/{len(prompt_ids)} tokens, prefill "
+                  f"{result['full_prefill_s'] * 1000:.1f} ms -> {result['prefix_prefill_s'] * 1000:.1f} ms")
+        results[name] = result
+    return results
+
+
+def parse_prefix_argument(value):
+    """name=text"""
+    name, separator, text = value.partition("=")
+    if not separator or not name:
+        raise argparse.ArgumentTypeError(f"Expected name=text, got {value!r}")
+    return name, text.encode("utf-8").decode("unicode_escape")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and check precomputed prompt-prefix KV states")
+    parser.add_argument("model", help="KV-cache graph (merged model.onnx or model_prefill.onnx)")
+    parser.add_argument("--prefix", dest="prefixes", type=parse_prefix_argument, action="append", default=[],
+                        help="Extra name=text prefix (\\n escapes allowed), repeatable")
+    parser.add_argument("--only", action="store_true", help="Build only the --prefix prefixes, not the declared ones")
+    parser.add_argument("--check", action="store_true", help="Only check existing states against a full prefill")
+    parser.add_argument("--max-new-tokens", type=int, default=8)
+    args = parser.parse_args()
+
+    from inference_server import load_tokenizer
+
+    prefixes = {} if args.only else dict(PROMPT_PREFIXES)
+    prefixes.update(args.prefixes)
+    try:
+        tokenizer = load_tokenizer(args.model)
+        if tokenizer is None:
+            raise FileNotFoundError("No tokenizer.bin or tokenizer.json next to the graph or in its parent")
+        if not args.check:
+            print(f"🚀 Building {len(prefixes)} prefix state(s) for {args.model}")
+            build_prefix_states(args.model, tokenizer, prefixes)
+        print("🧪 Checking prefix reuse against a full prefill...")
+        results = check_prefix_reuse(args.model, tokenizer, prefixes, args.max_new_tokens)
+        success = all(result["ok"] for result in results.values())
+    except Exception as e:
+        print(f"❌ Error during prefix state build: {e}")
+        import traceback
+        traceback.print_exc()
+        success = False
+
+    if success:
+        print("\n🎉 Prefix states are ready!")
+    else:
+        print("\n💥 Prefix state build failed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Quantization stage for exported CrypticDash ONNX models
+Produces int8 / int4 / fp16 variants and a size, latency and accuracy report
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import onnx
+
+from ort_runtime import EXTERNAL_DATA_THRESHOLD, DecoderSession, model_size_bytes
+from stage_trace import add_trace_arguments, stage, trace_run
+
+QUANT_MODES = ("int8", "int4", "fp16")
+
+# int4 keeps the name the app already loads (model_q4.onnx)
+QUANT_SUFFIXES = {"int8": "_int8", "int4": "_q4", "fp16": "_fp16"}
+
+# Normalization ops stay in fp32 when converting weights to fp16
+NORM_OP_TYPES = [
+    "LayerNormalization",
+    "SimplifiedLayerNormalization",
+    "SkipLayerNormalization",
+    "SkipSimplifiedLayerNormalization",
+    "RMSNormalization",
+]
+
+
+def quantized_path(model_path, mode):
+    """Output path of a quantized variant, e.g. model.onnx -> model_q4.onnx"""
+    stem, ext = os.path.splitext(model_path)
+    return f"{stem}{QUANT_SUFFIXES[mode]}{ext}"
+
+
+def _needs_external_data(model_path):
+    return model_size_bytes(model_path) >= EXTERNAL_DATA_THRESHOLD
+
+
+def quantize_int8(model_path, output_path):
+    """Dynamic int8 quantization (int8 weights, activations quantized at runtime)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(
+        model_path,
+        output_path,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+        use_external_data_format=_needs_external_data(model_path),
+    )
+
+
+def quantize_int4(model_path, output_path, block_size=32):
+    """Weight-only int4 block quantization of MatMul weights (MatMulNBits)"""
+    from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer
+
+    model = onnx.load(model_path)
+    quantizer = MatMul4BitsQuantizer(model, block_size=block_size, is_symmetric=True)
+    quantizer.process()
+    quantizer.model.save_model_to_file(output_path, _needs_external_data(model_path))
+
+
+def _norm_node_names(model):
+    """Nodes belonging to RMSNorm/LayerNorm blocks in a decomposed (unfused) export"""
+    names = []
+    for node in model.graph.node:
+        if "norm" in node.name.lower() or any("norm" in name.lower() for name in node.input):
+            names.append(node.name)
+    return names
+
+
+def quantize_fp16(model_path, output_path):
+    """fp16 weights and activations, keeping norms and graph I/O in fp32"""
+    from onnxruntime.transformers.float16 import DEFAULT_OP_BLOCK_LIST, convert_float_to_float16
+
+    model = onnx.load(model_path)
+    model = convert_float_to_float16(
+        model,
+        keep_io_types=True,
+        op_block_list=DEFAULT_OP_BLOCK_LIST + NORM_OP_TYPES,
+        node_block_list=_norm_node_names(model),
+    )
+    onnx.save_model(model, output_path, save_as_external_data=_needs_external_data(model_path))
+
+
+QUANTIZERS = {
+    "int8": quantize_int8,
+    "int4": quantize_int4,
+    "fp16": quantize_fp16,
+}
+
+
+def quantize_model(model_path, modes=QUANT_MODES):
+    """Write one quantized variant per mode next to model_path; returns {mode: path}"""
+    outputs = {}
+    for mode in modes:
+        output_path = quantized_path(model_path, mode)
+        print(f"🔧 Quantizing ({mode}) -> {output_path}")
+        QUANTIZERS[mode](model_path, output_path)
+        outputs[mode] = output_path
+    return outputs
+
+
+def _evaluate(model_path, prompt_ids, decode_tokens):
+    """Load time, per-token latency and last-position scores for one model"""
+    decoder = DecoderSession.load(model_path)
+    outputs, _ = decoder.run(prompt_ids)
+    scores, ids = decoder.next_token_scores(outputs)
+    _, timings = decoder.generate_greedy(prompt_ids[:1], decode_tokens)
+    steps = timings["step_s"] or [timings["prefill_s"]]
+    return {
+        "size_mb": model_size_bytes(model_path) / (1024 * 1024),
+        "load_s": decoder.load_seconds,
+        "per_token_ms": 1000 * float(np.mean(steps)),
+        "scores": scores.astype(np.float32),
+        "ids": ids,
+    }
+
+
+def _divergence(reference, candidate):
+    """Max/mean abs logit error and top-1 agreement against the fp32 graph"""
+    if reference["ids"] is not None:
+        # Top-k graphs: compare the returned scores position by position
+        agree = float(np.mean(reference["ids"][:, 0] == candidate["ids"][:, 0]))
+    else:
+        agree = float(np.mean(reference["scores"].argmax(-1) == candidate["scores"].argmax(-1)))
+    diff = np.abs(reference["scores"] - candidate["scores"])
+    return float(diff.max()), float(diff.mean()), agree
+
+
+def write_quantization_report(model_path, variants, report_path=None, num_prompts=4,
+                              prompt_length=64, decode_tokens=16, vocab_size=None, seed=0):
+    """
+    Benchmark fp32 and each quantized variant on the same random prompts and
+    write a markdown comparison table plus a JSON copy of the numbers.
+    """
+    reference = DecoderSession.load(model_path)
+    vocab_size = vocab_size or reference.vocab_size
+    if vocab_size is None:
+        raise ValueError("Could not infer vocabulary size from the graph; pass --vocab-size")
+    del reference
+
+    rng = np.random.default_rng(seed)
+    prompt_ids = rng.integers(0, vocab_size, size=(num_prompts, prompt_length), dtype=np.int64)
+
+    print(f"📊 Evaluating fp32 baseline: {model_path}")
+    baseline = _evaluate(model_path, prompt_ids, decode_tokens)
+    rows = [("fp32", model_path, baseline, (0.0, 0.0, 1.0))]
+    for mode, path in variants.items():
+        print(f"📊 Evaluating {mode}: {path}")
+        result = _evaluate(path, prompt_ids, decode_tokens)
+        rows.append((mode, path, result, _divergence(baseline, result)))
+
+    lines = [
+        f"# Quantization report for {os.path.basename(model_path)}",
+        "",
+        f"Prompts: {num_prompts} x {prompt_length} tokens, {decode_tokens} decode steps",
+        "",
+        "| Variant | File | Size (MB) | Load (s) | Per-token (ms) | Max abs err | Mean abs err | Top-1 agree |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    records = []
+    for mode, path, result, (max_err, mean_err, agree) in rows:
+        lines.append(
+            f"| {mode} | {os.path.basename(path)} | {result['size_mb']:.1f} | {result['load_s']:.2f} "
+            f"| {result['per_token_ms']:.1f} | {max_err:.4f} | {mean_err:.4f} | {agree:.0%} |"
+        )
+        records.append({
+            "variant": mode,
+            "path": path,
+            "size_mb": result["size_mb"],
+            "load_s": result["load_s"],
+            "per_token_ms": result["per_token_ms"],
+            "max_abs_error": max_err,
+            "mean_abs_error": mean_err,
+            "top1_agreement": agree,
+        })
+
+    report = "\n".join(lines) + "\n"
+    report_path = report_path or os.path.splitext(model_path)[0] + "_quantization_report.md"
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write(report)
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2)
+
+    print(report)
+    print(f"📝 Wrote {report_path}")
+    return records
+
+
+def run_quantization_stage(model_path, modes=QUANT_MODES, report=True, **report_options):
+    """Quantize an exported model and report each variant against the fp32 graph"""
+    try:
+        with stage("quantize", modes=",".join(modes)):
+            variants = quantize_model(model_path, modes)
+        if report:
+            with stage("quantization report"):
+                write_quantization_report(model_path, variants, **report_options)
+        return True
+    except Exception as e:
+        print(f"❌ Error during quantization: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def parse_modes(value):
+    """Parse a comma separated --quantize value such as "int8,int4" """
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    for mode in modes:
+        if mode not in QUANT_MODES:
+            raise argparse.ArgumentTypeError(f"Unknown quantization mode: {mode}")
+    return modes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize an exported ONNX model and compare variants")
+    parser.add_argument("model", help="Path to the fp32 model.onnx")
+    parser.add_argument("--modes", type=parse_modes, default=list(QUANT_MODES),
+                        help="Comma separated modes (int8,int4,fp16)")
+    parser.add_argument("--report", default=None, help="Markdown report path")
+    parser.add_argument("--prompt-length", type=int, default=64)
+    parser.add_argument("--num-prompts", type=int, default=4)
+    parser.add_argument("--decode-tokens", type=int, default=16)
+    parser.add_argument("--vocab-size", type=int, default=None,
+                        help="Needed for top-k graphs, whose outputs do not expose the vocabulary")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("quantize_onnx", args.trace):
+        success = run_quantization_stage(
+            args.model,
+            args.modes,
+            report_path=args.report,
+            num_prompts=args.num_prompts,
+            prompt_length=args.prompt_length,
+            decode_tokens=args.decode_tokens,
+            vocab_size=args.vocab_size,
+        )
+    if success:
+        print("\n🎉 Quantization completed successfully!")
+    else:
+        print("\n💥 Quantization failed. Check the error messages above.")
+        exit(1)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Local vector index for repository retrieval
+Splits repository files (README/TODO and other docs, code, config) into
+token-bounded chunks, embeds them in length-sorted batches with the pooled
+embedding graph (convert_*.py --embedding), stores the vectors as one
+memory-mapped float16 matrix and answers top-k cosine queries, so prompts
+can carry only the chunks that matter instead of whole repository summaries
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+
+from ort_runtime import create_session
+from stage_trace import add_trace_arguments, stage, trace_run
+
+INDEX_VERSION = 1
+INDEX_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+CHUNKS_FILE = "chunks.jsonl"
+DEFAULT_CHUNK_TOKENS = 256
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_RESULTS = 8
+# Budget for the retrieved chunks in a generation prompt
+DEFAULT_CONTEXT_TOKENS = 384
+MAX_FILE_BYTES = 256 * 1024
+# Rows scored per matmul, bounding the float32 copy of the float16 matrix
+SEARCH_BLOCK = 65536
+
+FILE_KINDS = {
+    ".md": "doc", ".markdown": "doc", ".rst": "doc", ".txt": "doc",
+    ".dart": "code", ".py": "code", ".js": "code", ".jsx": "code", ".ts": "code", ".tsx": "code",
+    ".gd": "code", ".kt": "code", ".java": "code", ".swift": "code", ".go": "code", ".rs": "code",
+    ".c": "code", ".cc": "code", ".cpp": "code", ".h": "code", ".cs": "code", ".sh": "code",
+    ".yaml": "config", ".yml": "config", ".toml": "config", ".json": "config", ".gradle": "config",
+}
+SKIP_DIRS = {
+    ".git", ".dart_tool", ".idea", ".vscode", ".gradle", "build", "node_modules", "Pods", "__pycache__",
+    ".model_cache", "traces", "ai_models",
+}
+SKIP_FILES = {"package-lock.json", "pubspec.lock", "yarn.lock", "Podfile.lock"}
+
+
+# ---------------------------------------------------------------------------
+# Chunking
+# ---------------------------------------------------------------------------
+
+def file_kind(relative_path):
+    name = os.path.basename(relative_path).lower()
+    if name.startswith("readme"):
+        return "readme"
+    if name.startswith("todo"):
+        return "todo"
+    return FILE_KINDS.get(os.path.splitext(name)[1])
+
+
+def iter_repository_files(repo_path, max_file_bytes=MAX_FILE_BYTES):
+    """(relative path, kind) of every indexable text file, in a stable order"""
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = sorted(name for name in dirs if name not in SKIP_DIRS and not name.startswith("."))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, repo_path).replace(os.sep, "/")
+            kind = file_kind(relative)
+            if kind is None or name in SKIP_FILES or os.path.getsize(path) > max_file_bytes:
+                continue
+            yield relative, kind
+
+
+def _blocks(lines, kind):
+    """
+    Split a file into (start, end) line ranges that should stay together:
+    markdown sections start at headings, code and config at blank lines
+    """
+    blocks, start = [], 0
+    for index, line in enumerate(lines):
+        if kind in ("readme", "todo", "doc"):
+            boundary = line.startswith("#") and index > start
+        else:
+            boundary = not line.strip() and index > start
+        if boundary:
+            blocks.append((start, index))
+            start = index
+    if start < len(lines):
+        blocks.append((start, len(lines)))
+    return blocks
+
+
+def chunk_file(text, kind, tokenizer, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    """
+    Pack consecutive blocks into chunks of at most chunk_tokens tokens.
+    Blocks that are too long on their own are split by lines. Returns
+    [(first line, last line, text)] with 1-based inclusive line numbers.
+    """
+    lines = text.splitlines()
+    pieces = []
+    for start, end in _blocks(lines, kind):
+        count = len(tokenizer.encode("\n".join(lines[start:end])))
+        if count <= chunk_tokens:
+            pieces.append((start, end, count))
+            continue
+        for line in range(start, end):
+            pieces.append((line, line + 1, len(tokenizer.encode(lines[line]))))
+
+    chunks, start, end, count = [], None, None, 0
+    for piece_start, piece_end, piece_count in pieces:
+        if start is not None and count + piece_count > chunk_tokens:
+            chunks.append((start, end))
+            start = None
+        if start is None:
+            start, count = piece_start, 0
+        end = piece_end
+        count += piece_count
+    if start is not None:
+        chunks.append((start, end))
+
+    result = []
+    for start, end in chunks:
+        body = "\n".join(lines[start:end]).strip()
+        if body:
+            result.append((start + 1, end, body))
+    return result
+
+
+def collect_chunks(repo_path, tokenizer, chunk_tokens=DEFAULT_CHUNK_TOKENS, max_file_bytes=MAX_FILE_BYTES):
+    """Chunk records for every indexable file; `digest` lets a rebuild reuse unchanged files"""
+    chunks = []
+    for relative, kind in iter_repository_files(repo_path, max_file_bytes):
+        with open(os.path.join(repo_path, relative), "rb") as f:
+            data = f.read()
+        if b"\0" in data[:1024]:
+            continue
+        digest = hashlib.sha1(data).hexdigest()
+        text = data.decode("utf-8", errors="replace")
+        for start_line, end_line, body in chunk_file(text, kind, tokenizer, chunk_tokens):
+            chunks.append({"path": relative, "kind": kind, "start_line": start_line, "end_line": end_line,
+                           "digest": digest, "text": body})
+    return chunks
+
+
+def embedding_text(chunk):
+    """The path is embedded with the chunk so file names take part in matching"""
+    return f"{chunk['path']}\n{chunk['text']}"
+
+
+# ---------------------------------------------------------------------------
+# Embedding
+# ---------------------------------------------------------------------------
+
+class EmbeddingSession:
+    """Runs embedding_model.onnx: right-padded input_ids + attention_mask -> [B, dim] unit vectors"""
+
+    def __init__(self, model_path, pad_token_id=0):
+        self.model_path = model_path
+        self.session, self.load_seconds = create_session(model_path)
+        output = self.session.get_outputs()[0]
+        if output.name != "embeddings" or not isinstance(output.shape[-1], int):
+            raise ValueError(f"{model_path} is not an embedding graph (export with --embedding)")
+        self.dim = output.shape[-1]
+        self.pad_token_id = pad_token_id
+
+    def embed(self, id_lists, batch_size=DEFAULT_BATCH_SIZE, max_tokens=None):
+        """
+        Embed token id lists in batches of similar length (least padding) and
+        return them in input order as float32 [N, dim]
+        """
+        out = np.empty((len(id_lists), self.dim), dtype=np.float32)
+        id_lists = [ids[:max_tokens] if max_tokens else ids for ids in id_lists]
+        order = sorted(range(len(id_lists)), key=lambda index: len(id_lists[index]))
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            length = max(1, max(len(id_lists[row]) for row in rows))
+            input_ids = np.full((len(rows), length), self.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(rows), length), dtype=np.int64)
+            for position, row in enumerate(rows):
+                ids = id_lists[row]
+                input_ids[position, :len(ids)] = ids
+                attention_mask[position, :len(ids)] = 1
+            (embeddings,) = self.session.run(["embeddings"], {"input_ids": input_ids, "attention_mask": attention_mask})
+            out[rows] = embeddings
+        return out
+
+
+# Loaded embedders by graph path: batch runs query one index per repository
+_EMBEDDERS = {}
+
+
+def load_embedder(model_path):
+    """(EmbeddingSession, tokenizer) for an embedding graph, loaded once per process"""
+    key = os.path.abspath(model_path)
+    if key not in _EMBEDDERS:
+        from inference_server import load_tokenizer
+
+        tokenizer = load_tokenizer(model_path)
+        if tokenizer is None:
+            raise FileNotFoundError("No tokenizer.bin or tokenizer.json next to the embedding graph or in its parent")
+        _EMBEDDERS[key] = (EmbeddingSession(model_path), tokenizer)
+    return _EMBEDDERS[key]
+
+
+# ---------------------------------------------------------------------------
+# Index
+# ---------------------------------------------------------------------------
+
+def _previous_vectors(index_dir, model_path, dim, chunk_tokens):
+    """{(path, digest): (first row, row count)} of an existing compatible index"""
+    try:
+        index = VectorIndex(index_dir)
+    except (OSError, ValueError, KeyError):
+        return None, {}
+    meta = index.meta
+    if meta["dim"] != dim or meta["chunk_tokens"] != chunk_tokens or \
+            os.path.abspath(meta["model"]) != os.path.abspath(model_path):
+        return None, {}
+    spans = {}
+    for row, chunk in enumerate(index.chunks):
+        key = (chunk["path"], chunk["digest"])
+        first, count = spans.get(key, (row, 0))
+        spans[key] = (first, count + 1)
+    return index, spans
+
+
+def build_index(repo_path, index_dir, model_path, chunk_tokens=DEFAULT_CHUNK_TOKENS, batch_size=DEFAULT_BATCH_SIZE,
+                max_file_bytes=MAX_FILE_BYTES):
+    """
+    Chunk and embed a repository into index_dir. Files whose content did not
+    change since the last build keep their vectors. Returns the index
+    metadata or None on failure.
+    """
+    try:
+        embedder, tokenizer = load_embedder(model_path)
+
+        with stage("chunking", repo=os.path.basename(os.path.abspath(repo_path))):
+            chunks = collect_chunks(repo_path, tokenizer, chunk_tokens, max_file_bytes)
+        if not chunks:
+            raise ValueError(f"No indexable files in {repo_path}")
+        files = len({chunk["path"] for chunk in chunks})
+
+        previous, spans = _previous_vectors(index_dir, model_path, embedder.dim, chunk_tokens)
+        os.makedirs(index_dir, exist_ok=True)
+        vectors_tmp = os.path.join(index_dir, VECTORS_FILE + ".tmp")
+        # open_memmap keeps the .npy header, so np.load(mmap_mode="r") can map the result
+        vectors = np.lib.format.open_memmap(vectors_tmp, mode="w+", dtype=np.float16,
+                                            shape=(len(chunks), embedder.dim))
+        pending, reused = [], 0
+        row = 0
+        while row < len(chunks):
+            # Chunks of one file are contiguous
+            key = (chunks[row]["path"], chunks[row]["digest"])
+            end = row
+            while end < len(chunks) and (chunks[end]["path"], chunks[end]["digest"]) == key:
+                end += 1
+            count = end - row
+            if key in spans and spans[key][1] == count:
+                first = spans[key][0]
+                vectors[row:row + count] = previous.vectors[first:first + count]
+                reused += count
+            else:
+                pending.extend(range(row, row + count))
+            row += count
+        print(f"📖 {files} file(s), {len(chunks)} chunk(s): {len(pending)} to embed, {reused} unchanged")
+
+        if pending:
+            with stage("embedding", chunks=len(pending)):
+                id_lists = [tokenizer.encode(embedding_text(chunks[row])) for row in pending]
+                embedded = embedder.embed(id_lists, batch_size, max_tokens=2 * chunk_tokens)
+                vectors[pending] = embedded.astype(np.float16)
+        vectors.flush()
+        del vectors, previous
+
+        chunks_tmp = os.path.join(index_dir, CHUNKS_FILE + ".tmp")
+        with open(chunks_tmp, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(json.dumps(chunk) + "\n")
+        meta = {
+            "version": INDEX_VERSION,
+            "model": os.path.abspath(model_path),
+            "repo": os.path.abspath(repo_path),
+            "dim": embedder.dim,
+            "count": len(chunks),
+            "files": files,
+            "chunk_tokens": chunk_tokens,
+            "dtype": "float16",
+        }
+        os.replace(vectors_tmp, os.path.join(index_dir, VECTORS_FILE))
+        os.replace(chunks_tmp, os.path.join(index_dir, CHUNKS_FILE))
+        with open(os.path.join(index_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        size_kb = os.path.getsize(os.path.join(index_dir, VECTORS_FILE)) / 1024
+        print(f"✅ Indexed {len(chunks)} chunk(s) x {embedder.dim} dims into {index_dir} ({size_kb:.1f} KB of vectors)")
+        return meta
+    except Exception as e:
+        print(f"❌ Error during indexing: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+class VectorIndex:
+    """A built index: the vectors stay memory-mapped, chunks are read once"""
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(index_dir, CHUNKS_FILE), "r", encoding="utf-8") as f:
+            self.chunks = [json.loads(line) for line in f if line.strip()]
+        if self.vectors.shape != (self.meta["count"], self.meta["dim"]) or len(self.chunks) != self.meta["count"]:
+            raise ValueError(f"{index_dir} is incomplete (interrupted build?)")
+
+    def search(self, queries, k=DEFAULT_RESULTS):
+        """Top-k cosine scores and rows for [Q, dim] unit query vectors, best first"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.meta["dim"])
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.vectors), SEARCH_BLOCK):
+            block = np.asarray(self.vectors[start:start + SEARCH_BLOCK], dtype=np.float32)
+            scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)),
+                                                              (len(queries), len(block)))], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def query(self, text, k=DEFAULT_RESULTS, model_path=None):
+        """Chunks most similar to a text query, each with its score"""
+        embedder, tokenizer = load_embedder(model_path or self.meta["model"])
+        query = embedder.embed([tokenizer.encode(text)])
+        scores, rows = self.search(query, k)
+        return [{"score": float(score), **self.chunks[row]} for score, row in zip(scores[0], rows[0])]
+
+
+def retrieve_context(index_dir, query, k=DEFAULT_RESULTS, token_budget=DEFAULT_CONTEXT_TOKENS, tokenizer=None):
+    """
+    The best chunks for a query that fit in token_budget (counted with
+    `tokenizer` when given), in file order so related chunks read naturally
+    """
+    index = VectorIndex(index_dir)
+    selected, used = [], 0
+    for chunk in index.query(query, k):
+        tokens = len(tokenizer.encode(chunk["text"])) if tokenizer else len(chunk["text"]) // 4
+        if used + tokens > token_budget:
+            continue
+        selected.append(chunk)
+        used += tokens
+    return sorted(selected, key=lambda chunk: (chunk["path"], chunk["start_line"]))
+
+
+def build_indexes(repos_dir, index_root, model_path, **options):
+    """One index per repository checkout, at <index_root>/<repo name>"""
+    from batch_generate import safe_name
+
+    results = []
+    for entry in sorted(os.listdir(repos_dir)):
+        path = os.path.join(repos_dir, entry)
+        if os.path.isdir(path):
+            print(f"🔍 {entry}")
+            results.append(build_index(path, os.path.join(index_root, safe_name(entry)), model_path, **options))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed repository chunks into a local vector index and search it")
+    parser.add_argument("--model", default=None, help="Embedding graph (embedding_model.onnx); needed to build")
+    parser.add_argument("--repo", default=None, help="Repository to index into --index-dir")
+    parser.add_argument("--index-dir", default=None, help="Index directory to build or query")
+    parser.add_argument("--repos", default=None, help="Directory of checkouts to index, one per subdirectory")
+    parser.add_argument("--index-root", default=None, help="Where --repos indexes go (<index-root>/<repo>)")
+    parser.add_argument("--chunk-tokens", type=int, default=DEFAULT_CHUNK_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--max-file-kb", type=int, default=MAX_FILE_BYTES // 1024)
+    parser.add_argument("--query", default=None, help="Search --index-dir for this text")
+    parser.add_argument("-k", type=int, default=DEFAULT_RESULTS, help="Results per query")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    options = {"chunk_tokens": args.chunk_tokens, "batch_size": args.batch_size,
+               "max_file_bytes": args.max_file_kb * 1024}
+    success = True
+    with trace_run("repo_index", args.trace):
+        try:
+            if (args.repo or args.repos) and not args.model:
+                raise ValueError("--model is required to build an index")
+            if args.repo:
+                print(f"🚀 Indexing {args.repo} -> {args.index_dir}")
+                success = build_index(args.repo, args.index_dir, args.model, **options) is not None
+            if args.repos:
+                print(f"🚀 Indexing every repository in {args.repos} -> {args.index_root}")
+                success = all(meta is not None for meta in build_indexes(args.repos, args.index_root, args.model,
+                                                                         **options)) and success
+            if args.query:
+                with stage("query"):
+                    results = VectorIndex(args.index_dir).query(args.query, args.k, args.model)
+                print(f"🔍 Top {len(results)} for {args.query!r}:")
+                for result in results:
+                    print(f"   {result['score']:.3f}  {result['path']}:{result['start_line']}-{result['end_line']} "
+                          f"({result['kind']})  {result['text'][:80]!r}")
+        except Exception as e:
+            print(f"❌ Error: {e}")
+            import traceback
+            traceback.print_exc()
+            success = False
+
+    if success:
+        print("\n🎉 Repository index ready!")
+    else:
+        print("\n💥 Repository indexing failed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+onnxruntime session-config tuner for exported CrypticDash models
+Searches thread counts, execution mode, graph optimization level and memory
+arena / pattern settings on this machine for representative prompt lengths,
+and writes the winner as <stem>.session.json next to the graph, which
+ort_runtime.create_session loads automatically
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import numpy as np
+import onnxruntime as ort
+
+from ort_runtime import DecoderSession, build_session_options, session_config_path
+from stage_trace import add_trace_arguments, stage, trace_run
+
+SESSION_TUNER_VERSION = 1
+DEFAULT_PROMPT_LENGTHS = (16, 128)
+DEFAULT_DECODE_TOKENS = 8
+DEFAULT_REPEATS = 5
+# Successive halving: candidates sampled from the grid, and the fraction kept per rung
+DEFAULT_TRIALS = 24
+HALVING_RATE = 3
+STRATEGIES = ("halving", "grid")
+FALLBACK_VOCAB_SIZE = 1000
+
+
+def search_space(cpu_count=None):
+    """
+    Every candidate config as a build_session_options dict. Inter-op threads
+    only matter in parallel mode, so sequential configs leave them unset and
+    single-CPU machines skip parallel mode.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    intra_threads = sorted({threads for threads in (1, 2, 4, cpu_count // 2, cpu_count) if 1 <= threads <= cpu_count})
+    inter_threads = sorted({threads for threads in (2, 4) if threads <= cpu_count})
+    candidates = []
+    for level in ("basic", "extended", "all"):
+        for intra in intra_threads:
+            modes = [{"execution_mode": "sequential"}]
+            modes += [{"execution_mode": "parallel", "inter_op_num_threads": inter} for inter in inter_threads]
+            for mode in modes:
+                for arena in (True, False):
+                    for pattern in (True, False):
+                        candidates.append({
+                            "graph_optimization_level": level,
+                            "intra_op_num_threads": intra,
+                            **mode,
+                            "enable_cpu_mem_arena": arena,
+                            "enable_mem_pattern": pattern,
+                        })
+    return candidates
+
+
+def describe(config):
+    if not config:
+        return "default"
+    parts = [config["graph_optimization_level"], f"intra={config['intra_op_num_threads']}", config["execution_mode"]]
+    if "inter_op_num_threads" in config:
+        parts.append(f"inter={config['inter_op_num_threads']}")
+    if not config["enable_cpu_mem_arena"]:
+        parts.append("no arena")
+    if not config["enable_mem_pattern"]:
+        parts.append("no mem pattern")
+    return ", ".join(parts)
+
+
+def make_workloads(decoder, prompt_lengths, seed=0):
+    vocab_size = decoder.vocab_size
+    if vocab_size is None:
+        print(f"   ⚠️ Vocabulary size unknown, sampling ids below {FALLBACK_VOCAB_SIZE}")
+        vocab_size = FALLBACK_VOCAB_SIZE
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, vocab_size, size=(1, length), dtype=np.int64) for length in prompt_lengths]
+
+
+def _run_workload(decoder, input_ids, decode_tokens):
+    """Prefill plus decode_tokens greedy steps; graphs without logits only prefill"""
+    start = time.perf_counter()
+    if decode_tokens and ("logits" in decoder.outputs or decoder.topk):
+        decoder.generate_greedy(input_ids, decode_tokens + 1)
+    else:
+        decoder.run(input_ids)
+    return time.perf_counter() - start
+
+
+def measure_config(model_path, config, workloads, decode_tokens, repeats):
+    """
+    Median latency per workload for one config (after a warmup run) and their
+    sum, which is what the search minimizes. An empty config measures the
+    plain SessionOptions() default rather than any existing sidecar.
+    """
+    decoder = DecoderSession.load(model_path, build_session_options(config))
+    medians = []
+    for input_ids in workloads:
+        _run_workload(decoder, input_ids, decode_tokens)
+        medians.append(statistics.median(_run_workload(decoder, input_ids, decode_tokens) for _ in range(repeats)))
+    return {"latency_s": sum(medians), "workload_s": medians, "load_s": decoder.load_seconds}
+
+
+def _trial(model_path, config, workloads, decode_tokens, repeats, rung, trials):
+    try:
+        result = measure_config(model_path, config, workloads, decode_tokens, repeats)
+    except Exception as e:
+        # Some combinations are rejected by particular builds or graphs
+        print(f"   ⚠️ {describe(config)}: {e}")
+        result = {"latency_s": float("inf"), "workload_s": [], "load_s": 0.0, "error": f"{type(e).__name__}: {e}"}
+    trials.append({"rung": rung, "config": config, "repeats": repeats, **result})
+    return result["latency_s"]
+
+
+def search(model_path, candidates, workloads, decode_tokens, repeats, strategy="halving", trials=DEFAULT_TRIALS, seed=0):
+    """
+    grid measures every candidate with `repeats` runs. halving samples
+    `trials` candidates, measures them with one run each and keeps the best
+    1/HALVING_RATE, multiplying the runs per candidate by HALVING_RATE on
+    each rung until one is left (capped at `repeats`).
+    Returns (best config, list of every trial).
+    """
+    history = []
+    if strategy == "grid":
+        scored = [(_trial(model_path, config, workloads, decode_tokens, repeats, 0, history), index)
+                  for index, config in enumerate(candidates)]
+        return candidates[min(scored)[1]], history
+
+    pool = list(candidates)
+    if len(pool) > trials:
+        pool = random.Random(seed).sample(pool, trials)
+    rung, rung_repeats = 0, 1
+    while len(pool) > 1:
+        print(f"   - Rung {rung}: {len(pool)} config(s), {rung_repeats} run(s) each")
+        scored = sorted(
+            ((_trial(model_path, config, workloads, decode_tokens, rung_repeats, rung, history), index)
+             for index, config in enumerate(pool))
+        )
+        pool = [pool[index] for _, index in scored[:max(1, len(pool) // HALVING_RATE)]]
+        rung += 1
+        rung_repeats = min(repeats, rung_repeats * HALVING_RATE)
+    return pool[0], history
+
+
+def compare_to_default(model_path, best, workloads, decode_tokens, repeats):
+    """
+    Alternate default and best sessions for `repeats` rounds so drift such as
+    thermal throttling hits both equally. Returns (default, best) latency in seconds.
+    """
+    default_runs, best_runs = [], []
+    for _ in range(repeats):
+        default_runs.append(measure_config(model_path, {}, workloads, decode_tokens, 1)["latency_s"])
+        best_runs.append(measure_config(model_path, best, workloads, decode_tokens, 1)["latency_s"])
+    return statistics.median(default_runs), statistics.median(best_runs)
+
+
+def write_session_report(record, report_path):
+    """Markdown summary plus a JSON copy next to it"""
+    tuned = record["tuned"]
+    lines = [
+        f"# Session tuning report: {tuned['model']}",
+        "",
+        f"- Machine: {tuned['machine']['processor'] or tuned['machine']['platform']}, "
+        f"{tuned['machine']['cpu_count']} logical CPU(s), onnxruntime {tuned['machine']['onnxruntime']}",
+        f"- Workload: prompt lengths {', '.join(map(str, tuned['prompt_lengths']))}, "
+        f"{tuned['decode_tokens']} decode token(s) each",
+        f"- Search: {tuned['strategy']}, {len(tuned['trials'])} trial(s)",
+        f"- Recommended: {describe(record['session_options'])}",
+        f"- Latency: {tuned['default_latency_ms']:.1f} ms default -> {tuned['latency_ms']:.1f} ms tuned "
+        f"({tuned['gain_percent']:.1f}% faster, {tuned['speedup']:.2f}x)",
+        "",
+        "| Config | Rung | Runs | Latency (ms) | Session load (ms) |",
+        "|---|---|---|---|---|",
+    ]
+    for trial in sorted(tuned["trials"], key=lambda trial: (-trial["rung"], trial["latency_s"])):
+        latency = "error" if "error" in trial else f"{trial['latency_s'] * 1000:.1f}"
+        lines.append(f"| {describe(trial['config'])} | {trial['rung']} | {trial['repeats']} | {latency} | "
+                     f"{trial['load_s'] * 1000:.1f} |")
+    lines.append("")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2, default=str)
+    return report_path
+
+
+def tune_session(model_path, prompt_lengths=DEFAULT_PROMPT_LENGTHS, decode_tokens=DEFAULT_DECODE_TOKENS,
+                 repeats=DEFAULT_REPEATS, strategy="halving", trials=DEFAULT_TRIALS, report_path=None, seed=0):
+    """
+    Tune one graph and write <stem>.session.json plus <stem>_session_report.md.
+    The default config is kept when nothing beats it. Returns the sidecar
+    record or None on failure.
+    """
+    report_path = report_path or os.path.splitext(model_path)[0] + "_session_report.md"
+    print(f"🔧 Tuning session config for {model_path} ({strategy})")
+    try:
+        workloads = make_workloads(DecoderSession.load(model_path, ort.SessionOptions()), prompt_lengths, seed)
+        with stage("session search", model=os.path.basename(model_path), strategy=strategy):
+            best, history = search(model_path, search_space(), workloads, decode_tokens, repeats, strategy, trials, seed)
+        with stage("default comparison", repeats=repeats):
+            default_s, best_s = compare_to_default(model_path, best, workloads, decode_tokens, repeats)
+        if best_s >= default_s:
+            print(f"   ⚠️ {describe(best)} did not beat the default, recommending the default")
+            best, best_s = {}, default_s
+
+        record = {
+            "session_options": best,
+            "tuned": {
+                "version": SESSION_TUNER_VERSION,
+                "model": os.path.basename(model_path),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "machine": {
+                    "platform": platform.platform(),
+                    "processor": platform.processor(),
+                    "cpu_count": os.cpu_count(),
+                    "onnxruntime": ort.__version__,
+                },
+                "prompt_lengths": list(prompt_lengths),
+                "decode_tokens": decode_tokens,
+                "strategy": strategy,
+                "latency_ms": best_s * 1000,
+                "default_latency_ms": default_s * 1000,
+                "speedup": default_s / best_s,
+                "gain_percent": 100 * (default_s - best_s) / default_s,
+                "trials": history,
+            },
+        }
+        sidecar_path = session_config_path(model_path)
+        with open(sidecar_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2, default=str)
+        os.replace(sidecar_path + ".tmp", sidecar_path)
+        write_session_report(record, report_path)
+
+        tuned = record["tuned"]
+        print(f"✅ {describe(best)}: {tuned['default_latency_ms']:.1f} ms -> {tuned['latency_ms']:.1f} ms "
+              f"({tuned['gain_percent']:.1f}% faster than the default)")
+        print(f"📝 Wrote {sidecar_path} and {report_path}")
+        return record
+    except Exception as e:
+        print(f"❌ Error during session tuning: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def find_graphs(paths):
+    """Expand directories to the graphs directly inside them"""
+    graphs = []
+    for path in paths:
+        if os.path.isdir(path):
+            graphs.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".onnx")))
+        else:
+            graphs.append(path)
+    return graphs
+
+
+def parse_lengths(value):
+    return [int(length) for length in value.split(",") if length.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune onnxruntime session options for exported models")
+    parser.add_argument("models", nargs="+", help="Graphs to tune, or directories of graphs (e.g. model.onnx model_q4.onnx)")
+    parser.add_argument("--prompt-lengths", type=parse_lengths, default=list(DEFAULT_PROMPT_LENGTHS),
+                        help="Comma separated prompt lengths to optimize for")
+    parser.add_argument("--decode-tokens", type=int, default=DEFAULT_DECODE_TOKENS,
+                        help="Greedy tokens generated after each prompt (0 for prefill only)")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--strategy", choices=STRATEGIES, default="halving",
+                        help="halving samples --trials configs and prunes them; grid measures every config")
+    parser.add_argument("--trials", type=int, default=DEFAULT_TRIALS)
+    parser.add_argument("--seed", type=int, default=0)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    graphs = find_graphs(args.models)
+    print(f"🚀 Tuning {len(graphs)} graph(s) on {os.cpu_count()} CPU(s)")
+    with trace_run("session_tuner", args.trace):
+        results = [
+            tune_session(path, args.prompt_lengths, args.decode_tokens, args.repeats, args.strategy, args.trials,
+                         seed=args.seed)
+            for path in graphs
+        ]
+    success = bool(graphs) and all(result is not None for result in results)
+
+    if success:
+        print("\n🎉 Session configs written!")
+    else:
+        print("\n💥 Session tuning failed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Parallel safetensors shard loader with progress reporting and cancellation
+Shards are read concurrently inside a worker process that is killed on
+timeout or Ctrl+C, so a cancelled load releases all of its memory
+"""
+
+import os
+import json
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import torch
+import torch.multiprocessing as mp
+
+DEFAULT_LOAD_TIMEOUT = 60
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+class LoadCancelled(Exception):
+    """Raised inside the worker when the parent asks it to stop"""
+
+
+def list_shards(model_path):
+    """Shard file names from model.safetensors.index.json, or the single model.safetensors"""
+    index_path = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        return sorted(set(weight_map.values()))
+    return ["model.safetensors"]
+
+
+def _read_shard(shard_path, dtype, messages, cancel_event):
+    """Read every tensor of one shard into shared memory, reporting progress"""
+    from safetensors import safe_open
+
+    shard = os.path.basename(shard_path)
+    total_bytes = os.path.getsize(shard_path)
+    done_bytes = 0
+    start = time.time()
+    tensors = {}
+    with safe_open(shard_path, framework="pt") as handle:
+        for key in handle.keys():
+            if cancel_event.is_set():
+                raise LoadCancelled(shard)
+            tensor = handle.get_tensor(key)
+            done_bytes += tensor.numel() * tensor.element_size()
+            if dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            # Shared memory lets the parent receive the tensor without a pickle copy
+            tensors[key] = tensor.share_memory_()
+            messages.put(("progress", shard, done_bytes, total_bytes, time.time() - start))
+    return tensors
+
+
+def _loader_process(model_path, shards, dtype_name, max_workers, messages, cancel_event, received_event):
+    """Worker process entry point: read all shards with a thread pool"""
+    try:
+        dtype = DTYPES.get(dtype_name)
+        state_dict = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(_read_shard, os.path.join(model_path, shard), dtype, messages, cancel_event)
+                for shard in shards
+            ]
+            for future in as_completed(futures):
+                state_dict.update(future.result())
+        messages.put(("done", state_dict))
+        # Keep the shared-memory handles alive until the parent has them
+        received_event.wait()
+    except LoadCancelled:
+        messages.put(("cancelled", None))
+    except Exception as e:
+        messages.put(("error", f"{type(e).__name__}: {e}"))
+
+
+class ShardProgress:
+    """Prints per-shard percent complete and MB/s, throttled to every 10%"""
+
+    def __init__(self, shards, step=10):
+        self.step = step
+        self.reported = {shard: -step for shard in shards}
+
+    def __call__(self, shard, done_bytes, total_bytes, elapsed):
+        percent = 100 * done_bytes / max(total_bytes, 1)
+        if percent - self.reported[shard] < self.step and done_bytes < total_bytes:
+            return
+        self.reported[shard] = percent
+        rate = done_bytes / (1024 * 1024) / max(elapsed, 1e-6)
+        print(f"   - {shard}: {min(percent, 100):5.1f}% "
+              f"({done_bytes / 1024 ** 2:.0f}/{total_bytes / 1024 ** 2:.0f} MB, {rate:.0f} MB/s)")
+
+
+def _stop_process(process, cancel_event):
+    cancel_event.set()
+    process.join(timeout=2)
+    if process.is_alive():
+        process.terminate()
+        process.join(timeout=5)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def load_state_dict_parallel(model_path, dtype=None, max_workers=None, timeout=DEFAULT_LOAD_TIMEOUT,
+                             on_progress=None):
+    """
+    Load all safetensors shards of a checkpoint concurrently in a worker process.
+
+    Raises TimeoutError after `timeout` seconds (None waits forever); the
+    worker is killed so its memory is returned to the OS. Ctrl+C cancels the
+    same way. Returns the state dict.
+    """
+    shards = list_shards(model_path)
+    max_workers = max_workers or min(len(shards), os.cpu_count() or 1)
+    on_progress = on_progress or ShardProgress(shards)
+    dtype_name = {value: key for key, value in DTYPES.items()}.get(dtype)
+
+    context = mp.get_context("spawn")
+    messages = context.Queue()
+    cancel_event = context.Event()
+    received_event = context.Event()
+    process = context.Process(
+        target=_loader_process,
+        args=(model_path, shards, dtype_name, max_workers, messages, cancel_event, received_event),
+        daemon=True,
+    )
+
+    print(f"🔍 Loading {len(shards)} shard(s) with {max_workers} thread(s) in worker process...")
+    start = time.time()
+    process.start()
+    try:
+        while True:
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"Model loading timed out after {timeout} seconds")
+            try:
+                kind, *payload = messages.get(timeout=0.5)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"Loader process exited with code {process.exitcode}")
+                continue
+
+            if kind == "progress":
+                on_progress(*payload)
+            elif kind == "done":
+                state_dict = payload[0]
+                received_event.set()
+                process.join()
+                total_gb = sum(t.numel() * t.element_size() for t in state_dict.values()) / 1024 ** 3
+                print(f"✅ Loaded {len(state_dict)} tensors ({total_gb:.2f} GB) in {time.time() - start:.1f} s")
+                return state_dict
+            elif kind == "cancelled":
+                raise RuntimeError("Model loading cancelled")
+            else:
+                raise RuntimeError(f"Loader process failed: {payload[0]}")
+    except BaseException:
+        print("🛑 Stopping loader process and releasing its memory...")
+        _stop_process(process, cancel_event)
+        raise
+
+
+def load_model_parallel(model_path, dtype=torch.float32, max_workers=None, timeout=DEFAULT_LOAD_TIMEOUT,
+                        **config_overrides):
+    """Build a causal LM skeleton without weights and fill it from load_state_dict_parallel"""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(model_path, local_files_only=True)
+    attn_implementation = config_overrides.pop("attn_implementation", "eager")
+    for key, value in config_overrides.items():
+        setattr(config, key, value)
+
+    state_dict = load_state_dict_parallel(model_path, dtype, max_workers, timeout)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, attn_implementation=attn_implementation)
+    result = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, parameter in model.named_parameters() if parameter.is_meta]
+    if missing:
+        raise RuntimeError(f"{len(missing)} weights missing from checkpoint, e.g. {missing[:3]}")
+    if result.unexpected_keys:
+        print(f"⚠️ Ignored {len(result.unexpected_keys)} unexpected checkpoint keys")
+    model.eval()
+    return model
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Speculative decoding for exported CrypticDash models
+A small draft model proposes k tokens greedily, the target verifies all of
+them in one multi-token pass, and the benchmark compares acceptance rate and
+tokens/sec against plain greedy decoding with the target alone
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from ort_runtime import DecoderSession
+
+DEFAULT_DRAFT_TOKENS = 4
+DEFAULT_MAX_NEW_TOKENS = 64
+
+BENCHMARK_PROMPTS = (
+    "Generate a TODO list for a Flutter project:",
+    "You are an intelligent project analyzer. Analyze this repository and generate specific, "
+    "actionable TODOs based on the ACTUAL project content:\nRepository: crypticdash\n",
+    "Next steps for a Python CLI that parses requirements.txt:",
+    "Roadmap for a Godot mobile game:\n1.",
+)
+
+
+class CachedDecoder:
+    """
+    Runs one sequence through a graph while keeping its KV cache, so tokens
+    can be fed one or several at a time and rejected ones rolled back.
+    Graphs without a KV cache recompute the whole sequence on every feed.
+    """
+
+    def __init__(self, decoder):
+        meta = decoder.outputs.get("logits")
+        if meta is None or len(meta.shape) != 3:
+            raise ValueError("Speculative decoding needs logits for every position (export with --logits full)")
+        self.decoder = decoder
+        self.kv_cache = decoder.has_past and bool(decoder.present_names)
+        self.tokens = []
+        self.past = None
+        self.runs = 0
+
+    @classmethod
+    def load(cls, model_path):
+        return cls(DecoderSession.load(model_path))
+
+    @property
+    def vocab_size(self):
+        return self.decoder.vocab_size
+
+    def reset(self):
+        self.tokens = []
+        self.past = None
+
+    def feed(self, tokens):
+        """Append tokens and return their [len(tokens), vocab] logits"""
+        self.runs += 1
+        if self.kv_cache:
+            outputs, self.past = self.decoder.run(np.array([tokens], dtype=np.int64), past=self.past)
+            self.tokens.extend(tokens)
+        else:
+            self.tokens.extend(tokens)
+            outputs, _ = self.decoder.run(np.array([self.tokens], dtype=np.int64))
+        return outputs["logits"][0, -len(tokens):]
+
+    def truncate(self, length):
+        """Forget everything after the first `length` tokens"""
+        del self.tokens[length:]
+        if self.past is not None:
+            self.past = {name: value[:, :, :length] for name, value in self.past.items()}
+
+
+def greedy_generate(target, prompt_ids, max_new_tokens, eos_token_id=None):
+    """Plain greedy decoding, one target run per token"""
+    target.reset()
+    logits = target.feed(list(prompt_ids))
+    generated = []
+    while len(generated) < max_new_tokens:
+        token = int(logits[-1].argmax())
+        generated.append(token)
+        if token == eos_token_id or len(generated) == max_new_tokens:
+            break
+        logits = target.feed([token])
+    return generated
+
+
+def speculative_generate(target, draft, prompt_ids, max_new_tokens, k=DEFAULT_DRAFT_TOKENS, eos_token_id=None):
+    """
+    Greedy speculative decoding. Every round the draft proposes up to k
+    tokens, the target scores [last token, proposals] in one run, the longest
+    agreeing prefix is kept plus the target's own next token, and both caches
+    are rolled back to the accepted sequence. The output equals greedy_generate.
+    Returns (generated ids, {"proposed", "accepted", "rounds"}).
+    """
+    target.reset()
+    draft.reset()
+    sequence = list(prompt_ids)
+    logits = target.feed(sequence)
+    sequence.append(int(logits[-1].argmax()))
+    generated = sequence[len(prompt_ids):]
+    stats = {"proposed": 0, "accepted": 0, "rounds": 0}
+
+    while len(generated) < max_new_tokens and generated[-1] != eos_token_id:
+        # The target's token is always kept, so leave room for it
+        budget = min(k, max_new_tokens - len(generated) - 1)
+        proposals = []
+        if budget > 0:
+            draft_logits = draft.feed(sequence[len(draft.tokens):])
+            while True:
+                proposals.append(int(draft_logits[-1].argmax()))
+                if len(proposals) == budget or proposals[-1] == eos_token_id:
+                    break
+                draft_logits = draft.feed(proposals[-1:])
+
+        # Row i holds the target's choice after sequence[-1] and proposals[:i]
+        choices = target.feed(sequence[len(target.tokens):] + proposals).argmax(axis=-1)
+        accepted = 0
+        while accepted < len(proposals) and proposals[accepted] == choices[accepted]:
+            accepted += 1
+        new_tokens = proposals[:accepted] + [int(choices[accepted])]
+        if eos_token_id in new_tokens:
+            new_tokens = new_tokens[:new_tokens.index(eos_token_id) + 1]
+
+        stats["proposed"] += len(proposals)
+        stats["accepted"] += accepted
+        stats["rounds"] += 1
+        sequence.extend(new_tokens)
+        generated.extend(new_tokens)
+        # The last token has not been run through either model yet
+        target.truncate(len(sequence) - 1)
+        draft.truncate(min(len(draft.tokens), len(sequence) - 1))
+
+    return generated[:max_new_tokens], stats
+
+
+def benchmark_speculative(target_path, draft_path, prompts, k_values=(DEFAULT_DRAFT_TOKENS,),
+                          max_new_tokens=DEFAULT_MAX_NEW_TOKENS, eos_token_id=None):
+    """
+    Time greedy decoding against speculative decoding for every k on the
+    same prompts. Returns a result dict (also printed as a table).
+    """
+    target = CachedDecoder.load(target_path)
+    draft = CachedDecoder.load(draft_path)
+    if target.vocab_size and draft.vocab_size and target.vocab_size != draft.vocab_size:
+        raise ValueError(f"Draft vocabulary ({draft.vocab_size}) does not match the target ({target.vocab_size})")
+    if not target.kv_cache:
+        print("⚠️ Target graph has no KV cache; every verification recomputes the whole sequence")
+
+    # Warm up both sessions
+    speculative_generate(target, draft, prompts[0], 4, k_values[0])
+
+    def timed(function):
+        tokens, seconds, stats = 0, 0.0, {"proposed": 0, "accepted": 0, "rounds": 0}
+        outputs = []
+        for prompt in prompts:
+            start = time.perf_counter()
+            result = function(prompt)
+            seconds += time.perf_counter() - start
+            output, prompt_stats = result if isinstance(result, tuple) else (result, None)
+            outputs.append(output)
+            tokens += len(output)
+            for key, value in (prompt_stats or {}).items():
+                stats[key] += value
+        return outputs, tokens, seconds, stats
+
+    baseline, tokens, seconds, _ = timed(lambda prompt: greedy_generate(target, prompt, max_new_tokens, eos_token_id))
+    results = {
+        "target": target_path,
+        "draft": draft_path,
+        "prompts": len(prompts),
+        "max_new_tokens": max_new_tokens,
+        "greedy": {"tokens": tokens, "seconds": seconds, "tokens_per_s": tokens / seconds},
+        "speculative": [],
+    }
+    print(f"   - greedy      {tokens} tokens in {seconds:.2f} s = {tokens / seconds:.1f} tokens/s")
+
+    for k in k_values:
+        outputs, tokens, spec_seconds, stats = timed(
+            lambda prompt: speculative_generate(target, draft, prompt, max_new_tokens, k, eos_token_id)
+        )
+        acceptance = stats["accepted"] / stats["proposed"] if stats["proposed"] else 0.0
+        run = {
+            "k": k,
+            "tokens": tokens,
+            "seconds": spec_seconds,
+            "tokens_per_s": tokens / spec_seconds,
+            "speedup": seconds / spec_seconds,
+            "acceptance_rate": acceptance,
+            "tokens_per_target_run": tokens / stats["rounds"] if stats["rounds"] else 0.0,
+            "identical_outputs": sum(a == b for a, b in zip(baseline, outputs)),
+        }
+        results["speculative"].append(run)
+        print(f"   - k={k:<2}        {tokens} tokens in {spec_seconds:.2f} s = {run['tokens_per_s']:.1f} tokens/s, "
+              f"{run['speedup']:.2f}x, acceptance {acceptance:.0%}, "
+              f"{run['tokens_per_target_run']:.2f} tokens/target run, "
+              f"identical {run['identical_outputs']}/{len(prompts)}")
+    return results
+
+
+def parse_k_values(value):
+    return [int(k) for k in value.split(",") if k.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speculative decoding with a draft model")
+    parser.add_argument("target", help="Target graph (merged KV-cache export with full logits)")
+    parser.add_argument("--draft", default=None, help="Draft graph (default: draft_model.onnx next to the target)")
+    parser.add_argument("--k", type=parse_k_values, default=[DEFAULT_DRAFT_TOKENS],
+                        help="Comma separated draft lengths to benchmark, e.g. 2,4,8")
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_MAX_NEW_TOKENS)
+    parser.add_argument("--prompt", dest="prompts", action="append", default=[],
+                        help="Prompt text, repeatable (default: built-in TODO prompts)")
+    parser.add_argument("--output", default=None, help="Write the benchmark results as JSON")
+    args = parser.parse_args()
+
+    from inference_server import load_tokenizer
+
+    draft_path = args.draft or os.path.join(os.path.dirname(os.path.abspath(args.target)), "draft_model.onnx")
+    print(f"🚀 Speculative decoding: {args.target} with draft {draft_path}")
+    try:
+        tokenizer = load_tokenizer(args.target)
+        texts = args.prompts or list(BENCHMARK_PROMPTS)
+        if tokenizer is not None:
+            prompts = [tokenizer.encode(text) for text in texts]
+            eos_token_id = tokenizer.eos_token_id
+        else:
+            print("⚠️ No tokenizer next to the target, using random prompt ids")
+            rng = np.random.default_rng(0)
+            vocab_size = DecoderSession.load(args.target).vocab_size or 1000
+            prompts = [rng.integers(0, vocab_size, size=16).tolist() for _ in texts]
+            eos_token_id = None
+        results = benchmark_speculative(args.target, draft_path, prompts, args.k, args.max_new_tokens, eos_token_id)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            print(f"📝 Wrote {args.output}")
+        success = all(run["identical_outputs"] == len(prompts) for run in results["speculative"])
+        if not success:
+            print("⚠️ Some speculative outputs differ from greedy (fp rounding between multi- and single-token runs)")
+    except Exception as e:
+        print(f"❌ Error during speculative decoding: {e}")
+        import traceback
+        traceback.print_exc()
+        success = False
+
+    if success:
+        print("\n🎉 Speculative decoding matches greedy decoding!")
+    else:
+        print("\n💥 Speculative decoding benchmark failed. Check the messages above.")
+        exit(1)
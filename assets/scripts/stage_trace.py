@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing and memory instrumentation for the model scripts
+Records wall time, CPU time, peak RSS and bytes read/written for every stage
+and writes a Chrome-trace (Perfetto) JSON file plus a summary table
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def _psutil_process():
+    try:
+        import psutil
+        return psutil.Process()
+    except ImportError:
+        return None
+
+
+def cpu_seconds():
+    """User + system CPU time of this process and its finished children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageTracer:
+    """
+    Records nested stages. A sampler thread polls RSS (including child
+    processes such as the shard loader) so every open stage gets its own
+    peak, not just the process-lifetime maximum.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self.rss_samples = []
+        self._open = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._process = _psutil_process()
+        self._stop = threading.Event()
+        self._sampler = None
+        if self._process is not None:
+            self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self._sampler.start()
+
+    def _now_us(self):
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def rss_bytes(self):
+        """RSS of this process plus its live children, or None without psutil"""
+        if self._process is None:
+            return None
+        try:
+            rss = self._process.memory_info().rss
+            for child in self._process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except Exception:
+                    pass
+            return rss
+        except Exception:
+            return None
+
+    def io_bytes(self):
+        """(read, written) by this process; read_chars also counts page-cache hits"""
+        if self._process is None or not hasattr(self._process, "io_counters"):
+            return None
+        try:
+            counters = self._process.io_counters()
+        except Exception:
+            return None
+        return (
+            getattr(counters, "read_chars", counters.read_bytes),
+            getattr(counters, "write_chars", counters.write_bytes),
+        )
+
+    def _record_rss(self, rss):
+        with self._lock:
+            self.rss_samples.append((self._now_us(), rss))
+            for record in self._open:
+                record["peak_rss"] = max(record["peak_rss"], rss)
+
+    def _sample_loop(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            rss = self.rss_bytes()
+            if rss is not None:
+                self._record_rss(rss)
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        """Time a block; extra keyword args (and record["args"]) go into the trace"""
+        rss = self.rss_bytes()
+        record = {
+            "name": name,
+            "depth": len(self._open),
+            "args": dict(args),
+            "start_us": self._now_us(),
+            "cpu_start": cpu_seconds(),
+            "io_start": self.io_bytes(),
+            "peak_rss": rss or 0,
+            "thread": threading.get_ident(),
+        }
+        with self._lock:
+            self._open.append(record)
+        if rss is not None:
+            self._record_rss(rss)
+        try:
+            yield record
+        finally:
+            rss = self.rss_bytes()
+            if rss is not None:
+                self._record_rss(rss)
+            with self._lock:
+                self._open.remove(record)
+            record["wall_s"] = (self._now_us() - record["start_us"]) / 1e6
+            record["cpu_s"] = cpu_seconds() - record.pop("cpu_start")
+            io_start, io_end = record.pop("io_start"), self.io_bytes()
+            record["read_bytes"] = io_end[0] - io_start[0] if io_start and io_end else None
+            record["written_bytes"] = io_end[1] - io_start[1] if io_start and io_end else None
+            record["peak_rss"] = record["peak_rss"] if self._process is not None else None
+            self.records.append(record)
+
+    def close(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join(timeout=1)
+
+    def chrome_trace(self):
+        """Trace Event Format dict: one complete event per stage plus an RSS counter"""
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}}]
+        for record in sorted(self.records, key=lambda record: record["start_us"]):
+            metrics = {
+                "cpu_s": round(record["cpu_s"], 4),
+                "peak_rss_mb": _mb(record["peak_rss"]),
+                "read_mb": _mb(record["read_bytes"]),
+                "written_mb": _mb(record["written_bytes"]),
+            }
+            events.append({
+                "name": record["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": record["start_us"],
+                "dur": record["wall_s"] * 1e6,
+                "pid": pid,
+                "tid": record["thread"],
+                "args": {**metrics, **record["args"]},
+            })
+        for timestamp, rss in self.rss_samples:
+            events.append({"name": "RSS", "ph": "C", "ts": timestamp, "pid": pid, "args": {"MB": _mb(rss)}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"script": self.name}}
+
+    def write_chrome_trace(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+        return path
+
+    def summary_table(self):
+        rows = sorted(self.records, key=lambda record: record["start_us"])
+        width = max([len("Stage")] + [2 * row["depth"] + len(row["name"]) for row in rows])
+        lines = [f"{'Stage':<{width}}  {'wall s':>8}  {'cpu s':>8}  {'peak RSS MB':>11}  {'read MB':>9}  {'written MB':>10}"]
+        for row in rows:
+            label = "  " * row["depth"] + row["name"]
+            lines.append(
+                f"{label:<{width}}  {row['wall_s']:>8.2f}  {row['cpu_s']:>8.2f}  "
+                f"{_fmt_mb(row['peak_rss']):>11}  {_fmt_mb(row['read_bytes']):>9}  {_fmt_mb(row['written_bytes']):>10}"
+            )
+        return "\n".join(lines)
+
+
+def _mb(value):
+    return None if value is None else round(value / (1024 * 1024), 2)
+
+
+def _fmt_mb(value):
+    return "-" if value is None else f"{value / (1024 * 1024):.1f}"
+
+
+_tracer = None
+
+
+def get_tracer():
+    """The tracer of the running script (a throwaway one when none was started)"""
+    global _tracer
+    if _tracer is None:
+        _tracer = StageTracer(os.path.basename(sys.argv[0]) or "python")
+    return _tracer
+
+
+def stage(name, **args):
+    """Record a stage on the running script's tracer"""
+    return get_tracer().stage(name, **args)
+
+
+def current_rss_mb():
+    rss = get_tracer().rss_bytes()
+    return rss / (1024 * 1024) if rss is not None else float("nan")
+
+
+def default_trace_path(script_name):
+    stem = os.path.splitext(os.path.basename(script_name))[0]
+    return os.path.join(TRACE_DIR, f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+
+
+@contextlib.contextmanager
+def trace_run(script_name, trace_path=None):
+    """
+    Trace a whole script run: everything inside is one root stage, and on
+    exit (including errors) the summary table is printed and the Chrome
+    trace is written. Open the file in https://ui.perfetto.dev
+    """
+    global _tracer
+    _tracer = StageTracer(script_name)
+    try:
+        with _tracer.stage(script_name):
+            yield _tracer
+    finally:
+        _tracer.close()
+        path = _tracer.write_chrome_trace(trace_path or default_trace_path(script_name))
+        print("\n📊 Stage metrics:")
+        print(_tracer.summary_table())
+        print(f"📝 Wrote trace {path}")
+
+
+def add_trace_arguments(parser):
+    parser.add_argument("--trace", default=None,
+                        help="Chrome trace JSON path (default: traces/<script>-<time>.json)")
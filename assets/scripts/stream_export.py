@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Memory-bounded streaming ONNX export for checkpoints larger than RAM
+Traces a weightless (meta-device) model, then streams weights from the
+memory-mapped safetensors shards straight into ONNX external data
+"""
+
+import os
+import json
+import time
+import argparse
+import torch
+import onnx
+from onnx import TensorProto
+
+from export_wrappers import (
+    DEFAULT_TOP_K, LOGITS_MODES, DecoderWithPastWrapper, LogitsHead,
+    build_kv_dummy_inputs, kv_dynamic_axes, logits_dynamic_axes, logits_output_names,
+    parse_top_k, past_input_names, present_output_names,
+)
+from stage_trace import add_trace_arguments, stage, trace_run
+
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16}
+# The weightless trace only produces a single graph, so there is no split prefill/decode export
+KV_CACHE_MODES = ("none", "merged")
+
+_SAFETENSORS_ITEMSIZE = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "I64": 8, "I32": 4, "U8": 1, "BOOL": 1}
+
+_ONNX_TO_TORCH = {
+    TensorProto.FLOAT: torch.float32,
+    TensorProto.FLOAT16: torch.float16,
+    TensorProto.BFLOAT16: torch.bfloat16,
+    TensorProto.INT64: torch.int64,
+    TensorProto.INT32: torch.int32,
+    TensorProto.BOOL: torch.bool,
+}
+
+
+class SafetensorsCheckpoint:
+    """Lazy, mmap-backed view over a single-file or sharded safetensors checkpoint"""
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        index_path = os.path.join(model_path, "model.safetensors.index.json")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                weight_map = json.load(f)["weight_map"]
+        else:
+            from safetensors import safe_open
+            with safe_open(os.path.join(model_path, "model.safetensors"), framework="pt") as handle:
+                weight_map = {key: "model.safetensors" for key in handle.keys()}
+        self.weight_map = weight_map
+        self._handles = {}
+
+    def __contains__(self, key):
+        return key in self.weight_map
+
+    def shards(self):
+        """Shard file names in checkpoint order"""
+        return sorted(set(self.weight_map.values()))
+
+    def get_slice(self, key):
+        """Lazy slice of one tensor; indexing it only reads the selected rows"""
+        from safetensors import safe_open
+
+        shard = self.weight_map[key]
+        if shard not in self._handles:
+            self._handles[shard] = safe_open(os.path.join(self.model_path, shard), framework="pt")
+        return self._handles[shard].get_slice(key)
+
+    def close(self):
+        self._handles.clear()
+
+
+class StreamingExportWrapper(torch.nn.Module):
+    """input_ids -> logits (or last_hidden_state without a logits mode) wrapper used when exporting without a KV cache"""
+
+    def __init__(self, model, logits_mode="full", top_k=DEFAULT_TOP_K):
+        super().__init__()
+        self.model = model
+        self.head = LogitsHead(model, logits_mode, top_k) if logits_mode else None
+
+    def forward(self, input_ids):
+        outputs = self.model.model(input_ids=input_ids, use_cache=False)
+        if self.head is None:
+            return outputs.last_hidden_state
+        return self.head(outputs.last_hidden_state)
+
+
+def _parameter_aliases(module):
+    """Map every parameter name to all names sharing that tensor (tied weights)"""
+    groups = {}
+    for name, parameter in module.named_parameters(remove_duplicate=False):
+        groups.setdefault(id(parameter), []).append(name)
+    return {name: names for names in groups.values() for name in names}
+
+
+def _suffixes(name):
+    """model.model.layers.0.mlp.fc1.weight, model.layers.0..., layers.0..., ..."""
+    parts = name.split(".")
+    return [".".join(parts[i:]) for i in range(len(parts))]
+
+
+def export_weightless_graph(model_path, graph_path, dtype=torch.float32, kv_cache="none",
+                            logits_mode="full", top_k=DEFAULT_TOP_K):
+    """
+    Trace the model with every parameter on the meta device and save a graph
+    whose weights are left as named inputs. Nothing model-sized is allocated.
+    Returns (config, real buffer values, parameter aliases).
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(model_path, local_files_only=True)
+    config.use_cache = kv_cache != "none"
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, attn_implementation="eager")
+
+    num_layers = config.num_hidden_layers
+    if kv_cache == "none":
+        wrapper = StreamingExportWrapper(model, logits_mode, top_k)
+        dummy_inputs = (torch.randint(0, config.vocab_size, (1, 8)),)
+        input_names = ["input_ids"]
+        if logits_mode:
+            output_names = logits_output_names(logits_mode)
+            output_axes = logits_dynamic_axes(logits_mode)
+        else:
+            output_names = ["last_hidden_state"]
+            output_axes = {"last_hidden_state": {0: "batch_size", 1: "sequence_length"}}
+        dynamic_axes = {"input_ids": {0: "batch_size", 1: "sequence_length"}, **output_axes}
+    else:
+        # KV-cache graphs return logits (not hidden states) so they can drive decoding
+        logits_mode = logits_mode or "full"
+        wrapper = DecoderWithPastWrapper(model, num_layers, logits_mode, top_k)
+        dummy_inputs = build_kv_dummy_inputs(config, config.vocab_size, dtype=dtype)
+        input_names = ["input_ids", "attention_mask", "position_ids"] + past_input_names(num_layers)
+        output_names = logits_output_names(logits_mode) + present_output_names(num_layers)
+        dynamic_axes = kv_dynamic_axes(num_layers, logits_mode=logits_mode)
+    wrapper.eval()
+
+    # Buffers (rotary inv_freq, embed scale) are computed, not stored in the checkpoint
+    buffers = {name: buffer.detach().clone() for name, buffer in wrapper.named_buffers()}
+    aliases = _parameter_aliases(wrapper)
+    wrapper.to("meta")
+    dummy_inputs = tuple(tensor.to("meta") for tensor in dummy_inputs)
+
+    print(f"🔄 Tracing weightless graph ({num_layers} layers, {str(dtype).split('.')[-1]})...")
+    with torch.no_grad():
+        onnx_program = torch.onnx.export(
+            wrapper,
+            dummy_inputs,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            dynamo=True,
+            optimize=False,  # Constant folding needs the weights we have not loaded yet
+        )
+    onnx_program.save(graph_path, include_initializers=False, keep_initializers_as_inputs=True)
+    return config, buffers, aliases
+
+
+def _make_resolver(checkpoint, buffers, aliases):
+    """Return name -> ("checkpoint", key) | ("buffer", tensor) | None for graph inputs"""
+    def resolve(name):
+        for alias in aliases.get(name, [name]):
+            for key in _suffixes(alias):
+                if key in checkpoint:
+                    return "checkpoint", key
+        if name in buffers:
+            return "buffer", buffers[name]
+        return None
+    return resolve
+
+
+def _iter_chunks(source, dtype, budget_bytes):
+    """Yield a tensor in row chunks that fit the memory budget (source + converted copy)"""
+    kind, value = source
+    if kind == "buffer":
+        yield value.to(dtype)
+        return
+
+    tensor_slice = value
+    shape = tensor_slice.get_shape()
+    if not shape:
+        yield tensor_slice[...].to(dtype)
+        return
+
+    row_elements = 1
+    for dim in shape[1:]:
+        row_elements *= dim
+    # Budget both the source rows and their converted copy (e.g. bf16 -> fp32)
+    source_itemsize = _SAFETENSORS_ITEMSIZE.get(tensor_slice.get_dtype(), 4)
+    row_bytes = max(1, row_elements * (source_itemsize + torch.tensor([], dtype=dtype).element_size()))
+    rows_per_chunk = max(1, budget_bytes // row_bytes)
+    for start in range(0, shape[0], rows_per_chunk):
+        yield tensor_slice[start:start + rows_per_chunk].to(dtype)
+
+
+def _tensor_bytes(tensor):
+    tensor = tensor.contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().tobytes()
+
+
+def stream_initializers(graph_path, output_path, checkpoint, resolve, budget_bytes):
+    """
+    Turn weight inputs of a weightless graph into external-data initializers,
+    streaming each tensor chunk by chunk so peak memory stays under budget.
+    """
+    model = onnx.load(graph_path, load_external_data=False)
+    data_name = os.path.basename(output_path) + ".data"
+    data_path = os.path.join(os.path.dirname(os.path.abspath(output_path)), data_name)
+
+    kept_inputs = []
+    total_bytes = 0
+    start_time = time.time()
+    with open(data_path, "wb") as data_file:
+        for value_info in model.graph.input:
+            source = resolve(value_info.name)
+            if source is None:
+                kept_inputs.append(value_info)
+                continue
+            if source[0] == "checkpoint":
+                source = ("checkpoint", checkpoint.get_slice(source[1]))
+
+            tensor_type = value_info.type.tensor_type
+            offset = data_file.tell()
+            for chunk in _iter_chunks(source, _ONNX_TO_TORCH[tensor_type.elem_type], budget_bytes):
+                data_file.write(_tensor_bytes(chunk))
+                del chunk
+            length = data_file.tell() - offset
+            total_bytes += length
+
+            tensor = TensorProto()
+            tensor.name = value_info.name
+            tensor.data_type = tensor_type.elem_type
+            tensor.dims.extend(dim.dim_value for dim in tensor_type.shape.dim)
+            tensor.data_location = TensorProto.EXTERNAL
+            for key, value in (("location", data_name), ("offset", str(offset)), ("length", str(length))):
+                entry = tensor.external_data.add()
+                entry.key = key
+                entry.value = value
+            model.graph.initializer.append(tensor)
+
+    del model.graph.input[:]
+    model.graph.input.extend(kept_inputs)
+    onnx.save(model, output_path)
+
+    elapsed = time.time() - start_time
+    print(f"   - Streamed {len(model.graph.initializer)} tensors, {total_bytes / 1024 ** 3:.2f} GB "
+          f"in {elapsed:.1f} s ({total_bytes / 1024 ** 2 / max(elapsed, 1e-6):.0f} MB/s)")
+    return data_path
+
+
+def stream_export_model(model_path, output_path=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                        dtype="float32", kv_cache="none", logits_mode="full", top_k=DEFAULT_TOP_K):
+    """Export a safetensors checkpoint to ONNX without holding the model in RAM"""
+    if kv_cache not in KV_CACHE_MODES:
+        raise ValueError(f"Streaming export supports --kv-cache {', '.join(KV_CACHE_MODES)}, not {kv_cache}")
+
+    print(f"🚀 Streaming export of {os.path.abspath(model_path)}")
+    output_path = output_path or os.path.join(model_path, "model.onnx")
+    graph_path = os.path.splitext(output_path)[0] + ".graph.onnx"
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    budget_bytes = memory_budget_mb * 1024 * 1024
+    print(f"   - Memory budget: {memory_budget_mb} MB")
+
+    try:
+        checkpoint = SafetensorsCheckpoint(model_path)
+        print(f"   - Checkpoint: {len(checkpoint.weight_map)} tensors in {len(checkpoint.shards())} shard(s)")
+
+        with stage("export", weights="meta"):
+            config, buffers, aliases = export_weightless_graph(
+                model_path, graph_path, DTYPES[dtype], kv_cache, logits_mode, top_k
+            )
+
+        print("💾 Streaming weights into external data...")
+        resolve = _make_resolver(checkpoint, buffers, aliases)
+        with stage("file write", memory_budget_mb=memory_budget_mb):
+            data_path = stream_initializers(graph_path, output_path, checkpoint, resolve, budget_bytes)
+        checkpoint.close()
+        os.remove(graph_path)
+
+        missing = [value.name for value in onnx.load(output_path, load_external_data=False).graph.input
+                   if value.name not in ("input_ids", "attention_mask", "position_ids")
+                   and not value.name.startswith("past_key_values.")]
+        if missing:
+            print(f"❌ Error: {len(missing)} weights not found in checkpoint, e.g. {missing[:3]}")
+            return False
+
+        print("✅ Streaming export completed!")
+        print(f"   - Graph: {output_path} ({os.path.getsize(output_path) / 1024 ** 2:.1f} MB)")
+        print(f"   - Weights: {data_path} ({os.path.getsize(data_path) / 1024 ** 2:.1f} MB)")
+        return True
+
+    except Exception as e:
+        print(f"❌ Error during streaming export: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def add_streaming_arguments(parser):
+    """Streaming export options shared by the converters"""
+    parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="Peak memory used for weight conversion buffers")
+    parser.add_argument("--dtype", choices=list(DTYPES), default="float32")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a large safetensors checkpoint to ONNX with bounded memory")
+    parser.add_argument("--model-path", default="../ai_models/phi-2")
+    parser.add_argument("--output", default=None, help="Defaults to <model-path>/model.onnx")
+    parser.add_argument("--kv-cache", choices=KV_CACHE_MODES, default="none")
+    parser.add_argument("--logits", choices=LOGITS_MODES, default="full")
+    parser.add_argument("--top-k", type=parse_top_k, default=DEFAULT_TOP_K)
+    add_streaming_arguments(parser)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("stream_export", args.trace):
+        success = stream_export_model(
+            args.model_path,
+            args.output,
+            memory_budget_mb=args.memory_budget_mb,
+            dtype=args.dtype,
+            kv_cache=args.kv_cache,
+            logits_mode=args.logits,
+            top_k=args.top_k,
+        )
+    if success:
+        print("\n🎉 Streaming ONNX export completed successfully!")
+    else:
+        print("\n💥 Streaming export failed. Check the error messages above.")
+        exit(1)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Seeded tiny model fixtures for CrypticDash converter regression runs
+Builds Gemma-3-like and Phi-like checkpoints plus BPE tokenizers over a size
+matrix entirely offline, runs them through the conversion matrix and
+benchmarks the published graphs against an optional baseline
+"""
+
+import os
+import json
+import glob
+import random
+import hashlib
+import argparse
+import tempfile
+
+from conversion_matrix import PRECISIONS, expand_jobs, schedule, write_matrix_report, _run_job
+from model_pipeline import VALIDATION_PROMPT
+from export_wrappers import KV_CACHE_MODES
+from stage_trace import add_trace_arguments, stage, trace_run
+
+DEFAULT_ROOT = "../ai_models/fixtures"
+DEFAULT_SEED = 0
+DEFAULT_MAX_REGRESSION = 0.25  # tiny graphs run in milliseconds, so timings are noisier than real models'
+DEFAULT_MEMORY_BUDGET_GB = 4.0
+
+FIXTURE_SIZES = {
+    "xs": {"hidden_size": 64, "num_hidden_layers": 2, "num_attention_heads": 4, "num_key_value_heads": 2,
+           "intermediate_size": 128, "vocab_size": 512},
+    "s": {"hidden_size": 128, "num_hidden_layers": 4, "num_attention_heads": 4, "num_key_value_heads": 2,
+          "intermediate_size": 256, "vocab_size": 1024},
+    "m": {"hidden_size": 256, "num_hidden_layers": 6, "num_attention_heads": 8, "num_key_value_heads": 4,
+          "intermediate_size": 512, "vocab_size": 2048},
+}
+
+# Special tokens in id order, mirroring each family's real tokenizer
+ARCHITECTURES = {
+    "gemma": {"special_tokens": ["<pad>", "<eos>", "<bos>", "<unk>"], "bos": "<bos>", "eos": "<eos>",
+              "pad": "<pad>", "unk": "<unk>"},
+    "phi2": {"special_tokens": ["<|endoftext|>"], "bos": "<|endoftext|>", "eos": "<|endoftext|>",
+             "pad": None, "unk": "<|endoftext|>"},
+}
+
+BENCHMARK_OPTIONS = {"sequence_lengths": [16, 64], "decode_tokens": 16, "repeats": 3}
+CONVERSION_METRICS = ("seconds", "peak_rss_bytes")
+
+_WORDS = (
+    "flutter", "widget", "state", "build", "context", "todo", "list", "project", "github", "repository",
+    "issue", "commit", "branch", "test", "async", "await", "future", "stream", "model", "onnx", "token",
+    "export", "layer", "cache", "dart", "class", "final", "return", "import", "package",
+)
+
+
+def fixture_name(arch, size):
+    return f"{arch}-{size}"
+
+
+def fixture_corpus(seed, lines=2000):
+    """Seeded synthetic training text: repo-ish prose, code-ish lines and the validation prompt"""
+    rng = random.Random(seed)
+    corpus = [VALIDATION_PROMPT]
+    for index in range(lines):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(4, 12))]
+        if index % 3 == 0:
+            corpus.append(f"final {words[0]}_{words[1]} = {words[2]}({', '.join(words[3:])});")
+        elif index % 3 == 1:
+            corpus.append(f"- [ ] {' '.join(words).capitalize()} #{rng.randint(1, 999)}")
+        else:
+            corpus.append(" ".join(words).capitalize() + ".")
+    return corpus
+
+
+def build_tokenizer(arch, vocab_size, seed, output_dir):
+    """Train a byte-level BPE tokenizer offline and write the files AutoTokenizer reads"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+
+    spec = ARCHITECTURES[arch]
+    tokenizer = Tokenizer(models.BPE(unk_token=spec["unk"]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=spec["special_tokens"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(fixture_corpus(seed), trainer=trainer)
+    if arch == "gemma":
+        # Gemma prepends <bos> to every encoded sequence
+        bos_id = tokenizer.token_to_id(spec["bos"])
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single=f"{spec['bos']} $A", pair=f"{spec['bos']} $A $B", special_tokens=[(spec["bos"], bos_id)])
+    else:
+        tokenizer.post_processor = processors.ByteLevel(trim_offsets=False)
+    tokenizer.save(os.path.join(output_dir, "tokenizer.json"))
+
+    special_tokens = {f"{role}_token": spec[role] for role in ("bos", "eos", "pad", "unk") if spec[role]}
+    with open(os.path.join(output_dir, "tokenizer_config.json"), "w", encoding="utf-8") as f:
+        json.dump({"tokenizer_class": "PreTrainedTokenizerFast", "model_max_length": 2048, **special_tokens},
+                  f, indent=2)
+    with open(os.path.join(output_dir, "special_tokens_map.json"), "w", encoding="utf-8") as f:
+        json.dump(special_tokens, f, indent=2)
+    return tokenizer
+
+
+def build_config(arch, size, tokenizer):
+    """Model config for one fixture; the vocabulary is whatever the tokenizer actually learned"""
+    dims = dict(FIXTURE_SIZES[size], vocab_size=tokenizer.get_vocab_size())
+    spec = ARCHITECTURES[arch]
+    ids = {f"{role}_token_id": tokenizer.token_to_id(spec[role]) for role in ("bos", "eos", "pad") if spec[role]}
+    if arch == "gemma":
+        from transformers import Gemma3TextConfig
+
+        return Gemma3TextConfig(
+            **dims, **ids,
+            head_dim=dims["hidden_size"] // dims["num_attention_heads"],
+            max_position_embeddings=2048,
+            sliding_window=64,
+            tie_word_embeddings=True,
+        )
+
+    from transformers import PhiConfig
+
+    # Phi-2 has no grouped-query attention
+    dims["num_key_value_heads"] = dims["num_attention_heads"]
+    return PhiConfig(**dims, **ids, max_position_embeddings=2048)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_fixture(arch, size, root=DEFAULT_ROOT, seed=DEFAULT_SEED):
+    """
+    Write one seeded checkpoint directory (safetensors, config, tokenizer)
+    under root. The same arch, size, seed and library versions give the same bytes.
+    """
+    import torch
+    from transformers import Gemma3ForCausalLM, PhiForCausalLM
+
+    output_dir = os.path.join(root, fixture_name(arch, size))
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"🔧 Building {fixture_name(arch, size)} (seed {seed}) in {output_dir}")
+
+    with stage("fixture tokenizer", arch=arch, size=size):
+        tokenizer = build_tokenizer(arch, FIXTURE_SIZES[size]["vocab_size"], seed, output_dir)
+    with stage("fixture model", arch=arch, size=size):
+        config = build_config(arch, size, tokenizer)
+        torch.manual_seed(seed)
+        model_class = Gemma3ForCausalLM if arch == "gemma" else PhiForCausalLM
+        model = model_class(config).eval()
+        model.save_pretrained(output_dir, safe_serialization=True)
+
+    parameters = sum(parameter.numel() for parameter in model.parameters())
+    record = {
+        "arch": arch,
+        "size": size,
+        "seed": seed,
+        "parameters": parameters,
+        "vocab_size": config.vocab_size,
+        "sha256": {name: _file_sha256(os.path.join(output_dir, name))
+                   for name in ("model.safetensors", "tokenizer.json")},
+    }
+    with open(os.path.join(output_dir, "fixture.json"), "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2)
+    print(f"   ✅ {parameters / 1e6:.2f}M parameters, vocabulary {config.vocab_size}")
+    return output_dir
+
+
+def build_fixtures(archs, sizes, root=DEFAULT_ROOT, seed=DEFAULT_SEED):
+    """Build every (arch, size) fixture; returns {fixture name: directory}"""
+    return {fixture_name(arch, size): build_fixture(arch, size, root, seed) for arch in archs for size in sizes}
+
+
+def fixture_matrix(fixtures, kv_cache, precisions):
+    """Conversion-matrix targets for the fixtures, named after them so job names stay unique"""
+    return {
+        "targets": [
+            {"name": name, "model": name.split("-")[0], "model_path": path,
+             "kv_cache": list(kv_cache), "precisions": list(precisions)}
+            for name, path in fixtures.items()
+        ],
+    }
+
+
+def compare_conversions(results, baseline, max_regression):
+    """Human-readable conversion time and peak RSS regressions against a baseline run"""
+    regressions = []
+    previous_jobs = baseline.get("conversions", {})
+    for name, result in results.items():
+        previous = previous_jobs.get(name)
+        if previous is None or not result["ok"]:
+            continue
+        for metric in CONVERSION_METRICS:
+            current, reference = result.get(metric), previous.get(metric)
+            if current is None or not reference:
+                continue
+            change = (current - reference) / reference
+            if change > max_regression:
+                regressions.append(f"{name}: {metric} {reference:.2f} -> {current:.2f} (+{change:.0%})")
+    return regressions
+
+
+def run_fixtures(archs, sizes, root=DEFAULT_ROOT, seed=DEFAULT_SEED, kv_cache=("none",), precisions=("fp32",),
+                 cache_dir=None, output_path="fixture_results.json", baseline_path=None,
+                 max_regression=DEFAULT_MAX_REGRESSION, memory_budget_gb=DEFAULT_MEMORY_BUDGET_GB,
+                 workers=None, build_only=False):
+    """
+    Build the fixtures, convert and benchmark them, and check for regressions.
+    Without cache_dir every conversion runs in a fresh pipeline cache, so the
+    conversion times and peaks measure the converters rather than cache hits.
+    """
+    from benchmark_onnx import benchmark_isolated, compare_to_baseline
+
+    try:
+        fixtures = build_fixtures(archs, sizes, root, seed)
+        if build_only:
+            return True
+
+        memory_budget_bytes = int(memory_budget_gb * 1024 ** 3)
+        workers = workers or os.cpu_count() or 1
+        with stage("plan"):
+            jobs = expand_jobs(fixture_matrix(fixtures, kv_cache, precisions))
+        print(f"📋 {len(jobs)} conversion job(s) over {len(fixtures)} fixture(s)")
+        if cache_dir is None:
+            with tempfile.TemporaryDirectory(prefix="fixture_cache_") as fresh_cache_dir:
+                conversions = schedule(jobs, memory_budget_bytes, workers, _run_job, fresh_cache_dir)
+        else:
+            conversions = schedule(jobs, memory_budget_bytes, workers, _run_job, cache_dir)
+        report_path = os.path.splitext(output_path)[0] + "_conversions.md"
+        write_matrix_report(conversions, memory_budget_bytes, workers, report_path)
+        print(f"📝 Wrote {report_path}")
+
+        records = {}
+        for name, path in fixtures.items():
+            with open(os.path.join(path, "fixture.json"), "r", encoding="utf-8") as f:
+                records[name] = json.load(f)
+
+        runs = []
+        for job in jobs:
+            if not conversions[job["name"]]["ok"]:
+                continue
+            # Graphs that only output hidden states do not expose the vocabulary themselves
+            vocab_size = records[job["name"].rsplit("-", 1)[0]]["vocab_size"]
+            for graph_path in sorted(glob.glob(os.path.join(job["output_dir"], "*.onnx"))):
+                run = benchmark_isolated(graph_path, vocab_size=vocab_size, **BENCHMARK_OPTIONS)
+                # Every fixture publishes model.onnx, so runs are keyed by job and file
+                run["name"] = f"{job['name']}/{os.path.basename(graph_path)}"
+                runs.append(run)
+
+        results = {"seed": seed, "benchmark_options": BENCHMARK_OPTIONS,
+                   "fixtures": records,
+                   "conversions": conversions, "runs": runs}
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"📝 Wrote {output_path}")
+    except Exception as e:
+        print(f"❌ Error during fixture run: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+    failed = sorted(name for name, result in conversions.items() if not result["ok"])
+    if failed:
+        print(f"❌ {len(failed)} conversion(s) failed: {', '.join(failed)}")
+
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        changed = sorted(name for name, fixture in results["fixtures"].items()
+                         if name in baseline.get("fixtures", {}) and baseline["fixtures"][name]["sha256"] != fixture["sha256"])
+        if changed:
+            print(f"⚠️ Fixture bytes differ from the baseline for {', '.join(changed)}; "
+                  "library versions likely changed, so timings may not be comparable")
+        regressions = compare_conversions(conversions, baseline, max_regression) + \
+            compare_to_baseline(results, baseline, max_regression)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) over {max_regression:.0%}:")
+            for line in regressions:
+                print(f"   - {line}")
+            return False
+        print(f"✅ No regressions over {max_regression:.0%} against {baseline_path}")
+
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build seeded tiny model fixtures and run them through the converters")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="Directory the fixture checkpoints are written under")
+    parser.add_argument("--archs", nargs="+", choices=sorted(ARCHITECTURES), default=sorted(ARCHITECTURES))
+    parser.add_argument("--sizes", nargs="+", choices=list(FIXTURE_SIZES), default=list(FIXTURE_SIZES))
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--kv-cache", nargs="+", choices=KV_CACHE_MODES, default=["none"])
+    parser.add_argument("--precisions", nargs="+", choices=PRECISIONS, default=["fp32"])
+    parser.add_argument("--cache-dir", default=None,
+                        help="Pipeline cache to reuse (default: a fresh one per run, so every conversion is timed)")
+    parser.add_argument("--output", default="fixture_results.json", help="JSON results path")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=DEFAULT_MAX_REGRESSION,
+                        help="Fail when a metric is this fraction slower/larger than the baseline")
+    parser.add_argument("--memory-budget-gb", type=float, default=DEFAULT_MEMORY_BUDGET_GB)
+    parser.add_argument("--workers", type=int, default=None, help="Maximum concurrent conversions (default: CPU count)")
+    parser.add_argument("--build-only", action="store_true", help="Only write the fixture checkpoints")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("tiny_fixtures", args.trace):
+        success = run_fixtures(
+            args.archs,
+            args.sizes,
+            root=args.root,
+            seed=args.seed,
+            kv_cache=args.kv_cache,
+            precisions=args.precisions,
+            cache_dir=args.cache_dir,
+            output_path=args.output,
+            baseline_path=args.baseline,
+            max_regression=args.max_regression,
+            memory_budget_gb=args.memory_budget_gb,
+            workers=args.workers,
+            build_only=args.build_only,
+        )
+    if success:
+        print("\n🎉 Fixture run completed successfully!")
+    else:
+        print("\n💥 Fixture run failed or regressed. Check the messages above.")
+        exit(1)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Vocabulary trimming for exported CrypticDash models
+Counts token frequencies over a corpus of repositories and TODO files, keeps
+the tokens that cover it (plus special tokens, the byte alphabet and every
+merge step needed to reach a kept token), and rewrites the embedding and LM
+head initializers, tokenizer files and an old -> new id map to that subset
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import onnx
+
+from batch_tokenizer import BatchTokenizer
+from binary_tokenizer import DEFAULT_CORPUS, _BYTE_ENCODER, compile_tokenizer, iter_corpus
+from dedup_initializers import save_with_data
+from ort_runtime import EXTERNAL_DATA_THRESHOLD, model_size_bytes, tensor_array, tensor_bytes
+from stage_trace import add_trace_arguments, stage, trace_run
+
+VOCAB_MAP_FILE = "vocab_map.npy"
+DEFAULT_COVERAGE = 0.9999
+DEFAULT_HOLDOUT = 0.1
+# Keeping the retained vocabulary a multiple of this keeps LM head GEMMs on full SIMD tiles
+VOCAB_MULTIPLE = 64
+BENCHMARK_OPTIONS = {"sequence_lengths": [16, 64], "decode_tokens": 16, "repeats": 3}
+# Copied unchanged: they name special tokens by text, not id
+TOKENIZER_COPIES = ("special_tokens_map.json",)
+
+
+def split_corpus(texts, holdout):
+    """Every n-th chunk is held out, so coverage is also measured on text the selection never saw"""
+    if not holdout:
+        return texts, []
+    step = max(2, round(1 / holdout))
+    return ([text for index, text in enumerate(texts) if index % step],
+            [text for index, text in enumerate(texts) if not index % step])
+
+
+def count_tokens(tokenizer, texts, batch_size=32):
+    """Occurrences of every token id over the texts, special tokens included"""
+    counts = np.zeros(tokenizer.vocab_size, dtype=np.int64)
+    for start in range(0, len(texts), batch_size):
+        encoded = tokenizer.encode_batch(texts[start:start + batch_size])
+        ids = encoded["input_ids"][encoded["attention_mask"].astype(bool)]
+        counts += np.bincount(ids, minlength=tokenizer.vocab_size)
+    return counts
+
+
+def _merge_pair(merge):
+    return tuple(merge.split(" ", 1)) if isinstance(merge, str) else tuple(merge)
+
+
+def base_tokens(spec):
+    """Tokens that keep any text encodable: added tokens, the byte alphabet and byte-fallback pieces"""
+    model = spec["model"]
+    vocab = model["vocab"]
+    keep = {token["content"] for token in spec.get("added_tokens", [])}
+    keep.update(token for token in vocab if len(token) == 1 and token in _BYTE_ENCODER.values())
+    keep.update(token for token in vocab if len(token) == 6 and token.startswith("<0x") and token.endswith(">"))
+    if model.get("unk_token") in vocab:
+        keep.add(model["unk_token"])
+    return keep
+
+
+def close_over_merges(keep, merges):
+    """
+    Add both parts of every merge that produces a kept token (SentencePiece
+    conversions often have several). BPE then reaches each kept token exactly
+    as before, so any word whose tokens were all kept still tokenizes
+    identically; other words fall back to shorter kept pieces.
+    """
+    sources = {}
+    for merge in merges:
+        left, right = _merge_pair(merge)
+        sources.setdefault(left + right, []).append((left, right))
+    pending = list(keep)
+    closed = set(keep)
+    while pending:
+        for pair in sources.get(pending.pop(), ()):
+            for part in pair:
+                if part not in closed:
+                    closed.add(part)
+                    pending.append(part)
+    return closed
+
+
+def select_vocabulary(spec, counts, coverage=DEFAULT_COVERAGE, max_vocab=None, min_count=1, padding_rows=0):
+    """
+    Old ids to keep, ascending: the base tokens, then the most frequent tokens
+    until `coverage` of the counted occurrences is reached (or max_vocab), all
+    closed over their merges and padded with the next most frequent tokens so
+    that, with the graph's padding_rows, the rows are a multiple of VOCAB_MULTIPLE
+    """
+    vocab = spec["model"]["vocab"]
+    tokens = {index: token for token, index in vocab.items()}
+    tokens.update({token["id"]: token["content"] for token in spec.get("added_tokens", [])})
+    merges = spec["model"].get("merges", [])
+
+    keep = base_tokens(spec)
+    order = [int(index) for index in np.argsort(-counts, kind="stable") if index in tokens]
+    total = int(counts.sum())
+    covered = 0
+    for index in order:
+        if counts[index] < min_count or (total and covered / total >= coverage):
+            break
+        if max_vocab and len(keep) >= max_vocab:
+            break
+        keep.add(tokens[index])
+        covered += int(counts[index])
+    keep = close_over_merges(keep, merges)
+
+    # Pad with frequent (then low) ids; a padded token's merge sources are added too
+    for index in order:
+        if (len(keep) + padding_rows) % VOCAB_MULTIPLE == 0 or len(keep) >= len(tokens):
+            break
+        if tokens[index] not in keep:
+            keep = close_over_merges(keep | {tokens[index]}, merges)
+    ids = {token_id for token_id, token in tokens.items() if token in keep}
+    return np.array(sorted(ids), dtype=np.int64)
+
+
+def _remap_post_processor(spec, remap):
+    if spec is None:
+        return
+    if spec["type"] == "Sequence":
+        for child in spec["processors"]:
+            _remap_post_processor(child, remap)
+    elif spec["type"] == "TemplateProcessing":
+        for special in spec["special_tokens"].values():
+            special["ids"] = [remap(token_id) for token_id in special["ids"]]
+    elif spec["type"] in ("RobertaProcessing", "BertProcessing"):
+        for key in ("cls", "sep"):
+            spec[key] = [spec[key][0], remap(spec[key][1])]
+
+
+def _remap_generation_config(config, remap):
+    """bos/eos/pad/decoder_start ids (an int or a list each) in the new numbering"""
+    config = dict(config)
+    for key, value in config.items():
+        if key.endswith("_token_id") and value is not None:
+            config[key] = [remap(token_id) for token_id in value] if isinstance(value, list) else remap(value)
+    return config
+
+
+def write_trimmed_tokenizer(spec, config, kept_ids, output_dir, generation_config=None):
+    """
+    tokenizer.json, tokenizer_config.json and generation_config.json
+    renumbered to the kept ids. The written tokenizer.json is loaded back
+    with the tokenizers library as a check.
+    """
+    from tokenizers import Tokenizer
+
+    new_ids = {int(old): new for new, old in enumerate(kept_ids)}
+
+    def remap(token_id):
+        return new_ids[int(token_id)]
+
+    spec = json.loads(json.dumps(spec))
+    model = spec["model"]
+    model["vocab"] = {token: remap(index) for token, index in model["vocab"].items() if index in new_ids}
+    if "merges" in model:
+        # Same relative order keeps the merge ranks (and so the tokenization) unchanged
+        model["merges"] = [merge for merge in model["merges"]
+                           if all(part in model["vocab"] for part in (*_merge_pair(merge), "".join(_merge_pair(merge))))]
+    for token in spec.get("added_tokens", []):
+        token["id"] = remap(token["id"])
+    _remap_post_processor(spec.get("post_processor"), remap)
+    tokenizer_path = os.path.join(output_dir, "tokenizer.json")
+    with open(tokenizer_path, "w", encoding="utf-8") as f:
+        json.dump(spec, f, ensure_ascii=False)
+    Tokenizer.from_file(tokenizer_path)
+
+    if config is not None:
+        config = dict(config)
+        if "added_tokens_decoder" in config:
+            config["added_tokens_decoder"] = {
+                str(remap(index)): token for index, token in config["added_tokens_decoder"].items()
+                if int(index) in new_ids
+            }
+        with open(os.path.join(output_dir, "tokenizer_config.json"), "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+
+    if generation_config is not None:
+        with open(os.path.join(output_dir, "generation_config.json"), "w", encoding="utf-8") as f:
+            json.dump(_remap_generation_config(generation_config, remap), f, indent=2)
+
+
+def graph_vocab_size(model_path):
+    """
+    Embedding / LM head rows: the logits width, else vocab_size from the
+    checkpoint config.json next to the graph or in its parent. This can be
+    larger than the tokenizer (Phi-2 pads ~50.3k tokens to 51,200 rows).
+    """
+    model = onnx.load(model_path, load_external_data=False)
+    for value in model.graph.output:
+        dims = value.type.tensor_type.shape.dim
+        if value.name == "logits" and dims and dims[-1].HasField("dim_value"):
+            return dims[-1].dim_value
+    model_dir = os.path.dirname(os.path.abspath(model_path))
+    for directory in (model_dir, os.path.dirname(model_dir)):
+        config_path = os.path.join(directory, "config.json")
+        if os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            config = config.get("text_config", config)
+            if "vocab_size" in config:
+                return config["vocab_size"]
+    raise ValueError("Cannot tell the graph's vocabulary size: no fixed-width logits output and no config.json")
+
+
+def trim_graph(model_path, output_path, kept_ids, vocab_size):
+    """
+    Slice every float initializer with a vocabulary-sized axis (embedding rows,
+    LM head columns, LM head bias) to the kept ids and fix vocabulary-sized
+    output dims. Returns the names of the sliced initializers.
+    """
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    model = onnx.load(model_path, load_external_data=False)
+    graph = model.graph
+    external = model_size_bytes(model_path) >= EXTERNAL_DATA_THRESHOLD or any(
+        tensor.data_location == onnx.TensorProto.EXTERNAL for tensor in graph.initializer)
+
+    data, sliced = {}, []
+    for tensor in graph.initializer:
+        data[tensor.name] = tensor_bytes(tensor, base_dir)
+        if tensor.data_type not in (onnx.TensorProto.FLOAT, onnx.TensorProto.FLOAT16) or vocab_size not in tensor.dims:
+            continue
+        if len(tensor.dims) > 2 or len(set(tensor.dims)) < len(tensor.dims):
+            raise ValueError(f"Cannot tell the vocabulary axis of {tensor.name} {list(tensor.dims)}")
+        axis = list(tensor.dims).index(vocab_size)
+        array = np.ascontiguousarray(np.take(tensor_array(tensor, data[tensor.name]), kept_ids, axis=axis))
+        data[tensor.name] = array.tobytes()
+        tensor.dims[axis] = len(kept_ids)
+        sliced.append(tensor.name)
+    if not sliced:
+        raise ValueError(f"No float initializer has a {vocab_size}-sized axis (quantized heads cannot be trimmed; "
+                         f"trim before quantizing)")
+
+    for value in [*graph.output, *graph.value_info]:
+        for dim in value.type.tensor_type.shape.dim:
+            if dim.HasField("dim_value") and dim.dim_value == vocab_size:
+                dim.dim_value = len(kept_ids)
+    for tensor in graph.initializer:
+        if tensor.data_type == onnx.TensorProto.INT64 and len(data[tensor.name]) <= 64 and \
+                vocab_size in np.frombuffer(data[tensor.name], dtype=np.int64):
+            print(f"   ⚠️ Shape constant {tensor.name} mentions the old vocabulary size; check its reshape")
+    save_with_data(model, data, output_path, external)
+    return sliced
+
+
+def corpus_coverage(tokenizer, trimmed, texts, kept_ids, batch_size=32):
+    """How much of the texts the kept ids cover, and what the trimmed tokenizer does with the rest"""
+    counts = count_tokens(tokenizer, texts, batch_size)
+    total = int(counts.sum())
+    lengths_before = lengths_after = unchanged = 0
+    new_to_old = kept_ids
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        before = tokenizer.encode_batch(batch)
+        after = trimmed.encode_batch(batch)
+        lengths_before += int(before["attention_mask"].sum())
+        lengths_after += int(after["attention_mask"].sum())
+        for ids, mask, new_ids, new_mask in zip(before["input_ids"], before["attention_mask"],
+                                                after["input_ids"], after["attention_mask"]):
+            original = ids[mask.astype(bool)]
+            remapped = new_to_old[new_ids[new_mask.astype(bool)]]
+            unchanged += int(np.array_equal(original, remapped))
+    return {
+        "texts": len(texts),
+        "token_coverage": float(counts[kept_ids].sum() / total) if total else 1.0,
+        "texts_unchanged": unchanged / len(texts) if texts else 1.0,
+        "tokens_before": lengths_before,
+        "tokens_after": lengths_after,
+    }
+
+
+def write_trim_report(report, report_path):
+    """Markdown summary plus a JSON copy next to it"""
+    mb = 1024 ** 2
+    lines = [
+        f"# Vocabulary trim: {report['model']}",
+        "",
+        f"- Vocabulary: {report['vocab_before']:,} -> {report['vocab_after']:,} tokens "
+        f"({report['vocab_after'] / report['vocab_before']:.1%} kept)",
+        f"- Embedding / LM head rows: {report['rows_before']:,} -> {report['rows_after']:,} "
+        f"({report['rows_before'] - report['vocab_before']:,} padding rows past the tokenizer kept)",
+        f"- Sliced initializers: {', '.join(report['sliced'])}",
+        f"- Model size: {report['size_before'] / mb:.1f} MB -> {report['size_after'] / mb:.1f} MB",
+        f"- Id map: {VOCAB_MAP_FILE} (old row of every new row, ascending)",
+        "",
+        "| Corpus | Texts | Token coverage | Texts tokenized identically | Tokens before | Tokens after |",
+        "|---|---|---|---|---|---|",
+    ]
+    for label, result in report["coverage"].items():
+        growth = result["tokens_after"] / max(1, result["tokens_before"]) - 1
+        lines.append(f"| {label} | {result['texts']} | {result['token_coverage']:.4%} | {result['texts_unchanged']:.1%} | "
+                     f"{result['tokens_before']:,} | {result['tokens_after']:,} (+{growth:.2%}) |")
+    if report.get("benchmark"):
+        prefill_length = BENCHMARK_OPTIONS["sequence_lengths"][-1]
+        lines += ["", f"| Graph | Size (MB) | Session (s) | Prefill {prefill_length} (ms) | Decode (ms/token) | Peak RSS (MB) |",
+                  "|---|---|---|---|---|---|"]
+        for label, run in report["benchmark"].items():
+            decode = f"{run['decode_per_token_ms']:.2f}" if run.get("decode_per_token_ms") else "-"
+            lines.append(f"| {label} | {run['size_mb']:.1f} | {run['session_create_s']:.2f} | "
+                         f"{run['prefill'][-1]['latency_ms']:.1f} | {decode} | {run['peak_rss_mb']:.0f} |")
+    lines.append("")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report_path
+
+
+def _load_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def trim_vocabulary(model_path, output_dir=None, corpus=DEFAULT_CORPUS, coverage=DEFAULT_COVERAGE, max_vocab=None,
+                    min_count=1, holdout=DEFAULT_HOLDOUT, benchmark=True):
+    """
+    Write the trimmed graph, tokenizer files and vocab_map.npy into
+    output_dir (default: <graph dir>/trimmed). The tokenizer is read from the
+    graph's directory or its parent. Returns the trimmed graph path or None.
+    """
+    model_dir = os.path.dirname(os.path.abspath(model_path))
+    output_dir = output_dir or os.path.join(model_dir, "trimmed")
+    try:
+        tokenizer_dir = next((directory for directory in (model_dir, os.path.dirname(model_dir))
+                              if os.path.exists(os.path.join(directory, "tokenizer.json"))), None)
+        if tokenizer_dir is None:
+            raise FileNotFoundError("No tokenizer.json next to the graph or in its parent")
+        with open(os.path.join(tokenizer_dir, "tokenizer.json"), "r", encoding="utf-8") as f:
+            spec = json.load(f)
+        if spec["model"].get("type", "BPE") != "BPE":
+            raise ValueError(f"Only BPE vocabularies can be trimmed, not {spec['model']['type']}")
+        config_path = os.path.join(tokenizer_dir, "tokenizer_config.json")
+        config = _load_json(config_path)
+        generation_config = _load_json(os.path.join(tokenizer_dir, "generation_config.json"))
+        os.makedirs(output_dir, exist_ok=True)
+
+        with tempfile.TemporaryDirectory(prefix="vocab_trim_") as scratch:
+            tokenizer = BatchTokenizer(compile_tokenizer(
+                os.path.join(tokenizer_dir, "tokenizer.json"), config_path, os.path.join(scratch, "original.bin")))
+            texts = [text for _, text in iter_corpus(corpus)]
+            if not texts:
+                raise ValueError("The corpus is empty")
+            selection, held_out = split_corpus(texts, holdout)
+            print(f"📖 Counting tokens over {len(selection)} chunk(s) ({len(held_out)} held out)...")
+            with stage("token counts", chunks=len(selection)):
+                counts = count_tokens(tokenizer, selection)
+
+            vocab_size = tokenizer.vocab_size
+            graph_rows = graph_vocab_size(model_path)
+            if graph_rows < vocab_size:
+                raise ValueError(f"The graph has {graph_rows:,} vocabulary rows for {vocab_size:,} tokenizer ids")
+            kept_ids = select_vocabulary(spec, counts, coverage, max_vocab, min_count, graph_rows - vocab_size)
+            # Padding rows past the tokenizer stay, after the kept tokens, so the map stays ascending
+            rows = np.concatenate([kept_ids, np.arange(vocab_size, graph_rows, dtype=np.int64)])
+            print(f"🔧 Keeping {len(kept_ids):,} of {vocab_size:,} tokens ({len(rows):,} of {graph_rows:,} rows)")
+            write_trimmed_tokenizer(spec, config, kept_ids, output_dir, generation_config)
+            for name in TOKENIZER_COPIES:
+                if os.path.exists(os.path.join(tokenizer_dir, name)):
+                    shutil.copy2(os.path.join(tokenizer_dir, name), output_dir)
+            np.save(os.path.join(output_dir, VOCAB_MAP_FILE), rows.astype(np.int32))
+
+            output_path = os.path.join(output_dir, os.path.basename(model_path))
+            with stage("trim graph", model=os.path.basename(model_path)):
+                sliced = trim_graph(model_path, output_path, rows, graph_rows)
+            print(f"✅ Sliced {', '.join(sliced)} -> {output_path}")
+
+            trimmed = BatchTokenizer(compile_tokenizer(
+                os.path.join(output_dir, "tokenizer.json"), os.path.join(output_dir, "tokenizer_config.json"),
+                os.path.join(scratch, "trimmed.bin")))
+            with stage("coverage"):
+                results = {"selection": corpus_coverage(tokenizer, trimmed, selection, kept_ids)}
+                if held_out:
+                    results["held out"] = corpus_coverage(tokenizer, trimmed, held_out, kept_ids)
+            for label, result in results.items():
+                print(f"   - {label}: {result['token_coverage']:.4%} of tokens kept, "
+                      f"{result['texts_unchanged']:.1%} of chunks tokenized identically")
+            tokenizer.close()
+            trimmed.close()
+
+        report = {
+            "model": os.path.basename(model_path),
+            "vocab_before": vocab_size,
+            "vocab_after": len(kept_ids),
+            "rows_before": graph_rows,
+            "rows_after": len(rows),
+            "sliced": sliced,
+            "size_before": model_size_bytes(model_path),
+            "size_after": model_size_bytes(output_path),
+            "coverage": results,
+            "options": {"coverage": coverage, "max_vocab": max_vocab, "min_count": min_count, "holdout": holdout,
+                        "corpus": list(corpus)},
+        }
+        if benchmark:
+            from benchmark_onnx import benchmark_isolated
+
+            # Ids below the trimmed size are valid in both graphs
+            report["benchmark"] = {
+                label: benchmark_isolated(path, vocab_size=len(kept_ids), **BENCHMARK_OPTIONS)
+                for label, path in (("original", model_path), ("trimmed", output_path))
+            }
+        report_path = write_trim_report(report, os.path.join(output_dir, "vocab_trim_report.md"))
+        print(f"📝 Wrote {report_path}")
+        return output_path
+    except Exception as e:
+        print(f"❌ Error during vocabulary trim: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trim a model's vocabulary to the tokens a corpus actually uses")
+    parser.add_argument("model", help="Exported fp32/fp16 model.onnx (tokenizer.json next to it or in its parent)")
+    parser.add_argument("--output-dir", default=None, help="Defaults to <graph dir>/trimmed")
+    parser.add_argument("--corpus", nargs="*", default=list(DEFAULT_CORPUS),
+                        help="Files/directories (repositories, TODO files) to count tokens over")
+    parser.add_argument("--coverage", type=float, default=DEFAULT_COVERAGE,
+                        help="Fraction of counted token occurrences the kept vocabulary must cover")
+    parser.add_argument("--max-vocab", type=int, default=None, help="Upper bound on frequency-selected tokens")
+    parser.add_argument("--min-count", type=int, default=1, help="Never keep tokens seen fewer times than this")
+    parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                        help="Fraction of corpus chunks kept out of the selection to measure coverage on")
+    parser.add_argument("--no-benchmark", action="store_true", help="Skip the size / latency comparison")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("vocab_trim", args.trace):
+        output = trim_vocabulary(args.model, args.output_dir, args.corpus, args.coverage, args.max_vocab,
+                                 args.min_count, args.holdout, not args.no_benchmark)
+    if output:
+        print("\n🎉 Vocabulary trim completed successfully!")
+    else:
+        print("\n💥 Vocabulary trim failed. Check the messages above.")
+        exit(1)
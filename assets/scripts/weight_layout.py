@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Page-aligned, layer-grouped external-data layout for exported models
+Moves every initializer into <stem>.<group>.data files (one per decoder layer
+plus one for shared weights) at page-aligned offsets with a JSON index, so the
+runtime can memory-map weights and page them in on demand instead of reading
+one monolithic model.onnx, and reports cold-start time and resident memory
+for the embedded layout versus the mmap layout
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import statistics
+import numpy as np
+import onnx
+from onnx import TensorProto, numpy_helper
+from onnx.external_data_helper import uses_external_data
+
+from ort_runtime import EXTERNAL_DATA_THRESHOLD, model_size_bytes
+from stage_trace import add_trace_arguments, stage, trace_run
+
+WEIGHT_LAYOUT_VERSION = 1
+MMAP_SUFFIX = "_mmap.onnx"
+INDEX_SUFFIX = ".weights.json"
+# Windows maps files in 64 KiB units; a multiple of every common page size
+DEFAULT_ALIGNMENT = 64 * 1024
+# Tensors below this stay embedded in the graph (same cut-off as onnx.save_model)
+MIN_EXTERNAL_BYTES = 1024
+COPY_BLOCK = 16 * 1024 * 1024
+DEFAULT_REPEATS = 3
+
+# Decoder layer index in an initializer name or the name of a node that reads it,
+# e.g. model.layers.3.mlp.fc1.weight or /model/layers.3/mlp/fc1/MatMul
+LAYER_PATTERN = re.compile(r"(?:layers|layer|blocks|h)[._/](\d+)(?=[._/]|$)")
+
+# Session configs measured by the cold-start report. Prepacking copies MatMul
+# weights into packed buffers, which touches every page of a mapped file.
+LAYOUT_SESSIONS = {
+    "embedded": {},
+    "mmap": {},
+    "mmap, no prepacking": {"session.disable_prepacking": "1"},
+}
+
+
+def mmap_layout_path(model_path):
+    return os.path.splitext(model_path)[0] + MMAP_SUFFIX
+
+
+def _iter_nodes(graph):
+    """Nodes of a graph and of its Loop/If/Scan subgraphs"""
+    for node in graph.node:
+        yield node
+        for attribute in node.attribute:
+            if attribute.type == onnx.AttributeProto.GRAPH:
+                yield from _iter_nodes(attribute.g)
+            elif attribute.type == onnx.AttributeProto.GRAPHS:
+                for subgraph in attribute.graphs:
+                    yield from _iter_nodes(subgraph)
+
+
+def tensor_groups(graph):
+    """
+    {initializer name: group}: "layerNN" for weights of decoder layer NN,
+    "shared" for embeddings, final norm, LM head and anything unmatched.
+    Constant-folded weights (onnx::MatMul_123) are placed by their readers.
+    """
+    readers = {}
+    for node in _iter_nodes(graph):
+        for name in node.input:
+            readers.setdefault(name, []).append(node.name)
+
+    layers = {}
+    for tensor in graph.initializer:
+        for candidate in (tensor.name, *readers.get(tensor.name, ())):
+            match = LAYER_PATTERN.search(candidate)
+            if match:
+                layers[tensor.name] = int(match.group(1))
+                break
+    width = len(str(max(layers.values()))) if layers else 1
+    return {
+        tensor.name: f"layer{layers[tensor.name]:0{width}d}" if tensor.name in layers else "shared"
+        for tensor in graph.initializer
+    }
+
+
+def _external_info(tensor):
+    return {entry.key: entry.value for entry in tensor.external_data}
+
+
+def _copy_tensor_bytes(tensor, base_dir, out_file):
+    """Append a tensor's raw bytes to out_file without loading external data whole"""
+    if uses_external_data(tensor):
+        info = _external_info(tensor)
+        with open(os.path.join(base_dir, info["location"]), "rb") as source:
+            source.seek(int(info.get("offset", 0)))
+            remaining = int(info["length"]) if "length" in info else None
+            while remaining is None or remaining > 0:
+                block = source.read(COPY_BLOCK if remaining is None else min(COPY_BLOCK, remaining))
+                if not block:
+                    break
+                out_file.write(block)
+                if remaining is not None:
+                    remaining -= len(block)
+    elif tensor.HasField("raw_data"):
+        out_file.write(tensor.raw_data)
+    else:
+        out_file.write(numpy_helper.to_array(tensor).tobytes())
+
+
+def _tensor_nbytes(tensor):
+    if uses_external_data(tensor):
+        info = _external_info(tensor)
+        if "length" in info:
+            return int(info["length"])
+    elif tensor.HasField("raw_data"):
+        return len(tensor.raw_data)
+    count = int(np.prod(tensor.dims)) if len(tensor.dims) else 1
+    return count * onnx.helper.tensor_dtype_to_np_dtype(tensor.data_type).itemsize
+
+
+def write_mmap_layout(model_path, output_path=None, alignment=DEFAULT_ALIGNMENT, min_external_bytes=MIN_EXTERNAL_BYTES):
+    """
+    Rewrite a model so its weights live in <stem>.<group>.data files, each
+    tensor starting at a multiple of `alignment`, plus <stem>.weights.json
+    indexing every tensor's file, offset and length. Works from embedded or
+    external-data models and copies weights block by block.
+    Returns (graph path, index).
+    """
+    output_path = output_path or mmap_layout_path(model_path)
+    if os.path.abspath(output_path) == os.path.abspath(model_path):
+        raise ValueError("Write the mmap layout next to the model, not over it")
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    stem = os.path.splitext(os.path.basename(output_path))[0]
+
+    model = onnx.load(model_path, load_external_data=False)
+    groups = tensor_groups(model.graph)
+    index = {
+        "version": WEIGHT_LAYOUT_VERSION,
+        "graph": os.path.basename(output_path),
+        "source": os.path.basename(model_path),
+        "alignment": alignment,
+        "files": {},
+        "tensors": {},
+    }
+
+    # Shared weights (embeddings, head) first, then layer by layer
+    ordered = sorted(model.graph.initializer, key=lambda tensor: (groups[tensor.name] != "shared", groups[tensor.name]))
+    files = {}
+    padding = 0
+    try:
+        for tensor in ordered:
+            nbytes = _tensor_nbytes(tensor)
+            if tensor.data_type == TensorProto.STRING or (nbytes < min_external_bytes and not uses_external_data(tensor)):
+                continue
+            group = groups[tensor.name]
+            location = f"{stem}.{group}.data"
+            if group not in files:
+                files[group] = open(os.path.join(output_dir, location), "wb")
+                index["files"][location] = {"group": group, "bytes": 0, "tensors": 0}
+            out_file = files[group]
+            offset = out_file.tell()
+            if offset % alignment:
+                gap = alignment - offset % alignment
+                out_file.write(b"\0" * gap)
+                padding += gap
+                offset += gap
+            _copy_tensor_bytes(tensor, base_dir, out_file)
+            length = out_file.tell() - offset
+
+            # Only the external reference stays in the graph
+            for field in ("raw_data", "float_data", "int32_data", "int64_data", "double_data", "uint64_data"):
+                tensor.ClearField(field)
+            del tensor.external_data[:]
+            tensor.data_location = TensorProto.EXTERNAL
+            for key, value in (("location", location), ("offset", str(offset)), ("length", str(length))):
+                entry = tensor.external_data.add()
+                entry.key = key
+                entry.value = value
+
+            index["files"][location]["bytes"] = offset + length
+            index["files"][location]["tensors"] += 1
+            index["tensors"][tensor.name] = {
+                "file": location,
+                "offset": offset,
+                "length": length,
+                "data_type": TensorProto.DataType.Name(tensor.data_type),
+                "dims": list(tensor.dims),
+            }
+    finally:
+        for out_file in files.values():
+            out_file.close()
+
+    onnx.save_model(model, output_path)
+    index["graph_bytes"] = os.path.getsize(output_path)
+    index["padding_bytes"] = padding
+    with open(os.path.splitext(output_path)[0] + INDEX_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    return output_path, index
+
+
+def layout_files(model_path):
+    """The graph and every external-data file it references"""
+    model = onnx.load(model_path, load_external_data=False)
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    locations = sorted({
+        _external_info(tensor)["location"] for tensor in model.graph.initializer if uses_external_data(tensor)
+    })
+    return [model_path] + [os.path.join(base_dir, location) for location in locations]
+
+
+def embedded_copy(model_path, output_path):
+    """The model with every weight inside the protobuf, or None past the 2 GB limit"""
+    if model_size_bytes(model_path) >= EXTERNAL_DATA_THRESHOLD:
+        return None
+    model = onnx.load(model_path)
+    onnx.save_model(model, output_path)
+    return output_path
+
+
+def _evict_page_cache(paths):
+    """Drop the files' clean pages so the next read comes from disk; False where unsupported"""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def _measure_cold_start(model_path, prompt_ids, session_config, evict):
+    """Runs in a fresh process: session creation and first greedy token, with RSS after each"""
+    import psutil
+    import onnxruntime as ort
+    from ort_runtime import DecoderSession
+
+    process = psutil.Process()
+    evicted = _evict_page_cache(layout_files(model_path)) if evict else False
+    rss_start = process.memory_info().rss
+
+    options = ort.SessionOptions()
+    for key, value in session_config.items():
+        options.add_session_config_entry(key, value)
+    decoder = DecoderSession.load(model_path, options)
+    rss_loaded = process.memory_info().rss
+
+    start = time.perf_counter()
+    outputs, _ = decoder.run(np.array([prompt_ids], dtype=np.int64))
+    decoder.greedy_tokens(outputs)
+    first_token_s = time.perf_counter() - start
+    rss_first_token = process.memory_info().rss
+    return {
+        "cold": evicted,
+        "load_s": decoder.load_seconds,
+        "first_token_s": first_token_s,
+        "time_to_first_token_s": decoder.load_seconds + first_token_s,
+        "session_rss_mb": (rss_loaded - rss_start) / 1024 ** 2,
+        "first_token_rss_mb": (rss_first_token - rss_start) / 1024 ** 2,
+    }
+
+
+def compare_cold_start(layouts, prompt_ids, repeats=DEFAULT_REPEATS, evict=True):
+    """
+    {label: (graph path, session config)} -> {label: median measurements}.
+    Every run gets its own spawned process, so no layout inherits pages or
+    arenas from another.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for label, (path, session_config) in layouts.items():
+        runs = []
+        for _ in range(repeats):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs.append(pool.submit(_measure_cold_start, path, prompt_ids, session_config, evict).result())
+        result = {key: statistics.median(run[key] for run in runs) for key in runs[0] if key != "cold"}
+        result.update({"cold": all(run["cold"] for run in runs), "runs": len(runs), "graph": os.path.basename(path),
+                       "session_config": session_config, "disk_mb": model_size_bytes(path) / 1024 ** 2})
+        results[label] = result
+        print(f"   - {label:<20} load {result['load_s'] * 1000:8.1f} ms, first token {result['first_token_s'] * 1000:8.1f} ms,"
+              f" RSS +{result['session_rss_mb']:.1f} MB -> +{result['first_token_rss_mb']:.1f} MB")
+    return results
+
+
+def check_layout_outputs(model_path, layout_path, prompt_ids):
+    """Both layouts must produce bit-identical outputs"""
+    from ort_runtime import DecoderSession
+
+    ids = np.array([prompt_ids], dtype=np.int64)
+    expected, _ = DecoderSession.load(model_path).run(ids)
+    actual, _ = DecoderSession.load(layout_path).run(ids)
+    return all(np.array_equal(expected[name], actual[name]) for name in expected)
+
+
+def write_layout_report(report, report_path):
+    """Markdown cold-start table plus a JSON copy next to it"""
+    lines = [
+        f"# Weight layout report: {report['model']}",
+        "",
+        f"- Layout: {len(report['index']['files'])} data file(s), {report['tensor_count']} tensors, "
+        f"{report['index']['alignment'] // 1024} KiB alignment, "
+        f"{report['index']['padding_bytes'] / 1024 ** 2:.1f} MB padding",
+        f"- Graph file: {report['index']['graph_bytes'] / 1024:.1f} KB",
+        f"- Outputs identical: {report['outputs_match']}",
+        f"- Page cache dropped before each run: {all(result['cold'] for result in report['cold_start'].values())}",
+        "",
+        "| Layout | Load (ms) | First token (ms) | Time to first token (ms) | RSS after load (MB) | "
+        "RSS after first token (MB) |",
+        "|---|---|---|---|---|---|",
+    ]
+    for label, result in report["cold_start"].items():
+        lines.append(
+            f"| {label} | {result['load_s'] * 1000:.1f} | {result['first_token_s'] * 1000:.1f} | "
+            f"{result['time_to_first_token_s'] * 1000:.1f} | {result['session_rss_mb']:.1f} | "
+            f"{result['first_token_rss_mb']:.1f} |"
+        )
+    if report.get("skipped"):
+        lines += ["", *(f"- {label}: {reason}" for label, reason in report["skipped"].items())]
+    lines += ["", "RSS is the growth of a fresh process from before session creation; medians over "
+                  f"{report['repeats']} run(s).", ""]
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    with open(os.path.splitext(report_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report_path
+
+
+def run_layout_stage(model_path, output_path=None, alignment=DEFAULT_ALIGNMENT, prompt_ids=None,
+                     repeats=DEFAULT_REPEATS, report_path=None):
+    """
+    Write the mmap layout next to a model and the cold-start report
+    <stem>_layout_report.md. Returns the layout graph path or None.
+    """
+    output_path = output_path or mmap_layout_path(model_path)
+    report_path = report_path or os.path.splitext(model_path)[0] + "_layout_report.md"
+    prompt_ids = prompt_ids or list(range(1, 17))
+    scratch = os.path.splitext(output_path)[0] + ".embedded"
+    try:
+        with stage("mmap layout", model=os.path.basename(model_path)):
+            output_path, index = write_mmap_layout(model_path, output_path, alignment)
+        data_mb = sum(entry["bytes"] for entry in index["files"].values()) / 1024 ** 2
+        print(f"✅ mmap layout: {output_path} + {len(index['files'])} data file(s), {data_mb:.1f} MB")
+
+        outputs_match = check_layout_outputs(model_path, output_path, prompt_ids)
+        print(f"   {'✅' if outputs_match else '❌'} Outputs identical to {os.path.basename(model_path)}")
+
+        layouts, skipped = {}, {}
+        os.makedirs(scratch, exist_ok=True)
+        embedded = embedded_copy(model_path, os.path.join(scratch, os.path.basename(model_path)))
+        if embedded is None:
+            skipped["embedded"] = "over the 2 GB protobuf limit, cannot be embedded"
+        for label, session_config in LAYOUT_SESSIONS.items():
+            path = embedded if label == "embedded" else output_path
+            if path is not None:
+                layouts[label] = (path, session_config)
+
+        print("🧪 Cold start (fresh process per run)...")
+        with stage("cold start", repeats=repeats):
+            cold_start = compare_cold_start(layouts, prompt_ids, repeats)
+        report = {
+            "model": os.path.basename(model_path),
+            "index": {key: value for key, value in index.items() if key != "tensors"},
+            "tensor_count": len(index["tensors"]),
+            "outputs_match": outputs_match,
+            "cold_start": cold_start,
+            "skipped": skipped,
+            "repeats": repeats,
+            "prompt_tokens": len(prompt_ids),
+        }
+        write_layout_report(report, report_path)
+        print(f"📝 Wrote {report_path}")
+        return output_path if outputs_match else None
+    except Exception as e:
+        print(f"❌ Error during weight layout: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a page-aligned, layer-grouped external-data layout")
+    parser.add_argument("model", help="Exported model.onnx (embedded or external data)")
+    parser.add_argument("--output", default=None, help="Layout graph path (default: <stem>_mmap.onnx)")
+    parser.add_argument("--alignment", type=int, default=DEFAULT_ALIGNMENT,
+                        help="Byte alignment of every tensor in the data files")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="Cold-start runs per layout")
+    parser.add_argument("--report", default=None, help="Report path (default: <stem>_layout_report.md)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    with trace_run("weight_layout", args.trace):
+        output = run_layout_stage(args.model, args.output, args.alignment, repeats=args.repeats,
+                                  report_path=args.report)
+    if output:
+        print("\n🎉 mmap layout is ready!")
+    else:
+        print("\n💥 Weight layout failed. Check the messages above.")
+        exit(1)